@@ -72,13 +72,22 @@ class LmcrecInstCacheEntry:
 
 
 class LmcrecStateCache:
-    def __init__(self, decoder: LmcrecDecoder, have_prev: bool = False):
+    def __init__(
+        self,
+        decoder: LmcrecDecoder,
+        have_prev: bool = False,
+        track_changes: bool = False,
+    ):
         """Create LMC state cache using decoder. Optionally provide previous
         variable values map too.
+
+        If track_changes is True then maintain changed_vars, the var IDs whose
+        value changed in the most recent scan, indexed by inst ID.
         """
 
         self._decoder = decoder
         self._have_prev = have_prev
+        self._track_changes = track_changes
         self.apply_next_scan = self._apply_next_scan
         self.reset()
 
@@ -106,6 +115,23 @@ class LmcrecStateCache:
         # given class; keep track of instance names on a per class basis:
         self.inst_by_class_name: Dict[str, Set[str]] = defaultdict(set)
 
+        # The instance hierarchy, [parent_inst_id] = {inst_id, ...}, maintained
+        # incrementally such that the subtree of an instance can be retrieved
+        # w/o scanning all the instances. The top instances have parent ID 0:
+        self.children_by_inst_id: Dict[int, Set[int]] = defaultdict(set)
+
+        # The names of the instances added by the most recent scan, such that
+        # the name based selections can be updated w/o scanning all the
+        # instances:
+        self.new_inst_names: List[str] = []
+
+        # Change tracking, [inst_id] = {var_id, ...}, cleared at every scan. A
+        # value re-stated with the same value, e.g. by a checkpoint scan, does
+        # not count as a change:
+        self.changed_vars: Optional[Dict[int, Set[int]]] = (
+            dict() if self._track_changes else None
+        )
+
         # Set by the most recent ClassInfo:
         self._curr_class = None
 
@@ -137,6 +163,8 @@ class LmcrecStateCache:
         self.new_inst = False
         self.deleted_inst = False
         self.new_class_def = False
+        if self.new_inst_names:
+            self.new_inst_names = []
 
         if self._have_prev:
             for inst in self.inst_by_id.values():
@@ -144,6 +172,10 @@ class LmcrecStateCache:
                     inst.prev_vars = dict()
                 inst.prev_vars.update(inst.vars)
 
+        changed_vars = self.changed_vars
+        if changed_vars is not None:
+            changed_vars.clear()
+
         while True:
             try:
                 record = self._decoder.next_record(record)
@@ -156,7 +188,14 @@ class LmcrecStateCache:
             # expected frequency:
             if record_type == LmcrecType.VAR_VALUE:
                 value = record.value
-                self._curr_inst.vars[record.var_id] = value
+                curr_vars = self._curr_inst.vars
+                if changed_vars is not None and curr_vars.get(record.var_id) != value:
+                    inst_changed_vars = changed_vars.get(self._curr_inst.inst_id)
+                    if inst_changed_vars is None:
+                        inst_changed_vars = set()
+                        changed_vars[self._curr_inst.inst_id] = inst_changed_vars
+                    inst_changed_vars.add(record.var_id)
+                curr_vars[record.var_id] = value
                 var_info = self._curr_class.var_info_by_id[record.var_id]
                 if (
                     record.file_record_type == LmcrecType.VAR_SINT_VAL
@@ -178,6 +217,11 @@ class LmcrecStateCache:
                     self.inst_by_class_name[
                         self.class_by_id[inst.class_id].name
                     ].discard(inst.name)
+                    siblings = self.children_by_inst_id.get(inst.parent_inst_id)
+                    if siblings is not None:
+                        siblings.discard(inst_id)
+                        if not siblings:
+                            del self.children_by_inst_id[inst.parent_inst_id]
                     del self.inst_by_name[inst.name]
                     del self.inst_by_id[inst_id]
                     self.deleted_inst = True
@@ -204,7 +248,9 @@ class LmcrecStateCache:
                     self.inst_by_class_name[self.class_by_id[record.class_id].name].add(
                         inst.name
                     )
+                    self.children_by_inst_id[inst.parent_inst_id].add(inst.inst_id)
                     self.inst_max_size = max(self.inst_max_size, len(inst.name))
+                    self.new_inst_names.append(inst.name)
                     self.new_inst = True
                 else:
                     # Sanity check: instance definition unchanged:
@@ -410,6 +456,38 @@ class LmcrecStateCache:
 
         return self.inst_by_class_name.get(class_name, set())
 
+    def get_inst_descendants(
+        self, inst_name: str, class_names: Optional[Set[str]] = None
+    ) -> List[str]:
+        """Retrieve the names of all the descendants of an instance
+
+        The descendants are returned in breadth first order, optionally limited
+        to those of the given classes; the instance itself is not included.
+        """
+
+        inst = self.inst_by_name.get(inst_name)
+        if inst is None:
+            return []
+        inst_by_id, children_by_inst_id = self.inst_by_id, self.children_by_inst_id
+        class_by_id = self.class_by_id
+        descendants = []
+        todo = [inst.inst_id]
+        while todo:
+            next_todo = []
+            for inst_id in todo:
+                for child_id in children_by_inst_id.get(inst_id, ()):
+                    child = inst_by_id.get(child_id)
+                    if child is None:
+                        continue
+                    next_todo.append(child_id)
+                    if (
+                        class_names is None
+                        or class_by_id[child.class_id].name in class_names
+                    ):
+                        descendants.append(child.name)
+            todo = next_todo
+        return descendants
+
 
 def get_inventory(
     state_cache: LmcrecStateCache,
@@ -16,6 +16,12 @@ from .decoder import (
     LmcrecType,
     LmcVarType,
 )
+from .file_cache import (
+    FILE_CACHE_MAX_FILES_DEFAULT,
+    LmcrecFileCache,
+    LmcrecIndexCache,
+    LmcrecInfoCache,
+)
 from .index_decoder import (
     LmcrecIndexDecoder,
     LmcrecIndexFileDecoder,
@@ -9,6 +9,7 @@ from misc.timeutils import format_ts
 from .varint_decoder import (
     decode_uvarint,
     decode_varint,
+    skip_uvarint,
 )
 
 # Must match the homonymous constants in lmcrec/codec/encoder.go:
@@ -120,6 +121,24 @@ class LmcRecord:
         return to_str()
 
 
+# The records skipped by structure only decoding, see
+# LmcrecDecoder.next_structure_record: (number of varint fields, whether a string
+# field follows):
+structure_skip_fields_by_record_type = {
+    LmcrecType.VAR_UINT_VAL: (2, False),
+    LmcrecType.VAR_SINT_VAL: (2, False),
+    LmcrecType.VAR_STRING_VAL: (1, True),
+    LmcrecType.VAR_ZERO_VAL: (1, False),
+    LmcrecType.VAR_BOOL_FALSE: (1, False),
+    LmcrecType.VAR_BOOL_TRUE: (1, False),
+    LmcrecType.VAR_EMPTY_STRING: (1, False),
+    LmcrecType.SET_INST_ID: (1, False),
+    LmcrecType.VAR_INFO: (3, True),
+    LmcrecType.SCAN_TALLY: (4, False),
+    LmcrecType.DURATION_USEC: (1, False),
+}
+
+
 class LmcrecDecoder:
     def __init__(self, stream: BinaryIO):
         self._stream = stream
@@ -207,6 +226,52 @@ class LmcrecDecoder:
 
         return lmc_record
 
+    def next_structure_record(
+        self, lmc_record: Optional[LmcRecord] = None
+    ) -> LmcRecord:
+        """Return the next structure record, skipping over the others
+
+        Structure only decoding, for tools which need the instance lifecycle
+        but not the values: only TIMESTAMP_USEC, CLASS_INFO, INST_INFO,
+        DELETE_INST_ID and EOR records are returned, the variable values and
+        the other records are skipped w/o being decoded.
+        """
+
+        stream = self._stream
+        skip_fields_by_record_type = structure_skip_fields_by_record_type
+        while True:
+            record_type = decode_uvarint(stream)
+            skip_fields = skip_fields_by_record_type.get(record_type)
+            if skip_fields is None:
+                break
+            num_varints, has_string = skip_fields
+            for _ in range(num_varints):
+                skip_uvarint(stream)
+            if has_string:
+                l = decode_uvarint(stream)
+                if len(stream.read(l)) != l:
+                    raise RuntimeError(f"not enough bytes for string, want: {l}")
+
+        record_type = LmcrecType(record_type)
+        if lmc_record is None:
+            lmc_record = LmcRecord(record_type=record_type)
+        else:
+            lmc_record.record_type = record_type
+            lmc_record.file_record_type = None
+        if record_type == LmcrecType.TIMESTAMP_USEC:
+            lmc_record.value = decode_varint(stream) / 1_000_000
+        elif record_type == LmcrecType.INST_INFO:
+            lmc_record.class_id = decode_uvarint(stream)
+            lmc_record.inst_id = decode_uvarint(stream)
+            lmc_record.parent_inst_id = decode_uvarint(stream)
+            lmc_record.name = self._read_string()
+        elif record_type == LmcrecType.DELETE_INST_ID:
+            lmc_record.inst_id = decode_uvarint(stream)
+        elif record_type == LmcrecType.CLASS_INFO:
+            lmc_record.class_id = decode_uvarint(stream)
+            lmc_record.name = self._read_string()
+        return lmc_record
+
 
 class LmcrecFileDecoder(LmcrecDecoder):
     _stream = None
@@ -229,6 +294,11 @@ class LmcrecFileDecoder(LmcrecDecoder):
                     break
                 offset -= n
 
+    def tell(self) -> int:
+        """Return the current offset, suitable for goto()"""
+
+        return self._stream.tell()
+
     def close(self):
         if self._stream is not None:
             self._stream.close()
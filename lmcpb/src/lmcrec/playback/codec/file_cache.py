@@ -0,0 +1,116 @@
+"""Cache of decoded sidecar files, for long running processes
+
+The .info and .index files are small but they are re-read for every query. A
+long running process, e.g. lmcrec-serve, can keep them decoded in memory. The
+entries are validated against the file size and modification time, so the files
+of active record files, which are updated in place, are re-read as needed.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+from .index_decoder import LmcrecIndexFileDecoder
+from .info_decoder import LmcrecInfo, decode_lmcrec_info_from_file
+
+FILE_CACHE_MAX_FILES_DEFAULT = 4096
+
+
+class LmcrecFileCache:
+    """LRU cache of decoded files, validated by (size, mtime)"""
+
+    def __init__(
+        self,
+        load: Callable[[str], Any],
+        max_files: Optional[int] = FILE_CACHE_MAX_FILES_DEFAULT,
+    ):
+        """Create the cache
+
+        Args:
+            load (Callable[[str], Any]):
+                Decode the file, given its name; the exceptions are passed
+                through to the caller of get().
+
+            max_files (int):
+                The maximum number of cached files, None for unlimited.
+        """
+
+        self._load = load
+        self._max_files = max_files
+        self._cache: OrderedDict[str, Tuple[Tuple[int, int], Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, file_name: str) -> Any:
+        """Return the decoded file, from cache if still valid
+
+        Raises:
+            OSError if the file cannot be accessed and whatever load raises.
+        """
+
+        st = os.stat(file_name)
+        signature = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._cache.get(file_name)
+            if entry is not None and entry[0] == signature:
+                self._cache.move_to_end(file_name)
+                self.hits += 1
+                return entry[1]
+        val = self._load(file_name)
+        with self._lock:
+            self.misses += 1
+            self._cache[file_name] = (signature, val)
+            self._cache.move_to_end(file_name)
+            if self._max_files is not None:
+                while len(self._cache) > self._max_files:
+                    self._cache.popitem(last=False)
+        return val
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class LmcrecInfoCache(LmcrecFileCache):
+    """Cache of decoded .info files"""
+
+    def __init__(self, max_files: Optional[int] = FILE_CACHE_MAX_FILES_DEFAULT):
+        super().__init__(decode_lmcrec_info_from_file, max_files=max_files)
+
+    def get(self, file_name: str) -> LmcrecInfo:
+        return super().get(file_name)
+
+
+def load_index_checkpoints(file_name: str) -> List[Tuple[float, int]]:
+    index_decoder = LmcrecIndexFileDecoder(file_name)
+    try:
+        return list(index_decoder.checkpoints())
+    finally:
+        index_decoder.close()
+
+
+class LmcrecIndexCache(LmcrecFileCache):
+    """Cache of decoded .index files, as lists of (ts, offset) checkpoints"""
+
+    def __init__(self, max_files: Optional[int] = FILE_CACHE_MAX_FILES_DEFAULT):
+        super().__init__(load_index_checkpoints, max_files=max_files)
+
+    def get(self, file_name: str) -> List[Tuple[float, int]]:
+        return super().get(file_name)
+
+    def last_checkpoint(
+        self, file_name: str, from_ts: float
+    ) -> Tuple[Optional[float], Optional[int]]:
+        """Cached counterpart of LmcrecIndexDecoder.last_checkpoint"""
+
+        chkpt_ts, chkpt_off = None, None
+        for ts, off in self.get(file_name):
+            if ts > from_ts:
+                break
+            chkpt_ts, chkpt_off = ts, off
+        return chkpt_ts, chkpt_off
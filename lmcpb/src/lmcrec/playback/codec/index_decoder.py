@@ -1,4 +1,4 @@
-from typing import BinaryIO, Optional, Tuple
+from typing import BinaryIO, Iterator, Optional, Tuple
 
 from .decoder import INDEX_FILE_SUFFIX
 from .varint_decoder import decode_varint
@@ -11,6 +11,14 @@ class LmcrecIndexDecoder:
     def next_checkpoint(self) -> Tuple[float, int]:
         return decode_varint(self._stream) / 1_000_000, decode_varint(self._stream)
 
+    def checkpoints(self) -> Iterator[Tuple[float, int]]:
+        """Iterate through all the checkpoints, best effort"""
+        while True:
+            try:
+                yield self.next_checkpoint()
+            except (EOFError, ValueError, RuntimeError, TypeError):
+                break
+
     def last_checkpoint(self, from_ts: float) -> Tuple[Optional[float], Optional[int]]:
         """Locate latest checkpoint preceding or at from_ts, best effort"""
         chkpt_ts, chkpt_off = None, None
@@ -42,12 +50,18 @@ class LmcrecIndexFileDecoder(LmcrecIndexDecoder):
 
 
 def locate_checkpoint(
-    lmcrec_file, from_ts: Optional[float] = None
+    lmcrec_file, from_ts: Optional[float] = None, index_cache=None
 ) -> Tuple[Optional[float], Optional[int]]:
-    """Locate last checkpoint for lmcrec file before from_ts."""
+    """Locate last checkpoint for lmcrec file before from_ts.
+
+    If index_cache (LmcrecIndexCache) is provided then the index file is looked
+    up in it rather than being decoded.
+    """
 
     chkpt_ts, chkpt_off = None, None
     if from_ts is not None:
+        if index_cache is not None:
+            return index_cache.last_checkpoint(lmcrec_file + INDEX_FILE_SUFFIX, from_ts)
         index_decoder = LmcrecIndexFileDecoder(lmcrec_file + INDEX_FILE_SUFFIX)
         chkpt_ts, chkpt_off = index_decoder.last_checkpoint(from_ts)
     return chkpt_ts, chkpt_off
@@ -23,3 +23,13 @@ def decode_varint(stream: BinaryIO) -> int:
     """Decodes an signed varint from a byte stream."""
     value = decode_uvarint(stream)
     return (-value - 1 if (value & 1) else value) >> 1
+
+
+def skip_uvarint(stream: BinaryIO):
+    """Skips over an (un)signed varint w/o decoding it."""
+    while True:
+        data = stream.read(1)
+        if not data:
+            raise EOFError()
+        if not (data[0] & 0x80):
+            return
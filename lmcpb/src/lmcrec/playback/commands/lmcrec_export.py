@@ -22,7 +22,7 @@ from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from shutil import rmtree
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 from uuid import uuid4
 from zlib import Z_DEFAULT_COMPRESSION, Z_NO_COMPRESSION
 
@@ -32,9 +32,19 @@ from codec import LmcVarType
 from config import get_lmcrec_runtime
 from misc.timeutils import format_ts
 from query import (
+    PARALLEL_SEGMENT_DURATION,
     LmcrecQueryIntervalStateCache,
+    LmcrecQueryTask,
+    build_query_tasks,
+    explain_query,
+    format_explain_plan,
+    get_catalog_arg_parser,
+    get_explain_arg_parser,
     get_file_selection_arg_parser,
+    process_catalog_args,
     process_file_selection_args,
+    resolve_workers,
+    run_tasks_in_order,
 )
 from tabulate import SEPARATING_LINE, tabulate
 from tzlocal import get_localzone
@@ -542,8 +552,10 @@ class CsvExportWriter:
         header: Optional[List[str]] = None,
         compress_level: Optional[int] = Z_NO_COMPRESSION,
         max_rows_per_file: int = 0,
+        file_prefix: str = CSV_BATCH_FILE_PREFIX,
     ):
         self._out_dir = out_dir
+        self._file_prefix = file_prefix
         os.makedirs(self._out_dir, exist_ok=True)
         self._dialect = dialect
         self._header = header
@@ -559,10 +571,12 @@ class CsvExportWriter:
     def write(self, row: Iterable[Any]):
         if self._writer is None:
             if self._max_rows_per_file > 0:
-                cvs_file = f"{CSV_BATCH_FILE_PREFIX}-{self._batch_no:06d}{CSV_BATCH_FILE_SUFFIX}"
+                cvs_file = (
+                    f"{self._file_prefix}-{self._batch_no:06d}{CSV_BATCH_FILE_SUFFIX}"
+                )
                 self._batch_no += 1
             else:
-                cvs_file = CSV_BATCH_FILE_PREFIX + CSV_BATCH_FILE_SUFFIX
+                cvs_file = self._file_prefix + CSV_BATCH_FILE_SUFFIX
             file_name = os.path.join(self._out_dir, cvs_file)
             if self._compress_level != Z_NO_COMPRESSION:
                 file_name += GZIP_FILE_SUFFIX
@@ -609,16 +623,20 @@ class LmcrecExporter:
         out_dir: str,
         compress_level: int = Z_NO_COMPRESSION,
         class_selection: Optional[Iterable[str]] = None,
+        batch_file_prefix: str = CSV_BATCH_FILE_PREFIX,
     ):
         self._lmcrec_db_mapping = lmcrec_db_mapping
+        self._batch_file_prefix = batch_file_prefix
         self._out_dir = out_dir
         self._compress_level = (
             compress_level if compress_level is not None else Z_NO_COMPRESSION
         )
         self._class_selection = set(class_selection) if class_selection else None
         self._table_csv_writers: Dict[str, CsvExportWriter] = dict()  # [name] -> writer
+        self._handler_by_id: Dict[int, LmcrecClassHandler] = dict()
         self._closed = False
         self.used_classes = set()
+        self.used_tables = set()
 
     def _build_class_handler(
         self, query_state_cache: LmcrecQueryIntervalStateCache, class_id: int
@@ -630,6 +648,7 @@ class LmcrecExporter:
             return LmcrecClassIgnore
         self.used_classes.add(class_name)
         table_name, var_mapping = lmcrec_db_mapping.lmc_classes[class_name]
+        self.used_tables.add(table_name)
         csv_writer = self._table_csv_writers.get(table_name)
         cols = lmcrec_db_mapping.tables[table_name]
         if csv_writer is None:
@@ -644,6 +663,7 @@ class LmcrecExporter:
                 header=header,
                 compress_level=self._compress_level,
                 max_rows_per_file=lmcrec_db_mapping.csv_max_rows_per_file,
+                file_prefix=self._batch_file_prefix,
             )
             self._table_csv_writers[table_name] = csv_writer
         col_index_by_var_id = dict()
@@ -727,8 +747,18 @@ class LmcrecExporter:
             class_handler.csv_writer.write(row)
         return True
 
+    def merge_used_classes(self, used_classes: Iterable[str]):
+        """Merge the classes used by another exporter, e.g. a parallel worker,
+        such that the bcp, sql and mapping files reflect them as well.
+        """
+
+        lmc_classes = self._lmcrec_db_mapping.lmc_classes
+        for class_name in used_classes:
+            self.used_classes.add(class_name)
+            self.used_tables.add(lmc_classes[class_name][0])
+
     def generate_bcp_fmt_files(self):
-        if not self._table_csv_writers:
+        if not self.used_tables:
             return
 
         lmcrec_db_mapping = self._lmcrec_db_mapping
@@ -744,11 +774,11 @@ class LmcrecExporter:
         bcp_string_collation = lmcrec_db_mapping.bcp_string_collation
         want_collation = bcp_string_collation is not None
 
-        for table_name, csv_writer in self._table_csv_writers.items():
+        for table_name in self.used_tables:
             cols = lmcrec_db_mapping.tables[table_name]
             n_cols = len(cols)
             last_index = n_cols - 1
-            out_dir = csv_writer._out_dir
+            out_dir = os.path.join(self._out_dir, EXPORT_DATA_SUB_DIR, table_name)
             os.makedirs(out_dir, exist_ok=True)
             with open(os.path.join(out_dir, BCP_FMT_FILE), "wt") as f:
                 print(bcp_version, file=f)
@@ -820,12 +850,20 @@ class LmcrecExporter:
                     )
             print(tabulate(rows, tablefmt="simple"), file=f)
 
-    def close(self):
+    def close(self, generate_files: bool = True):
+        """Close the exporter
+
+        If generate_files is True then generate the bcp, sql and mapping files;
+        parallel workers defer that to the main exporter, see
+        merge_used_classes.
+        """
+
         if not self._closed:
             self._closed = True
-            self.generate_bcp_fmt_files()
-            self.generate_sql_commands()
-            self.generate_mapping_info()
+            if generate_files:
+                self.generate_bcp_fmt_files()
+                self.generate_sql_commands()
+                self.generate_mapping_info()
             if self._table_csv_writers:
                 for csv_writer in self._table_csv_writers.values():
                     csv_writer.close()
@@ -835,11 +873,65 @@ class LmcrecExporter:
         self.close()
 
 
+def run_export_task(
+    task: LmcrecQueryTask,
+    lmcrec_schema: LmcrecSchema,
+    db_mapping: Optional[dict],
+    out_dir: str,
+    compress_level: Optional[int] = None,
+    verbose: bool = False,
+) -> Tuple[Set[str], Optional[float], Optional[float], LmcrecScanRetCode]:
+    """Export the task chain into task specific CSV batch files
+
+    This is the parallel worker function.
+
+    Returns:
+        The used classes, first_ts, last_ts and ret_code
+    """
+
+    lmcrec_exporter = LmcrecExporter(
+        lmcrec_db_mapping=LmcrecDbMapping(lmcrec_schema, db_mapping),
+        out_dir=out_dir,
+        compress_level=compress_level,
+        # Make the file names unique and in chronological order:
+        batch_file_prefix=f"{CSV_BATCH_FILE_PREFIX}-{task.index:06d}",
+    )
+    query_state_cache = LmcrecQueryIntervalStateCache(
+        from_ts=task.from_ts,
+        to_ts=task.to_ts,
+        chain_list=[task.chain_entry],
+        _verbose=verbose,
+    )
+    skip_first = task.skip_first
+
+    def next_scan_cb(query_state_cache: LmcrecQueryIntervalStateCache) -> bool:
+        nonlocal skip_first
+        if skip_first:
+            # The checkpoint was already exported by the previous task:
+            skip_first = False
+            return True
+        return lmcrec_exporter.next_scan_cb(query_state_cache)
+
+    ret_code = query_state_cache.run_with_cb(next_scan_cb)
+    query_state_cache.close()
+    lmcrec_exporter.close(generate_files=False)
+    return (
+        lmcrec_exporter.used_classes,
+        query_state_cache.first_ts,
+        query_state_cache.last_ts,
+        ret_code,
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=CustomWidthFormatter,
         description=description,
-        parents=[get_file_selection_arg_parser()],
+        parents=[
+            get_file_selection_arg_parser(),
+            get_catalog_arg_parser(),
+            get_explain_arg_parser(),
+        ],
     )
     parser.add_argument(
         "-S",
@@ -880,6 +972,19 @@ def main():
         Z_DEFAULT_COMPRESSION={Z_DEFAULT_COMPRESSION}. 
         """,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+        The number of worker processes used for exporting the file chains in
+        parallel, 0 stands for the number of CPUs. The chains are split at
+        checkpoints into segments of about 1 hour and each segment is exported
+        into its own set of batch-SEGMENT#-... files, numbered in chronological
+        order. Default: %(default)s.
+        """,
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -892,6 +997,18 @@ def main():
     start_ts = time.time()
 
     record_files_dir, from_ts, to_ts = process_file_selection_args(args)
+    catalog = process_catalog_args(args, record_files_dir)
+
+    if args.explain:
+        plan = explain_query(
+            record_files_dir,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            decode_speed=args.decode_speed,
+            catalog=catalog,
+        )
+        print(format_explain_plan(plan, record_files_dir))
+        return 0
 
     with open(args.schema_file, "rt") as f:
         lmcrec_schema = yaml.safe_load(f)
@@ -916,6 +1033,7 @@ def main():
         record_files_dir,
         from_ts=from_ts,
         to_ts=to_ts,
+        catalog=catalog,
         _verbose=args.verbose,
     )
 
@@ -926,8 +1044,35 @@ def main():
     )
 
     exit_code = 0
+    workers = resolve_workers(args.jobs)
     try:
-        ret_code = query_state_cache.run_with_cb(lmcrec_exporter.next_scan_cb)
+        if workers > 1:
+            ret_code = LmcrecScanRetCode.ATEOR
+            for used_classes, first_ts, last_ts, task_ret_code in run_tasks_in_order(
+                run_export_task,
+                build_query_tasks(
+                    query_state_cache._chain_list,
+                    from_ts,
+                    to_ts,
+                    segment_duration=PARALLEL_SEGMENT_DURATION,
+                ),
+                workers,
+                lmcrec_schema,
+                db_mapping,
+                output_dir,
+                compress_level=args.compress_level,
+                verbose=args.verbose,
+            ):
+                lmcrec_exporter.merge_used_classes(used_classes)
+                if first_ts is not None:
+                    if query_state_cache.first_ts is None:
+                        query_state_cache.first_ts = first_ts
+                    query_state_cache.last_ts = last_ts
+                if task_ret_code != LmcrecScanRetCode.ATEOR:
+                    ret_code = task_ret_code
+                    break
+        else:
+            ret_code = query_state_cache.run_with_cb(lmcrec_exporter.next_scan_cb)
         lmcrec_exporter.close()
         if ret_code != LmcrecScanRetCode.ATEOR:
             exit_code = 1
@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+
+description = """
+Display when instances were created and deleted, based on the instance
+lifecycle index.
+
+The index maps each instance name to the intervals when it existed, for every
+record file, and it is built from the instance creation and deletion records
+only, without decoding the variable values. It is kept under
+$LMCREC_RUNTIME/lifecycle and it is refreshed incrementally before every
+lookup: only the record files closed since the previous refresh are decoded.
+The active record file is not indexed until it is closed.
+
+The time range, if specified, selects the intervals overlapping it.
+"""
+
+import argparse
+import sys
+
+from misc.timeutils import format_ts
+from query import (
+    LmcrecLifecycleIndex,
+    get_catalog_arg_parser,
+    get_file_selection_arg_parser,
+    process_catalog_args,
+    process_file_selection_args,
+    summarize_lifecycle,
+)
+from tabulate import tabulate
+
+from .help_formatter import CustomWidthFormatter
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=CustomWidthFormatter,
+        description=description,
+        parents=[get_file_selection_arg_parser(), get_catalog_arg_parser()],
+    )
+    parser.add_argument(
+        "--index-file",
+        help="""
+            Use the specified lifecycle index file instead of the default one.
+        """,
+    )
+    parser.add_argument(
+        "-s",
+        "--summary",
+        action="store_true",
+        help="""
+            Display a single line per instance, from its first appearance to
+            its last one, rather than the interval for each record file.
+        """,
+    )
+    parser.add_argument(
+        "-N",
+        "--no-refresh",
+        action="store_true",
+        help="""
+            Use the index as is, w/o indexing the newly closed files.
+        """,
+    )
+    parser.add_argument(
+        "inst_name",
+        metavar="INST_NAME",
+        nargs="*",
+        help="""
+            Instance name selection: NAME for an exact match, ~SUFFIX for a
+            suffix match or /REGEX/ for a pattern match. All the instances are
+            displayed if none is specified.
+        """,
+    )
+
+    args = parser.parse_args()
+    record_files_dir, from_ts, to_ts = process_file_selection_args(args)
+    catalog = process_catalog_args(args, record_files_dir)
+
+    lifecycle_index = LmcrecLifecycleIndex(
+        record_files_dir, index_file=args.index_file, catalog=catalog
+    )
+    if not args.no_refresh:
+        lifecycle_index.refresh()
+    intervals = lifecycle_index.lookup(*args.inst_name, from_ts=from_ts, to_ts=to_ts)
+    if args.summary:
+        intervals = summarize_lifecycle(intervals)
+
+    if not intervals:
+        print("No matching instances", file=sys.stderr)
+        return 1
+
+    headers = ["Instance", "Class", "First", "Last", "Deleted"]
+    if not args.summary:
+        headers.append("File")
+    rows = []
+    for interval in intervals:
+        row = [
+            interval.inst_name,
+            interval.class_name,
+            format_ts(interval.first_ts),
+            format_ts(interval.last_ts),
+            "yes" if interval.deleted else "",
+        ]
+        if not args.summary:
+            row.append(interval.file_name)
+        rows.append(row)
+    print(tabulate(rows, headers=headers, tablefmt="simple"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
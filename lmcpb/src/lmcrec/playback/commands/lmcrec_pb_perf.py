@@ -13,6 +13,7 @@ from typing import Tuple
 
 from cache import LmcrecScanRetCode, LmcrecStateCache
 from codec import LmcrecFileDecoder
+from query import save_pb_perf_calibration
 from tabulate import SEPARATING_LINE, tabulate
 
 from .help_formatter import CustomWidthFormatter
@@ -47,6 +48,15 @@ def main():
         action="store_true",
         help="""Enable previous variable value state cache""",
     )
+    parser.add_argument(
+        "-s",
+        "--save-calibration",
+        action="store_true",
+        help="""
+        Save the average speed as the decode speed used for the time estimate
+        by the --explain option of lmcrec-query and lmcrec-export.
+        """,
+    )
     parser.add_argument("lmcrec_file", nargs="+")
     args = parser.parse_args()
 
@@ -81,6 +91,11 @@ def main():
                 rows, headers=["File", "Size (kB)", "Time (sec)", "Speed (kB/sec)"]
             )
         )
+        if args.save_calibration and total_d_time > 0:
+            calibration_file = save_pb_perf_calibration(
+                total_file_sz / 1000 / total_d_time, have_prev=args.have_prev
+            )
+            print(f"\nCalibration saved to {calibration_file!r}")
 
     return 0
 
@@ -14,33 +14,74 @@ For additional help with the command see:
 """
 
 import argparse
+import csv
 import gzip
+import io
+import json
 import os
 import re
 import sys
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from shutil import rmtree
-from typing import List, Optional, TextIO, Tuple
+from typing import Any, Dict, List, Optional, Set, TextIO, Tuple
 from uuid import uuid4
 from zlib import Z_DEFAULT_COMPRESSION, Z_NO_COMPRESSION
 
+import yaml
 from cache import LmcrecScanRetCode
+from codec import LmcVarType
 from config import get_lmcrec_runtime
 from misc.timeutils import format_ts
 from query import (
+    BUCKET_AGGREGATES,
     QUERY_FROM_FILE_SUFFIX,
+    QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    QUERY_VAL_QUAL_SEP,
+    LmcrecFleetQuery,
     LmcrecQuery,
+    LmcrecQueryBucketAggregator,
     LmcrecQueryClassResult,
     LmcrecQueryIntervalStateCache,
     LmcrecQueryResult,
+    LmcrecQueryTopKAggregator,
+    explain_query,
+    format_explain_plan,
+    get_catalog_arg_parser,
+    get_explain_arg_parser,
     get_file_selection_arg_parser,
+    get_fleet_arg_parser,
+    get_query_result_cache_dir,
+    get_time_index_arg_parser,
+    normalize_query_windows,
+    parse_bucket_aggregates,
+    parse_duration,
+    parse_from_to_ts,
+    parse_window_spec,
+    process_catalog_args,
     process_file_selection_args,
+    process_fleet_args,
+    process_time_index_args,
+    tag_fleet_result,
 )
 from tabulate import SEPARATING_LINE, tabulate
 
 from .help_formatter import CustomWidthFormatter
+from .lmcrec_schema import (
+    LMCREC_SCHEMA_CLASS_VAR_MAX_SIZE_KEY,
+    LMCREC_SCHEMA_CLASS_VAR_TYPE_KEY,
+    LMCREC_SCHEMA_CLASSES_KEY,
+    LMCREC_SCHEMA_INFO_INST_MAX_SIZE_KEY,
+    LMCREC_SCHEMA_INFO_KEY,
+    LmcrecSchema,
+)
 
 GZIP_FILE_SUFFIX = ".gz"
 
+# The max number of output files kept open at any given time:
+FILE_HANDLE_POOL_SIZE_DEFAULT = 64
+
 
 def box(txt: str, fh=sys.stdout):
     line = "+" + "-" * (len(txt) + 2) + "+"
@@ -91,54 +132,146 @@ def build_table(
     return ["Instance"] + class_result.var_names, rows
 
 
+class FileHandlePool:
+    """Bounded pool of output file handles, w/ LRU eviction
+
+    Broad queries may produce hundreds of (query, class) output files, each
+    with its own gzip buffers. Only the most recently used ones are kept open,
+    the evicted files are reopened in append mode, which for gzip files adds a
+    new member; the concatenation of members is a valid gzip file.
+    """
+
+    def __init__(
+        self,
+        max_open_files: int = FILE_HANDLE_POOL_SIZE_DEFAULT,
+        compress: bool = False,
+    ):
+        self._max_open_files = max(max_open_files, 1)
+        self._compress = compress
+        self._fh_by_path: OrderedDict[str, TextIO] = OrderedDict()
+        # The files opened at least once, to be reopened in append mode:
+        self._opened_paths: Set[str] = set()
+        self.num_opens = 0
+        self.num_evictions = 0
+
+    def get(self, file_path: str) -> TextIO:
+        fh = self._fh_by_path.get(file_path)
+        if fh is not None:
+            self._fh_by_path.move_to_end(file_path)
+            return fh
+        while len(self._fh_by_path) >= self._max_open_files:
+            _, evicted_fh = self._fh_by_path.popitem(last=False)
+            evicted_fh.close()
+            self.num_evictions += 1
+        mode = "at" if file_path in self._opened_paths else "wt"
+        if self._compress:
+            fh = gzip.open(file_path, mode)
+        else:
+            fh = open(file_path, mode)
+        self._opened_paths.add(file_path)
+        self._fh_by_path[file_path] = fh
+        self.num_opens += 1
+        return fh
+
+    def __len__(self) -> int:
+        return len(self._fh_by_path)
+
+    def close(self):
+        while self._fh_by_path:
+            _, fh = self._fh_by_path.popitem(last=False)
+            fh.close()
+
+
 class FileTableFormatter:
+    file_suffix = ".txt"
+
     def __init__(
         self,
         output_dir: str,
         compress_level: Optional[int] = None,
         full_data: bool = False,
+        skip_empty: bool = False,
+        max_open_files: int = FILE_HANDLE_POOL_SIZE_DEFAULT,
     ):
         self._output_dir = output_dir
         self._compress_level = compress_level
         self._build_table = build_table if full_data else build_non_null_table
-        self._fh_by_query_class = dict()
+        self._skip_empty = skip_empty
+        self._compress = (
+            self._compress_level is not None
+            and self._compress_level != Z_NO_COMPRESSION
+        )
+        self._fh_pool = FileHandlePool(max_open_files, compress=self._compress)
+        self._file_path_by_query_class: Dict[Tuple[str, str], str] = dict()
+        # The output is batched per scan, see format():
+        self._buf_by_query_class: Dict[Tuple[str, str], io.StringIO] = dict()
 
-    def _get_fh_for_query_class(self, query_name: str, class_name: str) -> TextIO:
-        fh = self._fh_by_query_class.get((query_name, class_name))
-        if fh is None:
+    def _get_file_path_for_query_class(self, query_name: str, class_name: str) -> str:
+        file_path = self._file_path_by_query_class.get((query_name, class_name))
+        if file_path is None:
             result_dir = os.path.join(
                 self._output_dir,
                 re.sub(r"[^a-zA-Z0-9._-]+", "_", query_name.lower()),
             )
-            os.makedirs(result_dir)
+            os.makedirs(result_dir, exist_ok=True)
             file_path = os.path.join(
                 result_dir,
-                re.sub(r"[^a-zA-Z0-9._-]+", "_", class_name) + ".txt",
+                re.sub(r"[^a-zA-Z0-9._-]+", "_", class_name) + self.file_suffix,
             )
-            if (
-                self._compress_level is not None
-                and self._compress_level != Z_NO_COMPRESSION
-            ):
-                fh = gzip.open(file_path + GZIP_FILE_SUFFIX, "wt")
-            else:
-                fh = open(file_path, "wt")
-            self._fh_by_query_class[(query_name, class_name)] = fh
-        return self._fh_by_query_class[(query_name, class_name)]
+            if self._compress:
+                file_path += GZIP_FILE_SUFFIX
+            self._file_path_by_query_class[(query_name, class_name)] = file_path
+        return file_path
+
+    def _get_fh_for_query_class(self, query_name: str, class_name: str) -> TextIO:
+        """Return the buffer for the current scan for the (query, class) file"""
+
+        buf = self._buf_by_query_class.get((query_name, class_name))
+        if buf is None:
+            buf = io.StringIO()
+            self._buf_by_query_class[(query_name, class_name)] = buf
+        return buf
+
+    def _flush(self):
+        """Write the buffers accumulated during the current scan to the files"""
+
+        for (query_name, class_name), buf in self._buf_by_query_class.items():
+            self._fh_pool.get(
+                self._get_file_path_for_query_class(query_name, class_name)
+            ).write(buf.getvalue())
+        self._buf_by_query_class.clear()
 
     def __call__(
         self,
         result: LmcrecQueryResult,
         query_state_cache: LmcrecQueryIntervalStateCache,
     ) -> bool:
-        timestamp = format_ts(query_state_cache.ts)
+        self.format(query_state_cache.ts, result, query_state_cache.window_index)
+        return True
+
+    def format(
+        self,
+        ts: float,
+        result: LmcrecQueryResult,
+        window_index: Optional[int] = None,
+    ):
+        timestamp = format_ts(ts)
+        if window_index is not None:
+            timestamp += f"] [Window#{window_index + 1}"
         if not self._output_dir:
             fh = sys.stdout
         for query_name in sorted(result):
+            query_result = result[query_name]
+            if self._skip_empty and not any(
+                class_result.vals_by_inst for class_result in query_result.values()
+            ):
+                continue
             if not self._output_dir:
                 box(f"Query: {query_name}")
-            query_result = result[query_name]
             for class_name in sorted(query_result):
                 class_result = query_result[class_name]
+                if self._skip_empty and not class_result.vals_by_inst:
+                    continue
                 if self._output_dir:
                     fh = self._get_fh_for_query_class(query_name, class_name)
                 print(f"[{timestamp}] Class: {class_name}", file=fh)
@@ -146,22 +279,410 @@ class FileTableFormatter:
                 rows.append(SEPARATING_LINE)
                 print(tabulate(rows, headers), file=fh)
                 print(file=fh)
-        return True
+        self._flush()
 
     def close(self):
-        for query_class in list(self._fh_by_query_class):
-            self._fh_by_query_class[query_class].close()
-            del self._fh_by_query_class[query_class]
+        self._flush()
+        self._fh_pool.close()
 
     def __del__(self):
         self.close()
 
 
+# Streaming output formats, one row per instance per scan:
+OUTPUT_FORMAT_TEXT = "text"
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_JSONL = "jsonl"
+OUTPUT_FORMAT_FIXED = "fixed"
+OUTPUT_FORMATS = [
+    OUTPUT_FORMAT_TEXT,
+    OUTPUT_FORMAT_CSV,
+    OUTPUT_FORMAT_JSONL,
+    OUTPUT_FORMAT_FIXED,
+]
+
+# Fixed width defaults, used for the columns missing from the schema:
+FIXED_WIDTH_TIMESTAMP = len(format_ts(0))
+FIXED_WIDTH_INST_DEFAULT = 40
+FIXED_WIDTH_BOOL = len("False")
+FIXED_WIDTH_NUMERIC = 20
+FIXED_WIDTH_STRING_DEFAULT = 32
+FIXED_WIDTH_SEP = "  "
+
+
+@dataclass
+class StreamTableInfo:
+    """The state of a query, class table for the streaming formats"""
+
+    var_names: List[str]
+    # The indices of the displayed columns; for non-null data it is maintained
+    # incrementally, i.e. a column is added when it has a non-null value for
+    # the 1st time and it is displayed from there on:
+    col_indices: List[int] = field(default_factory=list)
+    # The indices of the columns not displayed yet:
+    pending_indices: List[int] = field(default_factory=list)
+    # Fixed width mode only, the widths of the displayed columns, in var_names
+    # order, computed once:
+    widths: Optional[List[int]] = None
+    # Whether the header should be (re)written before the next row:
+    header_changed: bool = True
+
+
+class StreamTableFormatter(FileTableFormatter, ABC):
+    """Base class for the streaming formats
+
+    Unlike the text format, where a table is built for every class of every
+    query at every scan, the rows are written as they come. When written to
+    stdout the rows are prefixed by the query and class name and a new header
+    is written whenever the displayed columns change.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        compress_level: Optional[int] = None,
+        full_data: bool = False,
+        skip_empty: bool = False,
+        max_open_files: int = FILE_HANDLE_POOL_SIZE_DEFAULT,
+        lmcrec_schema: Optional[LmcrecSchema] = None,
+    ):
+        super().__init__(
+            output_dir,
+            compress_level=compress_level,
+            full_data=full_data,
+            skip_empty=skip_empty,
+            max_open_files=max_open_files,
+        )
+        self._full_data = full_data
+        self._lmcrec_schema = lmcrec_schema
+        self._table_info_by_query_class: Dict[Tuple[str, str], StreamTableInfo] = dict()
+
+    def _update_table_info(
+        self,
+        query_name: str,
+        class_name: str,
+        class_result: LmcrecQueryClassResult,
+    ) -> StreamTableInfo:
+        var_names = class_result.var_names
+        table_info = self._table_info_by_query_class.get((query_name, class_name))
+        if table_info is None or (
+            table_info.var_names is not var_names and table_info.var_names != var_names
+        ):
+            table_info = StreamTableInfo(var_names=var_names)
+            if self._full_data:
+                table_info.col_indices = list(range(len(var_names)))
+            else:
+                table_info.pending_indices = list(range(len(var_names)))
+            self._init_table_info(class_name, class_result, table_info)
+            self._table_info_by_query_class[(query_name, class_name)] = table_info
+        pending_indices = table_info.pending_indices
+        if pending_indices:
+            found = set()
+            for vals in class_result.vals_by_inst.values():
+                for i in pending_indices:
+                    val = vals[i]
+                    if val or isinstance(val, bool):
+                        found.add(i)
+                if len(found) == len(pending_indices):
+                    break
+            if found:
+                table_info.col_indices = sorted(set(table_info.col_indices) | found)
+                table_info.pending_indices = [
+                    i for i in pending_indices if i not in found
+                ]
+                table_info.header_changed = True
+        return table_info
+
+    def _init_table_info(
+        self,
+        class_name: str,
+        class_result: LmcrecQueryClassResult,
+        table_info: StreamTableInfo,
+    ):
+        pass
+
+    def format(
+        self,
+        ts: float,
+        result: LmcrecQueryResult,
+        window_index: Optional[int] = None,
+    ):
+        timestamp = format_ts(ts)
+        if not self._output_dir:
+            fh = sys.stdout
+        for query_name in sorted(result):
+            query_result = result[query_name]
+            for class_name in sorted(query_result):
+                class_result = query_result[class_name]
+                vals_by_inst = class_result.vals_by_inst
+                if self._skip_empty and not vals_by_inst:
+                    continue
+                table_info = self._update_table_info(
+                    query_name, class_name, class_result
+                )
+                col_indices = table_info.col_indices
+                if not col_indices:
+                    continue
+                if self._output_dir:
+                    fh = self._get_fh_for_query_class(query_name, class_name)
+                    prefix_names, prefix = ["Timestamp"], [timestamp]
+                else:
+                    prefix_names = ["Timestamp", "Query", "Class"]
+                    prefix = [timestamp, query_name, class_name]
+                if window_index is not None:
+                    prefix_names.append("Window")
+                    prefix.append(window_index + 1)
+                if table_info.header_changed:
+                    self._write_header(fh, prefix_names, prefix, table_info)
+                    table_info.header_changed = False
+                row_prefix = self._row_prefix(prefix_names, prefix)
+                full_data = self._full_data
+                for inst_name in sorted(vals_by_inst):
+                    vals = vals_by_inst[inst_name]
+                    vals = [vals[i] for i in col_indices]
+                    if not full_data and not any(
+                        val or isinstance(val, bool) for val in vals
+                    ):
+                        continue
+                    self._write_row(fh, row_prefix, inst_name, vals, table_info)
+        self._flush()
+
+    def _row_prefix(self, prefix_names: List[str], prefix: List[Any]) -> Any:
+        """Convert the row prefix into the format specific one, once per table"""
+        return prefix
+
+    def _write_header(
+        self,
+        fh: TextIO,
+        prefix_names: List[str],
+        prefix: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        pass
+
+    @abstractmethod
+    def _write_row(
+        self,
+        fh: TextIO,
+        row_prefix: Any,
+        inst_name: str,
+        vals: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        """Write the row for an instance, vals are those of the displayed columns"""
+
+
+class CsvTableFormatter(StreamTableFormatter):
+    """CSV format, one file per query, class table
+
+    A valid CSV file has a single header, therefore the output is supported
+    only to files and all the columns are displayed from the start; --full-data
+    applies only to the rows.
+    """
+
+    file_suffix = ".csv"
+
+    def __init__(self, output_dir: str, *args, **kwargs):
+        super().__init__(output_dir, *args, **kwargs)
+        if not output_dir:
+            raise ValueError("the CSV format requires an output dir")
+        self._csv_fh, self._csv_writer = None, None
+
+    def _init_table_info(
+        self,
+        class_name: str,
+        class_result: LmcrecQueryClassResult,
+        table_info: StreamTableInfo,
+    ):
+        table_info.col_indices = list(range(len(table_info.var_names)))
+        table_info.pending_indices = []
+
+    def _get_csv_writer(self, fh: TextIO):
+        # The rows of a table are written in sequence, to the same per scan
+        # buffer, so it is enough to cache the last writer:
+        if fh is not self._csv_fh:
+            self._csv_fh, self._csv_writer = fh, csv.writer(fh)
+        return self._csv_writer
+
+    def _write_header(
+        self,
+        fh: TextIO,
+        prefix_names: List[str],
+        prefix: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        var_names = table_info.var_names
+        self._get_csv_writer(fh).writerow(
+            prefix_names + ["Instance"] + [var_names[i] for i in table_info.col_indices]
+        )
+
+    def _write_row(
+        self,
+        fh: TextIO,
+        row_prefix: List[Any],
+        inst_name: str,
+        vals: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        self._get_csv_writer(fh).writerow(row_prefix + [inst_name] + vals)
+
+
+class JsonlTableFormatter(StreamTableFormatter):
+    file_suffix = ".jsonl"
+
+    def _row_prefix(self, prefix_names: List[str], prefix: List[Any]) -> Any:
+        return dict(zip(prefix_names, prefix))
+
+    def _write_row(
+        self,
+        fh: TextIO,
+        row_prefix: Dict[str, Any],
+        inst_name: str,
+        vals: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        var_names = table_info.var_names
+        row = dict(row_prefix)
+        row["Instance"] = inst_name
+        row["Values"] = {
+            var_names[i]: val for i, val in zip(table_info.col_indices, vals)
+        }
+        print(json.dumps(row, default=str), file=fh)
+
+
+class FixedWidthTableFormatter(StreamTableFormatter):
+    """Fixed width columns, based on the schema max_size for strings
+
+    The widths are computed once per query, class table and the values
+    exceeding them are not truncated.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        inst_width = FIXED_WIDTH_INST_DEFAULT
+        if self._lmcrec_schema is not None:
+            inst_width = (
+                self._lmcrec_schema.get(LMCREC_SCHEMA_INFO_KEY, {}).get(
+                    LMCREC_SCHEMA_INFO_INST_MAX_SIZE_KEY
+                )
+                or inst_width
+            )
+        self._inst_width = max(len("Instance"), inst_width)
+
+    def _init_table_info(
+        self,
+        class_name: str,
+        class_result: LmcrecQueryClassResult,
+        table_info: StreamTableInfo,
+    ):
+        class_schema = {}
+        if self._lmcrec_schema is not None:
+            class_schema = self._lmcrec_schema.get(LMCREC_SCHEMA_CLASSES_KEY, {}).get(
+                class_name, {}
+            )
+        # Fallback on the current values for the variables missing from the
+        # schema:
+        sample_vals = next(iter(class_result.vals_by_inst.values()), None)
+        widths = []
+        for i, var_name in enumerate(table_info.var_names):
+            width = FIXED_WIDTH_NUMERIC
+            var_schema = class_schema.get(var_name)
+            if var_schema is None and QUERY_VAL_QUAL_SEP in var_name:
+                # Qualified value, e.g. VAR:d:
+                var_schema = class_schema.get(
+                    var_name[: var_name.rfind(QUERY_VAL_QUAL_SEP)]
+                )
+            if var_schema is not None:
+                var_type = var_schema.get(LMCREC_SCHEMA_CLASS_VAR_TYPE_KEY)
+                if var_type in {
+                    LmcVarType.BOOLEAN.name,
+                    LmcVarType.BOOLEAN_CONFIG.name,
+                }:
+                    width = FIXED_WIDTH_BOOL
+                elif var_type in {
+                    LmcVarType.STRING.name,
+                    LmcVarType.STRING_CONFIG.name,
+                }:
+                    width = (
+                        var_schema.get(LMCREC_SCHEMA_CLASS_VAR_MAX_SIZE_KEY)
+                        or FIXED_WIDTH_STRING_DEFAULT
+                    )
+            elif sample_vals is not None:
+                if isinstance(sample_vals[i], bool):
+                    width = FIXED_WIDTH_BOOL
+                elif isinstance(sample_vals[i], str):
+                    width = FIXED_WIDTH_STRING_DEFAULT
+            widths.append(max(width, len(var_name)))
+        table_info.widths = widths
+
+    def _prefix_widths(self, prefix_names: List[str], prefix: List[Any]) -> List[int]:
+        return [FIXED_WIDTH_TIMESTAMP] + [
+            max(len(str(p)), len(h)) for p, h in zip(prefix[1:], prefix_names[1:])
+        ]
+
+    def _row_prefix(self, prefix_names: List[str], prefix: List[Any]) -> Any:
+        return FIXED_WIDTH_SEP.join(
+            f"{str(p):<{w}s}"
+            for p, w in zip(prefix, self._prefix_widths(prefix_names, prefix))
+        )
+
+    def _write_header(
+        self,
+        fh: TextIO,
+        prefix_names: List[str],
+        prefix: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        widths = table_info.widths
+        var_names = table_info.var_names
+        cols = [
+            f"{h:<{w}s}"
+            for h, w in zip(prefix_names, self._prefix_widths(prefix_names, prefix))
+        ]
+        cols.append(f"{'Instance':<{self._inst_width}s}")
+        cols.extend(f"{var_names[i]:>{widths[i]}s}" for i in table_info.col_indices)
+        header = FIXED_WIDTH_SEP.join(cols)
+        print(header, file=fh)
+        print("-" * len(header), file=fh)
+
+    def _write_row(
+        self,
+        fh: TextIO,
+        row_prefix: str,
+        inst_name: str,
+        vals: List[Any],
+        table_info: StreamTableInfo,
+    ):
+        widths = table_info.widths
+        cols = [row_prefix]
+        cols.append(f"{inst_name:<{self._inst_width}s}")
+        for i, val in zip(table_info.col_indices, vals):
+            if isinstance(val, str):
+                cols.append(f"{val:<{widths[i]}s}")
+            else:
+                cols.append(f"{str(val):>{widths[i]}s}")
+        print(FIXED_WIDTH_SEP.join(cols), file=fh)
+
+
+OUTPUT_FORMATTER_BY_FORMAT = {
+    OUTPUT_FORMAT_TEXT: FileTableFormatter,
+    OUTPUT_FORMAT_CSV: CsvTableFormatter,
+    OUTPUT_FORMAT_JSONL: JsonlTableFormatter,
+    OUTPUT_FORMAT_FIXED: FixedWidthTableFormatter,
+}
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=CustomWidthFormatter,
         description=description,
-        parents=[get_file_selection_arg_parser()],
+        parents=[
+            get_file_selection_arg_parser(),
+            get_fleet_arg_parser(),
+            get_catalog_arg_parser(),
+            get_time_index_arg_parser(),
+            get_explain_arg_parser(),
+        ],
     )
     parser.add_argument(
         "-F",
@@ -181,7 +702,45 @@ def main():
         Save the information under OUTPUT_DIR
         QUERY/CLASS_NAME.txt[{GZIP_FILE_SUFFIX}] files. The directory will be
         created as needed. If OUTPUT_DIR is specified as "auto" then it will
-        default to $LMCREC_RUNTIME/query/INST/FIRST_TIMESTAMP--LAST_TIMESTAMP
+        default to $LMCREC_RUNTIME/query/INST/FIRST_TIMESTAMP--LAST_TIMESTAMP,
+        where INST is "fleet" for --fleet.
+        """,
+    )
+    parser.add_argument(
+        "-O",
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMAT_TEXT,
+        help=f"""
+        Output format. {OUTPUT_FORMAT_TEXT!r} displays a table for every class
+        of every query at every scan. The others are streaming formats, one row
+        per instance per scan: {OUTPUT_FORMAT_CSV!r}, {OUTPUT_FORMAT_JSONL!r}
+        (JSON Lines) and {OUTPUT_FORMAT_FIXED!r} (fixed width columns, see
+        --schema-file). For the streaming formats the columns w/ no non-null
+        value are omitted until they get one, unless --full-data is
+        specified. {OUTPUT_FORMAT_CSV!r} requires --output-dir, for a single
+        header per file, and it always has all the columns. Default:
+        %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-S",
+        "--schema-file",
+        help="""
+        LmcrecSchema file (YAML format) created by inventory or merged from
+        multiple inventory files, used for determining the column widths for
+        the fixed width output format, based on the max_size of the string
+        variables and the inst_max_size.
+        """,
+    )
+    parser.add_argument(
+        "--max-open-files",
+        type=int,
+        default=FILE_HANDLE_POOL_SIZE_DEFAULT,
+        help="""
+        The max number of output files kept open at any given time when
+        --output-dir is used. The least recently used files are closed and
+        reopened in append mode, as needed. Default: %(default)s.
         """,
     )
     parser.add_argument(
@@ -196,6 +755,106 @@ def main():
         Z_DEFAULT_COMPRESSION={Z_DEFAULT_COMPRESSION}. 
         """,
     )
+    parser.add_argument(
+        "-C",
+        "--changed-only",
+        action="store_true",
+        help="""
+        Display only the instances with at least one selected variable that
+        changed since the previous scan. The first scan is displayed in full.
+        """,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+        The number of worker processes used for running the query against the
+        file chains in parallel, 0 stands for the number of CPUs. The results
+        are displayed in chronological order regardless. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-R",
+        "--result-cache",
+        metavar="CACHE_DIR",
+        nargs="?",
+        const="",
+        help="""
+        Use a persistent result cache under CACHE_DIR, default
+        $LMCREC_RUNTIME/query-cache. The results for closed record files are
+        cached and served w/o decoding the files when the same query is run
+        again; only the active file is replayed.
+        """,
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        metavar="MB",
+        type=int,
+        default=QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT >> 20,
+        help="""
+        The max size, in MB, of the result cache, 0 for no limit; the least
+        recently used entries are removed past it. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        metavar="DURATION",
+        help="""
+        Aggregate the results over DURATION time buckets, in [Hh][Mm][S[s]]
+        format, e.g. 5m, and display one row per bucket per instance. The
+        buckets are aligned to multiples of DURATION and they are identified
+        by their start timestamp.
+        """,
+    )
+    parser.add_argument(
+        "-A",
+        "--aggregates",
+        metavar="AGG[,AGG...]",
+        help=f"""
+        Comma separated list of aggregates to use with --bucket, from
+        {", ".join(BUCKET_AGGREGATES)}. sum applies only to delta (:d or :D)
+        columns. Default: all.
+        """,
+    )
+    parser.add_argument(
+        "-W",
+        "--window",
+        metavar="FROM,TO",
+        action="append",
+        help="""
+        Time window, FROM and TO have the same format as for --from-ts and
+        --to-ts, either may be empty. The option may be repeated for multiple,
+        non-overlapping, windows, e.g. a baseline and an incident interval,
+        which are played back in a single pass; the results are tagged w/
+        Window#N, the N-th window in the order of the options. It cannot be
+        combined with --from-ts, --to-ts, --jobs, --result-cache,
+        --use-zone-maps or --fleet.
+        """,
+    )
+    parser.add_argument(
+        "-U",
+        "--use-summaries",
+        action="store_true",
+        help="""
+        Skip the record files which cannot match the queries, based on the
+        class and instance summaries created by lmcrec-summarize. The files w/o
+        an up to date summary are played back as usual.
+        """,
+    )
+    parser.add_argument(
+        "-Z",
+        "--use-zone-maps",
+        action="store_true",
+        help="""
+        Skip the checkpoint segments which cannot satisfy the value predicates
+        of the queries, e.g. "v: [queue_depth>10000]", based on the zone maps
+        created by lmcrec-summarize --zone-maps. The playback is in-process
+        and it cannot be combined with --window or --fleet.
+        """,
+    )
     parser.add_argument(
         "query_or_files",
         metavar="QUERY_OR_FILE",
@@ -206,13 +865,137 @@ def main():
     )
 
     args = parser.parse_args()
-    record_files_dir, from_ts, to_ts = process_file_selection_args(args)
-    lmcrec_query = LmcrecQuery(
-        record_files_dir,
-        *args.query_or_files,
-        from_ts=from_ts,
-        to_ts=to_ts,
-    )
+    if args.output_format == OUTPUT_FORMAT_CSV and not args.output_dir:
+        raise RuntimeError(
+            f"--output-format {OUTPUT_FORMAT_CSV} requires --output-dir OUTPUT_DIR"
+        )
+    bucket, aggregates = None, None
+    if args.bucket is not None:
+        try:
+            bucket = parse_duration(args.bucket)
+        except ValueError as e:
+            raise RuntimeError(f"--bucket: {e}") from None
+        if bucket <= 0:
+            raise RuntimeError(f"--bucket {args.bucket!r}: it should be > 0")
+    if args.aggregates is not None:
+        if bucket is None:
+            raise RuntimeError("--aggregates requires --bucket DURATION")
+        if not args.aggregates.strip():
+            raise RuntimeError(
+                f"--aggregates: empty list, want one or more of {BUCKET_AGGREGATES}"
+            )
+        try:
+            aggregates = parse_bucket_aggregates(args.aggregates)
+        except ValueError as e:
+            raise RuntimeError(f"--aggregates: {e}") from None
+    record_files_dir_by_inst = process_fleet_args(args)
+    if record_files_dir_by_inst is not None:
+        if args.window or args.result_cache is not None or args.use_zone_maps:
+            raise RuntimeError(
+                "--fleet cannot be combined w/ --window, --result-cache or --use-zone-maps"
+            )
+        if args.catalog:
+            raise RuntimeError("--fleet cannot be combined w/ --catalog CATALOG_FILE")
+        if args.time_index is not None:
+            raise RuntimeError("--fleet cannot be combined w/ --time-index")
+        record_files_dir = None
+        from_ts, to_ts = parse_from_to_ts(args.from_ts, args.to_ts)
+        catalog_by_inst = {
+            inst: process_catalog_args(args, inst_record_files_dir)
+            for inst, inst_record_files_dir in record_files_dir_by_inst.items()
+        }
+    else:
+        record_files_dir, from_ts, to_ts = process_file_selection_args(args)
+    windows = None
+    if args.window:
+        if from_ts is not None or to_ts is not None:
+            raise RuntimeError("--window cannot be combined w/ --from-ts/--to-ts")
+        if args.jobs != 1 or args.result_cache is not None:
+            raise RuntimeError(
+                "--window cannot be combined w/ --jobs or --result-cache"
+            )
+        if args.use_zone_maps:
+            raise RuntimeError("--window cannot be combined w/ --use-zone-maps")
+        try:
+            windows = [parse_window_spec(spec) for spec in args.window]
+            normalize_query_windows(windows)
+        except ValueError as e:
+            raise RuntimeError(f"--window: {e}") from None
+    if args.explain:
+        if record_files_dir_by_inst is not None:
+            explain_targets = [
+                (inst, inst_record_files_dir, catalog_by_inst[inst])
+                for inst, inst_record_files_dir in record_files_dir_by_inst.items()
+            ]
+        else:
+            explain_targets = [
+                (None, record_files_dir, process_catalog_args(args, record_files_dir))
+            ]
+        for inst, record_files_dir, catalog in explain_targets:
+            if inst is not None:
+                print(f"Inst: {inst}")
+            for window_index, (from_ts, to_ts) in enumerate(
+                windows or [(from_ts, to_ts)]
+            ):
+                if windows is not None:
+                    print(f"Window#{window_index + 1}:")
+                plan = explain_query(
+                    record_files_dir,
+                    from_ts=from_ts,
+                    to_ts=to_ts,
+                    decode_speed=args.decode_speed,
+                    catalog=catalog,
+                )
+                print(format_explain_plan(plan, record_files_dir))
+                print()
+        return 0
+    bucket_aggregator = None
+    if bucket is not None:
+        bucket_aggregator = LmcrecQueryBucketAggregator(bucket, aggregates=aggregates)
+    if record_files_dir_by_inst is not None:
+        lmcrec_query = LmcrecFleetQuery(
+            record_files_dir_by_inst,
+            *args.query_or_files,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            changed_only=args.changed_only,
+            workers=args.jobs,
+            catalog_by_inst=catalog_by_inst,
+            use_summaries=args.use_summaries,
+        )
+    else:
+        catalog = process_catalog_args(args, record_files_dir)
+        lmcrec_query = LmcrecQuery(
+            record_files_dir,
+            *args.query_or_files,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            changed_only=args.changed_only,
+            workers=args.jobs,
+            result_cache_dir=(
+                (args.result_cache or get_query_result_cache_dir())
+                if args.result_cache is not None
+                else None
+            ),
+            result_cache_max_size=args.result_cache_size << 20,
+            windows=windows,
+            catalog=catalog,
+            index_cache=process_time_index_args(
+                args, record_files_dir, catalog=catalog
+            ),
+            use_summaries=args.use_summaries,
+            use_zone_maps=args.use_zone_maps,
+        )
+
+    def run_with_callback(cb):
+        if record_files_dir_by_inst is None:
+            return lmcrec_query.run_with_callback(cb)
+        # Tag the results w/ the instance:
+        return lmcrec_query.run_with_callback(
+            lambda result, scan_state: cb(
+                tag_fleet_result(scan_state.inst, result), scan_state
+            )
+        )
 
     full_data = args.full_data
     output_dir = args.output_dir
@@ -221,18 +1004,88 @@ def main():
         # First and last timestamps are not know until after the query: use a
         # temp dir and rename at the end:
         parent_output_dir = os.path.join(
-            get_lmcrec_runtime(), "query", args.inst or "unknown"
+            get_lmcrec_runtime(),
+            "query",
+            (
+                "fleet"
+                if record_files_dir_by_inst is not None
+                else args.inst or "unknown"
+            ),
         )
         tmp_output_dir = os.path.join(parent_output_dir, str(uuid4()))
         output_dir = tmp_output_dir
 
-    output_formatter = FileTableFormatter(
-        output_dir, compress_level=args.compress_level, full_data=full_data
+    output_formatter_kwargs = dict(
+        compress_level=args.compress_level,
+        full_data=full_data,
+        skip_empty=args.changed_only,
+        max_open_files=args.max_open_files,
+    )
+    if args.output_format != OUTPUT_FORMAT_TEXT:
+        lmcrec_schema = None
+        if args.schema_file is not None:
+            with open(args.schema_file, "rt") as f:
+                lmcrec_schema = yaml.safe_load(f)
+        output_formatter_kwargs["lmcrec_schema"] = lmcrec_schema
+    output_formatter = OUTPUT_FORMATTER_BY_FORMAT[args.output_format](
+        output_dir, **output_formatter_kwargs
     )
 
     exit_code = 0
     try:
-        ret_code = lmcrec_query.run_with_callback(output_formatter)
+        top_k_aggregator = None
+        window_top_k = lmcrec_query.window_top_k
+        if window_top_k and record_files_dir_by_inst is not None:
+            window_top_k = {
+                query_name: top_k
+                for inst in record_files_dir_by_inst
+                for query_name, top_k in tag_fleet_result(inst, window_top_k).items()
+            }
+        if window_top_k:
+            top_k_aggregator = LmcrecQueryTopKAggregator(window_top_k)
+
+        if bucket_aggregator is not None or top_k_aggregator is not None:
+
+            # The aggregates are per time window, for multiple windows:
+            window_index, window_last_ts = None, None
+
+            def flush_aggregators():
+                if bucket_aggregator is not None:
+                    bucket_result = bucket_aggregator.flush()
+                    if bucket_result is not None:
+                        output_formatter.format(*bucket_result, window_index)
+                if top_k_aggregator is not None:
+                    top_k_result = top_k_aggregator.flush()
+                    if top_k_result is not None:
+                        output_formatter.format(
+                            window_last_ts, top_k_result, window_index
+                        )
+
+            def aggregator_cb(
+                result: LmcrecQueryResult,
+                query_state_cache: LmcrecQueryIntervalStateCache,
+            ) -> bool:
+                nonlocal window_index, window_last_ts
+                if query_state_cache.window_index != window_index:
+                    flush_aggregators()
+                    window_index = query_state_cache.window_index
+                window_last_ts = query_state_cache.ts
+                if top_k_aggregator is not None:
+                    result = top_k_aggregator.update(result)
+                    if not result:
+                        return True
+                if bucket_aggregator is None:
+                    output_formatter.format(query_state_cache.ts, result, window_index)
+                    return True
+                bucket_result = bucket_aggregator.update(query_state_cache.ts, result)
+                if bucket_result is not None:
+                    output_formatter.format(*bucket_result, window_index)
+                return True
+
+            ret_code = run_with_callback(aggregator_cb)
+            flush_aggregators()
+        else:
+            ret_code = run_with_callback(output_formatter)
         if ret_code != LmcrecScanRetCode.ATEOR:
             exit_code = 1
             print(
@@ -0,0 +1,268 @@
+#! /usr/bin/env python3
+
+description = """
+Long running query service, w/ warm caches, on a localhost HTTP port.
+
+Requests:
+
+    POST /query
+        {"queries": QUERY or [QUERY, ...], "from": FROM, "to": TO, "changed_only": BOOL,
+         "max_scans": INT}
+
+    GET /status
+
+For the request and response format see:
+    https://github.com/bgp59/lmc-recorder/docs/Commands.md#lmcrec-serve
+
+"""
+
+import argparse
+import json
+import sys
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+from query import (
+    QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    QUERY_SERVICE_MAX_SCANS_DEFAULT,
+    QUERY_SERVICE_RESPONSE_CACHE_SIZE_DEFAULT,
+    STATE_SNAPSHOT_CACHE_MAX_SNAPSHOTS_DEFAULT,
+    TIME_INDEX_AUTO_REFRESH_INTERVAL_DEFAULT,
+    LmcrecQueryService,
+    LmcrecStateSnapshotCache,
+    get_catalog_arg_parser,
+    get_file_selection_arg_parser,
+    get_query_result_cache_dir,
+    get_time_index_arg_parser,
+    process_catalog_args,
+    process_file_selection_args,
+    process_time_index_args,
+)
+
+from .help_formatter import CustomWidthFormatter
+
+LMCREC_SERVE_HOST_DEFAULT = "127.0.0.1"
+LMCREC_SERVE_PORT_DEFAULT = 8059
+
+# The maximum request body size:
+LMCREC_SERVE_MAX_REQUEST_SIZE = 1 << 20
+
+
+class LmcrecServeRequestHandler(BaseHTTPRequestHandler):
+    """Handle lmcrec-serve requests, the service is a server attribute"""
+
+    def _reply(self, status: HTTPStatus, body: Dict[str, Any]):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/status":
+            self._reply(HTTPStatus.OK, self.server.service.status())
+        else:
+            self._reply(HTTPStatus.NOT_FOUND, {"error": f"{self.path}: not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/query":
+            self._reply(HTTPStatus.NOT_FOUND, {"error": f"{self.path}: not found"})
+            return
+        try:
+            size = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            size = -1
+        if not 0 < size <= LMCREC_SERVE_MAX_REQUEST_SIZE:
+            self._reply(HTTPStatus.BAD_REQUEST, {"error": "invalid Content-Length"})
+            return
+        try:
+            request = json.loads(self.rfile.read(size))
+            response = self.server.service.query(request)
+        except (ValueError, RuntimeError, KeyError, OSError) as e:
+            self._reply(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            return
+        self._reply(HTTPStatus.OK, response)
+
+    def log_message(self, format: str, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def build_server(
+    service: LmcrecQueryService,
+    host: str = LMCREC_SERVE_HOST_DEFAULT,
+    port: int = LMCREC_SERVE_PORT_DEFAULT,
+    verbose: bool = False,
+) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), LmcrecServeRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=CustomWidthFormatter,
+        description=description,
+        parents=[
+            get_file_selection_arg_parser(),
+            get_catalog_arg_parser(),
+            get_time_index_arg_parser(),
+        ],
+    )
+    parser.add_argument(
+        "-H",
+        "--host",
+        default=LMCREC_SERVE_HOST_DEFAULT,
+        help="""
+        The address to listen on. The service has no authentication, it should
+        be exposed only to trusted clients. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=LMCREC_SERVE_PORT_DEFAULT,
+        help="""
+        The port to listen on. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+        The number of worker processes used for running a query against the
+        file chains in parallel, 0 stands for the number of CPUs. Default:
+        %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-R",
+        "--result-cache",
+        metavar="CACHE_DIR",
+        help="""
+        Use the persistent result cache under CACHE_DIR. Default:
+        $LMCREC_RUNTIME/query-cache.
+        """,
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        metavar="MB",
+        type=int,
+        default=QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT >> 20,
+        help="""
+        The max size, in MB, of the result cache, 0 for no limit; the least
+        recently used entries are removed past it. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        action="store_true",
+        help="""
+        Do not use the persistent result cache.
+        """,
+    )
+    parser.add_argument(
+        "-S",
+        "--shared-scan",
+        action="store_true",
+        help="""
+        Share the decode passes among concurrent requests, rather than using
+        the result cache and the worker processes. Better suited for many
+        clients querying the most recent data.
+        """,
+    )
+    parser.add_argument(
+        "-N",
+        "--response-cache-size",
+        metavar="MB",
+        type=int,
+        default=QUERY_SERVICE_RESPONSE_CACHE_SIZE_DEFAULT >> 20,
+        help="""
+        The max estimated size, in MB, of the recent responses kept in memory, 0
+        to disable. A cached response is used only if the request and the
+        underlying files are unchanged. Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-M",
+        "--max-scans",
+        type=int,
+        default=QUERY_SERVICE_MAX_SCANS_DEFAULT,
+        help="""
+        The max number of scans in a response, 0 for no limit; the response is
+        flagged as truncated if there were more. A request may lower the limit
+        via "max_scans". Default: %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "--state-snapshots",
+        metavar="N",
+        type=int,
+        default=STATE_SNAPSHOT_CACHE_MAX_SNAPSHOTS_DEFAULT,
+        help="""
+        The max number of query state snapshots kept in memory, 0 to disable. A
+        request whose window starts at or after a snapshot resumes the playback
+        from it, rather than from the preceding checkpoint. Default:
+        %(default)s.
+        """,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="""
+        Log the requests to stderr.
+        """,
+    )
+
+    args = parser.parse_args()
+    if args.from_ts is not None or args.to_ts is not None:
+        print(
+            "Warning: --from-ts and --to-ts are ignored, the time window is per request",
+            file=sys.stderr,
+        )
+    record_files_dir, _, _ = process_file_selection_args(args)
+    result_cache_dir = None
+    if not (args.no_result_cache or args.shared_scan):
+        result_cache_dir = args.result_cache or get_query_result_cache_dir()
+    catalog = process_catalog_args(args, record_files_dir)
+    service = LmcrecQueryService(
+        record_files_dir,
+        result_cache_dir=result_cache_dir,
+        result_cache_max_size=args.result_cache_size << 20,
+        workers=args.jobs,
+        response_cache_size=args.response_cache_size << 20,
+        max_scans=args.max_scans,
+        # The newly closed files are indexed as the active one is looked up:
+        index_cache=process_time_index_args(
+            args,
+            record_files_dir,
+            catalog=catalog,
+            auto_refresh_interval=TIME_INDEX_AUTO_REFRESH_INTERVAL_DEFAULT,
+        ),
+        shared_scan=args.shared_scan,
+        catalog=catalog,
+        snapshot_cache=LmcrecStateSnapshotCache(max_snapshots=args.state_snapshots),
+    )
+    server = build_server(service, args.host, args.port, verbose=args.verbose)
+    print(
+        f"lmcrec-serve: {record_files_dir} on http://{args.host}:{server.server_port}",
+        file=sys.stderr,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+description = """
+Create the summary sidecars for the closed record files.
+
+A summary, FILE.lmcrec[.gz].summary, holds the classes present in the file,
+with their first and last seen timestamps, and a bloom filter of the instance
+names. lmcrec-query --use-summaries uses them for skipping the files which
+cannot match the queries.
+
+Optionally create the zone map sidecars, FILE.lmcrec[.gz].zonemap, as well,
+holding the min/max/changes of the numeric variables for every checkpoint
+segment. lmcrec-query --use-zone-maps uses them for skipping the segments
+which cannot satisfy the value predicates of the queries.
+
+Optionally refresh the global time index of the record files dir, see
+--time-index, by appending the checkpoints of the newly closed files. This
+command may be run periodically, e.g. from cron, to keep the sidecars and the
+index up to date as the record files close.
+
+Up to date summaries and zone maps are left alone, unless --force is
+specified.
+"""
+
+import argparse
+import sys
+
+from codec import INFO_FILE_SUFFIX, LmcrecInfoState, decode_lmcrec_info_from_file
+from misc.timeutils import format_ts
+from query import (
+    build_lmcrec_file_chains,
+    get_file_selection_arg_parser,
+    get_time_index_arg_parser,
+    map_lmcrec_file,
+    process_file_selection_args,
+    process_time_index_args,
+    summarize_lmcrec_file,
+)
+
+from .help_formatter import CustomWidthFormatter
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=CustomWidthFormatter,
+        description=description,
+        parents=[get_file_selection_arg_parser(), get_time_index_arg_parser()],
+    )
+    parser.add_argument(
+        "-F",
+        "--force",
+        action="store_true",
+        help="""
+            Rebuild the summaries even if up to date.
+        """,
+    )
+    parser.add_argument(
+        "-z",
+        "--zone-maps",
+        action="store_true",
+        help="""
+            Create the zone maps as well.
+        """,
+    )
+    parser.add_argument(
+        "-I",
+        "--per-inst",
+        action="store_true",
+        help="""
+            Maintain the zone map stats per instance as well, for pruning the
+            queries for specific instances. It implies --zone-maps.
+        """,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="""
+            Display the summarized classes and their first and last seen
+            timestamps.
+        """,
+    )
+    parser.add_argument(
+        "file",
+        nargs="*",
+        help="""
+            Specific lmcrec file(s) to summarize, they override the query style
+            selection.
+        """,
+    )
+
+    args = parser.parse_args()
+    if args.file and args.time_index is not None:
+        raise RuntimeError("--time-index cannot be combined w/ specific files")
+    if args.file:
+        file_info_list = []
+        for lmcrec_file in args.file:
+            try:
+                lmcrec_info = decode_lmcrec_info_from_file(
+                    lmcrec_file + INFO_FILE_SUFFIX
+                )
+            except Exception as e:
+                print(f"{lmcrec_file}: {e}", file=sys.stderr)
+                lmcrec_info = None
+            file_info_list.append((lmcrec_file, lmcrec_info))
+    else:
+        record_files_dir, from_ts, to_ts = process_file_selection_args(args)
+        chain_list = build_lmcrec_file_chains(record_files_dir, from_ts, to_ts)
+        file_info_list = []
+        for entry in chain_list or []:
+            while entry is not None:
+                file_info_list.append((entry.file_name, entry.lmcrec_info))
+                entry = entry.next
+
+    retval = 0
+    time_index = None
+    if args.time_index is not None:
+        time_index = process_time_index_args(args, record_files_dir)
+        print(
+            f"{time_index.index_dir}: {len(time_index)} files, "
+            f"{time_index.num_entries} checkpoints, "
+            f"{time_index.num_file_decodes} new file(s)"
+        )
+        time_index.close()
+    for lmcrec_file, lmcrec_info in file_info_list:
+        if lmcrec_info is None:
+            retval = 1
+            continue
+        if lmcrec_info.state != LmcrecInfoState.CLOSED:
+            print(f"{lmcrec_file}: not closed, skipped")
+            continue
+        try:
+            summary = summarize_lmcrec_file(
+                lmcrec_file, lmcrec_info=lmcrec_info, force=args.force
+            )
+        except Exception as e:
+            print(f"{lmcrec_file}: {e}", file=sys.stderr)
+            retval = 1
+            continue
+        print(
+            f"{lmcrec_file}: {len(summary.classes)} classes, {summary.num_inst} instances"
+        )
+        if args.zone_maps or args.per_inst:
+            try:
+                zone_map = map_lmcrec_file(
+                    lmcrec_file,
+                    lmcrec_info=lmcrec_info,
+                    per_inst=args.per_inst,
+                    force=args.force,
+                )
+            except Exception as e:
+                print(f"{lmcrec_file}: {e}", file=sys.stderr)
+                retval = 1
+                continue
+            print(f"{lmcrec_file}: {len(zone_map.segments)} zone map segments")
+        if args.verbose:
+            for class_name, (first_ts, last_ts) in sorted(summary.classes.items()):
+                print(f"  {class_name}: {format_ts(first_ts)} - {format_ts(last_ts)}")
+
+    return retval
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,6 +13,7 @@ from .config import (
     LMCREC_RUNTIME_DEFAULT,
     LMCREC_RUNTIME_ENV_VAR,
     get_lmcrec_config_file,
+    get_lmcrec_config_insts,
     get_lmcrec_runtime,
     get_record_files_dir,
     load_lmcrec_config,
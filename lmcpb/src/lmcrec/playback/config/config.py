@@ -2,7 +2,7 @@
 
 import os
 from functools import lru_cache
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import yaml
 
@@ -87,3 +87,13 @@ def get_record_files_dir(
     config_file: Optional[str] = None,
 ) -> str:
     return lookup_lmcrec_config_file(inst, config_file, "record_files_dir", expand=True)
+
+
+def get_lmcrec_config_insts(config_file: Optional[str] = None) -> List[str]:
+    """Return the insts of all the recorders in the config, in config order"""
+
+    return [
+        inst
+        for inst in load_lmcrec_config(config_file)[LMCREC_CONFIG_RECORDERS_BY_INST_KEY]
+        if inst
+    ]
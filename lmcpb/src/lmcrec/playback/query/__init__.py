@@ -7,17 +7,125 @@ if root_dir not in sys.path:
 
 from .args import (
     get_file_selection_arg_parser,
+    parse_duration,
+    parse_from_to_ts,
+    parse_window_spec,
     process_file_selection_args,
 )
+from .asof_join import LmcrecAsOfJoin, LmcrecAsOfScan
+from .bucket_aggregator import (
+    BUCKET_AGGREGATES,
+    LmcrecQueryBucketAggregator,
+    parse_bucket_aggregates,
+)
+from .catalog import (
+    LmcrecFileCatalog,
+    get_catalog_arg_parser,
+    get_lmcrec_catalog_file,
+    process_catalog_args,
+)
+from .columnar import (
+    COLUMNAR_FORMAT_ARROW,
+    COLUMNAR_FORMAT_COLUMNS,
+    COLUMNAR_FORMAT_PANDAS,
+    LmcrecQueryColumnarBatch,
+    LmcrecQueryColumnarBuilder,
+)
+from .explain import (
+    EXPLAIN_SCAN_INTERVAL_DEFAULT,
+    LmcrecExplainFile,
+    LmcrecExplainPlan,
+    explain_query,
+    format_explain_plan,
+    get_explain_arg_parser,
+    load_pb_perf_calibration,
+    save_pb_perf_calibration,
+)
 from .file_selector import build_lmcrec_file_chains, chain_to_file_list
+from .file_summary import (
+    SUMMARY_FILE_SUFFIX,
+    LmcrecBloomFilter,
+    LmcrecFileSummary,
+    build_lmcrec_file_summary,
+    get_query_file_filter,
+    load_lmcrec_file_summary,
+    save_lmcrec_file_summary,
+    summarize_lmcrec_file,
+)
+from .fleet import (
+    FLEET_INST_SEP,
+    LmcrecFleetQuery,
+    LmcrecFleetScanState,
+    get_fleet_arg_parser,
+    get_fleet_record_files_dirs,
+    process_fleet_args,
+    tag_fleet_result,
+)
+from .lifecycle import (
+    LIFECYCLE_SUB_DIR,
+    LmcrecLifecycleIndex,
+    LmcrecLifecycleInterval,
+    decode_lmcrec_file_lifecycle,
+    get_lmcrec_lifecycle_index_file,
+    summarize_lifecycle,
+)
 from .lmcrec_query import (
     LmcrecQuery,
     LmcrecQueryResult,
 )
+from .parallel import (
+    PARALLEL_BATCH_SIZE,
+    PARALLEL_SEGMENT_DURATION,
+    LmcrecQueryTask,
+    LmcrecQueryTaskResult,
+    build_query_tasks,
+    iter_query_task,
+    resolve_workers,
+    run_tasks_in_order,
+    split_chain,
+    stream_tasks_in_order,
+)
 from .query_selector import (
     QUERY_FROM_FILE_SUFFIX,
+    QUERY_VAL_QUAL_SEP,
     LmcrecQueryClassResult,
     LmcrecQuerySelector,
     build_query_selectors,
 )
-from .query_state_cache import LmcrecQueryIntervalStateCache
+from .query_state_cache import LmcrecQueryIntervalStateCache, normalize_query_windows
+from .result_cache import (
+    QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    LmcrecQueryResultCache,
+    get_query_result_cache_dir,
+)
+from .service import (
+    QUERY_SERVICE_MAX_SCANS_DEFAULT,
+    QUERY_SERVICE_RESPONSE_CACHE_SIZE_DEFAULT,
+    LmcrecQueryService,
+)
+from .shared_scan import LmcrecSharedScanConsumer, LmcrecSharedScanScheduler
+from .state_snapshot import (
+    STATE_SNAPSHOT_CACHE_MAX_SNAPSHOTS_DEFAULT,
+    LmcrecStateSnapshot,
+    LmcrecStateSnapshotCache,
+)
+from .time_index import (
+    TIME_INDEX_AUTO_REFRESH_INTERVAL_DEFAULT,
+    TIME_INDEX_SUB_DIR,
+    LmcrecTimeIndex,
+    get_lmcrec_time_index_dir,
+    get_time_index_arg_parser,
+    process_time_index_args,
+)
+from .top_k_aggregator import LmcrecQueryTopKAggregator
+from .zone_map import (
+    ZONE_MAP_FILE_SUFFIX,
+    LmcrecZoneMap,
+    LmcrecZoneMapSegment,
+    build_lmcrec_zone_map,
+    get_zone_map_windows,
+    load_lmcrec_zone_map,
+    map_lmcrec_file,
+    save_lmcrec_zone_map,
+    segment_may_match,
+)
@@ -118,6 +118,31 @@ def parse_from_to_ts(
     return from_ts, to_ts
 
 
+# The separator between the from and to specs of a window:
+QUERY_WINDOW_SEP = ","
+
+
+def parse_window_spec(spec: str) -> Tuple[Optional[float], Optional[float]]:
+    """Parse a FROM,TO window specifier
+
+    Args:
+        spec (str):
+            FROM,TO where FROM and TO are the same as for parse_from_to_ts;
+            either may be empty.
+
+    Returns:
+        (float, float): (from, to) timestamps.
+
+    Raises:
+        ValueError for invalid spec
+    """
+
+    from_spec, sep, to_spec = spec.partition(QUERY_WINDOW_SEP)
+    if not sep:
+        raise ValueError(f"{spec!r}: invalid window spec, want FROM,TO")
+    return parse_from_to_ts(from_spec.strip() or None, to_spec.strip() or None)
+
+
 def get_file_selection_arg_parser() -> argparse.ArgumentParser:
     """Return the argument parser with the standard args used for file selection
 
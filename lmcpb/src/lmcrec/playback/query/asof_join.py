@@ -0,0 +1,177 @@
+"""As-of join: align the results of multiple queries in time
+
+Different recorders, e.g. an ADH and its downstream ADS, scan at different
+phases and intervals, so their scans cannot be matched by timestamp. The as-of
+join plays back multiple queries at once, driven by one of them: for each scan
+of the driver it returns the most recent results of the other queries at or
+before the driver timestamp.
+
+The queries are played back in lockstep, each of the other queries reads ahead
+at most one scan, so the memory use is bounded by one pending and one current
+result per query, regardless of the time window.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+
+from .lmcrec_query import LmcrecQuery, LmcrecQueryResult
+from .parallel import copy_query_result
+
+
+@dataclass
+class LmcrecAsOfScan:
+    """The results of a query as of a driver scan"""
+
+    # The timestamp of the scan the results are from, None if there is no
+    # scan at or before the driver timestamp (or within the tolerance):
+    ts: Optional[float] = None
+    result: Optional[LmcrecQueryResult] = None
+
+
+# The callable for run w/ callback, invoked w/ the list of scans, the driver
+# first:
+LmcrecAsOfJoinCallback = Callable[[List[LmcrecAsOfScan]], bool]
+
+
+class _LmcrecAsOfStream:
+    """The read ahead state of a non driver query"""
+
+    def __init__(self, lmcrec_query: LmcrecQuery):
+        self.lmcrec_query = lmcrec_query
+        # The next scan, (ts, result), read but not yet current:
+        self.pending: Optional[Tuple[float, LmcrecQueryResult]] = None
+        self.current = LmcrecAsOfScan()
+        self.ret_code: Optional[LmcrecScanRetCode] = None
+
+    def advance(self, ts: float):
+        """Make current the most recent scan at or before ts"""
+
+        while True:
+            if self.pending is None:
+                if self.ret_code is not None:
+                    return
+                ret_code, next_ts, result = self.lmcrec_query.get_next_results()
+                if ret_code != LmcrecScanRetCode.COMPLETE:
+                    self.ret_code = ret_code
+                    return
+                # The query selectors re-use the result lists, copy the result
+                # since it outlives the next call:
+                self.pending = (next_ts, copy_query_result(result))
+            if self.pending[0] > ts:
+                return
+            self.current = LmcrecAsOfScan(*self.pending)
+            self.pending = None
+
+
+class LmcrecAsOfJoin:
+    """Play back multiple queries, aligned in time w/ the driver one"""
+
+    def __init__(
+        self,
+        driver: LmcrecQuery,
+        *others: LmcrecQuery,
+        tolerance: Optional[float] = None,
+    ):
+        """Build the join
+
+        Args:
+            driver (LmcrecQuery):
+                The query whose scans drive the join.
+
+            others (LmcrecQuery):
+                The queries to be aligned w/ the driver, typically against
+                different record files dirs.
+
+            tolerance (float):
+                If specified, the max age, in seconds, of the results of the
+                other queries relative to the driver scan; older results, e.g.
+                because of a gap in the recording, are reported as None.
+
+        Raises:
+            ValueError
+        """
+
+        if not others:
+            raise ValueError("at least one query to join w/ the driver is needed")
+        if tolerance is not None and tolerance < 0:
+            raise ValueError(f"tolerance={tolerance}: cannot be negative")
+        self.driver = driver
+        self._streams = [_LmcrecAsOfStream(lmcrec_query) for lmcrec_query in others]
+        self.tolerance = tolerance
+
+    def get_next_results(
+        self,
+    ) -> Tuple[LmcrecScanRetCode, Optional[float], Optional[List[LmcrecAsOfScan]]]:
+        """Apply the next driver scan and return the aligned results
+
+        Return: ret_code, ts, scans
+
+            ret_code:
+                LmcrecScanRetCode.COMPLETE: valid ts, scans
+                anything else: the driver ret_code, ts and scans are None
+
+            ts:
+                The driver scan timestamp
+
+            scans:
+                The driver scan first, followed by the as of scans of the other
+                queries, in the order of the latter. The driver result is valid
+                until the next call, the others are copies.
+        """
+
+        ret_code, ts, result = self.driver.get_next_results()
+        if ret_code != LmcrecScanRetCode.COMPLETE:
+            return ret_code, None, None
+        scans = [LmcrecAsOfScan(ts, result)]
+        tolerance = self.tolerance
+        for stream in self._streams:
+            stream.advance(ts)
+            scan = stream.current
+            if (
+                scan.ts is not None
+                and tolerance is not None
+                and ts - scan.ts > tolerance
+            ):
+                scan = LmcrecAsOfScan()
+            scans.append(scan)
+        return ret_code, ts, scans
+
+    @property
+    def ret_codes(self) -> List[Optional[LmcrecScanRetCode]]:
+        """The ret codes of the other queries, None if still playing back"""
+
+        return [stream.ret_code for stream in self._streams]
+
+    def close(self):
+        """Release the resources of all the queries"""
+
+        self.driver.close()
+        for stream in self._streams:
+            stream.lmcrec_query.close()
+            stream.pending = None
+
+    def run_with_callback(
+        self, cb: Optional[LmcrecAsOfJoinCallback]
+    ) -> LmcrecScanRetCode:
+        """Invoke callback in a loop w/ the aligned scans
+
+        Args:
+            cb (Callable[[List[LmcrecAsOfScan]], bool]):
+                Invoked w/ the result of get_next_results until either it
+                returns False or the driver playback ends.
+
+        Returns:
+            The most recent driver LmcrecScanRetCode
+        """
+
+        ret_code = None
+        while True:
+            ret_code, _, scans = self.get_next_results()
+            if ret_code != LmcrecScanRetCode.COMPLETE:
+                break
+            if cb is not None and not cb(scans):
+                break
+        self.close()
+        return ret_code
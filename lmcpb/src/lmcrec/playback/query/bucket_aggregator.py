@@ -0,0 +1,251 @@
+"""Time bucketed aggregation of query results
+
+The query results are aggregated incrementally over fixed time buckets, e.g. 5m,
+such that only one row per bucket per instance is emitted. Each result column
+col generates AGG(col) columns, where AGG is one of:
+
+    last: the most recent value
+    min, max, mean: numerical values only (booleans excluded)
+    sum: the sum, for delta columns (col:d or col:D) only, i.e. the sum of
+         deltas over the bucket
+
+The buckets are aligned to multiples of the bucket duration since the epoch and
+they are identified by their start timestamp.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .lmcrec_query import LmcrecQueryResult
+from .query_selector import (
+    QUERY_VAL_QUAL_SEP,
+    QUERY_VARIABLE_ADJUSTED_DELTA_FLAG,
+    QUERY_VARIABLE_UNADJUSTED_DELTA_FLAG,
+    LmcrecQueryClassResult,
+    var_val_flag_qual_map,
+)
+
+BUCKET_AGG_LAST = "last"
+BUCKET_AGG_MIN = "min"
+BUCKET_AGG_MAX = "max"
+BUCKET_AGG_MEAN = "mean"
+BUCKET_AGG_SUM = "sum"
+
+BUCKET_AGGREGATES = [
+    BUCKET_AGG_LAST,
+    BUCKET_AGG_MIN,
+    BUCKET_AGG_MAX,
+    BUCKET_AGG_MEAN,
+    BUCKET_AGG_SUM,
+]
+
+# Column name suffixes for which sum applies:
+bucket_sum_col_suffixes = tuple(
+    QUERY_VAL_QUAL_SEP + var_val_flag_qual_map[flag]
+    for flag in [
+        QUERY_VARIABLE_ADJUSTED_DELTA_FLAG,
+        QUERY_VARIABLE_UNADJUSTED_DELTA_FLAG,
+    ]
+)
+
+# Per column accumulator indices:
+_ACC_LAST = 0
+_ACC_MIN = 1
+_ACC_MAX = 2
+_ACC_SUM = 3
+_ACC_NUM = 4
+
+
+def parse_bucket_aggregates(spec: Optional[str] = None) -> List[str]:
+    """Parse comma separated list of aggregates
+
+    Returns:
+        List[str]: the aggregates, in BUCKET_AGGREGATES order. If spec is empty
+        then all the aggregates are returned.
+
+    Raises:
+        ValueError for invalid aggregates
+    """
+
+    if not spec:
+        return list(BUCKET_AGGREGATES)
+    aggregates = set()
+    for agg in spec.split(","):
+        agg = agg.strip().lower()
+        if agg not in BUCKET_AGGREGATES:
+            raise ValueError(
+                f"invalid aggregate {agg!r}, want one of {BUCKET_AGGREGATES}"
+            )
+        aggregates.add(agg)
+    return [agg for agg in BUCKET_AGGREGATES if agg in aggregates]
+
+
+def bucket_agg_col_name(agg: str, col_name: str) -> str:
+    return f"{agg}({col_name})"
+
+
+class _ClassAccumulator:
+    """Accumulate bucket data for a (query, class)"""
+
+    def __init__(self):
+        # Column index, in order of discovery:
+        self.col_index: Dict[str, int] = dict()
+        # Per instance accumulators, parallel to the column index:
+        self.acc_by_inst: Dict[str, List[Optional[List[Any]]]] = dict()
+
+    def update(self, class_result: LmcrecQueryClassResult):
+        col_index = self.col_index
+        indices = []
+        for col_name in class_result.var_names:
+            i = col_index.get(col_name)
+            if i is None:
+                i = len(col_index)
+                col_index[col_name] = i
+            indices.append(i)
+        num_cols = len(col_index)
+        acc_by_inst = self.acc_by_inst
+        for inst_name, vals in class_result.vals_by_inst.items():
+            inst_acc = acc_by_inst.get(inst_name)
+            if inst_acc is None:
+                inst_acc = [None] * num_cols
+                acc_by_inst[inst_name] = inst_acc
+            elif len(inst_acc) < num_cols:
+                inst_acc.extend([None] * (num_cols - len(inst_acc)))
+            for i, val in zip(indices, vals):
+                acc = inst_acc[i]
+                if acc is None:
+                    acc = [None, None, None, 0, 0]
+                    inst_acc[i] = acc
+                acc[_ACC_LAST] = val
+                if val is None or isinstance(val, (bool, str)):
+                    continue
+                if acc[_ACC_NUM] == 0:
+                    acc[_ACC_MIN] = val
+                    acc[_ACC_MAX] = val
+                else:
+                    if val < acc[_ACC_MIN]:
+                        acc[_ACC_MIN] = val
+                    if val > acc[_ACC_MAX]:
+                        acc[_ACC_MAX] = val
+                acc[_ACC_SUM] += val
+                acc[_ACC_NUM] += 1
+
+    def result(self, aggregates: List[str]) -> LmcrecQueryClassResult:
+        # Build the list of (accumulator index, aggregate) for the output
+        # columns:
+        out_cols: List[Tuple[int, str]] = []
+        var_names = []
+        for col_name, i in self.col_index.items():
+            for agg in aggregates:
+                if agg == BUCKET_AGG_SUM and not col_name.endswith(
+                    bucket_sum_col_suffixes
+                ):
+                    continue
+                out_cols.append((i, agg))
+                var_names.append(bucket_agg_col_name(agg, col_name))
+        vals_by_inst = dict()
+        for inst_name, inst_acc in self.acc_by_inst.items():
+            vals = [None] * len(out_cols)
+            for k, (i, agg) in enumerate(out_cols):
+                acc = inst_acc[i] if i < len(inst_acc) else None
+                if acc is None:
+                    continue
+                if agg == BUCKET_AGG_LAST:
+                    vals[k] = acc[_ACC_LAST]
+                elif acc[_ACC_NUM] == 0:
+                    continue
+                elif agg == BUCKET_AGG_MIN:
+                    vals[k] = acc[_ACC_MIN]
+                elif agg == BUCKET_AGG_MAX:
+                    vals[k] = acc[_ACC_MAX]
+                elif agg == BUCKET_AGG_MEAN:
+                    vals[k] = acc[_ACC_SUM] / acc[_ACC_NUM]
+                elif agg == BUCKET_AGG_SUM:
+                    vals[k] = acc[_ACC_SUM]
+            vals_by_inst[inst_name] = vals
+        return LmcrecQueryClassResult(var_names=var_names, vals_by_inst=vals_by_inst)
+
+
+class LmcrecQueryBucketAggregator:
+    """Aggregate query results over fixed time buckets"""
+
+    def __init__(
+        self,
+        bucket: float,
+        aggregates: Optional[Iterable[str]] = None,
+    ):
+        """Create the aggregator
+
+        Args:
+            bucket (float):
+                The bucket duration, in seconds, see parse_duration.
+
+            aggregates (Iterable[str]):
+                The aggregates to compute, from BUCKET_AGGREGATES. If not
+                specified then all of them are computed.
+
+        Raises:
+            ValueError for invalid args
+        """
+
+        if bucket is None or bucket <= 0:
+            raise ValueError(f"invalid bucket {bucket!r}, it should be > 0")
+        self._bucket = bucket
+        if aggregates is None:
+            self._aggregates = list(BUCKET_AGGREGATES)
+        elif not aggregates:
+            raise ValueError(f"no aggregates, want one or more of {BUCKET_AGGREGATES}")
+        else:
+            self._aggregates = parse_bucket_aggregates(",".join(aggregates))
+        self._bucket_ts = None
+        self._acc: Dict[str, Dict[str, _ClassAccumulator]] = dict()
+
+    def bucket_start(self, ts: float) -> float:
+        return (ts // self._bucket) * self._bucket
+
+    def update(
+        self, ts: float, result: LmcrecQueryResult
+    ) -> Optional[Tuple[float, LmcrecQueryResult]]:
+        """Apply scan results to the current bucket
+
+        Returns:
+            None if ts belongs to the current bucket, (bucket_ts,
+            bucket_result) for the completed bucket otherwise.
+        """
+
+        completed = None
+        bucket_ts = self.bucket_start(ts)
+        if self._bucket_ts is not None and bucket_ts != self._bucket_ts:
+            completed = self.flush()
+        self._bucket_ts = bucket_ts
+
+        acc = self._acc
+        for query_name, query_result in result.items():
+            query_acc = acc.get(query_name)
+            if query_acc is None:
+                query_acc = dict()
+                acc[query_name] = query_acc
+            for class_name, class_result in query_result.items():
+                class_acc = query_acc.get(class_name)
+                if class_acc is None:
+                    class_acc = _ClassAccumulator()
+                    query_acc[class_name] = class_acc
+                class_acc.update(class_result)
+        return completed
+
+    def flush(self) -> Optional[Tuple[float, LmcrecQueryResult]]:
+        """Return the current bucket, if any, and start a new one"""
+
+        bucket_ts = self._bucket_ts
+        if bucket_ts is None:
+            return None
+        aggregates = self._aggregates
+        result = {
+            query_name: {
+                class_name: class_acc.result(aggregates)
+                for class_name, class_acc in query_acc.items()
+            }
+            for query_name, query_acc in self._acc.items()
+        }
+        self._bucket_ts = None
+        self._acc = dict()
+        return bucket_ts, result
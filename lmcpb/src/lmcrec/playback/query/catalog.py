@@ -0,0 +1,364 @@
+"""Persistent catalog of record files
+
+Building the file chains for a query requires listing every day dir in the
+time range and decoding the .info file of every candidate record file. With
+months worth of files this is a noticeable startup cost, paid by every query.
+
+The catalog keeps the decoded .info files, which include the chain links (the
+previous file name), per day dir, in a JSON file under
+$LMCREC_RUNTIME/catalog by default. It is refreshed incrementally:
+
+    - a day dir is listed again only if its modification time changed
+    - the .info file of a record file is decoded again only if its size or
+      modification time changed; the closed files are not even checked, since
+      they never change
+
+The modification times have a coarse granularity, so a dir or a file modified
+very recently, i.e. less than CATALOG_RACY_INTERVAL_NS ago, may change again
+w/o its modification time changing. Such entries are checked again at the next
+lookup.
+
+The lookup is by time range: only the day dirs in range are refreshed and
+returned, see build_lmcrec_file_chains.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from codec import (
+    GZIP_FILE_SUFFIX,
+    INFO_FILE_SUFFIX,
+    LMCREC_FILE_SUFFIX,
+    LmcrecInfo,
+    LmcrecInfoState,
+    decode_lmcrec_info_from_file,
+)
+from config import get_lmcrec_runtime
+from misc.timeutils import format_ts
+
+CATALOG_SUB_DIR = "catalog"
+CATALOG_FILE_SUFFIX = ".json"
+
+# Bump this up whenever the stored format changes:
+CATALOG_VERSION = 1
+
+CATALOG_VERSION_KEY = "version"
+CATALOG_RECORD_FILES_DIR_KEY = "record_files_dir"
+CATALOG_DIRS_KEY = "dirs"
+CATALOG_DIR_MTIME_KEY = "mtime_ns"
+CATALOG_DIR_FILES_KEY = "files"
+CATALOG_FILE_SIGNATURE_KEY = "signature"
+CATALOG_FILE_INFO_KEY = "info"
+
+CATALOG_RACY_INTERVAL_NS = 2_000_000_000
+
+CATALOG_DAY_DIR_REGEXP = re.compile(r"\d{4}-\d{2}-\d{2}$")
+
+catalog_lmcrec_file_suffixes = [
+    LMCREC_FILE_SUFFIX,
+    LMCREC_FILE_SUFFIX + GZIP_FILE_SUFFIX,
+]
+
+
+def get_record_files_dir_runtime_file(
+    sub_dir: str, record_files_dir: str, suffix: str = CATALOG_FILE_SUFFIX
+) -> str:
+    """Return $LMCREC_RUNTIME/SUB_DIR/DIR-HASH.SUFFIX for a record files dir"""
+
+    record_files_dir = os.path.abspath(record_files_dir)
+    return os.path.join(
+        get_lmcrec_runtime(),
+        sub_dir,
+        re.sub(r"[^a-zA-Z0-9._-]+", "_", os.path.basename(record_files_dir))
+        + "-"
+        + hashlib.sha1(record_files_dir.encode("utf-8")).hexdigest()[:12]
+        + suffix,
+    )
+
+
+def get_lmcrec_catalog_file(record_files_dir: str) -> str:
+    """Return the default catalog file for a top record files dir"""
+
+    return get_record_files_dir_runtime_file(CATALOG_SUB_DIR, record_files_dir)
+
+
+def get_catalog_arg_parser() -> argparse.ArgumentParser:
+    """Return the argument parser with the args used for the catalog
+
+    To be used as a parent to a specific tool parser (see parents arg of
+    ArgumentParser).
+    """
+
+    parser = argparse.ArgumentParser(
+        add_help=False,
+    )
+    parser.add_argument(
+        "-K",
+        "--catalog",
+        metavar="CATALOG_FILE",
+        nargs="?",
+        const="",
+        help=f"""
+        Look up the record files in a persistent catalog, refreshed
+        incrementally, rather than listing the dirs and decoding the .info
+        files every time. Default CATALOG_FILE:
+        $LMCREC_RUNTIME/{CATALOG_SUB_DIR}/DIR-HASH{CATALOG_FILE_SUFFIX}.
+        """,
+    )
+    return parser
+
+
+def process_catalog_args(
+    args: argparse.Namespace, record_files_dir: str
+) -> Optional["LmcrecFileCatalog"]:
+    """Return the catalog based on the args, None if not enabled"""
+
+    if args.catalog is None:
+        return None
+    return LmcrecFileCatalog(record_files_dir, catalog_file=args.catalog or None)
+
+
+def lmcrec_info_to_json(lmcrec_info: LmcrecInfo) -> Dict[str, Any]:
+    info = asdict(lmcrec_info)
+    if lmcrec_info.state is not None:
+        info["state"] = int(lmcrec_info.state)
+    return info
+
+
+def lmcrec_info_from_json(info: Dict[str, Any]) -> LmcrecInfo:
+    lmcrec_info = LmcrecInfo(**info)
+    if lmcrec_info.state is not None:
+        lmcrec_info.state = LmcrecInfoState(lmcrec_info.state)
+    return lmcrec_info
+
+
+class LmcrecFileCatalog:
+    """Persistent catalog of the record files .info, w/ incremental refresh"""
+
+    def __init__(
+        self,
+        record_files_dir: str,
+        catalog_file: Optional[str] = None,
+        save: bool = True,
+    ):
+        """Create the catalog
+
+        Args:
+            record_files_dir (str):
+                Either the top record files dir or one of its sub-dirs; in the
+                latter case the lookup is restricted to that sub-dir.
+
+            catalog_file (str):
+                The file to persist the catalog, default: see
+                get_lmcrec_catalog_file.
+
+            save (bool):
+                Whether to save the catalog after the lookups which changed it.
+        """
+
+        record_files_dir = os.path.abspath(record_files_dir)
+        self._day_dir = None
+        if CATALOG_DAY_DIR_REGEXP.match(os.path.basename(record_files_dir)):
+            self._day_dir = os.path.basename(record_files_dir)
+            record_files_dir = os.path.dirname(record_files_dir)
+        self.record_files_dir = record_files_dir
+        self.catalog_file = (
+            catalog_file
+            if catalog_file is not None
+            else get_lmcrec_catalog_file(record_files_dir)
+        )
+        self._save = save
+        self._lock = threading.Lock()
+        self._dirs: Optional[Dict[str, Dict[str, Any]]] = None
+        # The decoded info, by relative file path, shared across lookups:
+        self._info_by_file: Dict[str, Optional[LmcrecInfo]] = dict()
+        self._dirty = False
+        self.num_dir_lists = 0
+        self.num_info_decodes = 0
+
+    def _load(self):
+        self._dirs = dict()
+        try:
+            with open(self.catalog_file, "rt") as f:
+                catalog = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f"{self.catalog_file}: {e}, ignored", file=sys.stderr)
+            return
+        if (
+            not isinstance(catalog, dict)
+            or catalog.get(CATALOG_VERSION_KEY) != CATALOG_VERSION
+            or catalog.get(CATALOG_RECORD_FILES_DIR_KEY) != self.record_files_dir
+        ):
+            return
+        self._dirs = catalog.get(CATALOG_DIRS_KEY) or dict()
+        for dir_entry in self._dirs.values():
+            for lmcrec_file, file_entry in dir_entry[CATALOG_DIR_FILES_KEY].items():
+                info = file_entry.get(CATALOG_FILE_INFO_KEY)
+                self._info_by_file[lmcrec_file] = (
+                    lmcrec_info_from_json(info) if info is not None else None
+                )
+
+    def save(self):
+        """Save the catalog, atomically"""
+
+        if self._dirs is None:
+            return
+        catalog_dir = os.path.dirname(self.catalog_file)
+        if catalog_dir:
+            os.makedirs(catalog_dir, exist_ok=True)
+        tmp_catalog_file = f"{self.catalog_file}.{os.getpid()}.tmp"
+        with open(tmp_catalog_file, "wt") as f:
+            json.dump(
+                {
+                    CATALOG_VERSION_KEY: CATALOG_VERSION,
+                    CATALOG_RECORD_FILES_DIR_KEY: self.record_files_dir,
+                    CATALOG_DIRS_KEY: self._dirs,
+                },
+                f,
+            )
+        os.replace(tmp_catalog_file, self.catalog_file)
+        self._dirty = False
+
+    def _refresh_file(
+        self, lmcrec_file: str, file_entry: Optional[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        info_file_name = os.path.join(self.record_files_dir, lmcrec_file)
+        info_file_name += INFO_FILE_SUFFIX
+        try:
+            st = os.stat(info_file_name)
+            signature = [st.st_size, st.st_mtime_ns]
+            if time.time_ns() - st.st_mtime_ns < CATALOG_RACY_INTERVAL_NS:
+                signature = None
+        except FileNotFoundError:
+            signature = None
+        if (
+            file_entry is not None
+            and signature is not None
+            and file_entry[CATALOG_FILE_SIGNATURE_KEY] == signature
+        ):
+            return file_entry
+        lmcrec_info = None
+        try:
+            lmcrec_info = decode_lmcrec_info_from_file(info_file_name)
+            self.num_info_decodes += 1
+        except FileNotFoundError as e:
+            print(e, file=sys.stderr)
+        except (ValueError, EOFError) as e:
+            print(f"{info_file_name}: {e}", file=sys.stderr)
+        self._info_by_file[lmcrec_file] = lmcrec_info
+        self._dirty = True
+        return {
+            # Failed decodes and racy files are checked again at the next lookup:
+            CATALOG_FILE_SIGNATURE_KEY: signature if lmcrec_info is not None else None,
+            CATALOG_FILE_INFO_KEY: (
+                lmcrec_info_to_json(lmcrec_info) if lmcrec_info is not None else None
+            ),
+        }
+
+    def _refresh_dir(self, day_dir: str):
+        dir_path = os.path.join(self.record_files_dir, day_dir)
+        dir_entry = self._dirs.get(day_dir)
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        if (
+            dir_entry is None
+            or dir_entry[CATALOG_DIR_MTIME_KEY] is None
+            or dir_entry[CATALOG_DIR_MTIME_KEY] != mtime_ns
+        ):
+            self.num_dir_lists += 1
+            old_files = dir_entry[CATALOG_DIR_FILES_KEY] if dir_entry else {}
+            files = dict()
+            for fname in os.listdir(dir_path):
+                if not any(
+                    fname.endswith(suffix) for suffix in catalog_lmcrec_file_suffixes
+                ):
+                    continue
+                lmcrec_file = os.path.join(day_dir, fname)
+                files[lmcrec_file] = self._refresh_file(
+                    lmcrec_file, old_files.get(lmcrec_file)
+                )
+            for lmcrec_file in old_files:
+                if lmcrec_file not in files:
+                    self._info_by_file.pop(lmcrec_file, None)
+            if time.time_ns() - mtime_ns < CATALOG_RACY_INTERVAL_NS:
+                mtime_ns = None
+            self._dirs[day_dir] = {
+                CATALOG_DIR_MTIME_KEY: mtime_ns,
+                CATALOG_DIR_FILES_KEY: files,
+            }
+            self._dirty = True
+            return
+        files = dir_entry[CATALOG_DIR_FILES_KEY]
+        for lmcrec_file, file_entry in files.items():
+            lmcrec_info = self._info_by_file.get(lmcrec_file)
+            if (
+                lmcrec_info is None
+                or lmcrec_info.state != LmcrecInfoState.CLOSED
+                or file_entry[CATALOG_FILE_SIGNATURE_KEY] is None
+            ):
+                files[lmcrec_file] = self._refresh_file(lmcrec_file, file_entry)
+
+    def lookup(
+        self,
+        from_ts: Optional[float] = None,
+        to_ts: Optional[float] = None,
+    ) -> List[Tuple[str, LmcrecInfo]]:
+        """Return the record files in the day dirs overlapping the time range
+
+        Args:
+            from_ts, to_ts (float): the time range, None for open ended
+
+        Returns:
+            list: of (lmcrec_file, LmcrecInfo), where lmcrec_file is relative
+            to the top record files dir, i.e. DAY_DIR/FILE.
+
+        """
+
+        from_yyyy_mm_dd = format_ts(from_ts)[:10] if from_ts is not None else None
+        to_yyyy_mm_dd = format_ts(to_ts)[:10] if to_ts is not None else None
+
+        with self._lock:
+            if self._dirs is None:
+                self._load()
+            if self._day_dir is not None:
+                day_dirs = [self._day_dir]
+            else:
+                day_dirs = [
+                    fname
+                    for fname in os.listdir(self.record_files_dir)
+                    if CATALOG_DAY_DIR_REGEXP.match(fname)
+                    and os.path.isdir(os.path.join(self.record_files_dir, fname))
+                ]
+                # Forget the dirs which were removed:
+                for day_dir in set(self._dirs) - set(day_dirs):
+                    for lmcrec_file in self._dirs.pop(day_dir)[CATALOG_DIR_FILES_KEY]:
+                        self._info_by_file.pop(lmcrec_file, None)
+                    self._dirty = True
+            lmcrec_files = []
+            for day_dir in sorted(day_dirs):
+                # Mirror build_lmcrec_file_chains: a sub-dir is taken as is:
+                if self._day_dir is None and (
+                    (from_yyyy_mm_dd is not None and day_dir < from_yyyy_mm_dd)
+                    or (to_yyyy_mm_dd is not None and to_yyyy_mm_dd < day_dir)
+                ):
+                    continue
+                self._refresh_dir(day_dir)
+                for lmcrec_file in self._dirs[day_dir][CATALOG_DIR_FILES_KEY]:
+                    lmcrec_info = self._info_by_file.get(lmcrec_file)
+                    if lmcrec_info is not None:
+                        lmcrec_files.append((lmcrec_file, lmcrec_info))
+            if self._dirty and self._save:
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"{self.catalog_file}: {e}", file=sys.stderr)
+        return lmcrec_files
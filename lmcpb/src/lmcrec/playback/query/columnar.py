@@ -0,0 +1,209 @@
+"""Columnar batches built from query results
+
+The query results are delivered one scan at a time as nested dicts of
+LmcrecQueryClassResult. For analysis it is more convenient to have them as
+columnar batches: timestamp, instance and one column per var name. The batches
+are built on a per (query, class) basis and they are flushed when they reach the
+batch size, so the memory usage is bounded.
+
+The batches may be delivered as plain columns (dict of lists), pandas DataFrame
+or pyarrow RecordBatch, the latter two require the optional `columnar`
+dependencies, e.g. `pip install lmcrec[columnar]`.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+
+from .lmcrec_query import LmcrecQuery, LmcrecQueryResult
+
+# Column names for the timestamp and instance:
+COLUMNAR_TIMESTAMP_COL = "timestamp"
+COLUMNAR_INSTANCE_COL = "instance"
+
+# Output formats:
+COLUMNAR_FORMAT_COLUMNS = "columns"
+COLUMNAR_FORMAT_PANDAS = "pandas"
+COLUMNAR_FORMAT_ARROW = "arrow"
+
+COLUMNAR_FORMATS = [
+    COLUMNAR_FORMAT_COLUMNS,
+    COLUMNAR_FORMAT_PANDAS,
+    COLUMNAR_FORMAT_ARROW,
+]
+
+COLUMNAR_BATCH_SIZE_DEFAULT = 65536
+
+
+@dataclass
+class LmcrecQueryColumnarBatch:
+    """A batch of rows for a given query and class"""
+
+    query_name: Optional[str] = None
+    class_name: Optional[str] = None
+    # The column names, in order:
+    col_names: List[str] = field(default_factory=list)
+    # The format specific data: Dict[str, List[Any]] for columns,
+    # pandas.DataFrame or pyarrow.RecordBatch:
+    data: Any = None
+    num_rows: int = 0
+
+
+class _ColumnarBuffer:
+    """Row accumulator for a (query, class) pair"""
+
+    def __init__(self, var_names: List[str]):
+        self.var_names = var_names
+        self.ts_col: List[float] = []
+        self.inst_col: List[str] = []
+        self.var_cols: List[List[Any]] = [[] for _ in var_names]
+
+    def __len__(self) -> int:
+        return len(self.ts_col)
+
+
+def _import_optional(module_name: str, output_format: str) -> Any:
+    try:
+        return __import__(module_name)
+    except ImportError as e:
+        raise RuntimeError(
+            f"{output_format!r} format requires {module_name!r}, "
+            "install the optional dependencies: pip install 'lmcrec[columnar]'"
+        ) from e
+
+
+class LmcrecQueryColumnarBuilder:
+    """Collect query results into columnar batches"""
+
+    def __init__(
+        self,
+        batch_size: int = COLUMNAR_BATCH_SIZE_DEFAULT,
+        output_format: str = COLUMNAR_FORMAT_COLUMNS,
+    ):
+        """Create the builder
+
+        Args:
+            batch_size (int):
+                The max number of rows per batch. If <= 0 then the batch is
+                unbounded and it will be delivered only at flush, use with
+                caution.
+
+            output_format (str):
+                One of COLUMNAR_FORMATS.
+
+        Raises:
+            ValueError for invalid format
+            RuntimeError if the format requires a missing optional dependency
+        """
+
+        if output_format not in COLUMNAR_FORMATS:
+            raise ValueError(
+                f"invalid output format {output_format!r}, want one of {COLUMNAR_FORMATS}"
+            )
+        self._batch_size = batch_size
+        self._output_format = output_format
+        # Validate the optional dependencies upfront rather than after the
+        # query ran for a while:
+        self._pd, self._pa = None, None
+        if output_format == COLUMNAR_FORMAT_PANDAS:
+            self._pd = _import_optional("pandas", output_format)
+        elif output_format == COLUMNAR_FORMAT_ARROW:
+            self._pa = _import_optional("pyarrow", output_format)
+        self._buffers: Dict[Tuple[str, str], _ColumnarBuffer] = dict()
+        self.ret_code = None
+
+    def _make_batch(
+        self, query_name: str, class_name: str, buf: _ColumnarBuffer
+    ) -> LmcrecQueryColumnarBatch:
+        col_names = [COLUMNAR_TIMESTAMP_COL, COLUMNAR_INSTANCE_COL] + buf.var_names
+        cols = [buf.ts_col, buf.inst_col] + buf.var_cols
+        output_format = self._output_format
+        if output_format == COLUMNAR_FORMAT_PANDAS:
+            pd = self._pd
+            data = pd.DataFrame(dict(zip(col_names, cols)), columns=col_names)
+            data[COLUMNAR_TIMESTAMP_COL] = pd.to_datetime(
+                data[COLUMNAR_TIMESTAMP_COL], unit="s", utc=True
+            )
+        elif output_format == COLUMNAR_FORMAT_ARROW:
+            pa = self._pa
+            arrays = [
+                pa.array(
+                    [int(ts * 1_000_000) for ts in buf.ts_col],
+                    type=pa.timestamp("us", tz="UTC"),
+                )
+            ] + [pa.array(col) for col in cols[1:]]
+            data = pa.RecordBatch.from_arrays(arrays, names=col_names)
+        else:
+            data = dict(zip(col_names, cols))
+        return LmcrecQueryColumnarBatch(
+            query_name=query_name,
+            class_name=class_name,
+            col_names=col_names,
+            data=data,
+            num_rows=len(buf),
+        )
+
+    def add(
+        self, ts: float, result: LmcrecQueryResult
+    ) -> List[LmcrecQueryColumnarBatch]:
+        """Add the results of a scan and return the completed batches, if any"""
+
+        batches = []
+        batch_size = self._batch_size
+        buffers = self._buffers
+        for query_name, query_result in result.items():
+            for class_name, class_result in query_result.items():
+                key = (query_name, class_name)
+                var_names = class_result.var_names
+                buf = buffers.get(key)
+                if buf is not None and buf.var_names != var_names:
+                    # Class definition changed, the columns no longer match:
+                    if len(buf) > 0:
+                        batches.append(self._make_batch(query_name, class_name, buf))
+                    buf = None
+                if buf is None:
+                    buf = _ColumnarBuffer(list(var_names))
+                    buffers[key] = buf
+                ts_col, inst_col, var_cols = buf.ts_col, buf.inst_col, buf.var_cols
+                for inst_name, vals in class_result.vals_by_inst.items():
+                    ts_col.append(ts)
+                    inst_col.append(inst_name)
+                    for col, val in zip(var_cols, vals):
+                        col.append(val)
+                    if batch_size > 0 and len(ts_col) >= batch_size:
+                        batches.append(self._make_batch(query_name, class_name, buf))
+                        buf = _ColumnarBuffer(buf.var_names)
+                        buffers[key] = buf
+                        ts_col, inst_col, var_cols = (
+                            buf.ts_col,
+                            buf.inst_col,
+                            buf.var_cols,
+                        )
+        return batches
+
+    def flush(self) -> List[LmcrecQueryColumnarBatch]:
+        """Return the pending, incomplete, batches"""
+
+        batches = [
+            self._make_batch(query_name, class_name, buf)
+            for (query_name, class_name), buf in self._buffers.items()
+            if len(buf) > 0
+        ]
+        self._buffers = dict()
+        return batches
+
+    def build(self, lmcrec_query: LmcrecQuery) -> Iterator[LmcrecQueryColumnarBatch]:
+        """Run the query and yield the batches as they are completed
+
+        The most recent LmcrecScanRetCode is available as .ret_code after the
+        iteration is exhausted.
+        """
+
+        while True:
+            ret_code, ts, result = lmcrec_query.get_next_results()
+            if ret_code != LmcrecScanRetCode.COMPLETE:
+                break
+            yield from self.add(ts, result)
+        self.ret_code = ret_code
+        yield from self.flush()
@@ -0,0 +1,363 @@
+"""Query cost estimator, see the --explain option of lmcrec-query and lmcrec-export
+
+The cost of a query is dominated by the decoding of the record files, which is
+proportional to the number of bytes replayed. The estimate is based solely on
+the metadata, i.e. no record data is decoded:
+
+    - the file chains, see build_lmcrec_file_chains
+    - the .info file totals and the file sizes
+    - the .index checkpoints, which determine where the replay starts
+
+The decode bytes and scans for a file are prorated on the fraction of the file
+time span that is replayed, from the checkpoint at or before from_ts (or the
+start of the file) up to to_ts (or the most recent scan). The time estimate is
+based on the decode speed, as measured by lmcrec-pb-perf --save-calibration.
+"""
+
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from codec import LmcrecIndexCache, LmcrecInfoCache, locate_checkpoint
+from config import get_lmcrec_runtime
+from misc.timeutils import format_ts
+from tabulate import SEPARATING_LINE, tabulate
+
+from .catalog import LmcrecFileCatalog
+from .file_selector import build_lmcrec_file_chains
+
+# Should match the lmcrec/**/*.go default:
+EXPLAIN_SCAN_INTERVAL_DEFAULT = 5.0
+
+PB_PERF_CALIBRATION_FILE = "pb-perf-calibration.json"
+PB_PERF_CALIBRATION_SPEED_KEY = "speed_kb_sec"
+PB_PERF_CALIBRATION_HAVE_PREV_KEY = "have_prev"
+PB_PERF_CALIBRATION_TS_KEY = "ts"
+
+
+def get_pb_perf_calibration_file() -> str:
+    return os.path.join(get_lmcrec_runtime(), PB_PERF_CALIBRATION_FILE)
+
+
+def save_pb_perf_calibration(
+    speed_kb_sec: float,
+    have_prev: bool = False,
+    calibration_file: Optional[str] = None,
+) -> str:
+    """Save the decode speed measured by lmcrec-pb-perf
+
+    Returns:
+        str: the path of the calibration file
+    """
+
+    if calibration_file is None:
+        calibration_file = get_pb_perf_calibration_file()
+    calibration_dir = os.path.dirname(calibration_file)
+    if calibration_dir:
+        os.makedirs(calibration_dir, exist_ok=True)
+    with open(calibration_file, "wt") as f:
+        json.dump(
+            {
+                PB_PERF_CALIBRATION_SPEED_KEY: speed_kb_sec,
+                PB_PERF_CALIBRATION_HAVE_PREV_KEY: have_prev,
+                PB_PERF_CALIBRATION_TS_KEY: time.time(),
+            },
+            f,
+        )
+        f.write("\n")
+    return calibration_file
+
+
+def load_pb_perf_calibration(
+    calibration_file: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Load the decode speed saved by lmcrec-pb-perf, None if not available"""
+
+    if calibration_file is None:
+        calibration_file = get_pb_perf_calibration_file()
+    try:
+        with open(calibration_file, "rt") as f:
+            calibration = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not isinstance(calibration, dict) or not isinstance(
+        calibration.get(PB_PERF_CALIBRATION_SPEED_KEY), (int, float)
+    ):
+        return None
+    return calibration
+
+
+@dataclass
+class LmcrecExplainFile:
+    """The replay estimate for a record file"""
+
+    chain_index: int
+    file_name: str
+    state: str
+    file_size: int
+    start_ts: float
+    most_recent_ts: float
+    # The replay starting point, the checkpoint offset is None if the replay
+    # starts at the beginning of the file:
+    replay_from_ts: float
+    replay_to_ts: float
+    checkpoint_offset: Optional[int]
+    # The fraction of the file time span that is replayed:
+    fraction: float
+    est_decode_bytes: int
+    est_scans: int
+    est_in_bytes: int
+    est_out_vars: int
+
+
+@dataclass
+class LmcrecExplainPlan:
+    """The cost estimate for a query"""
+
+    from_ts: Optional[float] = None
+    to_ts: Optional[float] = None
+    num_chains: int = 0
+    files: List[LmcrecExplainFile] = field(default_factory=list)
+    # The decode speed, kB/sec, None if unknown:
+    decode_speed: Optional[float] = None
+
+    @property
+    def est_decode_bytes(self) -> int:
+        return sum(f.est_decode_bytes for f in self.files)
+
+    @property
+    def est_scans(self) -> int:
+        return sum(f.est_scans for f in self.files)
+
+    @property
+    def est_time(self) -> Optional[float]:
+        if not self.decode_speed:
+            return None
+        return self.est_decode_bytes / 1000 / self.decode_speed
+
+
+def get_explain_arg_parser() -> argparse.ArgumentParser:
+    """Return the argument parser with the args used for the explain mode
+
+    To be used as a parent to a specific tool parser (see parents arg of
+    ArgumentParser).
+    """
+
+    parser = argparse.ArgumentParser(
+        add_help=False,
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help=f"""
+        Do not run, display instead the files and chains that would be replayed,
+        the replay start offsets and the estimated decode bytes, scans and time.
+        No record data is decoded. The time estimate is based on the decode
+        speed saved by lmcrec-pb-perf --save-calibration, under
+        $LMCREC_RUNTIME/{PB_PERF_CALIBRATION_FILE}.
+        """,
+    )
+    parser.add_argument(
+        "--decode-speed",
+        metavar="KB_PER_SEC",
+        type=float,
+        help="""
+        Use this decode speed for the --explain time estimate, instead of the
+        calibrated one.
+        """,
+    )
+    return parser
+
+
+def explain_query(
+    record_files_dir: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    scan_interval: float = EXPLAIN_SCAN_INTERVAL_DEFAULT,
+    decode_speed: Optional[float] = None,
+    info_cache: Optional[LmcrecInfoCache] = None,
+    index_cache: Optional[LmcrecIndexCache] = None,
+    catalog: Optional[LmcrecFileCatalog] = None,
+) -> LmcrecExplainPlan:
+    """Estimate the cost of a query w/o decoding any record data
+
+    Args:
+        record_files_dir (str):
+            Either the top record files dir or one of its sub-dirs.
+
+        from_ts, to_ts (float):
+            The time window, see LmcrecQueryIntervalStateCache.
+
+        scan_interval (float):
+            The recorder scan interval, used for estimating the number of scans.
+
+        decode_speed (float):
+            The decode speed, in kB/sec, used for the time estimate. If None
+            then the lmcrec-pb-perf calibration is used, if available.
+
+        info_cache (LmcrecInfoCache), index_cache (LmcrecIndexCache):
+            Optional caches, see build_lmcrec_file_chains and locate_checkpoint.
+
+        catalog (LmcrecFileCatalog):
+            Optional persistent catalog, see build_lmcrec_file_chains.
+
+    Returns:
+        LmcrecExplainPlan
+    """
+
+    if decode_speed is None:
+        calibration = load_pb_perf_calibration()
+        if calibration is not None:
+            decode_speed = calibration[PB_PERF_CALIBRATION_SPEED_KEY]
+    plan = LmcrecExplainPlan(from_ts=from_ts, to_ts=to_ts, decode_speed=decode_speed)
+    chain_list = build_lmcrec_file_chains(
+        record_files_dir,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        info_cache=info_cache,
+        catalog=catalog,
+    )
+    # Mirror the playback: only the first file is replayed from a checkpoint,
+    # the subsequent ones are replayed from the beginning:
+    check_from_ts = from_ts is not None
+    for chain_index, entry in enumerate(chain_list or []):
+        plan.num_chains += 1
+        while entry is not None:
+            lmcrec_info = entry.lmcrec_info
+            start_ts, most_recent_ts = lmcrec_info.start_ts, lmcrec_info.most_recent_ts
+            replay_from_ts, chkpt_off = start_ts, None
+            if check_from_ts:
+                check_from_ts = False
+                try:
+                    chkpt_ts, chkpt_off = locate_checkpoint(
+                        entry.file_name, from_ts, index_cache=index_cache
+                    )
+                except FileNotFoundError:
+                    chkpt_ts, chkpt_off = None, None
+                if chkpt_off is not None:
+                    replay_from_ts = chkpt_ts
+            replay_to_ts = most_recent_ts
+            if to_ts is not None and to_ts < replay_to_ts:
+                replay_to_ts = to_ts
+            time_span = most_recent_ts - start_ts
+            if time_span > 0:
+                fraction = (replay_to_ts - replay_from_ts) / time_span
+                fraction = min(max(fraction, 0.0), 1.0)
+            else:
+                fraction = 1.0
+            try:
+                file_size = os.stat(entry.file_name).st_size
+            except FileNotFoundError:
+                file_size = 0
+            est_decode_bytes = int(file_size * fraction)
+            if chkpt_off is not None:
+                # The replay cannot go past the end of the file:
+                est_decode_bytes = min(est_decode_bytes, file_size - chkpt_off)
+            plan.files.append(
+                LmcrecExplainFile(
+                    chain_index=chain_index,
+                    file_name=entry.file_name,
+                    state=lmcrec_info.state.name,
+                    file_size=file_size,
+                    start_ts=start_ts,
+                    most_recent_ts=most_recent_ts,
+                    replay_from_ts=replay_from_ts,
+                    replay_to_ts=replay_to_ts,
+                    checkpoint_offset=chkpt_off,
+                    fraction=fraction,
+                    est_decode_bytes=est_decode_bytes,
+                    est_scans=(
+                        int(max(replay_to_ts - replay_from_ts, 0) / scan_interval) + 1
+                        if scan_interval > 0
+                        else 0
+                    ),
+                    est_in_bytes=int(lmcrec_info.total_in_num_bytes * fraction),
+                    est_out_vars=int(lmcrec_info.total_out_num_var * fraction),
+                )
+            )
+            entry = entry.next
+    return plan
+
+
+def format_explain_plan(
+    plan: LmcrecExplainPlan, record_files_dir: Optional[str] = None
+) -> str:
+    """Format the plan as a table, followed by the totals
+
+    Args:
+        plan (LmcrecExplainPlan): the plan to format
+
+        record_files_dir (str):
+            If provided, then the file names are displayed relative to it.
+    """
+
+    rows = []
+    for f in plan.files:
+        file_name = f.file_name
+        if record_files_dir is not None:
+            file_name = os.path.relpath(file_name, os.path.abspath(record_files_dir))
+        rows.append(
+            (
+                f.chain_index,
+                file_name,
+                f.state,
+                f"{f.file_size/1000:.01f}",
+                format_ts(f.replay_from_ts),
+                format_ts(f.replay_to_ts),
+                f"+{f.checkpoint_offset}" if f.checkpoint_offset is not None else "-",
+                f"{f.est_decode_bytes/1000:.01f}",
+                f.est_scans,
+                f.est_out_vars,
+            )
+        )
+    if rows:
+        rows.append(SEPARATING_LINE)
+    rows.append(
+        (
+            "Total",
+            f"{len(plan.files)} file(s)",
+            "",
+            f"{sum(f.file_size for f in plan.files)/1000:.01f}",
+            "",
+            "",
+            "",
+            f"{plan.est_decode_bytes/1000:.01f}",
+            plan.est_scans,
+            sum(f.est_out_vars for f in plan.files),
+        )
+    )
+    lines = [
+        f"From: {format_ts(plan.from_ts) if plan.from_ts is not None else 'oldest'}",
+        f"To: {format_ts(plan.to_ts) if plan.to_ts is not None else 'newest'}",
+        f"Chains: {plan.num_chains}",
+        "",
+        tabulate(
+            rows,
+            headers=[
+                "Chain#",
+                "File",
+                "State",
+                "Size (kB)",
+                "Replay From",
+                "Replay To",
+                "Offset",
+                "Decode (kB)",
+                "Scans",
+                "Vars",
+            ],
+        ),
+        "",
+    ]
+    est_time = plan.est_time
+    if est_time is not None:
+        lines.append(
+            f"Estimated time: {est_time:.03f} sec @ {plan.decode_speed:.02f} kB/sec"
+        )
+    else:
+        lines.append(
+            "Estimated time: unknown, run lmcrec-pb-perf --save-calibration first"
+        )
+    return "\n".join(lines)
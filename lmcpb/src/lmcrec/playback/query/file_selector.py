@@ -3,20 +3,47 @@
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
 
 from codec import (
     GZIP_FILE_SUFFIX,
     INFO_FILE_SUFFIX,
     LMCREC_FILE_SUFFIX,
     LmcrecInfo,
+    LmcrecInfoCache,
     decode_lmcrec_info_from_file,
 )
 from misc.timeutils import format_ts
 
+from .catalog import LmcrecFileCatalog
+
 lmcrec_file_suffixes = [LMCREC_FILE_SUFFIX, LMCREC_FILE_SUFFIX + GZIP_FILE_SUFFIX]
 
+# The .info files are small and independent, loading them is bound by the file
+# system latency (e.g. NFS) rather than by the CPU, so they are loaded by a
+# thread pool:
+INFO_LOAD_WORKERS_DEFAULT = 8
+# Below this number of files the thread pool is not worth it:
+INFO_LOAD_PARALLEL_MIN_FILES = 4
+
+# The record files are named after their creation time, i.e.
+# yyyy-mm-dd/HH:MM:SS±HH:MM.lmcrec, see lmcrec/recorder/recorder.go:
+LMCREC_FILE_NAME_TS_REGEXP = re.compile(
+    r"(\d{4}-\d{2}-\d{2})/(\d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2})"
+    + re.escape(LMCREC_FILE_SUFFIX)
+    + f"({re.escape(GZIP_FILE_SUFFIX)})?$"
+)
+# The resolution of the timestamp in the file name:
+LMCREC_FILE_NAME_TS_RESOLUTION = 1
+
+
+# (file path, info) -> whether the file should be kept, see
+# build_lmcrec_file_chains:
+LmcrecFileFilter = Callable[[str, LmcrecInfo], bool]
+
 
 @dataclass
 class LmcrecFileEntry:
@@ -30,6 +57,10 @@ def build_lmcrec_file_chains(
     record_files_dir: str,
     from_ts: Optional[float] = None,
     to_ts: Optional[float] = None,
+    info_cache: Optional[LmcrecInfoCache] = None,
+    catalog: Optional[LmcrecFileCatalog] = None,
+    info_workers: Optional[int] = INFO_LOAD_WORKERS_DEFAULT,
+    file_filter: Optional[LmcrecFileFilter] = None,
 ) -> Optional[List[LmcrecFileEntry]]:
     """Build the list of lmcrec chains for the given dir and time window
 
@@ -46,6 +77,26 @@ def build_lmcrec_file_chains(
             The start of the timestamp window. If None then consider files up to
             the most recent available.
 
+        info_cache (LmcrecInfoCache):
+            If provided then look up the .info files in the cache rather than
+            decoding them; the cache is maintained by long running processes.
+
+        catalog (LmcrecFileCatalog):
+            If provided then look up the files and their .info in the
+            persistent catalog rather than listing the dirs and decoding them.
+            The catalog is bound to its own record files dir, which supersedes
+            record_files_dir.
+
+        info_workers (int):
+            The number of threads loading the .info files, None or <= 1 to
+            load them sequentially, see load_lmcrec_info_list.
+
+        file_filter (Callable[[str, LmcrecInfo], bool]):
+            If provided then it is invoked w/ the path and the info of each
+            file intersecting the time window and the files for which it
+            returns False are left out; the file following such a file in its
+            chain becomes the head of a new chain.
+
     Returns:
         list: of LmcrecFileEntry chains, sorted chronologically. A new LmcrecStateCache
         has to be created at the beginning of each chain and the files in the
@@ -58,6 +109,18 @@ def build_lmcrec_file_chains(
 
     """
 
+    if catalog is not None:
+        lmcrec_info_list = catalog.lookup(from_ts=from_ts, to_ts=to_ts)
+        if not lmcrec_info_list:
+            return None
+        return link_lmcrec_file_chains(
+            catalog.record_files_dir,
+            lmcrec_info_list,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            file_filter=file_filter,
+        )
+
     record_files_dir = os.path.abspath(record_files_dir)
 
     def yyyy_mm_dd_from_ts(ts: Optional[float]) -> Optional[str]:
@@ -115,9 +178,171 @@ def build_lmcrec_file_chains(
         return None
 
     # At this point record_files_dir is the true top dir and lmcrec_file_list
-    # holds subdir/lmcrec paths. Iterate through the list, keep only the
-    # files that intersect with the time window and place them in the
-    # appropriate chain.
+    # holds subdir/lmcrec paths.
+    lmcrec_file_list = prune_lmcrec_files_by_name(
+        lmcrec_file_list, from_ts=from_ts, to_ts=to_ts
+    )
+    if not lmcrec_file_list:
+        return None
+    lmcrec_info_list = load_lmcrec_info_list(
+        record_files_dir,
+        lmcrec_file_list,
+        info_cache=info_cache,
+        workers=info_workers,
+    )
+
+    return link_lmcrec_file_chains(
+        record_files_dir,
+        lmcrec_info_list,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        file_filter=file_filter,
+    )
+
+
+def lmcrec_file_name_ts(lmcrec_file: str) -> Optional[float]:
+    """Return the creation time encoded in the record file name
+
+    Args:
+        lmcrec_file (str): the yyyy-mm-dd/HH:MM:SS±HH:MM.lmcrec[.gz] path
+
+    Returns:
+        float: the timestamp or None if the name does not follow the convention
+    """
+
+    m = LMCREC_FILE_NAME_TS_REGEXP.search(lmcrec_file)
+    if m is None:
+        return None
+    try:
+        return datetime.fromisoformat(f"{m.group(1)}T{m.group(2)}").timestamp()
+    except ValueError:
+        return None
+
+
+def prune_lmcrec_files_by_name(
+    lmcrec_file_list: List[str],
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> List[str]:
+    """Discard the files outside the time window, based on their names only
+
+    A file is created before its first scan, so it cannot intersect the window
+    if it was created after to_ts. The files do not overlap in time (see the
+    sanity check in link_lmcrec_file_chains), so a file ends before the creation
+    of any subsequent file; if the latter was created before from_ts then the
+    former cannot intersect the window. The files whose names do not follow the
+    convention are kept, they are decided upon based on their .info.
+
+    Args:
+        lmcrec_file_list (list): subdir/lmcrec paths
+
+        from_ts, to_ts (float): the time window, None for open ended
+
+    Returns:
+        list: the remaining files, in the original order
+    """
+
+    if from_ts is None and to_ts is None:
+        return lmcrec_file_list
+
+    ts_by_file = {
+        lmcrec_file: lmcrec_file_name_ts(lmcrec_file)
+        for lmcrec_file in lmcrec_file_list
+    }
+    # The most recent creation time which is guaranteed to be before from_ts:
+    cutoff_ts = None
+    if from_ts is not None:
+        cutoff_ts = max(
+            (
+                ts
+                for ts in ts_by_file.values()
+                if ts is not None and ts + LMCREC_FILE_NAME_TS_RESOLUTION <= from_ts
+            ),
+            default=None,
+        )
+    return [
+        lmcrec_file
+        for lmcrec_file, ts in ts_by_file.items()
+        if ts is None
+        or ((cutoff_ts is None or ts >= cutoff_ts) and (to_ts is None or ts <= to_ts))
+    ]
+
+
+def load_lmcrec_info_list(
+    record_files_dir: str,
+    lmcrec_file_list: List[str],
+    info_cache: Optional[LmcrecInfoCache] = None,
+    workers: Optional[int] = INFO_LOAD_WORKERS_DEFAULT,
+) -> List[Tuple[str, Optional[LmcrecInfo]]]:
+    """Load the .info files, in parallel if so requested
+
+    Args:
+        record_files_dir (str): the top record files dir
+
+        lmcrec_file_list (list): subdir/lmcrec paths
+
+        info_cache (LmcrecInfoCache):
+            If provided then look up the .info files in the cache rather than
+            decoding them.
+
+        workers (int):
+            The number of threads, None or <= 1 to load the files sequentially.
+
+    Returns:
+        list: of (subdir/lmcrec path, LmcrecInfo), in the same order as
+        lmcrec_file_list. The info is None for the files which could not be
+        loaded; the errors are reported in the same order, regardless of the
+        loading order.
+    """
+
+    def load(lmcrec_file: str) -> Tuple[Optional[LmcrecInfo], Optional[str]]:
+        info_file_name = os.path.join(record_files_dir, lmcrec_file) + INFO_FILE_SUFFIX
+        try:
+            if info_cache is not None:
+                return info_cache.get(info_file_name), None
+            return decode_lmcrec_info_from_file(info_file_name), None
+        except FileNotFoundError as e:
+            return None, str(e)
+        except (ValueError, EOFError) as e:
+            return None, f"{info_file_name}: {e}"
+
+    if (
+        workers is not None
+        and workers > 1
+        and len(lmcrec_file_list) >= INFO_LOAD_PARALLEL_MIN_FILES
+    ):
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(lmcrec_file_list))
+        ) as executor:
+            results = list(executor.map(load, lmcrec_file_list))
+    else:
+        results = [load(lmcrec_file) for lmcrec_file in lmcrec_file_list]
+
+    lmcrec_info_list = []
+    for lmcrec_file, (lmcrec_info, err) in zip(lmcrec_file_list, results):
+        if err is not None:
+            print(err, file=sys.stderr)
+        lmcrec_info_list.append((lmcrec_file, lmcrec_info))
+    return lmcrec_info_list
+
+
+def link_lmcrec_file_chains(
+    record_files_dir: str,
+    lmcrec_info_list: List[Tuple[str, Optional[LmcrecInfo]]],
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    file_filter: Optional[LmcrecFileFilter] = None,
+) -> List[LmcrecFileEntry]:
+    """Build the chains from the list of (subdir/lmcrec path, info)
+
+    Keep only the files that intersect with the time window and pass the
+    optional file_filter and place them in the appropriate chain, see
+    build_lmcrec_file_chains.
+
+    Raises:
+        RuntimeError
+    """
+
     lmcrec_file_entry: Dict[str, LmcrecFileEntry] = dict()
 
     # The files are in the listdir order, which is not necessarily the
@@ -126,16 +351,8 @@ def build_lmcrec_file_chains(
     # should, should be the former's entry.
     lmcrec_next_file_entry: Dict[str, LmcrecFileEntry] = dict()
 
-    for lmcrec_file in lmcrec_file_list:
+    for lmcrec_file, lmcrec_info in lmcrec_info_list:
         file_name = os.path.join(record_files_dir, lmcrec_file)
-        info_file_name = file_name + INFO_FILE_SUFFIX
-        lmcrec_info = None
-        try:
-            lmcrec_info = decode_lmcrec_info_from_file(info_file_name)
-        except FileNotFoundError as e:
-            print(e, file=sys.stderr)
-        except (ValueError, EOFError) as e:
-            print(f"{info_file_name}: {e}", file=sys.stderr)
         if (
             lmcrec_info is None
             or from_ts is not None
@@ -144,6 +361,8 @@ def build_lmcrec_file_chains(
             and lmcrec_info.start_ts > to_ts
         ):
             continue
+        if file_filter is not None and not file_filter(file_name, lmcrec_info):
+            continue
 
         entry = LmcrecFileEntry(
             file_name=file_name,
@@ -0,0 +1,329 @@
+"""Per record file content summaries, used for pruning files w/o decoding them
+
+A query for specific classes and/or instances still has to replay every file in
+the time window, even those recorded before the instances existed. A summary
+sidecar, FILE.lmcrec[.gz].summary, holds:
+
+    - the classes w/ instances in the file, w/ their first and last seen
+      timestamps
+    - a bloom filter of the instance names
+
+such that the files which cannot match a query can be skipped. The summaries
+are created by lmcrec-summarize, only for closed files, and they are validated
+against the size and modification time of the record file.
+
+The files are skipped by leaving them out of the chains, see
+build_lmcrec_file_chains file_filter arg; the file following a skipped one
+starts a new chain.
+"""
+
+import base64
+import hashlib
+import json
+import math
+import os
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode, LmcrecStateCache
+from codec import LmcrecFileDecoder, LmcrecInfo, LmcrecInfoState
+
+from .query_selector import LmcrecQuerySelector
+
+SUMMARY_FILE_SUFFIX = ".summary"
+
+# Bump this up whenever the stored format changes:
+SUMMARY_VERSION = 1
+
+SUMMARY_VERSION_KEY = "version"
+SUMMARY_FILE_SIZE_KEY = "file_size"
+SUMMARY_FILE_MTIME_KEY = "mtime_ns"
+SUMMARY_CLASSES_KEY = "classes"
+SUMMARY_NUM_INST_KEY = "num_inst"
+SUMMARY_INST_BLOOM_KEY = "inst_bloom"
+SUMMARY_BLOOM_NUM_BITS_KEY = "num_bits"
+SUMMARY_BLOOM_NUM_HASHES_KEY = "num_hashes"
+SUMMARY_BLOOM_BITS_KEY = "bits"
+
+# The false positive rate of the instance name bloom filter, a false positive
+# merely causes a file to be replayed unnecessarily:
+SUMMARY_BLOOM_FP_RATE = 0.01
+
+
+class LmcrecBloomFilter:
+    """Bloom filter for strings, w/ double hashing"""
+
+    def __init__(
+        self,
+        num_bits: int,
+        num_hashes: int,
+        bits: Optional[bytearray] = None,
+    ):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(num_hashes, 1)
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(
+        cls, capacity: int, fp_rate: float = SUMMARY_BLOOM_FP_RATE
+    ) -> "LmcrecBloomFilter":
+        """Return the filter sized for capacity items at the given fp_rate"""
+
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = int(round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _bit_indices(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item: str):
+        bits = self.bits
+        for k in self._bit_indices(item):
+            bits[k >> 3] |= 1 << (k & 7)
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[k >> 3] & (1 << (k & 7)) for k in self._bit_indices(item))
+
+    def __eq__(self, other: Any) -> bool:
+        return (
+            isinstance(other, LmcrecBloomFilter)
+            and self.num_bits == other.num_bits
+            and self.num_hashes == other.num_hashes
+            and self.bits == other.bits
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            SUMMARY_BLOOM_NUM_BITS_KEY: self.num_bits,
+            SUMMARY_BLOOM_NUM_HASHES_KEY: self.num_hashes,
+            SUMMARY_BLOOM_BITS_KEY: base64.b64encode(bytes(self.bits)).decode("ascii"),
+        }
+
+    @classmethod
+    def from_json(cls, bloom: Dict[str, Any]) -> "LmcrecBloomFilter":
+        return cls(
+            bloom[SUMMARY_BLOOM_NUM_BITS_KEY],
+            bloom[SUMMARY_BLOOM_NUM_HASHES_KEY],
+            bytearray(base64.b64decode(bloom[SUMMARY_BLOOM_BITS_KEY])),
+        )
+
+
+@dataclass
+class LmcrecFileSummary:
+    """The content summary of a record file"""
+
+    # The record file signature, for validation:
+    file_size: int = 0
+    mtime_ns: int = 0
+    # (first, last) seen timestamps, by class name:
+    classes: Dict[str, Tuple[float, float]] = field(default_factory=dict)
+    num_inst: int = 0
+    inst_bloom: Optional[LmcrecBloomFilter] = None
+
+    def has_class(
+        self,
+        class_name: str,
+        from_ts: Optional[float] = None,
+        to_ts: Optional[float] = None,
+    ) -> bool:
+        """Whether the class has instances in the file, within the time window"""
+
+        first_last = self.classes.get(class_name)
+        if first_last is None:
+            return False
+        first_ts, last_ts = first_last
+        return (from_ts is None or last_ts >= from_ts) and (
+            to_ts is None or first_ts <= to_ts
+        )
+
+    def may_have_inst(self, inst_name: str) -> bool:
+        """Whether the instance may be in the file, subject to false positives"""
+
+        return self.inst_bloom is None or inst_name in self.inst_bloom
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            SUMMARY_VERSION_KEY: SUMMARY_VERSION,
+            SUMMARY_FILE_SIZE_KEY: self.file_size,
+            SUMMARY_FILE_MTIME_KEY: self.mtime_ns,
+            SUMMARY_CLASSES_KEY: {
+                class_name: list(first_last)
+                for class_name, first_last in self.classes.items()
+            },
+            SUMMARY_NUM_INST_KEY: self.num_inst,
+            SUMMARY_INST_BLOOM_KEY: (
+                self.inst_bloom.to_json() if self.inst_bloom is not None else None
+            ),
+        }
+
+    @classmethod
+    def from_json(cls, summary: Dict[str, Any]) -> "LmcrecFileSummary":
+        version = summary.get(SUMMARY_VERSION_KEY)
+        if version != SUMMARY_VERSION:
+            raise ValueError(
+                f"unsupported summary version: want: {SUMMARY_VERSION!r}, got: {version!r}"
+            )
+        inst_bloom = summary.get(SUMMARY_INST_BLOOM_KEY)
+        return cls(
+            file_size=summary[SUMMARY_FILE_SIZE_KEY],
+            mtime_ns=summary[SUMMARY_FILE_MTIME_KEY],
+            classes={
+                class_name: tuple(first_last)
+                for class_name, first_last in summary[SUMMARY_CLASSES_KEY].items()
+            },
+            num_inst=summary[SUMMARY_NUM_INST_KEY],
+            inst_bloom=(
+                LmcrecBloomFilter.from_json(inst_bloom)
+                if inst_bloom is not None
+                else None
+            ),
+        )
+
+
+def build_lmcrec_file_summary(file_name: str) -> LmcrecFileSummary:
+    """Decode the record file and build its summary
+
+    Raises:
+        RuntimeError if the file cannot be decoded to the end
+    """
+
+    st = os.stat(file_name)
+    classes: Dict[str, List[float]] = dict()
+    inst_names = set()
+    state_cache = LmcrecStateCache(LmcrecFileDecoder(file_name))
+    # The classes w/ instances, updated only when the instance set changes:
+    present_class_names: List[str] = []
+    while True:
+        ret_code = state_cache.apply_next_scan()
+        if ret_code != LmcrecScanRetCode.COMPLETE:
+            break
+        if state_cache.new_inst or state_cache.deleted_inst:
+            if state_cache.new_inst:
+                inst_names.update(state_cache.inst_by_name)
+            present_class_names = [
+                class_name
+                for class_name, class_inst_names in state_cache.inst_by_class_name.items()
+                if class_inst_names
+            ]
+        ts = state_cache.ts
+        for class_name in present_class_names:
+            first_last = classes.get(class_name)
+            if first_last is None:
+                classes[class_name] = [ts, ts]
+            else:
+                first_last[1] = ts
+    if ret_code != LmcrecScanRetCode.ATEOR:
+        raise RuntimeError(f"{file_name}: {ret_code!r}")
+
+    inst_bloom = LmcrecBloomFilter.for_capacity(len(inst_names))
+    for inst_name in inst_names:
+        inst_bloom.add(inst_name)
+    return LmcrecFileSummary(
+        file_size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        classes={
+            class_name: tuple(first_last) for class_name, first_last in classes.items()
+        },
+        num_inst=len(inst_names),
+        inst_bloom=inst_bloom,
+    )
+
+
+def save_lmcrec_file_summary(file_name: str, summary: LmcrecFileSummary) -> str:
+    """Save the summary sidecar for the record file, atomically
+
+    Returns:
+        str: the path of the summary file
+    """
+
+    summary_file = file_name + SUMMARY_FILE_SUFFIX
+    tmp_summary_file = f"{summary_file}.{os.getpid()}.tmp"
+    with open(tmp_summary_file, "wt") as f:
+        json.dump(summary.to_json(), f)
+    os.replace(tmp_summary_file, summary_file)
+    return summary_file
+
+
+def load_lmcrec_file_summary(file_name: str) -> Optional[LmcrecFileSummary]:
+    """Load the summary for the record file
+
+    Returns:
+        LmcrecFileSummary or None if there is no summary or if it is invalid or
+        out of date.
+    """
+
+    try:
+        with open(file_name + SUMMARY_FILE_SUFFIX, "rt") as f:
+            summary = LmcrecFileSummary.from_json(json.load(f))
+        st = os.stat(file_name)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if summary.file_size != st.st_size or summary.mtime_ns != st.st_mtime_ns:
+        return None
+    return summary
+
+
+def summarize_lmcrec_file(
+    file_name: str, lmcrec_info: Optional[LmcrecInfo] = None, force: bool = False
+) -> Optional[LmcrecFileSummary]:
+    """Build and save the summary for the record file, unless already up to date
+
+    Only closed files are summarized, since the active ones keep changing.
+
+    Returns:
+        LmcrecFileSummary or None if the file is not closed.
+    """
+
+    if lmcrec_info is not None and lmcrec_info.state != LmcrecInfoState.CLOSED:
+        return None
+    summary = None if force else load_lmcrec_file_summary(file_name)
+    if summary is None:
+        summary = build_lmcrec_file_summary(file_name)
+        save_lmcrec_file_summary(file_name, summary)
+    return summary
+
+
+def get_query_file_filter(
+    selectors: List[LmcrecQuerySelector],
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> Optional[Callable[[str, LmcrecInfo], bool]]:
+    """Return the file filter for the query selectors, based on the summaries
+
+    Returns:
+        A callable, (file_name, lmcrec_info) -> bool, which returns False for
+        the files which cannot match any of the selectors, see
+        build_lmcrec_file_chains, or None if the selectors may match any file.
+        The files w/o a valid summary are kept.
+    """
+
+    if not selectors or any(
+        selector.file_filter_spec() is None for selector in selectors
+    ):
+        return None
+
+    def file_filter(file_name: str, lmcrec_info: LmcrecInfo) -> bool:
+        summary = load_lmcrec_file_summary(file_name)
+        if summary is None:
+            return True
+        for selector in selectors:
+            class_names, inst_names = selector.file_filter_spec()
+            if class_names is not None and not any(
+                summary.has_class(class_name, from_ts, to_ts)
+                for class_name in class_names
+            ):
+                continue
+            if inst_names is not None and not any(
+                summary.may_have_inst(inst_name) for inst_name in inst_names
+            ):
+                continue
+            return True
+        return False
+
+    return file_filter
@@ -0,0 +1,400 @@
+"""Fleet query: run the same queries against multiple lmcrec instances
+
+The record files of each lmcrec instance form their own chains, which share no
+state with the other instances, so they can be played back independently, by
+parallel workers. The chains of every instance are split into segments, see
+parallel.py, and the tasks of all the instances are run in the order of their
+start time. The per scan results are merged into a single, time ordered,
+stream, tagged w/ the instance.
+
+The merge is based on the fact that the scans of a task cannot be older than
+its start time: once the results of all the tasks starting before a given time
+are available, the scans older than that time are final and they can be
+delivered. The memory used by pending results is therefore bounded by the
+segment duration rather than by the query time window.
+"""
+
+import argparse
+import heapq
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+from config import get_lmcrec_config_insts, get_record_files_dir
+
+from .catalog import LmcrecFileCatalog
+from .file_selector import build_lmcrec_file_chains
+from .file_summary import get_query_file_filter
+from .lmcrec_query import LmcrecQueryResult, prepare_query_selectors
+from .parallel import (
+    PARALLEL_SEGMENT_DURATION,
+    LmcrecQueryTask,
+    LmcrecQueryTaskResult,
+    build_query_tasks,
+    resolve_workers,
+    run_query_task,
+    run_tasks_in_order,
+)
+from .query_selector import LmcrecQuerySelector
+
+# The separator between the instance and the query name for tagged results, see
+# tag_fleet_result:
+FLEET_INST_SEP = "/"
+
+# The separator for the --inst list in fleet mode:
+FLEET_INST_LIST_SEP = ","
+
+
+@dataclass
+class LmcrecFleetTask:
+    """A query task for a given instance"""
+
+    inst_index: int = 0
+    task: Optional[LmcrecQueryTask] = None
+    # The time before which the task cannot have any scan:
+    start_ts: float = 0
+
+
+@dataclass
+class LmcrecFleetScanState:
+    """The state of the most recent scan, the fleet counterpart of the query
+    state cache attributes available to the callback"""
+
+    inst: Optional[str] = None
+    ts: Optional[float] = None
+    prev_ts: Optional[float] = None
+    # Whether the scan is the first of a chain for the instance:
+    new_chain: bool = False
+    # For compatibility w/ the single instance callbacks, fleet queries have a
+    # single window:
+    window_index: Optional[int] = None
+
+
+# The callable for run w/ callback:
+LmcrecFleetQueryCallback = Callable[[LmcrecQueryResult, LmcrecFleetScanState], bool]
+
+
+def get_fleet_record_files_dirs(
+    insts: Optional[List[str]] = None,
+    config_file: Optional[str] = None,
+) -> Dict[str, str]:
+    """Return the record files dir by inst
+
+    Args:
+        insts (List[str]): the instances, if None or empty then all the
+            recorders in the config
+
+        config_file (str): the lmcrec config file, see get_lmcrec_config_file
+
+    Raises:
+        RuntimeError
+    """
+
+    if not insts:
+        insts = get_lmcrec_config_insts(config_file)
+        if not insts:
+            raise RuntimeError("no recorders in the config")
+    record_files_dir_by_inst = dict()
+    for inst in insts:
+        if inst in record_files_dir_by_inst:
+            raise RuntimeError(f"duplicate inst: {inst!r}")
+        record_files_dir = get_record_files_dir(inst, config_file)
+        if not record_files_dir:
+            raise RuntimeError(f"inst {inst!r}: record_files_dir cannot be determined")
+        record_files_dir_by_inst[inst] = record_files_dir
+    return record_files_dir_by_inst
+
+
+def get_fleet_arg_parser() -> argparse.ArgumentParser:
+    """Return the argument parser with the args used for the fleet mode
+
+    To be used as a parent to a specific tool parser (see parents arg of
+    ArgumentParser), together w/ the file selection one.
+    """
+
+    parser = argparse.ArgumentParser(
+        add_help=False,
+    )
+    parser.add_argument(
+        "--fleet",
+        action="store_true",
+        help=f"""
+        Fleet mode, run the queries against multiple lmcrec instances: either
+        the {FLEET_INST_LIST_SEP!r} separated --inst list or, if the latter is
+        not specified, all the recorders in the config. The results are merged
+        in chronological order and the query names are prefixed by
+        INST{FLEET_INST_SEP}. It cannot be combined with --record-files-dir.
+        """,
+    )
+    return parser
+
+
+def process_fleet_args(args: argparse.Namespace) -> Optional[Dict[str, str]]:
+    """Return the record files dir by inst for fleet mode, None if not enabled
+
+    Raises:
+        RuntimeError
+    """
+
+    if not args.fleet:
+        return None
+    if args.record_files_dir:
+        raise RuntimeError("--fleet cannot be combined w/ --record-files-dir")
+    insts = None
+    if args.inst:
+        insts = [
+            inst.strip()
+            for inst in args.inst.split(FLEET_INST_LIST_SEP)
+            if inst.strip()
+        ]
+    return get_fleet_record_files_dirs(insts, args.config)
+
+
+def tag_fleet_result(inst: str, result: LmcrecQueryResult) -> LmcrecQueryResult:
+    """Prefix the query names w/ the instance"""
+
+    return {
+        f"{inst}{FLEET_INST_SEP}{query_name}": query_result
+        for query_name, query_result in result.items()
+    }
+
+
+def run_fleet_query_task(
+    fleet_task: LmcrecFleetTask,
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+) -> Tuple[int, LmcrecQueryTaskResult]:
+    """The worker function, see run_query_task"""
+
+    return fleet_task.inst_index, run_query_task(
+        fleet_task.task,
+        selectors,
+        have_prev=have_prev,
+        track_changes=track_changes,
+    )
+
+
+class LmcrecFleetQuery:
+    """Run the same queries against multiple lmcrec instances"""
+
+    def __init__(
+        self,
+        record_files_dir_by_inst: Dict[str, str],
+        *query_or_file,
+        from_ts: Optional[float] = None,
+        to_ts: Optional[float] = None,
+        force_prev: bool = False,
+        changed_only: bool = False,
+        workers: int = 1,
+        segment_duration: Optional[float] = PARALLEL_SEGMENT_DURATION,
+        catalog_by_inst: Optional[Dict[str, LmcrecFileCatalog]] = None,
+        use_summaries: bool = False,
+    ):
+        """Build the fleet query
+
+        Args:
+            record_files_dir_by_inst (Dict[str, str]):
+                The record files dir (top or sub-dir) by instance, see
+                get_fleet_record_files_dirs. The order of the instances is used
+                for ordering the scans w/ the same timestamp.
+
+            workers (int):
+                If > 1 then play back the chain segments of all the instances in
+                parallel, using a pool of that many worker processes, <= 0
+                stands for the number of CPUs.
+
+            segment_duration (float):
+                Split the chains into segments at least that long, in seconds,
+                see LmcrecQuery. The segments bound the memory used for merging
+                the results, so they are used even for in-process playback.
+
+            catalog_by_inst (Dict[str, LmcrecFileCatalog]):
+                Optional persistent catalog by instance, see catalog.py.
+
+            query_or_file, from_ts, to_ts, force_prev, changed_only,
+            use_summaries:
+                See LmcrecQuery.
+
+        Raises:
+            RuntimeError
+        """
+
+        if not record_files_dir_by_inst:
+            raise RuntimeError("no instances for fleet query")
+        selectors, have_prev = prepare_query_selectors(
+            *query_or_file, force_prev=force_prev, changed_only=changed_only
+        )
+        self._selectors = selectors
+        self.window_top_k = {
+            selector.name: selector.top_k
+            for selector in selectors
+            if selector.top_k_window
+        }
+        self._have_prev = have_prev
+        self._changed_only = changed_only
+        self._workers = resolve_workers(workers)
+        self.insts = list(record_files_dir_by_inst)
+
+        file_filter = (
+            get_query_file_filter(selectors, from_ts, to_ts) if use_summaries else None
+        )
+        self.from_ts, self.to_ts = None, None
+        self._tasks: List[LmcrecFleetTask] = []
+        for inst_index, (inst, record_files_dir) in enumerate(
+            record_files_dir_by_inst.items()
+        ):
+            chain_list = build_lmcrec_file_chains(
+                record_files_dir,
+                from_ts=from_ts,
+                to_ts=to_ts,
+                catalog=catalog_by_inst.get(inst) if catalog_by_inst else None,
+                file_filter=file_filter,
+            )
+            if not chain_list:
+                continue
+            c_from_ts = chain_list[0].lmcrec_info.start_ts
+            entry = chain_list[-1]
+            while entry.next is not None:
+                entry = entry.next
+            c_to_ts = entry.lmcrec_info.most_recent_ts
+            if self.from_ts is None or c_from_ts < self.from_ts:
+                self.from_ts = c_from_ts
+            if self.to_ts is None or c_to_ts > self.to_ts:
+                self.to_ts = c_to_ts
+            for task in build_query_tasks(
+                chain_list,
+                from_ts,
+                to_ts,
+                segment_duration=segment_duration,
+            ):
+                start_ts = task.chain_entry.lmcrec_info.start_ts
+                if task.from_ts is not None and task.from_ts > start_ts:
+                    start_ts = task.from_ts
+                self._tasks.append(
+                    LmcrecFleetTask(inst_index=inst_index, task=task, start_ts=start_ts)
+                )
+        if from_ts is not None:
+            self.from_ts = from_ts
+        if to_ts is not None:
+            self.to_ts = to_ts
+        # The tasks of an instance are already in chronological order, the
+        # sort is stable:
+        self._tasks.sort(key=lambda fleet_task: fleet_task.start_ts)
+
+        # The first non ATEOR return code, by instance:
+        self.ret_code_by_inst: Dict[str, LmcrecScanRetCode] = dict()
+        self.first_ts: Optional[float] = None
+        self.last_ts: Optional[float] = None
+        self.scan_state = LmcrecFleetScanState()
+        self._scans: Optional[Iterator[Tuple]] = None
+        self._task_results: Optional[Iterator] = None
+        self._closed = False
+
+    def _merge_scans(self) -> Iterator[Tuple]:
+        """Yield (ts, inst_index, seq, prev_ts, new_chain, result) in
+        chronological order"""
+
+        tasks = self._tasks
+        heap: List[Tuple] = []
+        seq = 0
+        failed = set()
+        for k, (inst_index, task_result) in enumerate(self._task_results):
+            if inst_index not in failed:
+                new_chain = task_result.new_chain
+                for ts, prev_ts, result in task_result.scans:
+                    heapq.heappush(
+                        heap, (ts, inst_index, seq, prev_ts, new_chain, result)
+                    )
+                    seq += 1
+                    new_chain = False
+                if task_result.ret_code != LmcrecScanRetCode.ATEOR:
+                    # Ignore the subsequent results for this instance:
+                    failed.add(inst_index)
+                    self.ret_code_by_inst[self.insts[inst_index]] = task_result.ret_code
+            task_result.scans = None
+            watermark = tasks[k + 1].start_ts if k + 1 < len(tasks) else None
+            while heap and (watermark is None or heap[0][0] < watermark):
+                yield heapq.heappop(heap)
+
+    def get_next_results(
+        self,
+    ) -> Tuple[
+        LmcrecScanRetCode, Optional[str], Optional[float], Optional[LmcrecQueryResult]
+    ]:
+        """Return the results for the next scan, from any of the instances
+
+        Return: ret_code, inst, ts, results
+
+            ret_code:
+                LmcrecScanRetCode.COMPLETE: valid inst, ts, results
+                LmcrecScanRetCode.ATEOR: no more scans; see ret_code_by_inst
+                    for the instances whose playback ended prematurely.
+                anything else: the query was closed
+
+            inst, ts, results: the instance, the timestamp of the scan and the
+                results, the latter in the same format as for LmcrecQuery.
+        """
+
+        if self._closed:
+            return LmcrecScanRetCode.CLOSED, None, None, None
+        if self._scans is None:
+            self._task_results = run_tasks_in_order(
+                run_fleet_query_task,
+                self._tasks,
+                self._workers,
+                self._selectors,
+                have_prev=self._have_prev,
+                track_changes=self._changed_only,
+            )
+            self._scans = self._merge_scans()
+        scan = next(self._scans, None)
+        if scan is None:
+            self.close()
+            return LmcrecScanRetCode.ATEOR, None, None, None
+        ts, inst_index, _, prev_ts, new_chain, result = scan
+        inst = self.insts[inst_index]
+        scan_state = self.scan_state
+        scan_state.inst, scan_state.ts, scan_state.prev_ts = inst, ts, prev_ts
+        scan_state.new_chain = new_chain
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+        return LmcrecScanRetCode.COMPLETE, inst, ts, result
+
+    def run_with_callback(
+        self, cb: Optional[LmcrecFleetQueryCallback]
+    ) -> LmcrecScanRetCode:
+        """Invoke callback in a loop after each next results
+
+        Args:
+            cb (Callable[[LmcrecQueryResult, LmcrecFleetScanState], bool]):
+                Invoked w/ the results and the scan state until either it
+                returns False or there are no more results.
+
+        Returns:
+            LmcrecScanRetCode: ATEOR if all the instances were played back to
+            the end, the first abnormal return code otherwise.
+        """
+
+        ret_code = None
+        while True:
+            ret_code, _, _, result = self.get_next_results()
+            if ret_code != LmcrecScanRetCode.COMPLETE:
+                break
+            if cb is not None and not cb(result, self.scan_state):
+                break
+        self.close()
+        if ret_code == LmcrecScanRetCode.ATEOR:
+            for inst in self.insts:
+                if inst in self.ret_code_by_inst:
+                    return self.ret_code_by_inst[inst]
+        return ret_code
+
+    def close(self):
+        """Release the resources, e.g. the worker pool, used by the query"""
+
+        if self._task_results is not None:
+            self._task_results.close()
+            self._task_results = None
+        self._closed = True
@@ -0,0 +1,375 @@
+"""Instance lifecycle index
+
+Finding out when an instance first appeared and when it was deleted requires
+replaying many days worth of record files. The lifecycle index maps each
+instance name to the intervals when it existed, as (file, first_ts, last_ts,
+deleted), for a record files dir. It is built from the INST_INFO and
+DELETE_INST_ID records only, via structure only decoding, see
+LmcrecDecoder.next_structure_record, i.e. w/o decoding the variable values.
+
+The index is kept in a JSON file under $LMCREC_RUNTIME/lifecycle by default
+and it is refreshed incrementally: only the closed files not yet indexed are
+decoded, the active file is indexed once closed.
+
+The intervals are per file: an instance existing throughout multiple files has
+an interval for each of them. deleted indicates that the interval ended w/ a
+DELETE_INST_ID record in the same file; last_ts is the most recent scan where
+the instance was still present.
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from codec import LmcrecFileDecoder, LmcrecInfoState, LmcRecord, LmcrecType
+
+from .catalog import LmcrecFileCatalog, get_record_files_dir_runtime_file
+from .file_selector import build_lmcrec_file_chains
+from .query_selector import QUERY_INSTANCE_PREFIX
+
+LIFECYCLE_SUB_DIR = "lifecycle"
+LIFECYCLE_FILE_SUFFIX = ".json"
+
+# Bump this up whenever the stored format changes:
+LIFECYCLE_VERSION = 1
+
+LIFECYCLE_VERSION_KEY = "version"
+LIFECYCLE_RECORD_FILES_DIR_KEY = "record_files_dir"
+LIFECYCLE_FILES_KEY = "files"
+LIFECYCLE_FILE_SIGNATURE_KEY = "signature"
+LIFECYCLE_FILE_INSTS_KEY = "insts"
+
+# The per file intervals, as stored, by instance name:
+# [inst_name] = [[class_name, first_ts, last_ts, deleted], ...]
+LmcrecFileLifecycle = Dict[str, List[List[Any]]]
+
+
+@dataclass
+class LmcrecLifecycleInterval:
+    """An interval when the instance existed, within a record file"""
+
+    inst_name: str = ""
+    class_name: Optional[str] = None
+    # Relative to the record files dir:
+    file_name: str = ""
+    first_ts: float = 0
+    last_ts: float = 0
+    # Whether the interval ended w/ the deletion of the instance:
+    deleted: bool = False
+
+
+def get_lmcrec_lifecycle_index_file(record_files_dir: str) -> str:
+    """Return the default lifecycle index file for a record files dir"""
+
+    return get_record_files_dir_runtime_file(
+        LIFECYCLE_SUB_DIR, record_files_dir, suffix=LIFECYCLE_FILE_SUFFIX
+    )
+
+
+def decode_lmcrec_file_lifecycle(file_name: str) -> LmcrecFileLifecycle:
+    """Decode the instance intervals of a record file, structure only
+
+    Raises:
+        RuntimeError, ValueError for invalid files
+    """
+
+    decoder = LmcrecFileDecoder(file_name)
+    class_name_by_id: Dict[int, str] = dict()
+    # [inst_id] = (inst_name, class_id, first_ts):
+    live: Dict[int, Tuple[str, int, float]] = dict()
+    lifecycle: LmcrecFileLifecycle = dict()
+    ts, prev_ts = None, None
+
+    def end_interval(inst_id: int, last_ts: Optional[float], deleted: bool):
+        inst_name, class_id, first_ts = live.pop(inst_id)
+        if last_ts is None or last_ts < first_ts:
+            last_ts = first_ts
+        lifecycle.setdefault(inst_name, []).append(
+            [class_name_by_id.get(class_id), first_ts, last_ts, deleted]
+        )
+
+    record = LmcRecord()
+    try:
+        while True:
+            decoder.next_structure_record(record)
+            record_type = record.record_type
+            if record_type == LmcrecType.TIMESTAMP_USEC:
+                prev_ts, ts = ts, record.value
+            elif record_type == LmcrecType.INST_INFO:
+                live_inst = live.get(record.inst_id)
+                if live_inst is not None:
+                    if live_inst[0] == record.name:
+                        # Re-stated, e.g. by a checkpoint scan:
+                        continue
+                    # The ID was reused:
+                    end_interval(record.inst_id, prev_ts, True)
+                live[record.inst_id] = (record.name, record.class_id, ts)
+            elif record_type == LmcrecType.DELETE_INST_ID:
+                if record.inst_id in live:
+                    end_interval(record.inst_id, prev_ts, True)
+            elif record_type == LmcrecType.CLASS_INFO:
+                class_name_by_id[record.class_id] = record.name
+            elif record_type == LmcrecType.EOR:
+                break
+    except EOFError:
+        pass
+    finally:
+        decoder.close()
+    for inst_id in list(live):
+        end_interval(inst_id, ts, False)
+    return lifecycle
+
+
+class LmcrecLifecycleIndex:
+    """Persistent instance lifecycle index, w/ incremental refresh"""
+
+    def __init__(
+        self,
+        record_files_dir: str,
+        index_file: Optional[str] = None,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        save: bool = True,
+    ):
+        """Create the index
+
+        Args:
+            record_files_dir (str):
+                Either the top record files dir or one of its sub-dirs.
+
+            index_file (str):
+                The file to persist the index, default: see
+                get_lmcrec_lifecycle_index_file.
+
+            catalog (LmcrecFileCatalog):
+                If provided then use it for listing the record files, see
+                build_lmcrec_file_chains.
+
+            save (bool):
+                Whether to save the index after the refreshes which changed it.
+        """
+
+        self.record_files_dir = os.path.abspath(record_files_dir)
+        self.index_file = (
+            index_file
+            if index_file is not None
+            else get_lmcrec_lifecycle_index_file(self.record_files_dir)
+        )
+        self._catalog = catalog
+        self._save = save
+        self._lock = threading.Lock()
+        self._files: Optional[Dict[str, Dict[str, Any]]] = None
+        # The intervals by instance name, built on demand:
+        self._intervals_by_inst: Optional[Dict[str, List[LmcrecLifecycleInterval]]] = (
+            None
+        )
+        self.num_file_decodes = 0
+
+    def _load(self):
+        self._files = dict()
+        try:
+            with open(self.index_file, "rt") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f"{self.index_file}: {e}, ignored", file=sys.stderr)
+            return
+        if (
+            not isinstance(index, dict)
+            or index.get(LIFECYCLE_VERSION_KEY) != LIFECYCLE_VERSION
+            or index.get(LIFECYCLE_RECORD_FILES_DIR_KEY) != self.record_files_dir
+        ):
+            return
+        self._files = index.get(LIFECYCLE_FILES_KEY) or dict()
+
+    def save(self):
+        """Save the index, atomically"""
+
+        if self._files is None:
+            return
+        index_dir = os.path.dirname(self.index_file)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_index_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_index_file, "wt") as f:
+            json.dump(
+                {
+                    LIFECYCLE_VERSION_KEY: LIFECYCLE_VERSION,
+                    LIFECYCLE_RECORD_FILES_DIR_KEY: self.record_files_dir,
+                    LIFECYCLE_FILES_KEY: self._files,
+                },
+                f,
+            )
+        os.replace(tmp_index_file, self.index_file)
+
+    def refresh(self) -> bool:
+        """Index the newly closed files and forget the removed ones
+
+        Returns:
+            bool: whether the index changed
+        """
+
+        with self._lock:
+            if self._files is None:
+                self._load()
+            closed_files = dict()
+            for entry in (
+                build_lmcrec_file_chains(self.record_files_dir, catalog=self._catalog)
+                or []
+            ):
+                while entry is not None:
+                    if entry.lmcrec_info.state == LmcrecInfoState.CLOSED:
+                        closed_files[
+                            os.path.relpath(entry.file_name, self.record_files_dir)
+                        ] = entry.file_name
+                    entry = entry.next
+            changed = False
+            for lmcrec_file in set(self._files) - set(closed_files):
+                del self._files[lmcrec_file]
+                changed = True
+            for lmcrec_file, file_name in sorted(closed_files.items()):
+                try:
+                    st = os.stat(file_name)
+                except FileNotFoundError:
+                    continue
+                signature = [st.st_size, st.st_mtime_ns]
+                file_entry = self._files.get(lmcrec_file)
+                if (
+                    file_entry is not None
+                    and file_entry[LIFECYCLE_FILE_SIGNATURE_KEY] == signature
+                ):
+                    continue
+                try:
+                    insts = decode_lmcrec_file_lifecycle(file_name)
+                    self.num_file_decodes += 1
+                except (RuntimeError, ValueError) as e:
+                    print(f"{file_name}: {e}", file=sys.stderr)
+                    continue
+                self._files[lmcrec_file] = {
+                    LIFECYCLE_FILE_SIGNATURE_KEY: signature,
+                    LIFECYCLE_FILE_INSTS_KEY: insts,
+                }
+                changed = True
+            if changed:
+                self._intervals_by_inst = None
+                if self._save:
+                    try:
+                        self.save()
+                    except OSError as e:
+                        print(f"{self.index_file}: {e}", file=sys.stderr)
+        return changed
+
+    def _get_intervals_by_inst(self) -> Dict[str, List[LmcrecLifecycleInterval]]:
+        if self._intervals_by_inst is None:
+            if self._files is None:
+                self._load()
+            intervals_by_inst = dict()
+            for lmcrec_file, file_entry in self._files.items():
+                for inst_name, intervals in file_entry[
+                    LIFECYCLE_FILE_INSTS_KEY
+                ].items():
+                    inst_intervals = intervals_by_inst.setdefault(inst_name, [])
+                    for class_name, first_ts, last_ts, deleted in intervals:
+                        inst_intervals.append(
+                            LmcrecLifecycleInterval(
+                                inst_name=inst_name,
+                                class_name=class_name,
+                                file_name=lmcrec_file,
+                                first_ts=first_ts,
+                                last_ts=last_ts,
+                                deleted=deleted,
+                            )
+                        )
+            for inst_intervals in intervals_by_inst.values():
+                inst_intervals.sort(key=lambda interval: interval.first_ts)
+            self._intervals_by_inst = intervals_by_inst
+        return self._intervals_by_inst
+
+    def lookup(
+        self,
+        *inst_names: str,
+        from_ts: Optional[float] = None,
+        to_ts: Optional[float] = None,
+    ) -> List[LmcrecLifecycleInterval]:
+        """Return the intervals of the instances, overlapping the time range
+
+        Args:
+            inst_names (str):
+                The instances, using the query syntax: NAME for an exact
+                match, ~SUFFIX for a suffix match or /REGEX/; all the instances
+                if none is specified.
+
+            from_ts, to_ts (float): the time range, None for open ended
+
+        Returns:
+            list: of LmcrecLifecycleInterval, sorted by instance name and
+            first_ts.
+        """
+
+        with self._lock:
+            intervals_by_inst = self._get_intervals_by_inst()
+        selected = sorted(
+            inst_name for inst_name in match_inst_names(intervals_by_inst, inst_names)
+        )
+        return [
+            interval
+            for inst_name in selected
+            for interval in intervals_by_inst[inst_name]
+            if (from_ts is None or interval.last_ts >= from_ts)
+            and (to_ts is None or interval.first_ts <= to_ts)
+        ]
+
+
+def match_inst_names(
+    all_inst_names: Iterable[str], inst_names: Iterable[str]
+) -> Iterable[str]:
+    """Return the instance names matching any of the specs, see lookup"""
+
+    full_names, suffixes, patterns = set(), [], []
+    for inst_name in inst_names:
+        if len(inst_name) > 1 and inst_name[0] == "/" and inst_name[-1] == "/":
+            patterns.append(re.compile(inst_name[1:-1]))
+        elif inst_name.startswith(QUERY_INSTANCE_PREFIX):
+            suffixes.append(inst_name[1:])
+        else:
+            full_names.add(inst_name)
+    if not full_names and not suffixes and not patterns:
+        return list(all_inst_names)
+    if not suffixes and not patterns:
+        return [inst_name for inst_name in full_names if inst_name in all_inst_names]
+    return [
+        inst_name
+        for inst_name in all_inst_names
+        if inst_name in full_names
+        or any(inst_name.endswith(suffix) for suffix in suffixes)
+        or any(pat.match(inst_name) for pat in patterns)
+    ]
+
+
+def summarize_lifecycle(
+    intervals: List[LmcrecLifecycleInterval],
+) -> List[LmcrecLifecycleInterval]:
+    """Merge the intervals of each instance into a single one
+
+    The result, by instance, spans from the first first_ts to the last
+    last_ts, it is deleted if the last interval is and its file_name is that of
+    the last interval.
+    """
+
+    merged: Dict[str, LmcrecLifecycleInterval] = dict()
+    for interval in intervals:
+        m = merged.get(interval.inst_name)
+        if m is None:
+            merged[interval.inst_name] = LmcrecLifecycleInterval(**interval.__dict__)
+            continue
+        m.first_ts = min(m.first_ts, interval.first_ts)
+        if interval.last_ts >= m.last_ts:
+            m.last_ts = interval.last_ts
+            m.deleted = interval.deleted
+            m.file_name = interval.file_name
+            m.class_name = interval.class_name
+    return list(merged.values())
@@ -1,9 +1,33 @@
 """Lmcrec Query Object"""
 
-from typing import Callable, Dict, Optional, Tuple
-
-from .query_selector import LmcrecQueryClassResult, build_query_selectors
-from .query_state_cache import LmcrecQueryIntervalStateCache, LmcrecScanRetCode
+from typing import Callable, Dict, List, Optional, Tuple
+
+from codec import LmcrecIndexCache, LmcrecInfoCache
+
+from .catalog import LmcrecFileCatalog
+from .file_selector import build_lmcrec_file_chains
+from .file_summary import get_query_file_filter
+from .parallel import (
+    PARALLEL_SEGMENT_DURATION,
+    build_query_tasks,
+    iter_query_task,
+    resolve_workers,
+    stream_tasks_in_order,
+)
+from .query_selector import (
+    LmcrecQueryClassResult,
+    LmcrecQuerySelector,
+    build_query_selectors,
+)
+from .query_state_cache import (
+    LmcrecQueryIntervalStateCache,
+    LmcrecQueryWindow,
+    LmcrecScanRetCode,
+    normalize_query_windows,
+)
+from .result_cache import QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT, iter_cached_query_task
+from .state_snapshot import LmcrecStateSnapshotCache
+from .zone_map import get_zone_map_windows
 
 # The query result is indexed by query name:
 LmcrecQueryResult = Dict[str, LmcrecQueryClassResult]
@@ -12,6 +36,40 @@ LmcrecQueryResult = Dict[str, LmcrecQueryClassResult]
 LmcrecQueryCallback = Callable[[LmcrecQueryResult, LmcrecQueryIntervalStateCache], bool]
 
 
+def prepare_query_selectors(
+    *query_or_file,
+    force_prev: bool = False,
+    changed_only: bool = False,
+) -> Tuple[List[LmcrecQuerySelector], bool]:
+    """Build the selectors for the queries and assign the missing names
+
+    Returns:
+        (selectors, have_prev): the latter indicates whether the previous state
+        is needed, either forced or because of the queries.
+
+    Raises:
+        RuntimeError for duplicate query names
+    """
+
+    selectors = build_query_selectors(*query_or_file, changed_only=changed_only)
+
+    # Auto-assign names as needed:
+    for i, selector in enumerate(selectors):
+        if not selector.name:
+            selector.name = f"query#{i + 1}"
+
+    # Verify name uniqueness and whether previous state is needed or not:
+    used_names = set()
+    have_prev = force_prev
+    for selector in selectors:
+        if selector.name in used_names:
+            raise RuntimeError(f"duplicate query name: {selector.name!r}")
+        used_names.add(selector.name)
+        if selector.needs_prev:
+            have_prev = True
+    return selectors, have_prev
+
+
 class LmcrecQuery:
     """Lmcrec Query Object"""
 
@@ -22,6 +80,18 @@ class LmcrecQuery:
         from_ts: Optional[float] = None,
         to_ts: Optional[float] = None,
         force_prev: bool = False,
+        changed_only: bool = False,
+        workers: int = 1,
+        segment_duration: Optional[float] = PARALLEL_SEGMENT_DURATION,
+        result_cache_dir: Optional[str] = None,
+        result_cache_max_size: int = QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+        info_cache: Optional[LmcrecInfoCache] = None,
+        index_cache: Optional[LmcrecIndexCache] = None,
+        snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+        windows: Optional[List[LmcrecQueryWindow]] = None,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        use_summaries: bool = False,
+        use_zone_maps: bool = False,
     ):
         """Build Lmcrec Query Object
 
@@ -43,6 +113,67 @@ class LmcrecQuery:
                 the queries are inspected to decide if it is needed or not,
                 based on whether any query specified delta or rate.
 
+            changed_only (bool):
+                Report only the instances with at least one selected variable
+                that changed since the previous scan. The change detection is
+                based on the state cache change tracking, so the cost scales
+                with the activity rather than with scans x instances.
+
+            workers (int):
+                If > 1 then play back the file chains in parallel, using a pool
+                of that many worker processes, <= 0 stands for the number of
+                CPUs. The results are still delivered in chronological order.
+
+            segment_duration (float):
+                Used for parallel playback, split the chains into segments at
+                least that long, in seconds, at checkpoint boundaries, such that
+                a single chain may be played back by multiple workers. If None
+                or 0 then each chain is played back by a single worker.
+
+            result_cache_dir (str):
+                If specified then use a persistent result cache under this
+                directory, see result_cache.py: the results for closed files are
+                cached and subsequently served w/o decoding the files. See
+                get_query_result_cache_dir for the default location.
+
+            result_cache_max_size (int):
+                The max size of the result cache, in bytes, 0 for no limit; the
+                least recently used entries are removed past it.
+
+            info_cache (LmcrecInfoCache), index_cache (LmcrecIndexCache):
+                Used by long running processes, e.g. lmcrec-serve, to keep the
+                decoded .info and .index files across queries. The index cache
+                is used for in-process playback only, i.e. not by the parallel
+                workers.
+
+            snapshot_cache (LmcrecStateSnapshotCache):
+                Used by long running processes to resume the playback from the
+                state of earlier queries, see LmcrecQueryIntervalStateCache; for
+                in-process playback only.
+
+            windows (List[LmcrecQueryWindow]):
+                Multiple, non-overlapping, (from_ts, to_ts) windows to be played
+                back in a single pass, instead of from_ts, to_ts; the results
+                are tagged w/ the window_index. The playback is in-process,
+                i.e. workers and result_cache_dir are not used.
+
+            catalog (LmcrecFileCatalog):
+                Look up the record files in this persistent catalog, see
+                catalog.py.
+
+            use_summaries (bool):
+                Skip the files which, according to their summaries, cannot
+                match any of the queries, see file_summary.py. The files w/o
+                a valid summary are played back as usual.
+
+            use_zone_maps (bool):
+                Skip the checkpoint segments which, according to the zone maps
+                of the files, cannot satisfy the value predicates of the
+                queries, see zone_map.py. The remaining segments are played back
+                in-process, i.e. workers and result_cache_dir are not used,
+                and the first scan after a skipped segment is flagged as
+                new_chain. It cannot be combined w/ windows.
+
             query_or_file (str):
                 Queries to execute. If a query starts w/ '@' then it is the name
                 of the file containing the actual query. If query does not have
@@ -53,33 +184,105 @@ class LmcrecQuery:
                 See: query_selector.py for actual query syntax.
         """
 
-        selectors = build_query_selectors(*query_or_file)
-
-        # Auto-assign names as needed:
-        for i, selector in enumerate(selectors):
-            if not selector.name:
-                selector.name = f"query#{i + 1}"
-
-        # Verify name uniqueness and whether previous state is needed or not:
-        used_names = set()
-        have_prev = force_prev
-        for selector in selectors:
-            if selector.name in used_names:
-                raise RuntimeError(f"duplicate query name: {selector.name!r}")
-            used_names.add(selector.name)
-            if selector.needs_prev:
-                have_prev = True
+        selectors, have_prev = prepare_query_selectors(
+            *query_or_file, force_prev=force_prev, changed_only=changed_only
+        )
         self._selectors = selectors
+        # The (ranking column, K) for the queries w/ top-K over the whole
+        # window, by query name, see LmcrecQueryTopKAggregator:
+        self.window_top_k = {
+            selector.name: selector.top_k
+            for selector in selectors
+            if selector.top_k_window
+        }
+        self._have_prev = have_prev
+        self._changed_only = changed_only
+        self._window = (from_ts, to_ts)
+        self.windows = windows
+        if windows is not None:
+            if from_ts is not None or to_ts is not None:
+                raise ValueError("windows and from_ts/to_ts are mutually exclusive")
+            if use_zone_maps:
+                raise ValueError("windows and use_zone_maps are mutually exclusive")
+            normalized_windows = normalize_query_windows(windows)
+            workers, result_cache_dir = 1, None
+
+        file_filter = None
+        if use_summaries:
+            if windows is not None:
+                f_from_ts, f_to_ts = normalized_windows[0][0], normalized_windows[-1][1]
+            else:
+                f_from_ts, f_to_ts = from_ts, to_ts
+            file_filter = get_query_file_filter(selectors, f_from_ts, f_to_ts)
+
+        # The chain list is built upfront for zone maps, the candidate segments
+        # are played back as untagged windows, in-process:
+        chain_list, zone_map_windows = None, None
+        if use_zone_maps:
+            chain_list = (
+                build_lmcrec_file_chains(
+                    record_files_dir,
+                    from_ts=from_ts,
+                    to_ts=to_ts,
+                    info_cache=info_cache,
+                    catalog=catalog,
+                    file_filter=file_filter,
+                )
+                or []
+            )
+            zone_map_windows = get_zone_map_windows(
+                chain_list, selectors, from_ts=from_ts, to_ts=to_ts
+            )
+            if zone_map_windows is not None:
+                workers, result_cache_dir = 1, None
+        self._workers = resolve_workers(workers)
+        self._segment_duration = segment_duration
+        self._result_cache_dir = result_cache_dir
+        self._result_cache_max_size = result_cache_max_size
+        self._index_cache = index_cache
+        self._snapshot_cache = snapshot_cache
+        # Whether the results are delivered by (parallel and/or cached) tasks:
+        self._use_tasks = self._workers > 1 or result_cache_dir is not None
+
+        # Parallel execution state:
+        self._task_results = None
+        self._task_scans = []
+        self._task_scan_i = 0
+        self._task_ret_code = None
 
         # Build the query state cache:
-        self.query_state_cache = LmcrecQueryIntervalStateCache(
-            record_files_dir,
-            from_ts=from_ts,
-            to_ts=to_ts,
-            have_prev=have_prev,
-        )
-
-        chain_list = self.query_state_cache._chain_list
+        if zone_map_windows:
+            self.query_state_cache = LmcrecQueryIntervalStateCache(
+                have_prev=have_prev,
+                track_changes=changed_only,
+                chain_list=chain_list,
+                index_cache=index_cache,
+                snapshot_cache=snapshot_cache,
+                windows=zone_map_windows,
+                tag_windows=False,
+            )
+        else:
+            self.query_state_cache = LmcrecQueryIntervalStateCache(
+                record_files_dir,
+                from_ts=from_ts,
+                to_ts=to_ts,
+                have_prev=have_prev,
+                track_changes=changed_only,
+                # Nothing to play back if no segment may match:
+                chain_list=[] if zone_map_windows == [] else chain_list,
+                info_cache=info_cache,
+                index_cache=index_cache,
+                snapshot_cache=snapshot_cache,
+                windows=windows,
+                catalog=catalog,
+                file_filter=file_filter,
+            )
+        if windows is not None:
+            from_ts, to_ts = normalized_windows[0][0], normalized_windows[-1][1]
+
+        if chain_list is None:
+            chain_list = self.query_state_cache._chain_list
+        c_from_ts, c_to_ts = None, None
         if chain_list:
             c_from_ts, c_to_ts = chain_list[0].lmcrec_info.start_ts, None
             entry = chain_list[-1]
@@ -109,6 +312,9 @@ class LmcrecQuery:
                     )
         """
 
+        if self._use_tasks:
+            return self._get_next_task_results()
+
         query_state_cache = self.query_state_cache
         ret_code = query_state_cache.apply_next_scan()
         if ret_code != LmcrecScanRetCode.COMPLETE:
@@ -120,6 +326,89 @@ class LmcrecQuery:
         }
         return ret_code, query_state_cache.ts, result
 
+    def _get_next_task_results(
+        self,
+    ) -> Tuple[LmcrecScanRetCode, float, LmcrecQueryResult]:
+        """Parallel and/or cached execution counterpart of get_next_results
+
+        The chain segments are played back by workers, or served from the
+        result cache, and their results are streamed back in batches, see
+        stream_tasks_in_order. The main query state cache is used only for the chain
+        list and for reflecting the current scan: ts, prev_ts, new_chain,
+        first_ts and last_ts.
+        """
+
+        query_state_cache = self.query_state_cache
+        if self._task_results is None:
+            if query_state_cache._closed:
+                return LmcrecScanRetCode.CLOSED, None, None
+            from_ts, to_ts = self._window
+            task_kwargs = dict(
+                have_prev=self._have_prev,
+                track_changes=self._changed_only,
+            )
+            if self._result_cache_dir is not None:
+                task_fn = iter_cached_query_task
+                task_kwargs["cache_dir"] = self._result_cache_dir
+                task_kwargs["cache_max_size"] = self._result_cache_max_size
+            else:
+                task_fn = iter_query_task
+            index_cache = None
+            if self._workers <= 1:
+                # In-process, the caches can be shared:
+                index_cache = self._index_cache
+                task_kwargs["index_cache"] = index_cache
+                task_kwargs["snapshot_cache"] = self._snapshot_cache
+            # The results are streamed in batches, see parallel.py:
+            self._task_results = stream_tasks_in_order(
+                task_fn,
+                build_query_tasks(
+                    query_state_cache._chain_list,
+                    from_ts,
+                    to_ts,
+                    segment_duration=(
+                        self._segment_duration if self._workers > 1 else None
+                    ),
+                    at_files=self._result_cache_dir is not None,
+                    index_cache=index_cache,
+                ),
+                self._workers,
+                self._selectors,
+                **task_kwargs,
+            )
+        new_chain = False
+        while self._task_scan_i >= len(self._task_scans):
+            task_result = None
+            if self._task_ret_code in {None, LmcrecScanRetCode.ATEOR}:
+                task_result = next(self._task_results, None)
+            if task_result is None:
+                ret_code = self._task_ret_code or LmcrecScanRetCode.ATEOR
+                self.close()
+                return ret_code, None, None
+            self._task_scans, self._task_scan_i = task_result.scans, 0
+            self._task_ret_code = task_result.ret_code
+            new_chain = new_chain or task_result.new_chain
+        ts, prev_ts, result = self._task_scans[self._task_scan_i]
+        # Release the reference, the result is handed over to the caller:
+        self._task_scans[self._task_scan_i] = None
+        self._task_scan_i += 1
+        query_state_cache.ts = ts
+        query_state_cache.prev_ts = prev_ts
+        query_state_cache.new_chain = new_chain
+        if query_state_cache.first_ts is None:
+            query_state_cache.first_ts = ts
+        query_state_cache.last_ts = ts
+        return LmcrecScanRetCode.COMPLETE, ts, result
+
+    def close(self):
+        """Release the resources, e.g. the worker pool, used by the query"""
+
+        if self._task_results is not None:
+            self._task_results.close()
+            self._task_scans, self._task_scan_i = [], 0
+            self._task_ret_code = LmcrecScanRetCode.CLOSED
+        self.query_state_cache.close()
+
     def run_with_callback(
         self,
         cb: Optional[
@@ -147,8 +436,16 @@ class LmcrecQuery:
                 break
             if cb is not None and not cb(result, self.query_state_cache):
                 break
+        if self._use_tasks:
+            self.close()
         return ret_code
 
+    @property
+    def window_index(self) -> Optional[int]:
+        """The index of the window of the most recent results, for windows"""
+
+        return self.query_state_cache.window_index
+
     @property
     def first_ts(self):
         return self.query_state_cache.first_ts
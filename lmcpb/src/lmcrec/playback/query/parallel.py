@@ -0,0 +1,535 @@
+"""Parallel query execution
+
+The file chains returned by build_lmcrec_file_chains share no state, so they can
+be played back independently, each by its own worker process. The work is
+described by tasks, one per chain, and the task results are delivered in task,
+i.e. chronological, order.
+
+A task may span days worth of scans, so its results are not returned as a
+whole: the task is played back by iter_query_task, which yields batches of at
+most PARALLEL_BATCH_SIZE scans, and the batches are streamed back from the
+workers through bounded queues, see stream_tasks_in_order. The memory used by
+the pending results is bounded by the number of tasks in flight times the
+queue size times the batch size, regardless of the time window.
+
+A long chain may be further split into segments at checkpoint boundaries, since
+the checkpoints are full state restart points, see the index file. The segments
+overlap by one scan, the checkpoint: the segment ending at a checkpoint includes
+it, with the previous values from the scan before, whereas the segment starting
+at it uses it only to seed the state cache and it skips it.
+
+The segments are streamed like the chains: the first scans of the segment
+being consumed are delivered while the worker is still playing it back, so
+the first results are available w/o waiting for a whole segment.
+
+"""
+
+import os
+import queue
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import Manager
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+from codec import INDEX_FILE_SUFFIX, LmcrecIndexCache, LmcrecIndexFileDecoder
+
+from .file_selector import LmcrecFileEntry
+from .query_selector import LmcrecQueryClassResult, LmcrecQuerySelector
+from .query_state_cache import LmcrecQueryIntervalStateCache
+from .state_snapshot import LmcrecStateSnapshotCache
+
+# How many tasks, per worker, may be queued ahead of the one whose results are
+# being consumed. This bounds the memory used by completed, but not yet
+# consumed, task results:
+PARALLEL_TASKS_AHEAD_PER_WORKER = 2
+
+# The maximum number of scans in a batch of task results:
+PARALLEL_BATCH_SIZE = 64
+
+# How many batches of a task may be queued ahead of the one being consumed, see
+# stream_tasks_in_order. A worker whose queue is full waits for the consumer:
+PARALLEL_BATCHES_AHEAD_PER_TASK = 4
+
+# How often a worker waiting for queue space checks for cancellation, in seconds:
+PARALLEL_QUEUE_POLL_INTERVAL = 0.1
+
+# The minimum duration of a chain segment, in seconds; the chains are split at
+# the first checkpoint at least that far from the start of the segment. Smaller
+# segments balance the load better and they reduce the memory used by the
+# pending results at the expense of seeding more state caches:
+PARALLEL_SEGMENT_DURATION = 3600
+
+
+@dataclass
+class LmcrecQueryTask:
+    """A unit of work for a worker: the playback of a chain"""
+
+    # The order number, the results are delivered in this order:
+    index: int = 0
+    # The file entry where the playback starts, either the head of the chain
+    # or the file containing the segment start checkpoint:
+    chain_entry: Optional[LmcrecFileEntry] = None
+    # The time window:
+    from_ts: Optional[float] = None
+    to_ts: Optional[float] = None
+    # Whether the task is the continuation of the previous one, from the same
+    # chain, in which case the first scan, i.e. the checkpoint at from_ts, is
+    # used only for seeding the state cache:
+    skip_first: bool = False
+
+
+@dataclass
+class LmcrecQueryTaskResult:
+    """The results of a task or of a batch of scans from a task
+
+    For batches, see iter_query_task, only the last one of the task has the
+    ret_code set and only the first one may have new_chain set.
+    """
+
+    index: int = 0
+    # (ts, prev_ts, result) for each scan, in chronological order; the result
+    # has the same structure as LmcrecQueryResult:
+    scans: List[Tuple[float, Optional[float], Any]] = field(default_factory=list)
+    first_ts: Optional[float] = None
+    last_ts: Optional[float] = None
+    ret_code: Optional[LmcrecScanRetCode] = None
+    # Whether the first scan starts a new chain or it continues the chain from
+    # the previous task:
+    new_chain: bool = True
+
+    def set_ts_range(self):
+        """Update first_ts and last_ts from the scans"""
+
+        if self.scans:
+            self.first_ts = self.scans[0][0]
+            self.last_ts = self.scans[-1][0]
+
+
+def resolve_workers(workers: Optional[int] = None) -> int:
+    """Return the actual number of workers, <= 0 stands for the number of CPUs"""
+
+    if workers is None:
+        return 1
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def get_chain_checkpoints(
+    chain_entry: LmcrecFileEntry,
+    index_cache: Optional[LmcrecIndexCache] = None,
+) -> List[Tuple[float, LmcrecFileEntry]]:
+    """Return the list of (checkpoint ts, file entry) for the chain
+
+    Files w/o index are ignored, their playback will be part of the segment
+    started by a previous checkpoint. If index_cache is provided then the index
+    files are looked up in it rather than being decoded.
+    """
+
+    checkpoints = []
+    while chain_entry is not None:
+        index_file_name = chain_entry.file_name + INDEX_FILE_SUFFIX
+        try:
+            if index_cache is not None:
+                file_checkpoints = index_cache.get(index_file_name)
+            else:
+                index_decoder = LmcrecIndexFileDecoder(index_file_name)
+                file_checkpoints = list(index_decoder.checkpoints())
+                index_decoder.close()
+        except FileNotFoundError:
+            file_checkpoints = []
+        prev_ts = checkpoints[-1][0] if checkpoints else None
+        for ts, _ in file_checkpoints:
+            # Sanity check, the checkpoints should be in chronological order:
+            if prev_ts is None or ts > prev_ts:
+                checkpoints.append((ts, chain_entry))
+                prev_ts = ts
+        chain_entry = chain_entry.next
+    return checkpoints
+
+
+def split_chain(
+    chain_entry: LmcrecFileEntry,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    segment_duration: Optional[float] = None,
+    at_files: bool = False,
+    index_cache: Optional[LmcrecIndexCache] = None,
+) -> List[Tuple[LmcrecFileEntry, Optional[float], Optional[float]]]:
+    """Split the chain time window into segments at checkpoint boundaries
+
+    The segments are at least segment_duration long, if specified, and/or they
+    are split at file boundaries, i.e. at the first checkpoint of each file, if
+    at_files is True.
+
+    Returns:
+        The list of (file entry, from_ts, to_ts), one per segment. All but
+        the first segment start at a checkpoint, which is also the end of the
+        previous segment.
+    """
+
+    if segment_duration is not None and segment_duration <= 0:
+        segment_duration = None
+    if segment_duration is None and not at_files:
+        return [(chain_entry, from_ts, to_ts)]
+
+    segments = []
+    seg_entry, seg_from_ts, seg_start = chain_entry, from_ts, from_ts
+    prev_entry = chain_entry
+    for ts, entry in get_chain_checkpoints(chain_entry, index_cache=index_cache):
+        new_file, prev_entry = entry is not prev_entry, entry
+        if from_ts is not None and ts <= from_ts:
+            continue
+        if to_ts is not None and ts >= to_ts:
+            break
+        if seg_start is None:
+            seg_start = ts
+        elif (
+            at_files
+            and new_file
+            or segment_duration is not None
+            and ts - seg_start >= segment_duration
+        ):
+            segments.append((seg_entry, seg_from_ts, ts))
+            seg_entry, seg_from_ts, seg_start = entry, ts, ts
+    segments.append((seg_entry, seg_from_ts, to_ts))
+    return segments
+
+
+def build_query_tasks(
+    chain_list: Optional[List[LmcrecFileEntry]],
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    segment_duration: Optional[float] = None,
+    at_files: bool = False,
+    index_cache: Optional[LmcrecIndexCache] = None,
+) -> List[LmcrecQueryTask]:
+    """Build the task list for the given chains and time window
+
+    If segment_duration is specified and/or at_files is True then the chains
+    are split into segments at checkpoint boundaries, see split_chain, with one
+    task per segment, otherwise there is one task per chain.
+    """
+
+    tasks = []
+    for chain_entry in chain_list or []:
+        segments = split_chain(
+            chain_entry,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            segment_duration=segment_duration,
+            at_files=at_files,
+            index_cache=index_cache,
+        )
+        for k, (seg_entry, seg_from_ts, seg_to_ts) in enumerate(segments):
+            tasks.append(
+                LmcrecQueryTask(
+                    index=len(tasks),
+                    chain_entry=seg_entry,
+                    from_ts=seg_from_ts,
+                    to_ts=seg_to_ts,
+                    skip_first=k > 0,
+                )
+            )
+    return tasks
+
+
+def copy_query_result(result: Any) -> Any:
+    """Make a copy of the query result
+
+    The query selectors re-use the result lists from one scan to the next, so
+    the results have to be copied if they are to be stored.
+    """
+
+    return {
+        query_name: {
+            class_name: LmcrecQueryClassResult(
+                var_names=list(class_result.var_names),
+                vals_by_inst={
+                    inst_name: list(vals)
+                    for inst_name, vals in class_result.vals_by_inst.items()
+                },
+            )
+            for class_name, class_result in query_result.items()
+        }
+        for query_name, query_result in result.items()
+    }
+
+
+def iter_query_task(
+    task: LmcrecQueryTask,
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+    index_cache: Optional[LmcrecIndexCache] = None,
+    snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+    batch_size: int = PARALLEL_BATCH_SIZE,
+) -> Iterator[LmcrecQueryTaskResult]:
+    """Play back the task chain and run the query selectors for each scan
+
+    The results are yielded in batches of at most batch_size scans, the last
+    batch, possibly w/o scans, has the ret_code set. The selectors are the
+    caller's own copies. The index_cache and snapshot_cache are meaningful only
+    for in-process execution.
+    """
+
+    query_state_cache = LmcrecQueryIntervalStateCache(
+        from_ts=task.from_ts,
+        to_ts=task.to_ts,
+        have_prev=have_prev,
+        track_changes=track_changes,
+        chain_list=[task.chain_entry],
+        index_cache=index_cache,
+        snapshot_cache=snapshot_cache,
+    )
+    batch = LmcrecQueryTaskResult(index=task.index, new_chain=not task.skip_first)
+    skip_first = task.skip_first
+    try:
+        while True:
+            ret_code = query_state_cache.apply_next_scan()
+            if ret_code != LmcrecScanRetCode.COMPLETE:
+                break
+            # The selectors are run even for a skipped scan since they may cache
+            # class info, updated based on the new chain/class def:
+            result = {
+                selector.name: selector.run(query_state_cache) for selector in selectors
+            }
+            if skip_first:
+                # The checkpoint was already reported by the previous task:
+                skip_first = False
+                continue
+            batch.scans.append(
+                (
+                    query_state_cache.ts,
+                    query_state_cache.prev_ts,
+                    copy_query_result(result),
+                )
+            )
+            if len(batch.scans) >= batch_size:
+                batch.set_ts_range()
+                yield batch
+                batch = LmcrecQueryTaskResult(index=task.index, new_chain=False)
+    finally:
+        query_state_cache.close()
+    batch.set_ts_range()
+    batch.ret_code = ret_code
+    yield batch
+
+
+def merge_task_batches(
+    batches: Iterable[LmcrecQueryTaskResult],
+) -> Optional[LmcrecQueryTaskResult]:
+    """Merge the batches of a task into a single task result"""
+
+    task_result = None
+    for batch in batches:
+        if task_result is None:
+            task_result = LmcrecQueryTaskResult(
+                index=batch.index, new_chain=batch.new_chain
+            )
+        task_result.scans.extend(batch.scans)
+        task_result.ret_code = batch.ret_code
+    if task_result is not None:
+        task_result.set_ts_range()
+    return task_result
+
+
+def split_task_result(
+    task_result: LmcrecQueryTaskResult, batch_size: int = PARALLEL_BATCH_SIZE
+) -> Iterator[LmcrecQueryTaskResult]:
+    """Split a task result into batches, the counterpart of merge_task_batches"""
+
+    scans = task_result.scans
+    for i in range(0, max(len(scans), 1), batch_size):
+        batch = LmcrecQueryTaskResult(
+            index=task_result.index,
+            scans=scans[i : i + batch_size],
+            new_chain=task_result.new_chain and i == 0,
+        )
+        batch.set_ts_range()
+        if i + batch_size >= len(scans):
+            batch.ret_code = task_result.ret_code
+        yield batch
+
+
+def run_query_task(
+    task: LmcrecQueryTask,
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+    index_cache: Optional[LmcrecIndexCache] = None,
+    snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+) -> LmcrecQueryTaskResult:
+    """Play back the task chain and return all its results at once
+
+    The whole task counterpart of iter_query_task, for the callers which need
+    all the results anyway.
+    """
+
+    return merge_task_batches(
+        iter_query_task(
+            task,
+            selectors,
+            have_prev=have_prev,
+            track_changes=track_changes,
+            index_cache=index_cache,
+            snapshot_cache=snapshot_cache,
+        )
+    )
+
+
+def run_tasks_in_order(
+    fn: Callable[..., Any],
+    tasks: Iterable[Any],
+    workers: int = 1,
+    *args,
+    **kwargs,
+) -> Iterator[Any]:
+    """Run fn(task, *args, **kwargs) for each task and yield the results in
+    task order
+
+    If workers > 1 then the tasks are run by a process pool, otherwise they are
+    run in the current process. fn, the tasks and the args must be picklable
+    for the former. Closing the iterator before exhaustion will cancel the
+    pending tasks.
+    """
+
+    if workers <= 1:
+        for task in tasks:
+            yield fn(task, *args, **kwargs)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending: Deque[Future] = deque()
+    try:
+        task_iter = iter(tasks)
+        max_pending = workers * PARALLEL_TASKS_AHEAD_PER_WORKER
+        for task in task_iter:
+            pending.append(executor.submit(fn, task, *args, **kwargs))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for task in task_iter:
+                pending.append(executor.submit(fn, task, *args, **kwargs))
+                break
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# The kinds of items in the stream_tasks_in_order queues:
+STREAM_ITEM = 0
+STREAM_END = 1
+STREAM_ERROR = 2
+
+
+def stream_task(
+    fn: Callable[..., Iterable[Any]],
+    task_queue: Any,
+    cancel: Any,
+    task: Any,
+    *args,
+    **kwargs,
+):
+    """The worker function for stream_tasks_in_order
+
+    Put the items yielded by fn(task, *args, **kwargs) into the queue, followed
+    by an end or an error marker. Give up if cancel (Event) is set while waiting
+    for queue space.
+    """
+
+    def put(kind: int, item: Any = None) -> bool:
+        while True:
+            try:
+                task_queue.put((kind, item), timeout=PARALLEL_QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if cancel.is_set():
+                    return False
+
+    try:
+        for item in fn(task, *args, **kwargs):
+            if not put(STREAM_ITEM, item):
+                return
+    except Exception as e:
+        put(STREAM_ERROR, e)
+        return
+    put(STREAM_END)
+
+
+def stream_tasks_in_order(
+    fn: Callable[..., Iterable[Any]],
+    tasks: Iterable[Any],
+    workers: int = 1,
+    *args,
+    **kwargs,
+) -> Iterator[Any]:
+    """Run fn(task, *args, **kwargs), a generator, for each task and yield
+    the generated items in task order
+
+    This is the streaming counterpart of run_tasks_in_order: if workers > 1
+    then the items of each task are passed back from the worker through a
+    bounded queue as soon as they are generated, such that the items of the
+    current task are delivered while the task is still running and the workers
+    running ahead are paused once PARALLEL_BATCHES_AHEAD_PER_TASK items are
+    pending. Otherwise the tasks are run in the current process, one item at a
+    time. Closing the iterator before exhaustion will cancel the pending tasks.
+    """
+
+    if workers <= 1:
+        for task in tasks:
+            yield from fn(task, *args, **kwargs)
+        return
+
+    manager = Manager()
+    cancel = manager.Event()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending: Deque[Tuple[Future, Any]] = deque()
+
+    def submit(task: Any):
+        task_queue = manager.Queue(maxsize=PARALLEL_BATCHES_AHEAD_PER_TASK)
+        pending.append(
+            (
+                executor.submit(
+                    stream_task, fn, task_queue, cancel, task, *args, **kwargs
+                ),
+                task_queue,
+            )
+        )
+
+    try:
+        task_iter = iter(tasks)
+        max_pending = workers * PARALLEL_TASKS_AHEAD_PER_WORKER
+        for task in task_iter:
+            submit(task)
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            future, task_queue = pending[0]
+            while True:
+                try:
+                    kind, item = task_queue.get(timeout=PARALLEL_QUEUE_POLL_INTERVAL)
+                except queue.Empty:
+                    if future.done():
+                        # Raise the worker failure, e.g. unpicklable args:
+                        future.result()
+                        if task_queue.empty():
+                            raise RuntimeError("task ended w/o end marker")
+                    continue
+                if kind == STREAM_ITEM:
+                    yield item
+                elif kind == STREAM_ERROR:
+                    raise item
+                else:
+                    break
+            pending.popleft()
+            for task in task_iter:
+                submit(task)
+                break
+    finally:
+        cancel.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        manager.shutdown()
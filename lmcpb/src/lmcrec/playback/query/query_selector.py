@@ -4,9 +4,13 @@ See https://github.com/bgp59/lmc-recorder/tree/main/docs/QueryDescription.md for
 
 """
 
+import ast
+import copy
+import heapq
+import operator
 import re
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 import yaml
 from cache import LmcrecStateCache
@@ -24,10 +28,49 @@ QUERY_INSTANCE_PREFIX = "~"
 QUERY_NAME_KEY = "n"
 QUERY_INST_KEY = "i"
 QUERY_CLASS_KEY = "c"
+QUERY_SUBTREE_KEY = "s"
 QUERY_EXCLUDE_TYPE_KEY = "T"
 QUERY_INCLUDE_TYPE_KEY = "t"
 QUERY_EXCLUDE_VAR_KEY = "V"
 QUERY_INCLUDE_VAR_KEY = "v"
+QUERY_TOP_K_KEY = "k"
+
+# Top-K spec: COLUMN/K[/w], the latter for the whole window rather than per scan:
+QUERY_TOP_K_SEP = "/"
+QUERY_TOP_K_WINDOW_FLAG = "w"
+
+# Group-by aggregation across instances: g: class | /REGEX/ | N, a: AGG[,AGG...]
+QUERY_GROUP_BY_KEY = "g"
+QUERY_GROUP_AGG_KEY = "a"
+QUERY_GROUP_BY_CLASS = "class"
+
+QUERY_GROUP_AGG_COUNT = "count"
+QUERY_GROUP_AGG_SUM = "sum"
+QUERY_GROUP_AGG_MIN = "min"
+QUERY_GROUP_AGG_MAX = "max"
+QUERY_GROUP_AGG_MEAN = "mean"
+# Percentiles are pNN, e.g. p50, p99, p99.9:
+QUERY_GROUP_AGG_PERCENTILE_PREFIX = "p"
+
+QUERY_GROUP_AGGREGATES = [
+    QUERY_GROUP_AGG_COUNT,
+    QUERY_GROUP_AGG_SUM,
+    QUERY_GROUP_AGG_MIN,
+    QUERY_GROUP_AGG_MAX,
+    QUERY_GROUP_AGG_MEAN,
+]
+
+# Per column group accumulator indices:
+_GROUP_ACC_COUNT = 0
+_GROUP_ACC_NUM = 1
+_GROUP_ACC_SUM = 2
+_GROUP_ACC_MIN = 3
+_GROUP_ACC_MAX = 4
+_GROUP_ACC_VALS = 5
+
+# Derived columns: e: NAME = EXPR or a list thereof, or {NAME: EXPR, ...}:
+QUERY_DERIVED_KEY = "e"
+QUERY_DERIVED_SEP = "="
 
 # Variable value qualifier separator:
 QUERY_VAL_QUAL_SEP = ":"
@@ -85,6 +128,68 @@ delta_rate_types = set(
 )
 
 
+# Value predicate operators, e.g. "var:r>10"; the order matters for parsing, the
+# 2 char operators should be tried first:
+query_predicate_op_map = {
+    "<=": operator.le,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+query_predicate_op_re = re.compile(
+    "|".join(re.escape(op) for op in query_predicate_op_map)
+)
+
+# A compiled predicate: (op, operand):
+LmcrecQueryPredicate = Tuple[Callable[[Any, Any], bool], Any]
+
+
+def parse_predicate_operand(operand: str) -> Any:
+    """Convert the predicate operand to a number or bool, if possible
+
+    Quoted operands are always strings, the quotes are removed.
+    """
+
+    operand = operand.strip()
+    if len(operand) >= 2 and operand[0] == operand[-1] and operand[0] in "\"'":
+        return operand[1:-1]
+    for convert in (int, float):
+        try:
+            return convert(operand)
+        except ValueError:
+            pass
+    if operand.lower() in {"true", "false"}:
+        return operand.lower() == "true"
+    return operand
+
+
+def split_var_predicate(spec: str) -> Tuple[str, Optional[LmcrecQueryPredicate]]:
+    """Split VAR[:QUALS][OP OPERAND] into VAR[:QUALS] and (op, operand)"""
+
+    m = query_predicate_op_re.search(spec)
+    if m is None:
+        return spec, None
+    return spec[: m.start()].strip(), (
+        query_predicate_op_map[m.group()],
+        parse_predicate_operand(spec[m.end() :]),
+    )
+
+
+def eval_predicate(predicate: LmcrecQueryPredicate, val: Any) -> bool:
+    """Evaluate the predicate; None values and type mismatches do not match"""
+
+    if val is None:
+        return False
+    op, operand = predicate
+    try:
+        return bool(op(val, operand))
+    except TypeError:
+        return False
+
+
 def parse_var_val_qualifiers(var_quals: str) -> int:
     flags = 0
     for q in var_quals:
@@ -94,6 +199,367 @@ def parse_var_val_qualifiers(var_quals: str) -> int:
     return flags
 
 
+# Variable references in derived column expressions, VAR[:QUAL]; the lookbehind
+# excludes the exponent in numbers such as 1e3:
+query_derived_ref_re = re.compile(r"(?<![\w.])([A-Za-z_]\w*)(?::([A-Za-z]+))?")
+
+# The functions which may be used in derived column expressions:
+query_derived_funcs = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+}
+
+query_derived_ast_nodes = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+)
+
+# The max absolute value of the exponent for **, which must be a number
+# constant such that the evaluation is bounded:
+QUERY_DERIVED_MAX_EXPONENT = 16
+
+# Placeholder prefix for the variable references in the parsed expression:
+_DERIVED_REF_PREFIX = "_r"
+# The name of the value list argument of the compiled expression:
+_DERIVED_VALS_ARG = "_v"
+
+
+@dataclass
+class LmcrecQueryDerived:
+    """Derived column, computed from other columns of the same instance"""
+
+    name: str
+    expr: str
+    # The referenced columns, normalized as per the result column names, e.g.
+    # "hits:d"; they map to placeholders _r0, _r1, ... in tree:
+    refs: List[str]
+    # The parsed expression:
+    tree: ast.Expression
+
+
+def parse_derived_spec(name: str, expr: str) -> LmcrecQueryDerived:
+    """Parse the expression for a derived column
+
+    The expression may use numbers, VAR[:QUAL] references with at most one
+    value qualifier, the operators + - * / // % ** and abs(), min(), max().
+    The exponent for ** must be a number constant, at most
+    QUERY_DERIVED_MAX_EXPONENT in absolute value.
+
+    Raises:
+        ValueError for invalid expressions
+    """
+
+    name, expr = str(name).strip(), str(expr).strip()
+    if not name or not expr:
+        raise ValueError(f"{name!r} = {expr!r}: invalid derived column")
+    refs: List[str] = []
+
+    def ref_to_placeholder(m: re.Match) -> str:
+        var_name, var_quals = m.group(1), m.group(2)
+        if var_quals is None and var_name in query_derived_funcs:
+            if expr[m.end() :].lstrip().startswith("("):
+                return m.group()
+        col_name = var_name
+        if var_quals is not None:
+            qual_flags = parse_var_val_qualifiers(var_quals)
+            if qual_flags & (qual_flags - 1):
+                raise ValueError(
+                    f"{name}: {m.group()!r}: at most one value qualifier allowed"
+                )
+            qual_suffix = var_val_flag_qual_map.get(qual_flags)
+            if qual_suffix:
+                col_name += f"{QUERY_VAL_QUAL_SEP}{qual_suffix}"
+        if col_name not in refs:
+            refs.append(col_name)
+        return f"{_DERIVED_REF_PREFIX}{refs.index(col_name)}"
+
+    try:
+        tree = ast.parse(
+            query_derived_ref_re.sub(ref_to_placeholder, expr), mode="eval"
+        )
+    except SyntaxError as e:
+        raise ValueError(f"{name}: {expr!r}: {e.msg}") from None
+    for node in ast.walk(tree):
+        if not isinstance(node, query_derived_ast_nodes):
+            raise ValueError(
+                f"{name}: {expr!r}: {node.__class__.__name__} not supported"
+            )
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"{name}: {expr!r}: {node.value!r} not supported")
+        if isinstance(node, ast.Call) and (
+            node.keywords
+            or not isinstance(node.func, ast.Name)
+            or node.func.id not in query_derived_funcs
+        ):
+            raise ValueError(f"{name}: {expr!r}: unsupported function call")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            exponent = node.right
+            if isinstance(exponent, ast.UnaryOp) and isinstance(
+                exponent.op, (ast.UAdd, ast.USub)
+            ):
+                exponent = exponent.operand
+            if (
+                not isinstance(exponent, ast.Constant)
+                or not isinstance(exponent.value, (int, float))
+                or isinstance(exponent.value, bool)
+                or abs(exponent.value) > QUERY_DERIVED_MAX_EXPONENT
+            ):
+                raise ValueError(
+                    f"{name}: {expr!r}: the exponent should be a number constant "
+                    f"in the [-{QUERY_DERIVED_MAX_EXPONENT}, "
+                    f"{QUERY_DERIVED_MAX_EXPONENT}] range"
+                )
+    if not refs:
+        raise ValueError(f"{name}: {expr!r}: no variable reference")
+    return LmcrecQueryDerived(name=name, expr=expr, refs=refs, tree=tree)
+
+
+def parse_derived_specs(spec: Any) -> List[LmcrecQueryDerived]:
+    """Parse e: NAME = EXPR, a list thereof, or {NAME: EXPR, ...}
+
+    Raises:
+        ValueError for invalid specs
+    """
+
+    if not spec:
+        return []
+    if isinstance(spec, dict):
+        items = list(spec.items())
+    else:
+        if isinstance(spec, str):
+            spec = [spec]
+        items = []
+        for name_expr in spec:
+            name, sep, expr = str(name_expr).partition(QUERY_DERIVED_SEP)
+            if not sep:
+                raise ValueError(
+                    f"{name_expr!r}: invalid derived column, want: NAME = EXPR"
+                )
+            items.append((name, expr))
+    return [parse_derived_spec(name, expr) for name, expr in items]
+
+
+class _DerivedRefTransformer(ast.NodeTransformer):
+    """Replace the placeholders w/ indexed access into the value list"""
+
+    def __init__(self, ref_indices: List[int]):
+        self._ref_indices = ref_indices
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if not node.id.startswith(_DERIVED_REF_PREFIX):
+            return node
+        return ast.Subscript(
+            value=ast.Name(id=_DERIVED_VALS_ARG, ctx=ast.Load()),
+            slice=ast.Constant(
+                value=self._ref_indices[int(node.id[len(_DERIVED_REF_PREFIX) :])]
+            ),
+            ctx=ast.Load(),
+        )
+
+
+def compile_derived(
+    derived: LmcrecQueryDerived, ref_indices: List[int]
+) -> Callable[[List[Any]], Any]:
+    """Compile the derived column expression into a function of the value list
+
+    Args:
+        derived (LmcrecQueryDerived): the parsed derived column
+        ref_indices (List[int]): the index in the value list for each of the
+            derived.refs
+
+    Returns:
+        The function, which may raise arithmetic and type errors.
+    """
+
+    body = _DerivedRefTransformer(ref_indices).visit(copy.deepcopy(derived.tree.body))
+    func_tree = ast.Expression(
+        body=ast.Lambda(
+            args=ast.arguments(
+                posonlyargs=[],
+                args=[ast.arg(arg=_DERIVED_VALS_ARG)],
+                kwonlyargs=[],
+                kw_defaults=[],
+                defaults=[],
+            ),
+            body=body,
+        )
+    )
+    ast.fix_missing_locations(func_tree)
+    code = compile(func_tree, f"<{derived.name}>", "eval")
+    return eval(code, {"__builtins__": {}, **query_derived_funcs})
+
+
+def eval_derived(
+    derived_info: List[Tuple[int, Optional[Callable], List[int]]],
+    var_vals: List[Any],
+):
+    """Evaluate the derived columns in place
+
+    The result is None if any of the referenced values is None or a string, or
+    if the evaluation fails, e.g. division by 0.
+    """
+
+    for dest_i, func, ref_indices in derived_info:
+        val = None
+        if func is not None:
+            for i in ref_indices:
+                ref_val = var_vals[i]
+                if ref_val is None or isinstance(ref_val, str):
+                    break
+            else:
+                try:
+                    val = func(var_vals)
+                except (ArithmeticError, TypeError, ValueError):
+                    pass
+        var_vals[dest_i] = val
+
+
+def parse_top_k_spec(spec: Any) -> Tuple[Tuple[str, int], bool]:
+    """Parse COLUMN/K[/w] top-K spec
+
+    COLUMN is VAR[:QUAL], with at most one qualifier, and it is normalized to
+    the result column name, e.g. "var:v" -> "var".
+
+    Returns:
+        ((column, k), window)
+
+    Raises:
+        ValueError for invalid spec
+    """
+
+    parts = [part.strip() for part in str(spec).split(QUERY_TOP_K_SEP)]
+    if (
+        len(parts) not in {2, 3}
+        or not parts[0]
+        or len(parts) == 3
+        and parts[2] != QUERY_TOP_K_WINDOW_FLAG
+    ):
+        raise ValueError(
+            f"{spec!r}: invalid top-K spec, want: "
+            f"VAR[:QUAL]{QUERY_TOP_K_SEP}K[{QUERY_TOP_K_SEP}{QUERY_TOP_K_WINDOW_FLAG}]"
+        )
+    try:
+        k = int(parts[1])
+    except ValueError:
+        k = 0
+    if k <= 0:
+        raise ValueError(f"{spec!r}: invalid top-K spec, K should be an int > 0")
+    col_name = parts[0]
+    i = col_name.rfind(QUERY_VAL_QUAL_SEP)
+    if i > 0:
+        qual_flags = parse_var_val_qualifiers(col_name[i + 1 :])
+        if qual_flags & (qual_flags - 1):
+            raise ValueError(
+                f"{spec!r}: invalid top-K spec, at most one value qualifier allowed"
+            )
+        col_name = col_name[:i]
+        qual_suffix = var_val_flag_qual_map.get(qual_flags)
+        if qual_suffix:
+            col_name += f"{QUERY_VAL_QUAL_SEP}{qual_suffix}"
+    return (col_name, k), len(parts) == 3
+
+
+def parse_group_aggregates(spec: Any = None) -> List[Tuple[str, Optional[float]]]:
+    """Parse the group-by aggregates
+
+    Args:
+        spec: comma separated string or list of aggregates, from
+            QUERY_GROUP_AGGREGATES or pNN percentiles, e.g. p99. If empty then
+            all the non-percentile aggregates are used.
+
+    Returns:
+        List[Tuple[str, Optional[float]]]: (aggregate, percentile) in spec
+        order, w/ duplicates removed. The percentile is None for
+        non-percentile aggregates.
+
+    Raises:
+        ValueError for invalid aggregates
+    """
+
+    if not spec:
+        return [(agg, None) for agg in QUERY_GROUP_AGGREGATES]
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    aggregates = []
+    for agg in spec:
+        agg = str(agg).strip().lower()
+        percentile = None
+        if agg not in QUERY_GROUP_AGGREGATES:
+            try:
+                if not agg.startswith(QUERY_GROUP_AGG_PERCENTILE_PREFIX):
+                    raise ValueError()
+                percentile = float(agg[len(QUERY_GROUP_AGG_PERCENTILE_PREFIX) :])
+                if not 0 <= percentile <= 100:
+                    raise ValueError()
+            except ValueError:
+                raise ValueError(
+                    f"invalid aggregate {agg!r}, want one of "
+                    f"{QUERY_GROUP_AGGREGATES} or pNN percentile"
+                ) from None
+        if (agg, percentile) not in aggregates:
+            aggregates.append((agg, percentile))
+    return aggregates
+
+
+def group_agg_col_name(agg: str, col_name: str) -> str:
+    return f"{agg}({col_name})"
+
+
+def percentile_of_sorted(vals: List[Any], percentile: float) -> Any:
+    """Percentile w/ linear interpolation of a sorted, non-empty, list"""
+
+    pos = percentile / 100 * (len(vals) - 1)
+    i = int(pos)
+    if i >= len(vals) - 1:
+        return vals[-1]
+    frac = pos - i
+    return vals[i] + (vals[i + 1] - vals[i]) * frac if frac else vals[i]
+
+
+def group_acc_result(
+    accs: List[List[Any]], aggregates: List[Tuple[str, Optional[float]]]
+) -> List[Any]:
+    """Build the aggregated values from the per column group accumulators"""
+
+    vals = []
+    for acc in accs:
+        num = acc[_GROUP_ACC_NUM]
+        sorted_vals = None
+        for agg, percentile in aggregates:
+            if agg == QUERY_GROUP_AGG_COUNT:
+                vals.append(acc[_GROUP_ACC_COUNT])
+            elif num == 0:
+                vals.append(None)
+            elif agg == QUERY_GROUP_AGG_SUM:
+                vals.append(acc[_GROUP_ACC_SUM])
+            elif agg == QUERY_GROUP_AGG_MIN:
+                vals.append(acc[_GROUP_ACC_MIN])
+            elif agg == QUERY_GROUP_AGG_MAX:
+                vals.append(acc[_GROUP_ACC_MAX])
+            elif agg == QUERY_GROUP_AGG_MEAN:
+                vals.append(acc[_GROUP_ACC_SUM] / num)
+            else:
+                if sorted_vals is None:
+                    sorted_vals = sorted(acc[_GROUP_ACC_VALS])
+                vals.append(percentile_of_sorted(sorted_vals, percentile))
+    return vals
+
+
 @dataclass
 class LmcrecQueryClassSelector:
     """Per class query selector.
@@ -113,10 +579,33 @@ class LmcrecQueryClassSelector:
     var_names: List[str] = field(default_factory=list)
     # Instance names:
     inst_names: Set[str] = field(default_factory=set)
+    # Value predicates, all must match for the instance to be selected; list
+    # of (index in var_names, predicate). The index is None for variables
+    # missing from the class, in which case no instance will match:
+    predicates: List[Tuple[Optional[int], LmcrecQueryPredicate]] = field(
+        default_factory=list
+    )
     # The timestamp of the last class_info used to update the selector. It will
     # be compared against the class_info.last_update_ts to determine if the
     # current selector is valid or it needs updating:
     last_update_ts: Optional[float] = None
+    # The index in var_names of the top-K ranking column, if any:
+    top_k_index: Optional[int] = None
+    # Derived columns, appended to var_names; list of:
+    #   (value index, compiled expression or None, value indices of refs)
+    # The function is None if the class is missing a referenced variable:
+    derived_info: List[Tuple[int, Optional[Callable], List[int]]] = field(
+        default_factory=list
+    )
+    # The number of hidden values, i.e. referenced by derived columns but not
+    # selected. They are stored in the value list after the result columns:
+    num_hidden: int = 0
+    # The index in var_handling_info based value list where the hidden values
+    # start, -1 if none:
+    hidden_val_i: int = -1
+    # The result column names for group-by aggregation, if any, i.e. AGG(VAR)
+    # for each of var_names and each of the aggregates:
+    group_var_names: List[str] = field(default_factory=list)
 
 
 @dataclass
@@ -147,13 +636,24 @@ class LmcrecQuerySelector:
 
     """
 
-    def __init__(self, query: Dict[str, Any]):
-        """Create query selector from query"""
+    def __init__(self, query: Dict[str, Any], changed_only: bool = False):
+        """Create query selector from query
+
+        If changed_only is True then the result will include only the instances
+        with at least one selected variable that changed since the previous
+        scan; this requires a state cache w/ track_changes enabled. The first
+        scan of a chain is always reported in full.
+        """
+
+        # The original query, e.g. for building result cache keys:
+        self.query = query
 
         self.name = query.get(QUERY_NAME_KEY)
 
         self.needs_prev = False
 
+        self.changed_only = changed_only
+
         self._query_full_inst_names = set()
         self._query_prefix_inst_names = []
         self._query_inst_re = []
@@ -170,7 +670,85 @@ class LmcrecQuerySelector:
                 else:
                     self._query_full_inst_names.add(inst_name)
 
+        # Subtree selection, the descendants of the given instance(s), resolved
+        # via the instance hierarchy maintained by the state cache:
+        self._query_subtree_full_names = []
+        self._query_subtree_prefix_names = []
+        subtree_names = query.get(QUERY_SUBTREE_KEY)
+        if isinstance(subtree_names, str):
+            subtree_names = [subtree_names]
+        if subtree_names:
+            for inst_name in subtree_names:
+                if inst_name.startswith(QUERY_INSTANCE_PREFIX):
+                    self._query_subtree_prefix_names.append(inst_name[1:])
+                else:
+                    self._query_subtree_full_names.append(inst_name)
+
+        # Class selection, a class name or a list thereof:
         self._query_class_name = query.get(QUERY_CLASS_KEY)
+        class_names = self._query_class_name
+        if isinstance(class_names, str):
+            class_names = [class_names]
+        self._query_class_names = set(class_names) if class_names else None
+
+        # Top-K: ((column, k), window), only the k instances with the largest
+        # column values are kept, either per scan or over the whole window. The
+        # latter is handled by LmcrecQueryTopKAggregator, the selector applies
+        # the per scan top-K regardless, since the window winners are also per
+        # scan winners:
+        self.top_k: Optional[Tuple[str, int]] = None
+        self.top_k_window = False
+        top_k_spec = query.get(QUERY_TOP_K_KEY)
+        if top_k_spec is not None:
+            self.top_k, self.top_k_window = parse_top_k_spec(top_k_spec)
+
+        # Derived columns:
+        self.derived = parse_derived_specs(query.get(QUERY_DERIVED_KEY))
+        for derived in self.derived:
+            for col_name in derived.refs:
+                i = col_name.rfind(QUERY_VAL_QUAL_SEP)
+                if i > 0 and (
+                    var_val_qual_flag_map[col_name[i + 1 :]]
+                    & QUERY_VARIABLE_NEEDS_PREV_FLAGS
+                ):
+                    self.needs_prev = True
+
+        # Group-by aggregation across instances; the group key is either the
+        # class name, the first capture group of a /REGEX/ (or the whole match
+        # if there is no group) or the N-th capture group of the matching
+        # instance selector /REGEX/. The instances w/o a group key are
+        # excluded:
+        self.group_by: Optional[str] = None
+        self.group_aggregates: List[Tuple[str, Optional[float]]] = []
+        self._group_re = None
+        self._group_inst_re_index = None
+        self._group_key_by_inst: Dict[str, Optional[str]] = dict()
+        group_by = query.get(QUERY_GROUP_BY_KEY)
+        group_aggregates = query.get(QUERY_GROUP_AGG_KEY)
+        if group_by is not None or group_aggregates is not None:
+            if self.top_k is not None:
+                raise ValueError(
+                    f"{QUERY_TOP_K_KEY!r} and {QUERY_GROUP_BY_KEY!r} are mutually exclusive"
+                )
+            group_by = str(group_by if group_by is not None else QUERY_GROUP_BY_CLASS)
+            if len(group_by) > 1 and group_by[0] == "/" and group_by[-1] == "/":
+                self._group_re = re.compile(group_by[1:-1])
+            elif group_by.isdigit():
+                if not self._query_inst_re:
+                    raise ValueError(
+                        f"{QUERY_GROUP_BY_KEY}: {group_by}: no /REGEX/ instance selector"
+                    )
+                self._group_inst_re_index = int(group_by)
+            elif group_by != QUERY_GROUP_BY_CLASS:
+                raise ValueError(
+                    f"{QUERY_GROUP_BY_KEY}: {group_by!r}: want "
+                    f"{QUERY_GROUP_BY_CLASS!r}, /REGEX/ or capture group#"
+                )
+            self.group_by = group_by
+            self.group_aggregates = parse_group_aggregates(group_aggregates)
+        self._group_want_vals = any(
+            percentile is not None for _, percentile in self.group_aggregates
+        )
 
         exclude_types = query.get(QUERY_EXCLUDE_TYPE_KEY, [])
         if isinstance(exclude_types, str):
@@ -198,10 +776,12 @@ class LmcrecQuerySelector:
             self._include_types[LmcVarType[t.upper()]] = qual_flags
 
         self._include_vars = dict()
+        self._include_var_predicates: Dict[str, LmcrecQueryPredicate] = dict()
         include_vars = query.get(QUERY_INCLUDE_VAR_KEY, [])
         if isinstance(include_vars, str):
             include_vars = [include_vars]
         for v in include_vars:
+            v, predicate = split_var_predicate(v)
             i = v.rfind(QUERY_VAL_QUAL_SEP)
             if i > 0:
                 qual_flags = parse_var_val_qualifiers(v[i + 1 :])
@@ -211,40 +791,149 @@ class LmcrecQuerySelector:
             else:
                 qual_flags = QUERY_VARIABLE_VALUE_FLAG
             self._include_vars[v] = qual_flags
+            if predicate is not None:
+                if qual_flags & (qual_flags - 1):
+                    raise ValueError(
+                        f"{v!r}: a value predicate requires a single value qualifier"
+                    )
+                self._include_var_predicates[v] = predicate
 
         self._reset()
 
+    def file_filter_spec(
+        self,
+    ) -> Optional[Tuple[Optional[Set[str]], Optional[Set[str]]]]:
+        """Return the selection criteria usable for pruning whole files
+
+        Returns:
+            (class_names, inst_names) such that a file which has none of the
+            classes (if not None) or none of the instances (if not None) cannot
+            match the selector, or None if any file may match. The instance
+            names are usable only if they are the sole instance selection.
+        """
+
+        inst_names = None
+        if self._query_full_inst_names and not (
+            self._query_prefix_inst_names
+            or self._query_inst_re
+            or self._query_subtree_full_names
+            or self._query_subtree_prefix_names
+        ):
+            inst_names = self._query_full_inst_names
+        if self._query_class_names is None and inst_names is None:
+            return None
+        return self._query_class_names, inst_names
+
+    def value_predicates(self) -> List[Tuple[str, LmcrecQueryPredicate]]:
+        """Return the predicates on plain, i.e. w/o delta or rate, values
+
+        Returns:
+            list of (var_name, predicate); an instance is selected only if all
+            of them match, so they can be used for pruning based on the value
+            ranges, see zone_map.py.
+        """
+
+        return [
+            (var_name, predicate)
+            for var_name, predicate in self._include_var_predicates.items()
+            if self._include_vars.get(var_name) == QUERY_VARIABLE_VALUE_FLAG
+        ]
+
     def _reset(self):
         """Invoked when the query state cache indicates a new chain"""
 
         self._classified_inst_names: Dict[str, str] = dict()
         self.selector: Dict[str, LmcrecQueryClassSelector] = dict()
         self._result = None
+        self._group_key_by_inst = dict()
+        # The instances matching the ~SUFFIX subtree roots, resolved at the
+        # first update and maintained incrementally thereafter:
+        self._subtree_suffix_roots: Optional[Set[str]] = None
+
+    def _group_key(self, inst_name: str, class_name: str) -> Optional[str]:
+        """Return the group key for the instance or None if not grouped"""
+
+        if self._group_re is not None:
+            m = self._group_re.search(inst_name)
+            if m is None:
+                return None
+            return m.group(1) if m.re.groups else m.group(0)
+        if self._group_inst_re_index is not None:
+            for pat in self._query_inst_re:
+                m = pat.match(inst_name)
+                if m is not None:
+                    try:
+                        return m.group(self._group_inst_re_index)
+                    except IndexError:
+                        return None
+            return None
+        return class_name
+
+    def _subtree_inst_names(self, state_cache: LmcrecStateCache) -> Optional[Set[str]]:
+        """Resolve the subtree selection, None if there is no subtree selector"""
+
+        if not self._query_subtree_full_names and not self._query_subtree_prefix_names:
+            return None
+        root_names = list(self._query_subtree_full_names)
+        if self._query_subtree_prefix_names:
+            if self._subtree_suffix_roots is None:
+                self._subtree_suffix_roots = set()
+                inst_names = state_cache.inst_by_name
+            else:
+                # Only the newly added instances may be new roots:
+                inst_names = state_cache.new_inst_names
+            for inst_name in inst_names:
+                for suffix in self._query_subtree_prefix_names:
+                    if inst_name.endswith(suffix):
+                        self._subtree_suffix_roots.add(inst_name)
+                        break
+            root_names.extend(self._subtree_suffix_roots)
+        subtree_inst_names = set()
+        for root_name in root_names:
+            subtree_inst_names.update(
+                state_cache.get_inst_descendants(root_name, self._query_class_names)
+            )
+        return subtree_inst_names
 
     def _selector_new_inst_class_update(self, state_cache: LmcrecStateCache):
         """Handle state cache new instance and/or class info update"""
 
         selector = self.selector
-        want_class_name = self._query_class_name
+        want_class_names = self._query_class_names
         class_by_id = state_cache.class_by_id
+        inst_by_name = state_cache.inst_by_name
+
+        have_inst_selectors = (
+            self._query_full_inst_names
+            or self._query_prefix_inst_names
+            or self._query_inst_re
+        )
+        subtree_inst_names = self._subtree_inst_names(state_cache)
+        if subtree_inst_names is not None and not have_inst_selectors:
+            # Only the subtree(s) need to be considered:
+            candidates = (
+                (inst_name, inst_by_name[inst_name]) for inst_name in subtree_inst_names
+            )
+        else:
+            candidates = inst_by_name.items()
 
         # Resolve the instance and class lists:
-        for inst_name, inst in state_cache.inst_by_name.items():
+        for inst_name, inst in candidates:
             # Already classified?
             if inst_name in self._classified_inst_names:
                 continue
 
             # Class selection?
             class_name = class_by_id[inst.class_id].name
-            if want_class_name and class_name != want_class_name:
+            if want_class_names and class_name not in want_class_names:
                 continue
 
             # Instance selection?
-            keep = (
-                not self._query_full_inst_names
-                and not self._query_prefix_inst_names
-                and not self._query_inst_re
-            )
+            keep = not have_inst_selectors and subtree_inst_names is None
+
+            # Try by subtree if no match yet:
+            if not keep and subtree_inst_names is not None:
+                keep = inst_name in subtree_inst_names
 
             # Try by name if no match yet:
             if not keep and self._query_full_inst_names:
@@ -308,8 +997,19 @@ class LmcrecQuerySelector:
                     )
                     selector_var_names.append(var_name)
             class_selector.var_names = []
+            predicates_by_var_name = self._include_var_predicates
+            class_selector.predicates = [
+                (None, predicate)
+                for var_name, predicate in predicates_by_var_name.items()
+                if var_name not in selector_var_names
+            ]
             for i, (_, var_quals) in enumerate(class_selector.var_handling_info):
                 var_name = selector_var_names[i]
+                predicate = predicates_by_var_name.get(var_name)
+                if predicate is not None:
+                    class_selector.predicates.append(
+                        (len(class_selector.var_names), predicate)
+                    )
                 for qual_flag in var_val_qual_flag_order:
                     if var_quals & qual_flag:
                         v_name = var_name
@@ -317,8 +1017,70 @@ class LmcrecQuerySelector:
                         if qual_suffix:
                             v_name += f"{QUERY_VAL_QUAL_SEP}{qual_suffix}"
                         class_selector.var_names.append(v_name)
+            self._derived_update(class_selector, class_info)
+            class_selector.top_k_index = None
+            if self.top_k is not None:
+                top_k_col_name = self.top_k[0]
+                if top_k_col_name in class_selector.var_names:
+                    class_selector.top_k_index = class_selector.var_names.index(
+                        top_k_col_name
+                    )
+            if self.group_by is not None:
+                class_selector.group_var_names = [
+                    group_agg_col_name(agg, var_name)
+                    for var_name in class_selector.var_names
+                    for agg, _ in self.group_aggregates
+                ]
             class_selector.last_update_ts = class_info.last_update_ts
 
+    def _derived_update(self, class_selector: LmcrecQueryClassSelector, class_info):
+        """Update the derived column info for the class selector
+
+        The value list layout is: selected columns, derived columns, hidden
+        columns. The latter are the derived column references which are not
+        selected and they are handled by additional var_handling_info entries.
+        """
+
+        class_selector.derived_info = []
+        class_selector.num_hidden = 0
+        class_selector.hidden_val_i = -1
+        if not self.derived:
+            return
+        num_selected = len(class_selector.var_names)
+        val_index = {col_name: i for i, col_name in enumerate(class_selector.var_names)}
+        num_cols = num_selected + len(self.derived)
+        var_info_by_name = class_info.var_info_by_name
+        for derived in self.derived:
+            ref_indices = []
+            for col_name in derived.refs:
+                i = val_index.get(col_name)
+                if i is None:
+                    q = col_name.rfind(QUERY_VAL_QUAL_SEP)
+                    var_name, qual_flags = col_name, QUERY_VARIABLE_VALUE_FLAG
+                    if q > 0:
+                        var_name = col_name[:q]
+                        qual_flags = var_val_qual_flag_map[col_name[q + 1 :]]
+                    var_info = var_info_by_name.get(var_name)
+                    if var_info is None:
+                        break
+                    i = num_cols + class_selector.num_hidden
+                    class_selector.var_handling_info.append(
+                        (var_info.var_id, qual_flags)
+                    )
+                    class_selector.num_hidden += 1
+                    val_index[col_name] = i
+                ref_indices.append(i)
+            dest_i = num_selected + len(class_selector.derived_info)
+            if len(ref_indices) < len(derived.refs):
+                class_selector.derived_info.append((dest_i, None, []))
+            else:
+                class_selector.derived_info.append(
+                    (dest_i, compile_derived(derived, ref_indices), ref_indices)
+                )
+        class_selector.var_names.extend(derived.name for derived in self.derived)
+        if class_selector.num_hidden > 0:
+            class_selector.hidden_val_i = num_selected
+
     def _selector_verify_del_inst_update(self, state_cache: LmcrecStateCache):
         """Handle state cache deleted instance update"""
 
@@ -331,6 +1093,13 @@ class LmcrecQuerySelector:
             class_name = self._classified_inst_names[inst_name]
             del self._classified_inst_names[inst_name]
             self.selector[class_name].inst_names.discard(inst_name)
+            self._group_key_by_inst.pop(inst_name, None)
+        if self._subtree_suffix_roots:
+            self._subtree_suffix_roots = {
+                inst_name
+                for inst_name in self._subtree_suffix_roots
+                if inst_name in state_cache.inst_by_name
+            }
 
     def selector_update(self, query_state_cache: LmcrecQueryIntervalStateCache) -> bool:
         updated = False
@@ -360,21 +1129,80 @@ class LmcrecQuerySelector:
         d_time = ts - prev_ts if prev_ts is not None else None
         result = self._result
         inst_by_name = query_state_cache.inst_by_name
+        group_by = self.group_by
+        # Aggregates cover all the instances, changed or not:
+        changed_vars = (
+            query_state_cache.changed_vars
+            if self.changed_only
+            and not query_state_cache.new_chain
+            and group_by is None
+            else None
+        )
+        top_k = self.top_k[1] if self.top_k is not None else None
+        # Either top-K or group-by need the values only transiently, so they
+        # are computed into a scratch list:
+        use_scratch_vals = top_k is not None or group_by is not None
+        group_want_vals = self._group_want_vals
+        group_key_by_inst = self._group_key_by_inst
         for class_name, class_selector in self.selector.items():
             if class_name not in result:
                 result[class_name] = LmcrecQueryClassResult(
-                    var_names=class_selector.var_names, vals_by_inst=dict()
+                    var_names=(
+                        class_selector.var_names
+                        if group_by is None
+                        else class_selector.group_var_names
+                    ),
+                    vals_by_inst=dict(),
                 )
             vals_by_inst = result[class_name].vals_by_inst
             var_info_by_id = query_state_cache.class_by_name[class_name].var_info_by_id
+            predicates = class_selector.predicates
+            if top_k is not None:
+                top_k_index = class_selector.top_k_index
+                if top_k_index is None:
+                    # No ranking column, no winners:
+                    vals_by_inst.clear()
+                    continue
+                # Bounded heap of (rank val, inst_name, vals) for the winners;
+                # the scratch values are copied for the winners only:
+                top_k_heap = []
+            if group_by is not None:
+                # Per column accumulators by group key:
+                group_acc: Dict[str, List[List[Any]]] = dict()
+            num_cols = len(class_selector.var_names)
+            derived_info = class_selector.derived_info
+            hidden_val_i = class_selector.hidden_val_i
+            # The hidden values, if any, require a scratch list too, since they
+            # are not part of the result:
+            scratch_vals = None
+            if use_scratch_vals or class_selector.num_hidden > 0:
+                scratch_vals = [None] * (num_cols + class_selector.num_hidden)
+            if changed_vars is not None:
+                selected_var_ids = set(
+                    var_id for var_id, _ in class_selector.var_handling_info
+                )
             for inst_name in class_selector.inst_names:
                 inst = inst_by_name[inst_name]
+                if changed_vars is not None:
+                    inst_changed_vars = changed_vars.get(inst.inst_id)
+                    if inst_changed_vars is None or inst_changed_vars.isdisjoint(
+                        selected_var_ids
+                    ):
+                        vals_by_inst.pop(inst_name, None)
+                        continue
                 vars, prev_vars = inst.vars, inst.prev_vars
-                if inst_name not in vals_by_inst:
-                    vals_by_inst[inst_name] = [None] * len(class_selector.var_names)
-                var_vals = vals_by_inst[inst_name]
+                if scratch_vals is not None:
+                    var_vals, new_var_vals = scratch_vals, False
+                else:
+                    var_vals = vals_by_inst.get(inst_name)
+                    new_var_vals = var_vals is None
+                    if new_var_vals:
+                        var_vals = [None] * len(class_selector.var_names)
                 val_i = 0
                 for var_id, var_quals in class_selector.var_handling_info:
+                    if val_i == hidden_val_i:
+                        # Skip over the derived columns:
+                        val_i = num_cols
                     val = vars.get(var_id)
                     var_info = var_info_by_id.get(var_id)
                     var_type = var_info.var_type if var_info is not None else None
@@ -413,11 +1241,85 @@ class LmcrecQuerySelector:
                             else:
                                 var_vals[val_i] = None
                         val_i += 1
+                if derived_info:
+                    eval_derived(derived_info, var_vals)
+                if predicates:
+                    matched = True
+                    for i, predicate in predicates:
+                        if i is None or not eval_predicate(predicate, var_vals[i]):
+                            matched = False
+                            break
+                    if not matched:
+                        if not use_scratch_vals:
+                            vals_by_inst.pop(inst_name, None)
+                        continue
+                if group_by is not None:
+                    if inst_name in group_key_by_inst:
+                        group_key = group_key_by_inst[inst_name]
+                    else:
+                        group_key = self._group_key(inst_name, class_name)
+                        group_key_by_inst[inst_name] = group_key
+                    if group_key is None:
+                        continue
+                    accs = group_acc.get(group_key)
+                    if accs is None:
+                        accs = [[0, 0, 0, None, None, []] for _ in range(num_cols)]
+                        group_acc[group_key] = accs
+                    for acc, val in zip(accs, var_vals):
+                        if val is None:
+                            continue
+                        acc[_GROUP_ACC_COUNT] += 1
+                        if isinstance(val, (bool, str)):
+                            continue
+                        if acc[_GROUP_ACC_NUM] == 0:
+                            acc[_GROUP_ACC_MIN] = val
+                            acc[_GROUP_ACC_MAX] = val
+                        else:
+                            if val < acc[_GROUP_ACC_MIN]:
+                                acc[_GROUP_ACC_MIN] = val
+                            if val > acc[_GROUP_ACC_MAX]:
+                                acc[_GROUP_ACC_MAX] = val
+                        acc[_GROUP_ACC_SUM] += val
+                        acc[_GROUP_ACC_NUM] += 1
+                        if group_want_vals:
+                            acc[_GROUP_ACC_VALS].append(val)
+                    continue
+                if top_k is not None:
+                    rank_val = var_vals[top_k_index]
+                    if rank_val is None or isinstance(rank_val, (bool, str)):
+                        continue
+                    if len(top_k_heap) < top_k:
+                        heapq.heappush(
+                            top_k_heap, (rank_val, inst_name, var_vals[:num_cols])
+                        )
+                    elif rank_val > top_k_heap[0][0]:
+                        heapq.heapreplace(
+                            top_k_heap, (rank_val, inst_name, var_vals[:num_cols])
+                        )
+                    continue
+                if new_var_vals:
+                    vals_by_inst[inst_name] = var_vals
+                elif scratch_vals is not None:
+                    vals_by_inst[inst_name] = var_vals[:num_cols]
+            if top_k is not None:
+                # Winners in descending order:
+                result[class_name].vals_by_inst = {
+                    inst_name: vals
+                    for _, inst_name, vals in sorted(top_k_heap, reverse=True)
+                }
+            elif group_by is not None:
+                group_aggregates = self.group_aggregates
+                result[class_name].vals_by_inst = {
+                    group_key: group_acc_result(group_acc[group_key], group_aggregates)
+                    for group_key in sorted(group_acc)
+                }
 
         return result
 
 
-def build_query_selectors(*query_or_file: str) -> List[LmcrecQuerySelector]:
+def build_query_selectors(
+    *query_or_file: str, changed_only: bool = False
+) -> List[LmcrecQuerySelector]:
     """Build list of query selectors from string or file
 
     Args:
@@ -425,6 +1327,9 @@ def build_query_selectors(*query_or_file: str) -> List[LmcrecQuerySelector]:
             A string or file name with the query/queries, each query or file may
             be in fact a list of queries. A file name should end w/ .yaml
 
+        changed_only (bool):
+            See LmcrecQuerySelector.
+
     Returns:
         List[LmcrecQuerySelector]
             The list of query selectors (there may be just one).
@@ -444,5 +1349,7 @@ def build_query_selectors(*query_or_file: str) -> List[LmcrecQuerySelector]:
             query_list = query_or_queries
 
         for query in query_list:
-            query_selectors.append(LmcrecQuerySelector(query))
+            query_selectors.append(
+                LmcrecQuerySelector(query, changed_only=changed_only)
+            )
     return query_selectors
@@ -2,16 +2,56 @@
 
 import inspect
 import sys
-from typing import Callable, Optional
+from typing import Callable, List, Optional, Tuple
 
 from cache import LmcrecScanRetCode, LmcrecStateCache
 from codec import (
     LmcrecFileDecoder,
+    LmcrecIndexCache,
+    LmcrecInfoCache,
     locate_checkpoint,
 )
 from misc.timeutils import format_ts
 
-from .file_selector import build_lmcrec_file_chains
+from .catalog import LmcrecFileCatalog
+from .file_selector import (
+    LmcrecFileEntry,
+    LmcrecFileFilter,
+    build_lmcrec_file_chains,
+)
+from .state_snapshot import LmcrecStateSnapshotCache
+
+# A time window, (from_ts, to_ts), None stands for the oldest, respectively the
+# newest, available data:
+LmcrecQueryWindow = Tuple[Optional[float], Optional[float]]
+
+
+def normalize_query_windows(
+    windows: List[LmcrecQueryWindow],
+) -> List[Tuple[Optional[float], Optional[float], int]]:
+    """Sort the windows by their start and verify that they do not overlap
+
+    Returns:
+        The list of (from_ts, to_ts, index) in chronological order, where index
+        is the position of the window in the original list.
+
+    Raises:
+        ValueError for empty list, invalid or overlapping windows
+    """
+
+    if not windows:
+        raise ValueError("empty window list")
+    normalized = []
+    for index, window in enumerate(windows):
+        from_ts, to_ts = window
+        if from_ts is not None and to_ts is not None and from_ts > to_ts:
+            raise ValueError(f"window#{index + 1}: from_ts={from_ts} > to_ts={to_ts}")
+        normalized.append((from_ts, to_ts, index))
+    normalized.sort(key=lambda w: float("-inf") if w[0] is None else w[0])
+    for prev, curr in zip(normalized, normalized[1:]):
+        if prev[1] is None or curr[0] is None or curr[0] <= prev[1]:
+            raise ValueError(f"window#{prev[2] + 1} and window#{curr[2] + 1} overlap")
+    return normalized
 
 
 class LmcrecQueryIntervalStateCache(LmcrecStateCache):
@@ -22,6 +62,15 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
         from_ts: Optional[float] = None,
         to_ts: Optional[float] = None,
         have_prev: bool = False,
+        track_changes: bool = False,
+        chain_list: Optional[List[LmcrecFileEntry]] = None,
+        info_cache: Optional[LmcrecInfoCache] = None,
+        index_cache: Optional[LmcrecIndexCache] = None,
+        windows: Optional[List[LmcrecQueryWindow]] = None,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        file_filter: Optional[LmcrecFileFilter] = None,
+        tag_windows: bool = True,
+        snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
         _verbose: bool = False,
         _no_chain_list: bool = False,  # used for testing
     ):
@@ -43,6 +92,50 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
             have_prev (bool):
                 Whether to maintain previous variable values or not.
 
+            track_changes (bool):
+                Whether to maintain the changed variables for the most recent
+                scan or not.
+
+            chain_list (List[LmcrecFileEntry]):
+                Use this chain list instead of building it from
+                record_files_dir; this is used for playing back a subset of the
+                chains, e.g. by parallel workers.
+
+            info_cache (LmcrecInfoCache):
+                Look up the .info files in this cache rather than decoding
+                them, for long running processes.
+
+            index_cache (LmcrecIndexCache):
+                Look up the checkpoints in this cache rather than decoding the
+                index files, for long running processes.
+
+            catalog (LmcrecFileCatalog):
+                Look up the files in this persistent catalog rather than listing
+                the dirs and decoding the .info files, see
+                build_lmcrec_file_chains.
+
+            file_filter (Callable[[str, LmcrecInfo], bool]):
+                Leave out the files for which it returns False, see
+                build_lmcrec_file_chains.
+
+            windows (List[LmcrecQueryWindow]):
+                Play back multiple, non-overlapping, time windows in a single
+                pass, instead of from_ts, to_ts. The chains are built over the
+                union of the windows and the gaps between them are skipped via
+                the checkpoints. The scans are tagged with window_index, the
+                index of their window in the list; the first scan after a gap
+                is flagged as new_chain, since the state is rebuilt.
+
+            tag_windows (bool):
+                If False then the windows are used only for skipping the gaps,
+                e.g. the segments pruned via zone maps, and window_index is not
+                set.
+
+            snapshot_cache (LmcrecStateSnapshotCache):
+                Resume from the state snapshots of earlier playbacks, when more
+                recent than the checkpoint preceding from_ts, and save the
+                state at from_ts, for long running processes.
+
             _verbose (bool):
                 Used for troubleshooting, create stderr trace.
 
@@ -50,10 +143,24 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                 Used for testing, do not actually access files
         """
 
+        self._windows = None
+        self._tag_windows = tag_windows
+        self._window_i = 0
+        self.window_index = None
+        if windows is not None:
+            if from_ts is not None or to_ts is not None:
+                raise ValueError("windows and from_ts/to_ts are mutually exclusive")
+            self._windows = normalize_query_windows(windows)
+            from_ts, to_ts = self._windows[0][0], self._windows[-1][1]
         self._from_ts = from_ts
         self._to_ts = to_ts
+        if self._windows is not None:
+            self._to_ts = self._windows[0][1]
         self._have_prev = have_prev
+        self._track_changes = track_changes
         self._verbose = _verbose
+        self._index_cache = index_cache
+        self._snapshot_cache = snapshot_cache
         self._chain_list_index = 0
         self._chain_entry = None
         self._decoder = None
@@ -63,9 +170,16 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
         self.last_ts = None
         if _no_chain_list:
             self._chain_list = None
+        elif chain_list is not None:
+            self._chain_list = chain_list
         else:
             self._chain_list = build_lmcrec_file_chains(
-                record_files_dir, from_ts=from_ts, to_ts=to_ts
+                record_files_dir,
+                from_ts=from_ts,
+                to_ts=to_ts,
+                info_cache=info_cache,
+                catalog=catalog,
+                file_filter=file_filter,
             )
         self.reset()
 
@@ -87,6 +201,10 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                     return LmcrecScanRetCode.ATEOR
                 self._chain_entry = self._chain_list[self._chain_list_index]
                 self._chain_list_index += 1
+                if self._windows is not None and self._check_from_ts:
+                    self._chain_entry = self._seek_chain_entry(
+                        self._chain_entry, self._from_ts
+                    )
                 self.new_chain = True
                 if self._verbose:
                     self._trace("new chain, invalidate the cache")
@@ -102,7 +220,9 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                         f"locate checkpoint before {format_ts(from_ts)}, if any"
                     )
                 try:
-                    chkpt_ts, chkpt_off = locate_checkpoint(self.lmcrec_file, from_ts)
+                    chkpt_ts, chkpt_off = locate_checkpoint(
+                        self.lmcrec_file, from_ts, index_cache=self._index_cache
+                    )
                 except FileNotFoundError as e:
                     chkpt_ts, chkpt_off = None, None
                     if self._verbose:
@@ -113,9 +233,27 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                             f"found checkpoint: ts={format_ts(chkpt_ts)}, off=+{chkpt_off}",
                         )
                     self._decoder.goto(chkpt_off)
+                if self._snapshot_cache is not None:
+                    snapshot_off = self._snapshot_cache.restore(
+                        self,
+                        self.lmcrec_file,
+                        self._get_file_start_ts(),
+                        from_ts,
+                        after_ts=chkpt_ts,
+                    )
+                    if snapshot_off is not None:
+                        if self._verbose:
+                            self._trace(
+                                f"restored snapshot: ts={format_ts(self.ts)}, off=+{snapshot_off}",
+                            )
+                        self._decoder.goto(snapshot_off)
+                        chkpt_ts = None
         # The state cache is now ready:
         ret_code = None
         if self._check_from_ts:
+            if self.ts is not None and self.ts >= from_ts:
+                # Restored from the snapshot at from_ts:
+                ret_code = LmcrecScanRetCode.COMPLETE
             # Locate the 1st scan after or at from_ts:
             if self._verbose:
                 self._trace(
@@ -132,9 +270,19 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                     chkpt_ts = None
                 if ret_code != LmcrecScanRetCode.COMPLETE:
                     break
-            if self._verbose and ret_code == LmcrecScanRetCode.COMPLETE:
-                self._trace(f"start ts={format_ts(self.ts)}")
-            self._check_from_ts = False
+            if ret_code == LmcrecScanRetCode.COMPLETE:
+                if self._verbose:
+                    self._trace(f"start ts={format_ts(self.ts)}")
+                if self._snapshot_cache is not None:
+                    self._snapshot_cache.save(
+                        self,
+                        self.lmcrec_file,
+                        self._get_file_start_ts(),
+                        self._decoder.tell(),
+                    )
+            if ret_code != LmcrecScanRetCode.ATEOR:
+                # Otherwise keep looking into the next file:
+                self._check_from_ts = False
         else:
             ret_code = self._apply_next_scan()
 
@@ -142,12 +290,18 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
             # Move to the next file in the chain and re-invoke:
             self._decoder = None
             self._chain_entry = self._chain_entry.next
+            new_chain = self.new_chain
             ret_code = self.apply_next_scan()
+            self.new_chain = self.new_chain or new_chain
         elif ret_code == LmcrecScanRetCode.COMPLETE:
-            if self.first_ts is None:
+            if self.first_ts is None and self._windows is None:
                 self.first_ts = self.ts
             # Check for time window end, if any:
             if self._to_ts is not None and self._to_ts < self.ts:
+                if self._windows is not None and self._window_i + 1 < len(
+                    self._windows
+                ):
+                    return self._next_window()
                 if self._verbose:
                     self._trace(
                         f"scan ts={format_ts(self.ts)} after to_ts={format_ts(self._to_ts)}, force close everything",
@@ -155,6 +309,11 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
                 self.close()
                 ret_code = LmcrecScanRetCode.ATEOR
             else:
+                if self._windows is not None:
+                    if self.first_ts is None:
+                        self.first_ts = self.ts
+                    if self._tag_windows:
+                        self.window_index = self._windows[self._window_i][2]
                 self.last_ts = self.ts
         else:
             self._trace(
@@ -164,6 +323,40 @@ class LmcrecQueryIntervalStateCache(LmcrecStateCache):
 
         return ret_code
 
+    def _get_file_start_ts(self) -> Optional[float]:
+        lmcrec_info = self._chain_entry.lmcrec_info
+        return lmcrec_info.start_ts if lmcrec_info is not None else None
+
+    def _seek_chain_entry(
+        self, entry: LmcrecFileEntry, from_ts: Optional[float]
+    ) -> LmcrecFileEntry:
+        """Return the most recent file in the chain starting at or before from_ts"""
+
+        if from_ts is not None:
+            while entry.next is not None and entry.next.lmcrec_info.start_ts <= from_ts:
+                entry = entry.next
+        return entry
+
+    def _next_window(self) -> LmcrecScanRetCode:
+        """Skip the gap to the next window, via the checkpoints"""
+
+        self._window_i += 1
+        self._from_ts, self._to_ts, _ = self._windows[self._window_i]
+        if self._verbose:
+            self._trace(
+                f"scan ts={format_ts(self.ts)} after window end, skip to from_ts={format_ts(self._from_ts)}",
+            )
+        if self._decoder is not None:
+            self._decoder.close()
+            self._decoder = None
+        self._chain_entry = self._seek_chain_entry(self._chain_entry, self._from_ts)
+        self._check_from_ts = True
+        # The deletions in the gap are not known, rebuild the state:
+        self.reset()
+        ret_code = self.apply_next_scan()
+        self.new_chain = True
+        return ret_code
+
     def run_with_cb(
         self, cb: Optional[Callable[["LmcrecQueryIntervalStateCache"], bool]]
     ) -> LmcrecScanRetCode:
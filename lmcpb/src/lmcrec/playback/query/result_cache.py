@@ -0,0 +1,455 @@
+"""Persistent query result cache
+
+The same queries are often run repeatedly against the same record files. Closed
+record files never change, so the query results for them can be cached and
+served w/o decoding the files again.
+
+The unit of caching is a chain segment, see parallel.py, split at file
+boundaries: a segment spans a file, from its first checkpoint (or from_ts) up
+to and including the first checkpoint of the next file in the chain, such that
+the previous values for delta and rate are correct. A segment is cacheable if
+all the files it spans are closed, with the exception of the last one, if it is
+needed only for the end checkpoint. In other words the active file is replayed
+but the closed ones are not.
+
+The cache key is the hash of the normalized query spec, the segment time window
+and the name, start_ts, most_recent_ts and state of the spanned files. The
+results are stored in a compact columnar format, as gzip-ed JSON files, one per
+segment, under $LMCREC_RUNTIME/query-cache by default.
+
+The cache is bounded by size: the entries are touched whenever they are used
+and, once the total size exceeds the limit, the least recently used ones, by
+modification time, are removed. The cleanup is performed after storing new
+entries, at most once every QUERY_RESULT_CACHE_CLEANUP_INTERVAL seconds, as
+tracked by the modification time of a marker file, such that concurrent users
+do not need to coordinate.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+from codec import LmcrecIndexCache, LmcrecInfoState
+from config import get_lmcrec_runtime
+
+from .parallel import (
+    LmcrecQueryTask,
+    LmcrecQueryTaskResult,
+    iter_query_task,
+    merge_task_batches,
+    split_task_result,
+)
+from .query_selector import LmcrecQueryClassResult, LmcrecQuerySelector
+from .state_snapshot import LmcrecStateSnapshotCache
+
+QUERY_RESULT_CACHE_SUB_DIR = "query-cache"
+QUERY_RESULT_CACHE_FILE_SUFFIX = ".json.gz"
+
+# Bump this up whenever the key or the stored format change:
+QUERY_RESULT_CACHE_VERSION = 1
+
+# The max size of the cache, in bytes:
+QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT = 1 << 30
+# The min interval, in seconds, between cleanups and the marker file recording
+# the most recent one:
+QUERY_RESULT_CACHE_CLEANUP_INTERVAL = 60
+QUERY_RESULT_CACHE_CLEANUP_MARKER = ".cleanup"
+
+
+def get_query_result_cache_dir() -> str:
+    return os.path.join(get_lmcrec_runtime(), QUERY_RESULT_CACHE_SUB_DIR)
+
+
+def normalize_query_spec(
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+) -> str:
+    """Return the normalized spec for the queries, as a JSON string"""
+
+    return json.dumps(
+        {
+            "queries": [
+                [selector.name, selector.query, selector.changed_only]
+                for selector in selectors
+            ],
+            "have_prev": have_prev,
+            "track_changes": track_changes,
+        },
+        sort_keys=True,
+        default=str,
+    )
+
+
+def get_task_files_key(task: LmcrecQueryTask) -> Optional[List[Tuple]]:
+    """Return the file part of the task key or None if the task is not cacheable"""
+
+    to_ts = task.to_ts
+    files = []
+    entry = task.chain_entry
+    while entry is not None:
+        lmcrec_info = entry.lmcrec_info
+        if to_ts is not None and lmcrec_info.start_ts > to_ts:
+            break
+        if lmcrec_info.state == LmcrecInfoState.CLOSED:
+            files.append(
+                (
+                    entry.file_name,
+                    lmcrec_info.start_ts,
+                    lmcrec_info.most_recent_ts,
+                    lmcrec_info.state,
+                )
+            )
+        elif (
+            entry.next is None
+            and to_ts is not None
+            and lmcrec_info.most_recent_ts >= to_ts
+        ):
+            # Only the scans up to to_ts matter and they were already recorded:
+            files.append((entry.file_name, lmcrec_info.start_ts, None, None))
+        else:
+            return None
+        entry = entry.next
+    return files
+
+
+def encode_task_result(
+    task_result: LmcrecQueryTaskResult, query_names: List[str]
+) -> Dict[str, Any]:
+    """Encode the task result in columnar format
+
+    The rows are grouped in blocks, one per (query, class, var_names) and each
+    block has the columns: scan#, instance and one per variable. The classes
+    present in each scan are listed as block indexes, in order.
+    """
+
+    ts_col, prev_ts_col, scan_blocks = [], [], []
+    blocks: List[Dict[str, Any]] = []
+    block_index: Dict[Tuple, int] = dict()
+    for k, (ts, prev_ts, result) in enumerate(task_result.scans):
+        ts_col.append(ts)
+        prev_ts_col.append(prev_ts)
+        blocks_in_scan = []
+        for query_name, query_result in result.items():
+            for class_name, class_result in query_result.items():
+                var_names = class_result.var_names
+                block_key = (query_name, class_name, tuple(var_names))
+                i = block_index.get(block_key)
+                if i is None:
+                    i = len(blocks)
+                    block_index[block_key] = i
+                    blocks.append(
+                        {
+                            "query": query_name,
+                            "class": class_name,
+                            "var_names": list(var_names),
+                            "scan": [],
+                            "inst": [],
+                            "cols": [[] for _ in var_names],
+                        }
+                    )
+                blocks_in_scan.append(i)
+                block = blocks[i]
+                scan_col, inst_col, cols = block["scan"], block["inst"], block["cols"]
+                for inst_name, vals in class_result.vals_by_inst.items():
+                    scan_col.append(k)
+                    inst_col.append(inst_name)
+                    for col, val in zip(cols, vals):
+                        col.append(val)
+        scan_blocks.append(blocks_in_scan)
+    return {
+        "version": QUERY_RESULT_CACHE_VERSION,
+        "queries": query_names,
+        "ts": ts_col,
+        "prev_ts": prev_ts_col,
+        "scan_blocks": scan_blocks,
+        "blocks": blocks,
+        "first_ts": task_result.first_ts,
+        "last_ts": task_result.last_ts,
+        "ret_code": int(task_result.ret_code),
+        "new_chain": task_result.new_chain,
+    }
+
+
+def decode_task_result(data: Dict[str, Any], index: int = 0) -> LmcrecQueryTaskResult:
+    """Decode the columnar format back into a task result
+
+    Raises:
+        ValueError for version mismatch
+    """
+
+    if data.get("version") != QUERY_RESULT_CACHE_VERSION:
+        raise ValueError(f"version: want {QUERY_RESULT_CACHE_VERSION}")
+    query_names = data["queries"]
+    blocks = data["blocks"]
+    results = []
+    for blocks_in_scan in data["scan_blocks"]:
+        result = {query_name: dict() for query_name in query_names}
+        for i in blocks_in_scan:
+            block = blocks[i]
+            result[block["query"]][block["class"]] = LmcrecQueryClassResult(
+                var_names=list(block["var_names"]), vals_by_inst=dict()
+            )
+        results.append(result)
+    for block in blocks:
+        query_name, class_name, cols = block["query"], block["class"], block["cols"]
+        for j, (k, inst_name) in enumerate(zip(block["scan"], block["inst"])):
+            results[k][query_name][class_name].vals_by_inst[inst_name] = [
+                col[j] for col in cols
+            ]
+    return LmcrecQueryTaskResult(
+        index=index,
+        scans=list(zip(data["ts"], data["prev_ts"], results)),
+        first_ts=data["first_ts"],
+        last_ts=data["last_ts"],
+        ret_code=LmcrecScanRetCode(data["ret_code"]),
+        new_chain=data["new_chain"],
+    )
+
+
+class LmcrecQueryResultCache:
+    """Persistent cache of query task results"""
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_size: int = QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    ):
+        """Create the cache
+
+        Args:
+            cache_dir (str):
+                The cache dir, default get_query_result_cache_dir().
+
+            max_size (int):
+                The max size of the cache, in bytes, 0 for no limit.
+        """
+
+        self.cache_dir = cache_dir or get_query_result_cache_dir()
+        self.max_size = max_size
+
+    def task_key(
+        self,
+        task: LmcrecQueryTask,
+        selectors: List[LmcrecQuerySelector],
+        have_prev: bool = False,
+        track_changes: bool = False,
+    ) -> Optional[str]:
+        """Return the cache key for the task or None if the task is not cacheable"""
+
+        files = get_task_files_key(task)
+        if not files:
+            return None
+        key_spec = json.dumps(
+            [
+                QUERY_RESULT_CACHE_VERSION,
+                normalize_query_spec(selectors, have_prev, track_changes),
+                task.from_ts,
+                task.to_ts,
+                task.skip_first,
+                files,
+            ]
+        )
+        return hashlib.sha256(key_spec.encode("utf-8")).hexdigest()
+
+    def key_path(self, key: str) -> str:
+        return os.path.join(
+            self.cache_dir, key[:2], key + QUERY_RESULT_CACHE_FILE_SUFFIX
+        )
+
+    def load(self, key: str, index: int = 0) -> Optional[LmcrecQueryTaskResult]:
+        """Return the cached task result or None if not cached or invalid"""
+
+        file_path = self.key_path(key)
+        try:
+            with gzip.open(file_path, "rt") as f:
+                task_result = decode_task_result(json.load(f), index=index)
+            # Mark it as recently used, for cleanup:
+            try:
+                os.utime(file_path)
+            except OSError:
+                pass
+            return task_result
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"{self.key_path(key)}: {e}", file=sys.stderr)
+        return None
+
+    def store(
+        self,
+        key: str,
+        task_result: LmcrecQueryTaskResult,
+        query_names: List[str],
+    ):
+        """Store the task result, best effort"""
+
+        file_path = self.key_path(key)
+        tmp_file_path = f"{file_path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with gzip.open(tmp_file_path, "wt") as f:
+                json.dump(encode_task_result(task_result, query_names), f)
+            # Make the update atomic, for concurrent users:
+            os.replace(tmp_file_path, file_path)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"{file_path}: {e}", file=sys.stderr)
+            try:
+                os.unlink(tmp_file_path)
+            except OSError:
+                pass
+            return
+        self.maybe_cleanup()
+
+    def maybe_cleanup(self) -> int:
+        """Clean up the cache if the previous cleanup is old enough
+
+        Returns:
+            The number of removed entries.
+        """
+
+        if self.max_size <= 0:
+            return 0
+        marker = os.path.join(self.cache_dir, QUERY_RESULT_CACHE_CLEANUP_MARKER)
+        try:
+            if (
+                time.time() - os.stat(marker).st_mtime
+                < QUERY_RESULT_CACHE_CLEANUP_INTERVAL
+            ):
+                return 0
+        except FileNotFoundError:
+            pass
+        try:
+            with open(marker, "a"):
+                pass
+            os.utime(marker)
+        except OSError as e:
+            print(f"{marker}: {e}", file=sys.stderr)
+            return 0
+        return self.cleanup()
+
+    def cleanup(self) -> int:
+        """Remove the least recently used entries while over max_size
+
+        Returns:
+            The number of removed entries.
+        """
+
+        entries, total_size = [], 0
+        try:
+            with os.scandir(self.cache_dir) as dir_entries:
+                sub_dirs = [entry.path for entry in dir_entries if entry.is_dir()]
+            for sub_dir in sub_dirs:
+                with os.scandir(sub_dir) as dir_entries:
+                    for entry in dir_entries:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries.append((st.st_mtime, st.st_size, entry.path))
+                            total_size += st.st_size
+        except OSError as e:
+            print(f"{self.cache_dir}: {e}", file=sys.stderr)
+            return 0
+        if self.max_size <= 0 or total_size <= self.max_size:
+            return 0
+        entries.sort()
+        num_removed = 0
+        for _, size, file_path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(file_path)
+                num_removed += 1
+            except FileNotFoundError:
+                # Removed by a concurrent cleanup:
+                pass
+            except OSError as e:
+                print(f"{file_path}: {e}", file=sys.stderr)
+                continue
+            total_size -= size
+        return num_removed
+
+
+def iter_cached_query_task(
+    task: LmcrecQueryTask,
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+    cache_dir: Optional[str] = None,
+    index_cache: Optional[LmcrecIndexCache] = None,
+    cache_max_size: int = QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+) -> Iterator[LmcrecQueryTaskResult]:
+    """Cache aware counterpart of iter_query_task
+
+    The cached result, if any, is yielded in batches w/o decoding the files,
+    otherwise the task is run and its batches are yielded as they become
+    available and they are cached at the end, if the task is cacheable and the
+    play back was complete. The cacheable tasks span a single file, see
+    get_task_files_key, so the results held for caching are bounded by the file
+    size.
+    """
+
+    result_cache = LmcrecQueryResultCache(cache_dir, max_size=cache_max_size)
+    key = result_cache.task_key(task, selectors, have_prev, track_changes)
+    if key is not None:
+        task_result = result_cache.load(key, index=task.index)
+        if task_result is not None:
+            yield from split_task_result(task_result)
+            return
+    batches = [] if key is not None else None
+    for batch in iter_query_task(
+        task,
+        selectors,
+        have_prev=have_prev,
+        track_changes=track_changes,
+        index_cache=index_cache,
+        snapshot_cache=snapshot_cache,
+    ):
+        if batches is not None:
+            # The consumer may release the scans from the batch it was handed:
+            batches.append(
+                LmcrecQueryTaskResult(
+                    index=batch.index,
+                    scans=list(batch.scans),
+                    ret_code=batch.ret_code,
+                    new_chain=batch.new_chain,
+                )
+            )
+        yield batch
+    if batches is not None:
+        task_result = merge_task_batches(batches)
+        if task_result.ret_code == LmcrecScanRetCode.ATEOR:
+            result_cache.store(
+                key, task_result, [selector.name for selector in selectors]
+            )
+
+
+def run_cached_query_task(
+    task: LmcrecQueryTask,
+    selectors: List[LmcrecQuerySelector],
+    have_prev: bool = False,
+    track_changes: bool = False,
+    cache_dir: Optional[str] = None,
+    index_cache: Optional[LmcrecIndexCache] = None,
+    cache_max_size: int = QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+    snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+) -> LmcrecQueryTaskResult:
+    """Cache aware counterpart of run_query_task, see iter_cached_query_task"""
+
+    return merge_task_batches(
+        iter_cached_query_task(
+            task,
+            selectors,
+            have_prev=have_prev,
+            track_changes=track_changes,
+            cache_dir=cache_dir,
+            index_cache=index_cache,
+            cache_max_size=cache_max_size,
+            snapshot_cache=snapshot_cache,
+        )
+    )
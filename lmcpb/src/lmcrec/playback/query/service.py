@@ -0,0 +1,568 @@
+"""Long running query service, see lmcrec-serve
+
+Every query tool invocation rebuilds the file chains, re-reads the .info and
+.index files and replays the record files. A long running service keeps warm:
+
+    - the decoded .info files, i.e. the chain catalog, see LmcrecInfoCache
+    - the decoded .index files, see LmcrecIndexCache
+    - the recent responses, in an LRU cache keyed by the request and the state
+      of the files in the chains, such that a repeated request is served w/o any
+      playback as long as the underlying files did not change; the cache is
+      bounded by the estimated size of the responses
+    - the per file results via the persistent result cache, see
+      result_cache.py, such that overlapping requests replay only the active
+      file
+    - the recently materialized query states, as a small LRU of snapshots taken
+      at the start of the request windows, see state_snapshot.py, such that a
+      later request w/ a window starting at or after a snapshot resumes from
+      it, rather than replaying from the checkpoint preceding its window
+
+The response cache key is based on the request as received, such that the
+requests relative to the current time, e.g. "from": "-30m", may be served from
+the cache as well. Since their window moves w/ the clock, such responses are
+reused only within the same response_cache_ts_granularity slot, i.e. their
+window may lag behind by up to that many seconds.
+
+The number of scans in a response is limited by max_scans, w/ the response
+flagged as truncated if the window had more; a request may lower the limit.
+
+Alternatively the concurrent requests may share the decode passes, see
+shared_scan.py, which is better suited for many clients querying the most
+recent data, e.g. dashboards.
+
+The requests are JSON objects:
+
+    {
+        "queries": QUERY or [QUERY, ...],
+        "from": FROM_SPEC, // optional
+        "to": TO_SPEC, // optional
+        "changed_only": BOOL, // optional
+        "max_scans": INT // optional
+    }
+
+where QUERY is a query spec, see QueryDescription.md, and the FROM/TO_SPEC are
+either timestamps (numbers) or the same specs as for the command line tools,
+e.g. "-30m" or ISO 8601 dates.
+
+The response is a JSON object:
+
+    {
+        "ret_code": RET_CODE_NAME,
+        "from_ts": FROM_TS,
+        "to_ts": TO_TS,
+        "first_ts": FIRST_TS,
+        "last_ts": LAST_TS,
+        "cached": BOOL,
+        "truncated": BOOL,
+        "scans": [
+            {
+                "ts": TS,
+                "prev_ts": PREV_TS,
+                "new_chain": BOOL,
+                "result": {
+                    QUERY_NAME: {
+                        CLASS_NAME: {
+                            "var_names": [VAR_NAME, ...],
+                            "vals_by_inst": {INST_NAME: [VAL, ...], ...}
+                        },
+                    },
+                },
+            },
+        ],
+        "window": { // for k: COLUMN/K/w queries only
+            "ts": LAST_TS,
+            "result": {...}
+        }
+    }
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+from codec import LmcrecIndexCache, LmcrecInfoCache
+
+from .args import parse_from_to_ts
+from .catalog import LmcrecFileCatalog
+from .file_selector import LmcrecFileEntry
+from .lmcrec_query import LmcrecQuery, LmcrecQueryResult
+from .result_cache import QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT
+from .shared_scan import (
+    LmcrecSharedScanConsumer,
+    LmcrecSharedScanScheduler,
+)
+from .state_snapshot import LmcrecStateSnapshotCache
+from .top_k_aggregator import LmcrecQueryTopKAggregator
+
+# The response cache size, in bytes:
+QUERY_SERVICE_RESPONSE_CACHE_SIZE_DEFAULT = 64 << 20
+# The estimated memory footprint of a response value, used for sizing the
+# response cache:
+QUERY_SERVICE_RESPONSE_VALUE_SIZE = 32
+# The time slot, in seconds, for reusing the responses to requests relative to
+# the current time:
+QUERY_SERVICE_RESPONSE_CACHE_TS_GRANULARITY_DEFAULT = 10
+# The max number of scans in a response:
+QUERY_SERVICE_MAX_SCANS_DEFAULT = 10000
+
+
+def query_result_to_json(
+    result: LmcrecQueryResult, copy: bool = False
+) -> Dict[str, Any]:
+    """Convert the query result to JSON types
+
+    Args:
+        result (LmcrecQueryResult):
+            The result to convert.
+
+        copy (bool):
+            Copy the values, required for the results of a running query since
+            the selectors re-use the value lists from one scan to the next.
+    """
+
+    return {
+        query_name: {
+            class_name: {
+                "var_names": list(class_result.var_names),
+                "vals_by_inst": (
+                    {
+                        inst_name: list(vals)
+                        for inst_name, vals in class_result.vals_by_inst.items()
+                    }
+                    if copy
+                    else class_result.vals_by_inst
+                ),
+            }
+            for class_name, class_result in query_result.items()
+        }
+        for query_name, query_result in result.items()
+    }
+
+
+def count_query_result_values(result: LmcrecQueryResult) -> int:
+    """Return the number of values in the result, names included"""
+
+    num_values = 0
+    for query_result in result.values():
+        for class_result in query_result.values():
+            num_vals = len(class_result.var_names)
+            num_values += num_vals + len(class_result.vals_by_inst) * (num_vals + 1)
+    return num_values
+
+
+def parse_request_ts(spec: Any) -> Optional[str]:
+    """Convert the request from/to into the command line format
+
+    Raises:
+        ValueError for invalid spec
+    """
+
+    if spec is None or isinstance(spec, str):
+        return spec
+    if isinstance(spec, (int, float)) and not isinstance(spec, bool):
+        return datetime.fromtimestamp(spec, timezone.utc).isoformat()
+    raise ValueError(f"{spec!r}: invalid timestamp spec")
+
+
+def get_chain_list_signature(
+    chain_list: Optional[List[LmcrecFileEntry]],
+) -> List[Tuple]:
+    """Return the state of the files in the chain list, for cache validation"""
+
+    signature = []
+    for entry in chain_list or []:
+        while entry is not None:
+            lmcrec_info = entry.lmcrec_info
+            signature.append(
+                (
+                    entry.file_name,
+                    lmcrec_info.start_ts,
+                    lmcrec_info.most_recent_ts,
+                    lmcrec_info.state,
+                )
+            )
+            entry = entry.next
+    return signature
+
+
+class LmcrecQueryResponseBuilder:
+    """Build the response scans as the results come in"""
+
+    def __init__(
+        self,
+        window_top_k: Optional[Dict[str, Tuple[str, int]]] = None,
+        max_scans: int = 0,
+    ):
+        """Create the builder
+
+        Args:
+            window_top_k (dict):
+                See LmcrecQuery.window_top_k.
+
+            max_scans (int):
+                The max number of scans, 0 for no limit.
+        """
+
+        self.top_k_aggregator = (
+            LmcrecQueryTopKAggregator(window_top_k) if window_top_k else None
+        )
+        self.max_scans = max_scans
+        self.scans: List[Dict[str, Any]] = []
+        self.truncated = False
+        self.num_values = 0
+
+    def add(
+        self,
+        ts: float,
+        prev_ts: Optional[float],
+        new_chain: bool,
+        result: LmcrecQueryResult,
+        copy: bool = False,
+    ) -> bool:
+        """Add the scan result
+
+        Returns:
+            False if the scan was dropped because of max_scans, True otherwise.
+        """
+
+        if self.max_scans > 0 and len(self.scans) >= self.max_scans:
+            self.truncated = True
+            return False
+        if self.top_k_aggregator is not None:
+            result = self.top_k_aggregator.update(result)
+        self.num_values += count_query_result_values(result)
+        self.scans.append(
+            {
+                "ts": ts,
+                "prev_ts": prev_ts,
+                "new_chain": new_chain,
+                "result": query_result_to_json(result, copy=copy),
+            }
+        )
+        return True
+
+    @property
+    def last_ts(self) -> Optional[float]:
+        return self.scans[-1]["ts"] if self.scans else None
+
+    def build(self, last_ts: Optional[float] = None) -> Dict[str, Any]:
+        """Return the scans part of the response"""
+
+        response = {"truncated": self.truncated, "scans": self.scans}
+        if self.top_k_aggregator is not None:
+            window_result = self.top_k_aggregator.flush()
+            if window_result is not None:
+                self.num_values += count_query_result_values(window_result)
+                response["window"] = {
+                    "ts": last_ts,
+                    "result": query_result_to_json(window_result),
+                }
+        return response
+
+
+class LmcrecQueryService:
+    """Run query requests against a record files dir, w/ warm caches"""
+
+    def __init__(
+        self,
+        record_files_dir: str,
+        result_cache_dir: Optional[str] = None,
+        result_cache_max_size: int = QUERY_RESULT_CACHE_MAX_SIZE_DEFAULT,
+        workers: int = 1,
+        response_cache_size: int = QUERY_SERVICE_RESPONSE_CACHE_SIZE_DEFAULT,
+        response_cache_ts_granularity: float = (
+            QUERY_SERVICE_RESPONSE_CACHE_TS_GRANULARITY_DEFAULT
+        ),
+        max_scans: int = QUERY_SERVICE_MAX_SCANS_DEFAULT,
+        info_cache: Optional[LmcrecInfoCache] = None,
+        index_cache: Optional[LmcrecIndexCache] = None,
+        shared_scan: bool = False,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+    ):
+        """Create the service
+
+        Args:
+            record_files_dir (str):
+                Either the top record files dir or one of its sub-dirs.
+
+            result_cache_dir (str):
+                The persistent result cache dir, None to disable.
+
+            result_cache_max_size (int):
+                See LmcrecQuery.
+
+            workers (int):
+                See LmcrecQuery.
+
+            response_cache_size (int):
+                The max estimated size, in bytes, of the responses to keep, 0
+                to disable.
+
+            response_cache_ts_granularity (float):
+                The time slot, in seconds, for reusing the responses to
+                requests relative to the current time.
+
+            max_scans (int):
+                The max number of scans in a response, 0 for no limit.
+
+            info_cache (LmcrecInfoCache), index_cache (LmcrecIndexCache):
+                The caches to use; new ones are created if not provided.
+
+            shared_scan (bool):
+                Share the decode passes among concurrent requests, see
+                LmcrecSharedScanScheduler. The result_cache_dir and workers are
+                not used in this mode.
+
+            catalog (LmcrecFileCatalog):
+                Look up the record files in this persistent catalog, rather than
+                listing the dirs for every request, see catalog.py.
+
+            snapshot_cache (LmcrecStateSnapshotCache):
+                The query state snapshots to resume from; a new one is created
+                if not provided.
+        """
+
+        self.record_files_dir = record_files_dir
+        self.result_cache_dir = result_cache_dir
+        self.result_cache_max_size = result_cache_max_size
+        self.workers = workers
+        self.info_cache = info_cache if info_cache is not None else LmcrecInfoCache()
+        self.index_cache = (
+            index_cache if index_cache is not None else LmcrecIndexCache()
+        )
+        self.snapshot_cache = (
+            snapshot_cache if snapshot_cache is not None else LmcrecStateSnapshotCache()
+        )
+        self.catalog = catalog
+        self.max_scans = max_scans
+        self._response_cache_size = response_cache_size
+        self._response_cache_ts_granularity = response_cache_ts_granularity
+        # key -> (response, size):
+        self._response_cache: OrderedDict[str, Tuple[Dict[str, Any], int]] = (
+            OrderedDict()
+        )
+        self._response_cache_used = 0
+        self.shared_scan_scheduler = None
+        if shared_scan:
+            self.shared_scan_scheduler = LmcrecSharedScanScheduler(
+                record_files_dir,
+                info_cache=self.info_cache,
+                index_cache=self.index_cache,
+                catalog=self.catalog,
+                snapshot_cache=self.snapshot_cache,
+            )
+        # The queries run concurrently, the lock protects the response cache
+        # and the stats:
+        self._lock = threading.Lock()
+        self.start_ts = time.time()
+        self.num_requests = 0
+        self.num_cached_responses = 0
+
+    def query(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Run the request and return the response
+
+        Raises:
+            ValueError, RuntimeError for invalid requests
+        """
+
+        if not isinstance(request, dict):
+            raise ValueError("the request should be a JSON object")
+        queries = request.get("queries")
+        if isinstance(queries, str):
+            queries = [queries]
+        if (
+            not queries
+            or not isinstance(queries, list)
+            or not all(isinstance(query, str) for query in queries)
+        ):
+            raise ValueError("queries: want a query or a list of queries")
+        changed_only = bool(request.get("changed_only", False))
+        max_scans = self.max_scans
+        request_max_scans = request.get("max_scans")
+        if request_max_scans is not None:
+            if (
+                not isinstance(request_max_scans, int)
+                or isinstance(request_max_scans, bool)
+                or request_max_scans <= 0
+            ):
+                raise ValueError("max_scans: want a positive integer")
+            if max_scans <= 0 or request_max_scans < max_scans:
+                max_scans = request_max_scans
+        from_spec = parse_request_ts(request.get("from"))
+        to_spec = parse_request_ts(request.get("to"))
+        from_ts, to_ts = parse_from_to_ts(from_spec, to_spec)
+
+        with self._lock:
+            self.num_requests += 1
+        shared_scan = self.shared_scan_scheduler is not None
+        lmcrec_query = LmcrecQuery(
+            self.record_files_dir,
+            *queries,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            changed_only=changed_only,
+            workers=1 if shared_scan else self.workers,
+            result_cache_dir=None if shared_scan else self.result_cache_dir,
+            result_cache_max_size=self.result_cache_max_size,
+            info_cache=self.info_cache,
+            index_cache=self.index_cache,
+            snapshot_cache=self.snapshot_cache,
+            catalog=self.catalog,
+        )
+        key = None
+        if self._response_cache_size > 0:
+            key = self._response_cache_key(
+                queries,
+                from_spec,
+                to_spec,
+                to_ts,
+                changed_only,
+                max_scans,
+                lmcrec_query.query_state_cache._chain_list,
+            )
+            with self._lock:
+                cached = self._response_cache.get(key)
+                if cached is not None:
+                    self._response_cache.move_to_end(key)
+                    self.num_cached_responses += 1
+            if cached is not None:
+                lmcrec_query.close()
+                return dict(cached[0], cached=True)
+        builder = LmcrecQueryResponseBuilder(lmcrec_query.window_top_k, max_scans)
+        if shared_scan:
+            lmcrec_query.close()
+            consumer = LmcrecSharedScanConsumer.from_query(
+                lmcrec_query, max_scans=max_scans if max_scans > 0 else None
+            )
+            ret_code = self.shared_scan_scheduler.run(consumer)
+            # The consumer scans are already private copies:
+            for ts, prev_ts, new_chain, result in consumer.scans:
+                builder.add(ts, prev_ts, new_chain, result)
+            builder.truncated = consumer.truncated
+            first_ts, last_ts = consumer.first_ts, consumer.last_ts
+        else:
+
+            def cb(result, query_state_cache):
+                return builder.add(
+                    query_state_cache.ts,
+                    query_state_cache.prev_ts,
+                    query_state_cache.new_chain,
+                    result,
+                    copy=True,
+                )
+
+            try:
+                ret_code = lmcrec_query.run_with_callback(cb)
+            finally:
+                lmcrec_query.close()
+            first_ts, last_ts = lmcrec_query.first_ts, lmcrec_query.last_ts
+            if builder.truncated:
+                # The state cache is one scan past the response:
+                last_ts = builder.last_ts
+        response = {
+            "ret_code": ret_code.name,
+            "from_ts": lmcrec_query.from_ts,
+            "to_ts": lmcrec_query.to_ts,
+            "first_ts": first_ts,
+            "last_ts": last_ts,
+        }
+        response.update(builder.build(last_ts))
+        if key is not None and (
+            ret_code == LmcrecScanRetCode.ATEOR or builder.truncated
+        ):
+            self._cache_response(
+                key, response, builder.num_values * QUERY_SERVICE_RESPONSE_VALUE_SIZE
+            )
+        return dict(response, cached=False)
+
+    def _response_cache_key(
+        self,
+        queries: List[str],
+        from_spec: Optional[str],
+        to_spec: Optional[str],
+        to_ts: Optional[float],
+        changed_only: bool,
+        max_scans: int,
+        chain_list: Optional[List[LmcrecFileEntry]],
+    ) -> str:
+        # The window of a request relative to the current time moves w/ the
+        # clock, such requests share the response within the same time slot:
+        ts_slot = None
+        if to_spec is None and from_spec is not None and from_spec.startswith("-"):
+            granularity = self._response_cache_ts_granularity
+            ts_slot = int(to_ts // granularity) if granularity > 0 else to_ts
+        return json.dumps(
+            [
+                queries,
+                from_spec,
+                to_spec,
+                ts_slot,
+                changed_only,
+                max_scans,
+                get_chain_list_signature(chain_list),
+            ],
+            default=str,
+        )
+
+    def _cache_response(self, key: str, response: Dict[str, Any], size: int):
+        if size > self._response_cache_size:
+            return
+        with self._lock:
+            cached = self._response_cache.pop(key, None)
+            if cached is not None:
+                self._response_cache_used -= cached[1]
+            self._response_cache[key] = (response, size)
+            self._response_cache_used += size
+            while self._response_cache_used > self._response_cache_size:
+                _, (_, evicted_size) = self._response_cache.popitem(last=False)
+                self._response_cache_used -= evicted_size
+
+    def status(self) -> Dict[str, Any]:
+        """Return the service status and cache statistics"""
+
+        status = {
+            "record_files_dir": self.record_files_dir,
+            "result_cache_dir": self.result_cache_dir,
+            "workers": self.workers,
+            "shared_scan": self.shared_scan_scheduler is not None,
+            "uptime": time.time() - self.start_ts,
+            "num_requests": self.num_requests,
+            "num_cached_responses": self.num_cached_responses,
+            "response_cache": len(self._response_cache),
+            "response_cache_used": self._response_cache_used,
+            "info_cache": {
+                "files": len(self.info_cache),
+                "hits": self.info_cache.hits,
+                "misses": self.info_cache.misses,
+            },
+            "index_cache": {
+                "files": len(self.index_cache),
+                "hits": self.index_cache.hits,
+                "misses": self.index_cache.misses,
+            },
+            "snapshot_cache": {
+                "snapshots": len(self.snapshot_cache),
+                "hits": self.snapshot_cache.hits,
+                "misses": self.snapshot_cache.misses,
+            },
+        }
+        catalog = self.catalog
+        if catalog is not None:
+            status["catalog"] = {
+                "file": catalog.catalog_file,
+                "dir_lists": catalog.num_dir_lists,
+                "info_decodes": catalog.num_info_decodes,
+            }
+        scheduler = self.shared_scan_scheduler
+        if scheduler is not None:
+            status["shared_scan_stats"] = {
+                "passes": scheduler.num_passes,
+                "joins": scheduler.num_joins,
+                "private_runs": scheduler.num_private_runs,
+            }
+        return status
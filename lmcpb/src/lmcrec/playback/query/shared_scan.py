@@ -0,0 +1,443 @@
+"""Shared scan scheduling for concurrent queries
+
+Every query runs its own playback, so N concurrent queries against the same
+record files decode the same files N times. The scheduler lets the concurrent
+queries share a single decode pass:
+
+    - the first query starts a pass over its time window and it drives the
+      playback (it is the leader)
+    - a query arriving while a compatible pass is in flight attaches to it at
+      the next scan; every applied scan is fanned out to the selectors of all
+      attached queries, filtered by their own time window
+    - a query which attached after the pass got past its start (a late
+      joiner) wraps around when the pass is over: it replays its missed
+      prefix, and, if its window extends beyond that of the pass, its suffix
+      on its own; the results are then assembled in chronological order
+
+The decoding cost is therefore paid once per file for the overlapping part of
+the windows, rather than once per query.
+
+A query attaching mid-pass has its selectors reset at the first shared scan, as
+if it were the start of a new chain; this does not change the results since the
+selectors do not carry state from one scan to the next, except for the
+changed-only mode. The latter queries therefore always run on their own.
+
+The shared pass always maintains the previous values, so a late joiner may get
+the deltas and rates for its first shared scan even when it starts at a
+checkpoint, whereas a standalone run would not.
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode
+from codec import LmcrecIndexCache, LmcrecInfoCache
+
+from .catalog import LmcrecFileCatalog
+from .lmcrec_query import LmcrecQuery, LmcrecQueryResult
+from .parallel import copy_query_result
+from .query_selector import LmcrecQuerySelector
+from .query_state_cache import LmcrecQueryIntervalStateCache
+from .state_snapshot import LmcrecStateSnapshotCache
+
+# (ts, prev_ts, new_chain, result):
+LmcrecSharedScan = Tuple[float, Optional[float], bool, LmcrecQueryResult]
+
+
+@dataclass
+class LmcrecSharedScanConsumer:
+    """A query attached to the shared scan scheduler
+
+    The results are collected in scans, in chronological order, once
+    LmcrecSharedScanScheduler.run returns. If max_scans is set then at most
+    that many scans are collected and truncated is set if there were more.
+    """
+
+    selectors: List[LmcrecQuerySelector]
+    from_ts: Optional[float] = None
+    to_ts: Optional[float] = None
+    have_prev: bool = False
+    changed_only: bool = False
+    max_scans: Optional[int] = None
+    scans: List[LmcrecSharedScan] = field(default_factory=list)
+    ret_code: Optional[LmcrecScanRetCode] = None
+    truncated: bool = False
+    # The shared pass bookkeeping:
+    _shared_scans: List[LmcrecSharedScan] = field(default_factory=list)
+    # The ts of the most recent scan of the pass when the consumer attached,
+    # None if it attached before the first scan:
+    _join_ts: Optional[float] = None
+    _needs_reset: bool = True
+    _done: bool = False
+    _detached: bool = False
+    _pass_ret_code: Optional[LmcrecScanRetCode] = None
+
+    @classmethod
+    def from_query(
+        cls, lmcrec_query: LmcrecQuery, max_scans: Optional[int] = None
+    ) -> "LmcrecSharedScanConsumer":
+        """Build the consumer for a query; the query itself is not run
+
+        Raises:
+            ValueError for multi-window queries
+        """
+
+        if lmcrec_query.windows is not None:
+            raise ValueError("multi-window queries cannot share scans")
+        from_ts, to_ts = lmcrec_query._window
+        return cls(
+            selectors=lmcrec_query._selectors,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            have_prev=lmcrec_query._have_prev,
+            changed_only=lmcrec_query._changed_only,
+            max_scans=max_scans,
+        )
+
+    @property
+    def first_ts(self) -> Optional[float]:
+        return self.scans[0][0] if self.scans else None
+
+    @property
+    def last_ts(self) -> Optional[float]:
+        return self.scans[-1][0] if self.scans else None
+
+
+def apply_consumer_scan(
+    consumer: LmcrecSharedScanConsumer,
+    query_state_cache: LmcrecQueryIntervalStateCache,
+    scans: List[LmcrecSharedScan],
+    after_ts: Optional[float] = None,
+):
+    """Run the consumer selectors against the most recent scan
+
+    The scan is collected into scans if it is in the consumer window and after
+    after_ts, if specified. Past the window end, or past max_scans, the consumer
+    is marked as done.
+    """
+
+    ts = query_state_cache.ts
+    if consumer.from_ts is not None and ts < consumer.from_ts:
+        return
+    if consumer.to_ts is not None and ts > consumer.to_ts:
+        consumer._done = True
+        return
+    if consumer.max_scans is not None and len(scans) >= consumer.max_scans:
+        consumer._done = True
+        consumer.truncated = True
+        return
+    new_chain = query_state_cache.new_chain
+    if consumer._needs_reset:
+        query_state_cache.new_chain = True
+    try:
+        result = {
+            selector.name: selector.run(query_state_cache)
+            for selector in consumer.selectors
+        }
+    finally:
+        query_state_cache.new_chain = new_chain
+    consumer._needs_reset = False
+    if after_ts is None or ts > after_ts:
+        scans.append(
+            (ts, query_state_cache.prev_ts, new_chain, copy_query_result(result))
+        )
+
+
+class _LmcrecSharedScanPass:
+    """An in-flight decode pass"""
+
+    def __init__(self, from_ts: Optional[float], to_ts: Optional[float]):
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+        # The ts of the most recently applied scan:
+        self.ts: Optional[float] = None
+        # The consumers waiting to be attached at the next scan:
+        self.pending: List[LmcrecSharedScanConsumer] = []
+        # All the consumers ever attached:
+        self.consumers: List[LmcrecSharedScanConsumer] = []
+        self.done = False
+
+    def can_join(self, consumer: LmcrecSharedScanConsumer) -> bool:
+        if self.done or consumer.changed_only:
+            return False
+        if (
+            self.to_ts is not None
+            and consumer.from_ts is not None
+            and consumer.from_ts > self.to_ts
+        ):
+            return False
+        if self.ts is not None and consumer.to_ts is not None:
+            return consumer.to_ts > self.ts
+        return True
+
+
+class LmcrecSharedScanScheduler:
+    """Share the decode passes among concurrent queries"""
+
+    def __init__(
+        self,
+        record_files_dir: str,
+        info_cache: Optional[LmcrecInfoCache] = None,
+        index_cache: Optional[LmcrecIndexCache] = None,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        snapshot_cache: Optional[LmcrecStateSnapshotCache] = None,
+        _on_scan: Optional[Callable[[LmcrecQueryIntervalStateCache], None]] = None,
+    ):
+        """Create the scheduler
+
+        Args:
+            record_files_dir (str):
+                Either the top record files dir or one of its sub-dirs.
+
+            info_cache (LmcrecInfoCache), index_cache (LmcrecIndexCache),
+            catalog (LmcrecFileCatalog), snapshot_cache
+            (LmcrecStateSnapshotCache):
+                See LmcrecQueryIntervalStateCache.
+
+            _on_scan (Callable):
+                Used for testing, invoked by the leader after each shared scan.
+        """
+
+        self.record_files_dir = record_files_dir
+        self.info_cache = info_cache
+        self.index_cache = index_cache
+        self.catalog = catalog
+        self.snapshot_cache = snapshot_cache
+        self._on_scan = _on_scan
+        self._cond = threading.Condition()
+        self._passes: List[_LmcrecSharedScanPass] = []
+        # Statistics:
+        self.num_passes = 0
+        self.num_joins = 0
+        self.num_private_runs = 0
+
+    def _new_state_cache(
+        self,
+        from_ts: Optional[float],
+        to_ts: Optional[float],
+        have_prev: bool,
+        track_changes: bool = False,
+    ) -> LmcrecQueryIntervalStateCache:
+        return LmcrecQueryIntervalStateCache(
+            self.record_files_dir,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            have_prev=have_prev,
+            track_changes=track_changes,
+            info_cache=self.info_cache,
+            index_cache=self.index_cache,
+            catalog=self.catalog,
+            snapshot_cache=self.snapshot_cache,
+        )
+
+    def run(self, consumer: LmcrecSharedScanConsumer) -> LmcrecScanRetCode:
+        """Run the consumer query, sharing the decode pass whenever possible
+
+        The call blocks until all the results are collected into
+        consumer.scans; it is meant to be invoked from concurrent threads, e.g.
+        those of a threading HTTP server.
+
+        Returns:
+            The LmcrecScanRetCode of the playback, also stored in
+            consumer.ret_code.
+        """
+
+        scan_pass = None
+        with self._cond:
+            for in_flight in self._passes:
+                if in_flight.can_join(consumer):
+                    scan_pass = in_flight
+                    break
+            if scan_pass is not None:
+                consumer._join_ts = scan_pass.ts
+                scan_pass.pending.append(consumer)
+                self.num_joins += 1
+                while not consumer._detached:
+                    self._cond.wait()
+            elif not consumer.changed_only:
+                scan_pass = _LmcrecSharedScanPass(consumer.from_ts, consumer.to_ts)
+                scan_pass.pending.append(consumer)
+                self._passes.append(scan_pass)
+                self.num_passes += 1
+        if scan_pass is not None and not consumer._detached:
+            self._run_pass(scan_pass)
+        return self._complete(consumer, scan_pass)
+
+    def run_batch(
+        self, consumers: List[LmcrecSharedScanConsumer]
+    ) -> List[LmcrecScanRetCode]:
+        """Run a batch of queries w/ a single decode pass over the union window
+
+        Returns:
+            The LmcrecScanRetCode for each consumer.
+        """
+
+        shared = [consumer for consumer in consumers if not consumer.changed_only]
+        if shared:
+            from_ts, to_ts = shared[0].from_ts, shared[0].to_ts
+            for consumer in shared[1:]:
+                if from_ts is not None:
+                    from_ts = (
+                        None
+                        if consumer.from_ts is None
+                        else min(from_ts, consumer.from_ts)
+                    )
+                if to_ts is not None:
+                    to_ts = (
+                        None if consumer.to_ts is None else max(to_ts, consumer.to_ts)
+                    )
+            scan_pass = _LmcrecSharedScanPass(from_ts, to_ts)
+            scan_pass.pending.extend(shared)
+            with self._cond:
+                self._passes.append(scan_pass)
+                self.num_passes += 1
+            self._run_pass(scan_pass)
+        return [
+            self._complete(consumer, scan_pass if not consumer.changed_only else None)
+            for consumer in consumers
+        ]
+
+    def _run_pass(self, scan_pass: _LmcrecSharedScanPass):
+        """Drive the decode pass, invoked by the leader"""
+
+        query_state_cache = self._new_state_cache(
+            scan_pass.from_ts, scan_pass.to_ts, have_prev=True
+        )
+        active = []
+        ret_code = None
+        try:
+            while True:
+                with self._cond:
+                    for consumer in scan_pass.pending:
+                        consumer._needs_reset = True
+                        active.append(consumer)
+                        scan_pass.consumers.append(consumer)
+                    scan_pass.pending.clear()
+                    if not active:
+                        # Everybody is past their window end:
+                        ret_code = LmcrecScanRetCode.ATEOR
+                        scan_pass.done = True
+                        break
+                ret_code = query_state_cache.apply_next_scan()
+                if ret_code != LmcrecScanRetCode.COMPLETE:
+                    break
+                with self._cond:
+                    scan_pass.ts = query_state_cache.ts
+                for consumer in active:
+                    apply_consumer_scan(
+                        consumer, query_state_cache, consumer._shared_scans
+                    )
+                active = [consumer for consumer in active if not consumer._done]
+                if self._on_scan is not None:
+                    self._on_scan(query_state_cache)
+        finally:
+            query_state_cache.close()
+            with self._cond:
+                scan_pass.done = True
+                if scan_pass in self._passes:
+                    self._passes.remove(scan_pass)
+                # Those still pending did not get any scan, they will run on
+                # their own:
+                for consumer in scan_pass.consumers + scan_pass.pending:
+                    consumer._pass_ret_code = ret_code
+                    consumer._detached = True
+                scan_pass.pending.clear()
+                self._cond.notify_all()
+
+    def _run_private(
+        self,
+        consumer: LmcrecSharedScanConsumer,
+        scans: List[LmcrecSharedScan],
+        from_ts: Optional[float],
+        to_ts: Optional[float],
+        after_ts: Optional[float] = None,
+        before_ts: Optional[float] = None,
+    ) -> LmcrecScanRetCode:
+        """Play back (a part of) the consumer window on its own"""
+
+        with self._cond:
+            self.num_private_runs += 1
+        query_state_cache = self._new_state_cache(
+            from_ts,
+            to_ts,
+            have_prev=consumer.have_prev,
+            track_changes=consumer.changed_only,
+        )
+        consumer._needs_reset = True
+        consumer._done = False
+        try:
+            while True:
+                ret_code = query_state_cache.apply_next_scan()
+                if ret_code != LmcrecScanRetCode.COMPLETE:
+                    return ret_code
+                if before_ts is not None and query_state_cache.ts >= before_ts:
+                    return LmcrecScanRetCode.ATEOR
+                apply_consumer_scan(
+                    consumer, query_state_cache, scans, after_ts=after_ts
+                )
+                if consumer._done:
+                    return LmcrecScanRetCode.ATEOR
+        finally:
+            query_state_cache.close()
+
+    def _complete(
+        self,
+        consumer: LmcrecSharedScanConsumer,
+        scan_pass: Optional[_LmcrecSharedScanPass],
+    ) -> LmcrecScanRetCode:
+        """Cover the part of the consumer window missed by the shared pass"""
+
+        shared_scans = consumer._shared_scans
+        if scan_pass is None or not shared_scans:
+            scans = []
+            ret_code = self._run_private(
+                consumer, scans, consumer.from_ts, consumer.to_ts
+            )
+        else:
+            ret_code = consumer._pass_ret_code
+            shared_done = consumer._done
+            prefix, prefix_ret_code = [], LmcrecScanRetCode.ATEOR
+            join_ts, from_ts = consumer._join_ts, consumer.from_ts
+            if join_ts is not None:
+                missed_prefix = from_ts is None or from_ts <= join_ts
+            else:
+                missed_prefix = scan_pass.from_ts is not None and (
+                    from_ts is None or from_ts < scan_pass.from_ts
+                )
+            if missed_prefix:
+                # Wrap around:
+                prefix_ret_code = self._run_private(
+                    consumer,
+                    prefix,
+                    from_ts,
+                    shared_scans[0][0],
+                    before_ts=shared_scans[0][0],
+                )
+            suffix = []
+            if not consumer.truncated and (
+                ret_code != LmcrecScanRetCode.ATEOR
+                or (
+                    not shared_done
+                    and scan_pass.to_ts is not None
+                    and (consumer.to_ts is None or consumer.to_ts > scan_pass.to_ts)
+                )
+            ):
+                # The pass ended before the consumer window:
+                last_ts = shared_scans[-1][0]
+                ret_code = self._run_private(
+                    consumer, suffix, last_ts, consumer.to_ts, after_ts=last_ts
+                )
+            if prefix_ret_code != LmcrecScanRetCode.ATEOR:
+                ret_code = prefix_ret_code
+            scans = prefix + shared_scans + suffix
+            if consumer.max_scans is not None and len(scans) > consumer.max_scans:
+                del scans[consumer.max_scans :]
+                consumer.truncated = True
+        if scans and not scans[0][2]:
+            ts, prev_ts, _, result = scans[0]
+            scans[0] = (ts, prev_ts, True, result)
+        consumer.scans = scans
+        consumer._shared_scans = []
+        consumer.ret_code = ret_code
+        return ret_code
@@ -0,0 +1,197 @@
+"""Snapshots of the query state cache, for long running processes
+
+A request seeds its state from the checkpoint preceding its window and replays
+the scans from there up to its from_ts. A long running process, e.g.
+lmcrec-serve, can instead resume from the state materialized by an earlier
+request, if more recent than the checkpoint. The snapshots are taken at the
+first scan of the window, i.e. once per request and file, and they are kept in
+a small LRU cache keyed by the file and the scan timestamp.
+
+The snapshot holds a private copy of the state cache and the file offset of the
+next scan; the record files are append only, so the offset remains valid while
+the file is being written. The file start timestamp guards against a file
+replaced under the same name.
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+from cache import LmcrecStateCache
+
+# The max number of snapshots to keep:
+STATE_SNAPSHOT_CACHE_MAX_SNAPSHOTS_DEFAULT = 16
+
+# The state cache attributes saved in a snapshot. They are copied in one go, so
+# the objects referenced from multiple attributes, e.g. inst_by_name and
+# inst_by_id, remain shared in the copy:
+STATE_SNAPSHOT_ATTRS = (
+    "ts",
+    "prev_ts",
+    "duration",
+    "scan_tally",
+    "num_scans",
+    "new_inst",
+    "deleted_inst",
+    "new_class_def",
+    "class_by_name",
+    "class_by_id",
+    "inst_by_name",
+    "inst_by_id",
+    "inst_max_size",
+    "inst_by_class_name",
+    "children_by_inst_id",
+    "new_inst_names",
+    "changed_vars",
+    "_curr_class",
+    "_curr_inst",
+)
+
+# (file_name, ts, have_prev, track_changes):
+LmcrecStateSnapshotKey = Tuple[str, float, bool, bool]
+
+
+@dataclass
+class LmcrecStateSnapshot:
+    file_name: str
+    # The start ts of the file, to detect a file replaced under the same name:
+    start_ts: Optional[float]
+    # The offset of the scan following the snapshot:
+    offset: int
+    ts: float
+    state: Tuple[Any, ...]
+
+
+class LmcrecStateSnapshotCache:
+    """LRU cache of query state snapshots"""
+
+    def __init__(self, max_snapshots: int = STATE_SNAPSHOT_CACHE_MAX_SNAPSHOTS_DEFAULT):
+        """Create the cache
+
+        Args:
+            max_snapshots (int):
+                The maximum number of snapshots to keep, 0 to disable.
+        """
+
+        self._max_snapshots = max_snapshots
+        self._cache: OrderedDict[LmcrecStateSnapshotKey, LmcrecStateSnapshot] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def save(
+        self,
+        state_cache: LmcrecStateCache,
+        file_name: str,
+        start_ts: Optional[float],
+        offset: int,
+    ):
+        """Save a snapshot of the state cache, following its most recent scan
+
+        Args:
+            state_cache (LmcrecStateCache):
+                The state cache, w/ its most recent scan applied.
+
+            file_name (str), start_ts (float):
+                The file being played back and its start ts.
+
+            offset (int):
+                The file offset of the next scan.
+        """
+
+        if self._max_snapshots <= 0:
+            return
+        key = (
+            file_name,
+            state_cache.ts,
+            state_cache._have_prev,
+            state_cache._track_changes,
+        )
+        with self._lock:
+            snapshot = self._cache.get(key)
+            if snapshot is not None and snapshot.start_ts == start_ts:
+                self._cache.move_to_end(key)
+                return
+        state = copy.deepcopy(
+            tuple(getattr(state_cache, attr) for attr in STATE_SNAPSHOT_ATTRS)
+        )
+        with self._lock:
+            self._cache[key] = LmcrecStateSnapshot(
+                file_name=file_name,
+                start_ts=start_ts,
+                offset=offset,
+                ts=state_cache.ts,
+                state=state,
+            )
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_snapshots:
+                self._cache.popitem(last=False)
+
+    def restore(
+        self,
+        state_cache: LmcrecStateCache,
+        file_name: str,
+        start_ts: Optional[float],
+        from_ts: float,
+        after_ts: Optional[float] = None,
+    ) -> Optional[int]:
+        """Restore the most recent snapshot at or before from_ts, if any
+
+        Args:
+            state_cache (LmcrecStateCache):
+                The state cache to restore into; only the snapshots taken w/ the
+                same have_prev and track_changes are considered.
+
+            file_name (str), start_ts (float):
+                The file being played back and its start ts.
+
+            from_ts (float):
+                The ts to resume from.
+
+            after_ts (float):
+                Consider only the snapshots more recent than this, e.g. the
+                checkpoint the playback would otherwise start from.
+
+        Returns:
+            The file offset to resume the playback from, None if no snapshot
+            was restored.
+        """
+
+        if self._max_snapshots <= 0:
+            return None
+        have_prev, track_changes = state_cache._have_prev, state_cache._track_changes
+        found = None
+        with self._lock:
+            for key, snapshot in self._cache.items():
+                if (
+                    key[0] != file_name
+                    or key[2] != have_prev
+                    or key[3] != track_changes
+                    or snapshot.start_ts != start_ts
+                    or snapshot.ts > from_ts
+                    or after_ts is not None
+                    and snapshot.ts <= after_ts
+                ):
+                    continue
+                if found is None or found[1].ts < snapshot.ts:
+                    found = (key, snapshot)
+            if found is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(found[0])
+            self.hits += 1
+        snapshot = found[1]
+        for attr, val in zip(STATE_SNAPSHOT_ATTRS, copy.deepcopy(snapshot.state)):
+            setattr(state_cache, attr, val)
+        return snapshot.offset
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
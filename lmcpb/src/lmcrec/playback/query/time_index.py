@@ -0,0 +1,538 @@
+"""Global time to checkpoint index for a record files dir
+
+Seeking to a timestamp requires building the file chains, i.e. decoding the
+.info files, and then decoding the .index file of the selected record file.
+Tools jumping back and forth through a long time range pay this cost for every
+seek.
+
+The time index consolidates the .index files of all the closed record files of
+a record files dir into 3 parallel arrays, sorted by timestamp:
+
+    - the checkpoint timestamp, int64 microseconds
+    - the checkpoint offset, int64
+    - the record file number, int32, into the file list
+
+each stored in its own binary file, in native byte order, so that it can be
+memory mapped. The file list, holding the record file names, signatures and
+their array ranges, is kept in a JSON file alongside. The index is kept under
+$LMCREC_RUNTIME/time_index by default.
+
+The index is refreshed incrementally: the checkpoints of the newly closed files
+are appended to the arrays. The file list holds the number of valid entries, so
+the arrays are extended in place and the entries past that number, e.g. from an
+interrupted refresh, are ignored. If a file was removed or changed, or if the
+new checkpoints are older than the indexed ones, the index is rebuilt under a
+new generation and the old generation files are removed.
+
+A seek is then a single bisect, see LmcrecTimeIndex.seek. The index also
+provides the last_checkpoint method of LmcrecIndexCache, so it can be used
+wherever the latter is accepted, e.g. LmcrecQuery(..., index_cache=...), with
+the files which are not indexed, e.g. the active one, being delegated to an
+LmcrecIndexCache.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+
+from codec import (
+    INDEX_FILE_SUFFIX,
+    LmcrecIndexCache,
+    LmcrecIndexFileDecoder,
+    LmcrecInfoState,
+)
+
+from .catalog import LmcrecFileCatalog, get_record_files_dir_runtime_file
+from .file_selector import build_lmcrec_file_chains
+
+TIME_INDEX_SUB_DIR = "time_index"
+
+# The auto refresh interval for long running processes, see LmcrecTimeIndex:
+TIME_INDEX_AUTO_REFRESH_INTERVAL_DEFAULT = 60
+
+# Bump this up whenever the stored format changes:
+TIME_INDEX_VERSION = 1
+
+TIME_INDEX_FILES_FILE = "files.json"
+TIME_INDEX_TS_FILE_PREFIX = "ts"
+TIME_INDEX_OFFSET_FILE_PREFIX = "offset"
+TIME_INDEX_FILE_NUM_FILE_PREFIX = "file"
+
+TIME_INDEX_VERSION_KEY = "version"
+TIME_INDEX_RECORD_FILES_DIR_KEY = "record_files_dir"
+TIME_INDEX_GENERATION_KEY = "generation"
+TIME_INDEX_NUM_ENTRIES_KEY = "num_entries"
+TIME_INDEX_FILES_KEY = "files"
+
+# The array files: (prefix, array typecode):
+time_index_arrays = [
+    (TIME_INDEX_TS_FILE_PREFIX, "q"),
+    (TIME_INDEX_OFFSET_FILE_PREFIX, "q"),
+    (TIME_INDEX_FILE_NUM_FILE_PREFIX, "i"),
+]
+
+# The file list entries: [file_name, size, mtime_ns, most_recent_ts, first, count]
+# where file_name is relative to the record files dir and first, count are the
+# range of its checkpoints in the arrays.
+TIME_INDEX_FILE_NAME_I = 0
+TIME_INDEX_FILE_SIZE_I = 1
+TIME_INDEX_FILE_MTIME_I = 2
+TIME_INDEX_FILE_LAST_TS_I = 3
+TIME_INDEX_FILE_FIRST_I = 4
+TIME_INDEX_FILE_COUNT_I = 5
+
+
+def get_lmcrec_time_index_dir(record_files_dir: str) -> str:
+    """Return the default time index dir for a record files dir"""
+
+    return get_record_files_dir_runtime_file(
+        TIME_INDEX_SUB_DIR, record_files_dir, suffix=""
+    )
+
+
+def get_time_index_arg_parser() -> argparse.ArgumentParser:
+    """Return the argument parser with the args used for the time index
+
+    To be used as a parent to a specific tool parser (see parents arg of
+    ArgumentParser).
+    """
+
+    parser = argparse.ArgumentParser(
+        add_help=False,
+    )
+    parser.add_argument(
+        "-X",
+        "--time-index",
+        metavar="TIME_INDEX_DIR",
+        nargs="?",
+        const="",
+        help=f"""
+        Locate the checkpoints via the global time index of the record files
+        dir, refreshed incrementally, rather than decoding the .index file of
+        every record file. Default TIME_INDEX_DIR:
+        $LMCREC_RUNTIME/{TIME_INDEX_SUB_DIR}/DIR-HASH.
+        """,
+    )
+    return parser
+
+
+def process_time_index_args(
+    args: argparse.Namespace,
+    record_files_dir: str,
+    catalog: Optional[LmcrecFileCatalog] = None,
+    auto_refresh_interval: Optional[float] = None,
+) -> Optional["LmcrecTimeIndex"]:
+    """Return the refreshed time index based on the args, None if not enabled"""
+
+    if args.time_index is None:
+        return None
+    time_index = LmcrecTimeIndex(
+        record_files_dir,
+        index_dir=args.time_index or None,
+        catalog=catalog,
+        auto_refresh_interval=auto_refresh_interval,
+    )
+    time_index.refresh()
+    return time_index
+
+
+def ts_to_usec(ts: float) -> int:
+    return round(ts * 1_000_000)
+
+
+class LmcrecTimeIndex:
+    """Memory mapped global time index, w/ incremental refresh"""
+
+    def __init__(
+        self,
+        record_files_dir: str,
+        index_dir: Optional[str] = None,
+        catalog: Optional[LmcrecFileCatalog] = None,
+        index_cache: Optional[LmcrecIndexCache] = None,
+        auto_refresh_interval: Optional[float] = None,
+    ):
+        """Create the index
+
+        Args:
+            record_files_dir (str):
+                Either the top record files dir or one of its sub-dirs.
+
+            index_dir (str):
+                The dir to persist the index, default: see
+                get_lmcrec_time_index_dir.
+
+            catalog (LmcrecFileCatalog):
+                If provided then use it for listing the record files, see
+                build_lmcrec_file_chains.
+
+            index_cache (LmcrecIndexCache):
+                The cache to use for the files which are not indexed, a new one
+                is created if not provided.
+
+            auto_refresh_interval (float):
+                If not None then a lookup for a file which is not indexed
+                triggers a refresh, if none happened in the last that many
+                seconds. Useful for long running processes, which would
+                otherwise have to refresh the index explicitly as files close.
+        """
+
+        self.record_files_dir = os.path.abspath(record_files_dir)
+        self.index_dir = (
+            index_dir
+            if index_dir is not None
+            else get_lmcrec_time_index_dir(self.record_files_dir)
+        )
+        self._catalog = catalog
+        self.index_cache = (
+            index_cache if index_cache is not None else LmcrecIndexCache()
+        )
+        self._auto_refresh_interval = auto_refresh_interval
+        self._last_refresh = None
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._num_entries = 0
+        self._files: Optional[List[List[Any]]] = None
+        self._file_num_by_name: Dict[str, int] = dict()
+        self._mmaps: List[Optional[mmap.mmap]] = []
+        self._views: List[Any] = []
+        # The arrays, either memory mapped or empty:
+        self._ts = self._offset = self._file_num = array("q")
+        self.num_file_decodes = 0
+        # Lookup stats, for compatibility w/ LmcrecIndexCache:
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._files) if self._files is not None else 0
+
+    @property
+    def num_entries(self) -> int:
+        return self._num_entries
+
+    def _array_file(self, prefix: str, generation: Optional[int] = None) -> str:
+        if generation is None:
+            generation = self._generation
+        return os.path.join(self.index_dir, f"{prefix}-{generation}.bin")
+
+    def _unmap(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        for m in self._mmaps:
+            if m is not None:
+                m.close()
+        self._mmaps = []
+        self._ts = self._offset = self._file_num = array("q")
+
+    def _map(self):
+        self._unmap()
+        arrays = []
+        for prefix, typecode in time_index_arrays:
+            if self._num_entries == 0:
+                arrays.append(array(typecode))
+                continue
+            with open(self._array_file(prefix), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps.append(m)
+            view = memoryview(m).cast(typecode)
+            self._views.append(view)
+            if len(view) < self._num_entries:
+                raise RuntimeError(
+                    f"{self._array_file(prefix)}: {len(view)} entries, "
+                    f"want at least {self._num_entries}"
+                )
+            arrays.append(view)
+        self._ts, self._offset, self._file_num = arrays
+
+    def _reset(self):
+        self._unmap()
+        self._files = []
+        self._file_num_by_name = dict()
+        self._num_entries = 0
+
+    def _load(self):
+        self._reset()
+        try:
+            with open(os.path.join(self.index_dir, TIME_INDEX_FILES_FILE), "rt") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f"{self.index_dir}: {e}, ignored", file=sys.stderr)
+            return
+        if (
+            not isinstance(index, dict)
+            or index.get(TIME_INDEX_VERSION_KEY) != TIME_INDEX_VERSION
+            or index.get(TIME_INDEX_RECORD_FILES_DIR_KEY) != self.record_files_dir
+        ):
+            return
+        self._generation = index[TIME_INDEX_GENERATION_KEY]
+        self._num_entries = index[TIME_INDEX_NUM_ENTRIES_KEY]
+        self._files = index[TIME_INDEX_FILES_KEY]
+        try:
+            self._map()
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"{self.index_dir}: {e}, ignored", file=sys.stderr)
+            self._reset()
+            return
+        self._file_num_by_name = {
+            file_entry[TIME_INDEX_FILE_NAME_I]: file_num
+            for file_num, file_entry in enumerate(self._files)
+        }
+
+    def _save_files(self):
+        tmp_files_file = os.path.join(
+            self.index_dir, f"{TIME_INDEX_FILES_FILE}.{os.getpid()}.tmp"
+        )
+        with open(tmp_files_file, "wt") as f:
+            json.dump(
+                {
+                    TIME_INDEX_VERSION_KEY: TIME_INDEX_VERSION,
+                    TIME_INDEX_RECORD_FILES_DIR_KEY: self.record_files_dir,
+                    TIME_INDEX_GENERATION_KEY: self._generation,
+                    TIME_INDEX_NUM_ENTRIES_KEY: self._num_entries,
+                    TIME_INDEX_FILES_KEY: self._files,
+                },
+                f,
+            )
+        os.replace(tmp_files_file, os.path.join(self.index_dir, TIME_INDEX_FILES_FILE))
+
+    def _append(
+        self,
+        new_files: List[Tuple[List[Any], List[Tuple[float, int]]]],
+        rebuild: bool,
+    ):
+        """Append the new files, w/ their checkpoints, to the arrays"""
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        prev_generation = self._generation
+        if rebuild:
+            self._files, self._num_entries = [], 0
+            self._generation += 1
+        new_arrays = [array(typecode) for _, typecode in time_index_arrays]
+        ts_array, offset_array, file_num_array = new_arrays
+        for file_entry, checkpoints in new_files:
+            file_num = len(self._files)
+            file_entry[TIME_INDEX_FILE_FIRST_I] = self._num_entries + len(ts_array)
+            file_entry[TIME_INDEX_FILE_COUNT_I] = len(checkpoints)
+            for ts, off in checkpoints:
+                ts_array.append(ts_to_usec(ts))
+                offset_array.append(off)
+                file_num_array.append(file_num)
+            self._files.append(file_entry)
+        # Unmap before extending the array files:
+        self._unmap()
+        for (prefix, _), new_array in zip(time_index_arrays, new_arrays):
+            array_file = self._array_file(prefix)
+            with open(array_file, "r+b" if os.path.exists(array_file) else "wb") as f:
+                # Drop the entries past the valid ones, if any:
+                f.truncate(self._num_entries * new_array.itemsize)
+                f.seek(0, os.SEEK_END)
+                new_array.tofile(f)
+        self._num_entries += len(ts_array)
+        self._save_files()
+        self._file_num_by_name = {
+            file_entry[TIME_INDEX_FILE_NAME_I]: file_num
+            for file_num, file_entry in enumerate(self._files)
+        }
+        if rebuild:
+            for prefix, _ in time_index_arrays:
+                try:
+                    os.unlink(self._array_file(prefix, prev_generation))
+                except FileNotFoundError:
+                    pass
+        self._map()
+
+    def refresh(self) -> bool:
+        """Index the newly closed files, rebuild if needed
+
+        Returns:
+            bool: whether the index changed
+        """
+
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            if self._files is None:
+                self._load()
+            # The closed files, in chronological order:
+            closed_files = []
+            for entry in (
+                build_lmcrec_file_chains(self.record_files_dir, catalog=self._catalog)
+                or []
+            ):
+                while entry is not None:
+                    lmcrec_info = entry.lmcrec_info
+                    if lmcrec_info.state == LmcrecInfoState.CLOSED:
+                        closed_files.append(
+                            (lmcrec_info.start_ts, entry.file_name, lmcrec_info)
+                        )
+                    entry = entry.next
+            closed_files.sort(key=lambda closed_file: closed_file[:2])
+
+            signatures = dict()
+            for _, file_name, _ in closed_files:
+                try:
+                    st = os.stat(file_name)
+                except FileNotFoundError:
+                    continue
+                signatures[os.path.relpath(file_name, self.record_files_dir)] = [
+                    st.st_size,
+                    st.st_mtime_ns,
+                ]
+
+            def collect_new_files(
+                rebuild: bool,
+            ) -> Optional[List[Tuple[List[Any], List[Tuple[float, int]]]]]:
+                """Return the files to append, None if a rebuild is needed"""
+
+                new_files = []
+                last_usec = (
+                    self._ts[self._num_entries - 1]
+                    if self._num_entries > 0 and not rebuild
+                    else None
+                )
+                for _, file_name, lmcrec_info in closed_files:
+                    lmcrec_file = os.path.relpath(file_name, self.record_files_dir)
+                    signature = signatures.get(lmcrec_file)
+                    if signature is None or (
+                        not rebuild and lmcrec_file in self._file_num_by_name
+                    ):
+                        continue
+                    index_decoder = LmcrecIndexFileDecoder(
+                        file_name + INDEX_FILE_SUFFIX
+                    )
+                    try:
+                        checkpoints = list(index_decoder.checkpoints())
+                    finally:
+                        index_decoder.close()
+                    self.num_file_decodes += 1
+                    if checkpoints:
+                        first_usec = ts_to_usec(checkpoints[0][0])
+                        if last_usec is not None and first_usec < last_usec:
+                            if not rebuild:
+                                return None
+                            print(
+                                f"{file_name}: checkpoints overlapping the "
+                                "previous file, seeks may be off",
+                                file=sys.stderr,
+                            )
+                        last_usec = ts_to_usec(checkpoints[-1][0])
+                    new_files.append(
+                        (
+                            [lmcrec_file, *signature, lmcrec_info.most_recent_ts, 0, 0],
+                            checkpoints,
+                        )
+                    )
+                return new_files
+
+            # Rebuild if any of the indexed files was removed or changed:
+            rebuild = any(
+                signatures.get(file_entry[TIME_INDEX_FILE_NAME_I])
+                != file_entry[TIME_INDEX_FILE_SIZE_I : TIME_INDEX_FILE_MTIME_I + 1]
+                for file_entry in self._files
+            )
+            new_files = collect_new_files(rebuild)
+            if new_files is None:
+                # Out of order:
+                rebuild = True
+                new_files = collect_new_files(rebuild)
+            if not rebuild and not new_files:
+                return False
+            self._append(new_files, rebuild)
+        return True
+
+    def seek(self, ts: float) -> Optional[Tuple[str, float, int]]:
+        """Locate the checkpoint to start the playback from, for ts
+
+        That is the most recent checkpoint at or before ts or, if ts falls
+        between files or before the first one, the first checkpoint
+        following it.
+
+        Returns:
+            tuple: (file_name, chkpt_ts, chkpt_off), None if there is no
+            checkpoint at or after ts, the file_name is absolute.
+        """
+
+        with self._lock:
+            if self._files is None:
+                self._load()
+            n = self._num_entries
+            i = bisect_right(self._ts, ts_to_usec(ts), 0, n) - 1
+            if i < 0:
+                i = 0
+            else:
+                last_ts = self._files[self._file_num[i]][TIME_INDEX_FILE_LAST_TS_I]
+                if last_ts is not None and ts > last_ts:
+                    i += 1
+            if i >= n:
+                return None
+            return (
+                os.path.join(
+                    self.record_files_dir,
+                    self._files[self._file_num[i]][TIME_INDEX_FILE_NAME_I],
+                ),
+                self._ts[i] / 1_000_000,
+                self._offset[i],
+            )
+
+    def last_checkpoint(
+        self, file_name: str, from_ts: float
+    ) -> Tuple[Optional[float], Optional[int]]:
+        """Indexed counterpart of LmcrecIndexCache.last_checkpoint
+
+        Args:
+            file_name (str): the .index file
+            from_ts (float): the timestamp
+        """
+
+        with self._lock:
+            if self._files is None:
+                self._load()
+            lmcrec_file = os.path.relpath(
+                file_name[: -len(INDEX_FILE_SUFFIX)], self.record_files_dir
+            )
+            file_num = self._file_num_by_name.get(lmcrec_file)
+            if (
+                file_num is None
+                and self._auto_refresh_interval is not None
+                and (
+                    self._last_refresh is None
+                    or time.monotonic() - self._last_refresh
+                    >= self._auto_refresh_interval
+                )
+            ):
+                self.refresh()
+                file_num = self._file_num_by_name.get(lmcrec_file)
+            if file_num is not None:
+                self.hits += 1
+                file_entry = self._files[file_num]
+                first = file_entry[TIME_INDEX_FILE_FIRST_I]
+                i = (
+                    bisect_right(
+                        self._ts,
+                        ts_to_usec(from_ts),
+                        first,
+                        first + file_entry[TIME_INDEX_FILE_COUNT_I],
+                    )
+                    - 1
+                )
+                if i < first:
+                    return None, None
+                return self._ts[i] / 1_000_000, self._offset[i]
+            self.misses += 1
+        return self.index_cache.last_checkpoint(file_name, from_ts)
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+            self._files = None
+
+    def __del__(self):
+        self.close()
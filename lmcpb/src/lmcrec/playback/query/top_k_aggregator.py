@@ -0,0 +1,144 @@
+"""Top-K instances over a whole time window
+
+The query selector keeps only the top-K instances per scan, based on the
+ranking column, see the query k: COLUMN/K spec. For k: COLUMN/K/w queries the
+winners are determined over the whole window, by their peak column value. An
+instance which is not a per scan winner cannot be a window winner either, so
+the window winners can be determined from the per scan results.
+
+The aggregator keeps at most K instances per (query, class), so its memory usage
+is bounded regardless of the number of matching instances.
+"""
+
+import heapq
+from typing import Any, Dict, List, Optional, Tuple
+
+from .lmcrec_query import LmcrecQueryResult
+from .query_selector import LmcrecQueryClassResult
+
+
+class _TopKTracker:
+    """Track the top-K instances by their peak value"""
+
+    def __init__(self, k: int):
+        self.k = k
+        # [inst_name] = (peak_val, vals, var_names):
+        self.best: Dict[str, Tuple[Any, List[Any], List[str]]] = dict()
+        # Min heap of (peak_val, inst_name); it may contain stale entries for
+        # instances whose peak value was superseded or which were evicted:
+        self._heap: List[Tuple[Any, str]] = []
+        # The most recent var_names:
+        self.var_names: List[str] = []
+
+    def _min(self) -> Tuple[Any, str]:
+        heap, best = self._heap, self.best
+        while True:
+            val, inst_name = heap[0]
+            entry = best.get(inst_name)
+            if entry is not None and entry[0] == val:
+                return val, inst_name
+            heapq.heappop(heap)
+
+    def update(self, inst_name: str, val: Any, vals: List[Any], var_names: List[str]):
+        best = self.best
+        entry = best.get(inst_name)
+        if entry is not None:
+            if val <= entry[0]:
+                return
+        elif len(best) >= self.k:
+            min_val, min_inst_name = self._min()
+            if val <= min_val:
+                return
+            heapq.heappop(self._heap)
+            del best[min_inst_name]
+        best[inst_name] = (val, list(vals), var_names)
+        heapq.heappush(self._heap, (val, inst_name))
+        if len(self._heap) > 2 * self.k:
+            # Too many stale entries, rebuild:
+            self._heap = [(entry[0], inst_name) for inst_name, entry in best.items()]
+            heapq.heapify(self._heap)
+
+    def result(self) -> LmcrecQueryClassResult:
+        var_names = self.var_names
+        vals_by_inst = dict()
+        for inst_name, (_, vals, inst_var_names) in sorted(
+            self.best.items(), key=lambda item: (item[1][0], item[0]), reverse=True
+        ):
+            if inst_var_names is not var_names and inst_var_names != var_names:
+                # The class definition changed in the meantime, re-map by name:
+                val_by_name = dict(zip(inst_var_names, vals))
+                vals = [val_by_name.get(var_name) for var_name in var_names]
+            vals_by_inst[inst_name] = vals
+        return LmcrecQueryClassResult(
+            var_names=list(var_names), vals_by_inst=vals_by_inst
+        )
+
+
+class LmcrecQueryTopKAggregator:
+    """Determine the top-K instances over the whole window"""
+
+    def __init__(self, top_k_by_query: Dict[str, Tuple[str, int]]):
+        """Create the aggregator
+
+        Args:
+            top_k_by_query (Dict[str, Tuple[str, int]]):
+                The (ranking column, K) by query name, for the queries to be
+                aggregated, see LmcrecQuery.window_top_k.
+        """
+
+        self._top_k_by_query = top_k_by_query
+        self._trackers: Dict[str, Dict[str, _TopKTracker]] = dict()
+
+    def update(self, result: LmcrecQueryResult) -> LmcrecQueryResult:
+        """Apply the scan results
+
+        Returns:
+            The results for the other queries, i.e. those not handled by the
+            aggregator.
+        """
+
+        other_result = dict()
+        for query_name, query_result in result.items():
+            top_k = self._top_k_by_query.get(query_name)
+            if top_k is None:
+                other_result[query_name] = query_result
+                continue
+            col_name, k = top_k
+            query_trackers = self._trackers.get(query_name)
+            if query_trackers is None:
+                query_trackers = dict()
+                self._trackers[query_name] = query_trackers
+            for class_name, class_result in query_result.items():
+                tracker = query_trackers.get(class_name)
+                if tracker is None:
+                    tracker = _TopKTracker(k)
+                    query_trackers[class_name] = tracker
+                var_names = class_result.var_names
+                if var_names != tracker.var_names:
+                    tracker.var_names = list(var_names)
+                try:
+                    col_index = var_names.index(col_name)
+                except ValueError:
+                    continue
+                var_names = tracker.var_names
+                for inst_name, vals in class_result.vals_by_inst.items():
+                    val = vals[col_index]
+                    if val is None or isinstance(val, (bool, str)):
+                        continue
+                    tracker.update(inst_name, val, vals, var_names)
+        return other_result
+
+    def flush(self) -> Optional[LmcrecQueryResult]:
+        """Return the window winners, if any, and start a new window"""
+
+        if not self._trackers:
+            return None
+        result = {
+            query_name: {
+                class_name: tracker.result()
+                for class_name, tracker in query_trackers.items()
+            }
+            for query_name, query_trackers in self._trackers.items()
+        }
+        self._trackers = dict()
+        return result
@@ -0,0 +1,419 @@
+"""Per checkpoint segment zone maps, used for value predicate pruning
+
+A query w/ a value predicate, e.g. "v: [queue_depth>10000]", over a long time
+window replays every scan, even though only a few may match. A zone map
+sidecar, FILE.lmcrec[.gz].zonemap, splits the record file into segments at the
+checkpoints from the .index file and holds, for every segment and for every
+variable of every class, either the (min, max, changes) of its values or None
+for non numeric variables. Optionally the same information is maintained per
+instance.
+
+A segment where none of the query selectors can match is skipped; the
+remaining ones are played back as multiple time windows, see
+LmcrecQueryIntervalStateCache, which seek directly to the segment checkpoint.
+
+Only closed files are mapped and the zone maps are validated against the size
+and modification time of the record file.
+"""
+
+import json
+import operator
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import LmcrecScanRetCode, LmcrecStateCache
+from codec import (
+    INDEX_FILE_SUFFIX,
+    LmcrecFileDecoder,
+    LmcrecIndexFileDecoder,
+    LmcrecInfo,
+    LmcrecInfoState,
+)
+
+from .file_selector import LmcrecFileEntry
+from .query_selector import LmcrecQueryPredicate, LmcrecQuerySelector
+from .query_state_cache import LmcrecQueryWindow
+
+ZONE_MAP_FILE_SUFFIX = ".zonemap"
+
+# Bump this up whenever the stored format changes:
+ZONE_MAP_VERSION = 1
+
+ZONE_MAP_VERSION_KEY = "version"
+ZONE_MAP_FILE_SIZE_KEY = "file_size"
+ZONE_MAP_FILE_MTIME_KEY = "mtime_ns"
+ZONE_MAP_PER_INST_KEY = "per_inst"
+ZONE_MAP_SEGMENTS_KEY = "segments"
+ZONE_MAP_SEGMENT_TS_KEY = "ts"
+ZONE_MAP_SEGMENT_LAST_TS_KEY = "last_ts"
+ZONE_MAP_SEGMENT_OFFSET_KEY = "offset"
+ZONE_MAP_SEGMENT_CLASSES_KEY = "classes"
+ZONE_MAP_SEGMENT_INSTS_KEY = "insts"
+
+# The value stats, [min, max, changes], by var name, None for non numeric
+# variables:
+LmcrecZoneMapVarStats = Dict[str, Optional[List[Any]]]
+
+
+@dataclass
+class LmcrecZoneMapSegment:
+    """The value stats for the scans between 2 consecutive checkpoints"""
+
+    # The first and the last scan timestamp:
+    ts: float = 0
+    last_ts: float = 0
+    # The checkpoint offset, from the .index file:
+    offset: int = 0
+    stats_by_class: Dict[str, LmcrecZoneMapVarStats] = field(default_factory=dict)
+    # Only if the zone map was built per instance:
+    stats_by_inst: Optional[Dict[str, LmcrecZoneMapVarStats]] = None
+
+
+@dataclass
+class LmcrecZoneMap:
+    """The zone map of a record file"""
+
+    # The record file signature, for validation:
+    file_size: int = 0
+    mtime_ns: int = 0
+    per_inst: bool = False
+    segments: List[LmcrecZoneMapSegment] = field(default_factory=list)
+
+    def to_json(self) -> Dict[str, Any]:
+        segments = []
+        for segment in self.segments:
+            segment_json = {
+                ZONE_MAP_SEGMENT_TS_KEY: segment.ts,
+                ZONE_MAP_SEGMENT_LAST_TS_KEY: segment.last_ts,
+                ZONE_MAP_SEGMENT_OFFSET_KEY: segment.offset,
+                ZONE_MAP_SEGMENT_CLASSES_KEY: segment.stats_by_class,
+            }
+            if segment.stats_by_inst is not None:
+                segment_json[ZONE_MAP_SEGMENT_INSTS_KEY] = segment.stats_by_inst
+            segments.append(segment_json)
+        return {
+            ZONE_MAP_VERSION_KEY: ZONE_MAP_VERSION,
+            ZONE_MAP_FILE_SIZE_KEY: self.file_size,
+            ZONE_MAP_FILE_MTIME_KEY: self.mtime_ns,
+            ZONE_MAP_PER_INST_KEY: self.per_inst,
+            ZONE_MAP_SEGMENTS_KEY: segments,
+        }
+
+    @classmethod
+    def from_json(cls, zone_map: Dict[str, Any]) -> "LmcrecZoneMap":
+        version = zone_map.get(ZONE_MAP_VERSION_KEY)
+        if version != ZONE_MAP_VERSION:
+            raise ValueError(
+                f"unsupported zone map version: want: {ZONE_MAP_VERSION!r}, got: {version!r}"
+            )
+        return cls(
+            file_size=zone_map[ZONE_MAP_FILE_SIZE_KEY],
+            mtime_ns=zone_map[ZONE_MAP_FILE_MTIME_KEY],
+            per_inst=zone_map[ZONE_MAP_PER_INST_KEY],
+            segments=[
+                LmcrecZoneMapSegment(
+                    ts=segment[ZONE_MAP_SEGMENT_TS_KEY],
+                    last_ts=segment[ZONE_MAP_SEGMENT_LAST_TS_KEY],
+                    offset=segment[ZONE_MAP_SEGMENT_OFFSET_KEY],
+                    stats_by_class=segment[ZONE_MAP_SEGMENT_CLASSES_KEY],
+                    stats_by_inst=segment.get(ZONE_MAP_SEGMENT_INSTS_KEY),
+                )
+                for segment in zone_map[ZONE_MAP_SEGMENTS_KEY]
+            ],
+        )
+
+
+def _update_var_stats(
+    var_stats: LmcrecZoneMapVarStats, var_name: str, val: Any, changed: bool
+):
+    if var_name in var_stats:
+        stats = var_stats[var_name]
+        if stats is None:
+            return
+    else:
+        stats = None
+    if not isinstance(val, (int, float)):
+        # Non numeric, there is no range for it:
+        var_stats[var_name] = None
+        return
+    if stats is None:
+        var_stats[var_name] = [val, val, 1 if changed else 0]
+        return
+    if val < stats[0]:
+        stats[0] = val
+    elif val > stats[1]:
+        stats[1] = val
+    if changed:
+        stats[2] += 1
+
+
+def build_lmcrec_zone_map(file_name: str, per_inst: bool = False) -> LmcrecZoneMap:
+    """Decode the record file and build its zone map
+
+    Args:
+        file_name (str): The record file
+
+        per_inst (bool): Maintain the stats per instance as well
+
+    Raises:
+        RuntimeError if the file cannot be decoded to the end
+    """
+
+    st = os.stat(file_name)
+    try:
+        index_decoder = LmcrecIndexFileDecoder(file_name + INDEX_FILE_SUFFIX)
+        try:
+            checkpoints = list(index_decoder.checkpoints())
+        finally:
+            index_decoder.close()
+    except FileNotFoundError:
+        checkpoints = []
+    if not checkpoints:
+        # A single segment, from the beginning of the file:
+        checkpoints = [(None, 0)]
+
+    zone_map = LmcrecZoneMap(
+        file_size=st.st_size, mtime_ns=st.st_mtime_ns, per_inst=per_inst
+    )
+    state_cache = LmcrecStateCache(LmcrecFileDecoder(file_name), track_changes=True)
+    segment = None
+    while True:
+        ret_code = state_cache.apply_next_scan()
+        if ret_code != LmcrecScanRetCode.COMPLETE:
+            break
+        ts = state_cache.ts
+        class_by_id = state_cache.class_by_id
+        new_segment = False
+        while len(zone_map.segments) < len(checkpoints):
+            chkpt_ts, chkpt_off = checkpoints[len(zone_map.segments)]
+            if segment is not None and (chkpt_ts is None or chkpt_ts > ts):
+                break
+            segment = LmcrecZoneMapSegment(
+                ts=ts,
+                last_ts=ts,
+                offset=chkpt_off,
+                stats_by_inst=dict() if per_inst else None,
+            )
+            zone_map.segments.append(segment)
+            new_segment = True
+        segment.last_ts = ts
+        changed_vars = state_cache.changed_vars
+        if new_segment:
+            # Start w/ the current values of all the instances:
+            insts = state_cache.inst_by_id.values()
+        else:
+            insts = (
+                state_cache.inst_by_id[inst_id]
+                for inst_id in changed_vars
+                if inst_id in state_cache.inst_by_id
+            )
+        for inst in insts:
+            class_info = class_by_id[inst.class_id]
+            class_stats = segment.stats_by_class.get(class_info.name)
+            if class_stats is None:
+                class_stats = dict()
+                segment.stats_by_class[class_info.name] = class_stats
+            inst_stats = None
+            if per_inst:
+                inst_stats = segment.stats_by_inst.get(inst.name)
+                if inst_stats is None:
+                    inst_stats = dict()
+                    segment.stats_by_inst[inst.name] = inst_stats
+            inst_changed_vars = changed_vars.get(inst.inst_id, ())
+            if new_segment:
+                var_ids = inst.vars
+            else:
+                var_ids = inst_changed_vars
+            var_info_by_id = class_info.var_info_by_id
+            for var_id in var_ids:
+                val = inst.vars.get(var_id)
+                var_info = var_info_by_id.get(var_id)
+                if val is None or var_info is None:
+                    continue
+                changed = var_id in inst_changed_vars
+                _update_var_stats(class_stats, var_info.name, val, changed)
+                if inst_stats is not None:
+                    _update_var_stats(inst_stats, var_info.name, val, changed)
+    if ret_code != LmcrecScanRetCode.ATEOR:
+        raise RuntimeError(f"{file_name}: {ret_code!r}")
+    return zone_map
+
+
+def save_lmcrec_zone_map(file_name: str, zone_map: LmcrecZoneMap) -> str:
+    """Save the zone map sidecar for the record file, atomically
+
+    Returns:
+        str: the path of the zone map file
+    """
+
+    zone_map_file = file_name + ZONE_MAP_FILE_SUFFIX
+    tmp_zone_map_file = f"{zone_map_file}.{os.getpid()}.tmp"
+    with open(tmp_zone_map_file, "wt") as f:
+        json.dump(zone_map.to_json(), f)
+    os.replace(tmp_zone_map_file, zone_map_file)
+    return zone_map_file
+
+
+def load_lmcrec_zone_map(file_name: str) -> Optional[LmcrecZoneMap]:
+    """Load the zone map for the record file
+
+    Returns:
+        LmcrecZoneMap or None if there is no zone map or if it is invalid or
+        out of date.
+    """
+
+    try:
+        with open(file_name + ZONE_MAP_FILE_SUFFIX, "rt") as f:
+            zone_map = LmcrecZoneMap.from_json(json.load(f))
+        st = os.stat(file_name)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if zone_map.file_size != st.st_size or zone_map.mtime_ns != st.st_mtime_ns:
+        return None
+    return zone_map
+
+
+def map_lmcrec_file(
+    file_name: str,
+    lmcrec_info: Optional[LmcrecInfo] = None,
+    per_inst: bool = False,
+    force: bool = False,
+) -> Optional[LmcrecZoneMap]:
+    """Build and save the zone map for the record file, unless already up to date
+
+    Only closed files are mapped, since the active ones keep changing. A zone
+    map w/o per instance stats is rebuilt if per_inst is requested.
+
+    Returns:
+        LmcrecZoneMap or None if the file is not closed.
+    """
+
+    if lmcrec_info is not None and lmcrec_info.state != LmcrecInfoState.CLOSED:
+        return None
+    zone_map = None if force else load_lmcrec_zone_map(file_name)
+    if zone_map is None or per_inst and not zone_map.per_inst:
+        zone_map = build_lmcrec_zone_map(file_name, per_inst=per_inst)
+        save_lmcrec_zone_map(file_name, zone_map)
+    return zone_map
+
+
+def range_may_match(predicate: LmcrecQueryPredicate, stats: List[Any]) -> bool:
+    """Whether any value within [min, max] may satisfy the predicate"""
+
+    op, operand = predicate
+    min_val, max_val = stats[0], stats[1]
+    try:
+        if op is operator.lt:
+            return min_val < operand
+        if op is operator.le:
+            return min_val <= operand
+        if op is operator.gt:
+            return max_val > operand
+        if op is operator.ge:
+            return max_val >= operand
+        if op is operator.eq:
+            return min_val <= operand <= max_val
+        if op is operator.ne:
+            return not (min_val == max_val == operand)
+    except TypeError:
+        pass
+    return True
+
+
+def _var_stats_may_match(
+    var_stats: LmcrecZoneMapVarStats,
+    value_predicates: List[Tuple[str, LmcrecQueryPredicate]],
+) -> bool:
+    for var_name, predicate in value_predicates:
+        if var_name not in var_stats:
+            # No value, the predicate cannot match:
+            return False
+        stats = var_stats[var_name]
+        if stats is not None and not range_may_match(predicate, stats):
+            return False
+    return True
+
+
+def segment_may_match(
+    segment: LmcrecZoneMapSegment, selector: LmcrecQuerySelector
+) -> bool:
+    """Whether the selector may select any instance in the segment"""
+
+    value_predicates = selector.value_predicates()
+    if not value_predicates:
+        return True
+    class_names, inst_names = selector.file_filter_spec() or (None, None)
+    if inst_names is not None and segment.stats_by_inst is not None:
+        return any(
+            _var_stats_may_match(segment.stats_by_inst[inst_name], value_predicates)
+            for inst_name in inst_names
+            if inst_name in segment.stats_by_inst
+        )
+    return any(
+        _var_stats_may_match(var_stats, value_predicates)
+        for class_name, var_stats in segment.stats_by_class.items()
+        if class_names is None or class_name in class_names
+    )
+
+
+def get_zone_map_windows(
+    chain_list: List[LmcrecFileEntry],
+    selectors: List[LmcrecQuerySelector],
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> Optional[List[LmcrecQueryWindow]]:
+    """Return the time windows which may match the selectors, based on zone maps
+
+    The candidate segments are merged into windows, in chronological order. The
+    files w/o a valid zone map are candidates as a whole.
+
+    Returns:
+        list of (from_ts, to_ts), possibly empty, or None if any selector lacks
+        value predicates, i.e. nothing can be pruned.
+    """
+
+    if not selectors or any(not selector.value_predicates() for selector in selectors):
+        return None
+
+    windows: List[List[float]] = []
+    for entry in chain_list:
+        # Whether the previous segment in the chain was a candidate, such that
+        # it can be extended:
+        extend = False
+        while entry is not None:
+            zone_map = load_lmcrec_zone_map(entry.file_name)
+            if zone_map is not None:
+                ranges = [
+                    (
+                        segment.ts,
+                        segment.last_ts,
+                        any(
+                            segment_may_match(segment, selector)
+                            for selector in selectors
+                        ),
+                    )
+                    for segment in zone_map.segments
+                ]
+            else:
+                lmcrec_info = entry.lmcrec_info
+                ranges = [(lmcrec_info.start_ts, lmcrec_info.most_recent_ts, True)]
+            for first_ts, last_ts, candidate in ranges:
+                if from_ts is not None and last_ts < from_ts:
+                    continue
+                if to_ts is not None and first_ts > to_ts:
+                    break
+                if not candidate:
+                    extend = False
+                    continue
+                if from_ts is not None and first_ts < from_ts:
+                    first_ts = from_ts
+                if to_ts is not None and last_ts > to_ts:
+                    last_ts = to_ts
+                if extend:
+                    windows[-1][1] = last_ts
+                else:
+                    windows.append([first_ts, last_ts])
+                extend = True
+            entry = entry.next
+    return [(first_ts, last_ts) for first_ts, last_ts in windows]
@@ -0,0 +1,277 @@
+"""Helpers for creating lmcrec record files (.lmcrec, .info, .index) for tests
+
+The files are encoded the same way as the recorder does it, see
+lmcrec/codec/encoder.go, but only for the subset needed by the tests:
+
+    - the first scan and every checkpoint_every-th scan are full scans: class,
+      var and inst info + all values; they are also the checkpoints recorded in
+      the index file
+    - the other scans contain only the changed values and instance deletions
+
+"""
+
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+from lmcrec.playback.codec import (
+    INDEX_FILE_SUFFIX,
+    INFO_FILE_SUFFIX,
+    LMCREC_FILE_SUFFIX,
+    LmcrecInfoState,
+    LmcrecType,
+    LmcVarType,
+)
+
+# A scan is described by the full state at that time:
+#   (ts, {inst_name: (class_name, {var_name: val, ...}), ...})
+LmcrecTestScan = Tuple[float, Dict[str, Tuple[str, Dict[str, Any]]]]
+
+LMCREC_TEST_FILE_DATE_DIR = "2025-01-01"
+
+
+def encode_uvarint(value: int) -> bytes:
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def encode_varint(value: int) -> bytes:
+    return encode_uvarint((value << 1) ^ (value >> 63))
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return encode_uvarint(len(data)) + data
+
+
+def encode_ts(ts: float) -> bytes:
+    return encode_varint(int(round(ts * 1_000_000)))
+
+
+def lmc_var_type_for_val(val: Any) -> LmcVarType:
+    if isinstance(val, bool):
+        return LmcVarType.BOOLEAN
+    if isinstance(val, int):
+        return LmcVarType.COUNTER
+    return LmcVarType.STRING
+
+
+def encode_var_val(var_id: int, val: Any) -> bytes:
+    if isinstance(val, bool):
+        record_type = LmcrecType.VAR_BOOL_TRUE if val else LmcrecType.VAR_BOOL_FALSE
+        return encode_uvarint(record_type) + encode_uvarint(var_id)
+    if isinstance(val, int):
+        if val == 0:
+            return encode_uvarint(LmcrecType.VAR_ZERO_VAL) + encode_uvarint(var_id)
+        if val < 0:
+            return (
+                encode_uvarint(LmcrecType.VAR_SINT_VAL)
+                + encode_uvarint(var_id)
+                + encode_varint(val)
+            )
+        return (
+            encode_uvarint(LmcrecType.VAR_UINT_VAL)
+            + encode_uvarint(var_id)
+            + encode_uvarint(val)
+        )
+    if val == "":
+        return encode_uvarint(LmcrecType.VAR_EMPTY_STRING) + encode_uvarint(var_id)
+    return (
+        encode_uvarint(LmcrecType.VAR_STRING_VAL)
+        + encode_uvarint(var_id)
+        + encode_string(val)
+    )
+
+
+def encode_lmcrec_info(
+    prev_file_name: str = "",
+    start_ts: float = 0,
+    state: LmcrecInfoState = LmcrecInfoState.CLOSED,
+    most_recent_ts: float = 0,
+) -> bytes:
+    return (
+        encode_string("test")
+        + encode_string(prev_file_name)
+        + encode_ts(start_ts)
+        + bytes([state])
+        + encode_ts(most_recent_ts)
+        + encode_uvarint(0) * 4
+    )
+
+
+@dataclass
+class LmcrecTestFileWriter:
+    """Write the files of a chain; the IDs and the previous state are shared
+    by all the files in the chain, the same way the recorder does it.
+    """
+
+    record_files_dir: str = ""
+    checkpoint_every: int = 0
+    class_ids: Dict[str, int] = field(default_factory=dict)
+    var_ids: Dict[Tuple[str, str], int] = field(default_factory=dict)
+    inst_ids: Dict[str, int] = field(default_factory=dict)
+    # The previous state, [inst_name] = (class_name, {var_name: val}):
+    state: Dict[str, Tuple[str, Dict[str, Any]]] = field(default_factory=dict)
+    # The most recent file, relative to the record files dir:
+    prev_file_name: str = ""
+
+    def _get_id(self, ids: Dict[Any, int], key: Any) -> Tuple[int, bool]:
+        new = key not in ids
+        if new:
+            ids[key] = len(ids) + 1
+        return ids[key], new
+
+    def _encode_scan(
+        self, ts: float, scan_state: Dict[str, Tuple[str, Dict[str, Any]]], full: bool
+    ) -> bytes:
+        data = encode_uvarint(LmcrecType.TIMESTAMP_USEC) + encode_ts(ts)
+        for inst_name in self.state:
+            if inst_name not in scan_state:
+                data += encode_uvarint(LmcrecType.DELETE_INST_ID) + encode_uvarint(
+                    self.inst_ids[inst_name]
+                )
+        prev_state = dict() if full else self.state
+        for inst_name, (class_name, vals) in scan_state.items():
+            class_id, new_class = self._get_id(self.class_ids, class_name)
+            if new_class or full:
+                data += (
+                    encode_uvarint(LmcrecType.CLASS_INFO)
+                    + encode_uvarint(class_id)
+                    + encode_string(class_name)
+                )
+            for var_name, val in vals.items():
+                var_id, new_var = self._get_id(self.var_ids, (class_name, var_name))
+                if new_var or full:
+                    data += (
+                        encode_uvarint(LmcrecType.VAR_INFO)
+                        + encode_uvarint(class_id)
+                        + encode_uvarint(var_id)
+                        + encode_uvarint(lmc_var_type_for_val(val))
+                        + encode_string(var_name)
+                    )
+            inst_id, new_inst = self._get_id(self.inst_ids, inst_name)
+            if new_inst or full or inst_name not in prev_state:
+                data += (
+                    encode_uvarint(LmcrecType.INST_INFO)
+                    + encode_uvarint(class_id)
+                    + encode_uvarint(inst_id)
+                    + encode_uvarint(0)
+                    + encode_string(inst_name)
+                )
+                prev_vals = dict()
+            else:
+                prev_vals = prev_state[inst_name][1]
+                if any(prev_vals.get(v) != val for v, val in vals.items()):
+                    data += encode_uvarint(LmcrecType.SET_INST_ID) + encode_uvarint(
+                        inst_id
+                    )
+            for var_name, val in vals.items():
+                if var_name not in prev_vals or prev_vals[var_name] != val:
+                    data += encode_var_val(self.var_ids[(class_name, var_name)], val)
+        data += encode_uvarint(LmcrecType.SCAN_TALLY) + encode_uvarint(0) * 4
+        data += encode_uvarint(LmcrecType.DURATION_USEC) + encode_varint(1000)
+        self.state = {
+            inst_name: (class_name, dict(vals))
+            for inst_name, (class_name, vals) in scan_state.items()
+        }
+        return data
+
+    def write_file(
+        self,
+        name: str,
+        scans: List[LmcrecTestScan],
+        state: LmcrecInfoState = LmcrecInfoState.CLOSED,
+    ) -> str:
+        """Write the record file for the scans and return its path"""
+
+        file_name = os.path.join(LMCREC_TEST_FILE_DATE_DIR, name + LMCREC_FILE_SUFFIX)
+        file_path = os.path.join(self.record_files_dir, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        data, index = bytes(), bytes()
+        for i, (ts, scan_state) in enumerate(scans):
+            full = (
+                i == 0 or self.checkpoint_every > 0 and i % self.checkpoint_every == 0
+            )
+            if full:
+                index += encode_ts(ts) + encode_varint(len(data))
+            data += self._encode_scan(ts, scan_state, full)
+        if state == LmcrecInfoState.CLOSED:
+            data += encode_uvarint(LmcrecType.EOR)
+        with open(file_path, "wb") as f:
+            f.write(data)
+        with open(file_path + INDEX_FILE_SUFFIX, "wb") as f:
+            f.write(index)
+        with open(file_path + INFO_FILE_SUFFIX, "wb") as f:
+            f.write(
+                encode_lmcrec_info(
+                    prev_file_name=self.prev_file_name,
+                    start_ts=scans[0][0],
+                    state=state,
+                    most_recent_ts=scans[-1][0],
+                )
+            )
+        self.prev_file_name = file_name
+        return file_path
+
+
+def write_test_chains(
+    top_dir: str,
+    chains: List[List[List[LmcrecTestScan]]],
+    checkpoint_every: int = 4,
+    active: bool = False,
+) -> str:
+    """Write the chains, each a list of files given by their scans
+
+    The J-th file of the I-th chain is named chainI-J. If active is True then
+    the last file of the last chain, i.e. the most recent one, is left active.
+
+    Returns:
+        The record files dir, i.e. the date dir under top_dir.
+    """
+
+    for i, chain in enumerate(chains):
+        writer = LmcrecTestFileWriter(top_dir, checkpoint_every=checkpoint_every)
+        for j, scans in enumerate(chain):
+            state = LmcrecInfoState.CLOSED
+            if active and i == len(chains) - 1 and j == len(chain) - 1:
+                state = LmcrecInfoState.ACTIVE
+            writer.write_file(f"chain{i}-{j}", scans, state=state)
+    return os.path.join(top_dir, LMCREC_TEST_FILE_DATE_DIR)
+
+
+def make_test_scans(
+    from_ts: float,
+    num_scans: int,
+    interval: float = 5,
+    num_inst: int = 2,
+    class_name: str = "TestClass",
+) -> List[LmcrecTestScan]:
+    """Generate scans w/ deterministic, ts based, values"""
+
+    scans = []
+    for i in range(num_scans):
+        ts = from_ts + i * interval
+        scans.append(
+            (
+                ts,
+                {
+                    f"inst{k}": (
+                        class_name,
+                        {
+                            "counter": int(ts) * (k + 1),
+                            "flag": (i // 3) % 2 == 0,
+                            "label": f"label{k}-{i // 4}",
+                        },
+                    )
+                    for k in range(num_inst)
+                },
+            )
+        )
+    return scans
@@ -64,6 +64,10 @@ class LmcrecQueryIntervalStateCacheBuilder:
         default_factory=dict
     )
 
+    #   parents: {inst_name: parent_inst_name}, the other instances are top
+    #   instances:
+    parents: Dict[str, str] = field(default_factory=dict)
+
     # Time delta, for rates:
     d_time: Optional[float] = None
 
@@ -71,6 +75,8 @@ class LmcrecQueryIntervalStateCacheBuilder:
     ts: float = 0
     new_chain: bool = False
     new_inst: bool = False
+    # The names of the new instances, for new_inst:
+    new_inst_names: List[str] = field(default_factory=list)
     deleted_inst: bool = False
     new_class_def: bool = False
 
@@ -156,6 +162,18 @@ class LmcrecQueryIntervalStateCacheBuilder:
             query_state_cache.inst_by_id[inst_id] = inst_entry
             inst_id += 1
 
+        for inst_entry in query_state_cache.inst_by_id.values():
+            parent_name = self.parents.get(inst_entry.name)
+            if parent_name is not None:
+                inst_entry.parent_inst_id = query_state_cache.inst_by_name[
+                    parent_name
+                ].inst_id
+            else:
+                inst_entry.parent_inst_id = 0
+            query_state_cache.children_by_inst_id[inst_entry.parent_inst_id].add(
+                inst_entry.inst_id
+            )
+
         query_state_cache.ts = self.ts
         query_state_cache.prev_ts = (
             query_state_cache.ts - self.d_time if self.d_time is not None else None
@@ -165,6 +183,7 @@ class LmcrecQueryIntervalStateCacheBuilder:
         else:
             query_state_cache.new_chain = self.new_chain
             query_state_cache.new_inst = self.new_inst
+            query_state_cache.new_inst_names = list(self.new_inst_names)
             query_state_cache.deleted_inst = self.deleted_inst
             query_state_cache.new_class_def = self.new_class_def
         return query_state_cache
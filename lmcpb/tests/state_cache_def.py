@@ -26,7 +26,11 @@ class LmcrecStateCacheTestCase:
     expect_class_cache: List[LmcrecClassCacheEntry] = field(default_factory=list)
     expect_inst_cache: List[LmcrecInstCacheEntry] = field(default_factory=list)
     expect_inst_by_class_name: Dict[str, Set[str]] = field(default_factory=dict)
+    # The instance hierarchy, if to be checked:
+    expect_children_by_inst_id: Optional[Dict[int, Set[int]]] = None
     expect_new_inst: bool = False
+    # The names of the new instances, if to be checked:
+    expect_new_inst_names: Optional[List[str]] = None
     expect_deleted_inst: bool = False
     expect_new_class_def: bool = False
     # Exception condition:
@@ -183,7 +183,12 @@ test_cases_ok = [
             "Parent": {"parent1"},
             "Child": {"child1", "child2"},
         },
+        expect_children_by_inst_id={
+            0: {100},
+            100: {200, 201},
+        },
         expect_new_inst=True,
+        expect_new_inst_names=["parent1", "child1", "child2"],
         expect_new_class_def=True,
     ),
     LmcrecStateCacheTestCase(
@@ -229,6 +234,8 @@ test_cases_ok = [
         expect_inst_by_class_name={
             "Counter": {"counter1"},
         },
+        # Cleared by the scan w/o new instances:
+        expect_new_inst_names=[],
     ),
     LmcrecStateCacheTestCase(
         name="BooleanVariables",
@@ -339,6 +346,7 @@ test_cases_ok = [
         expect_inst_by_class_name={
             "Temp": set(),
         },
+        expect_children_by_inst_id={},
         expect_deleted_inst=True,
     ),
     LmcrecStateCacheTestCase(
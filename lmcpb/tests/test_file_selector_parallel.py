@@ -0,0 +1,110 @@
+# /usr/bin/env python3
+
+"""Unit tests for the file name pruning and the parallel .info loading"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+from lmcrec.playback.query.file_selector import (
+    build_lmcrec_file_chains,
+    chain_to_file_list,
+    lmcrec_file_name_ts,
+    prune_lmcrec_files_by_name,
+)
+
+from .lmcrec_files_def import (
+    LMCREC_TEST_FILE_DATE_DIR,
+    LmcrecTestFileWriter,
+    make_test_scans,
+)
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+# 2025-01-01T00:00:00+00:00, matching LMCREC_TEST_FILE_DATE_DIR:
+T0 = 1_735_689_600
+FILE_DURATION = 600
+
+
+def _file_name(ts: float) -> str:
+    h, m, s = int(ts - T0) // 3600, int(ts - T0) // 60 % 60, int(ts - T0) % 60
+    return f"{h:02d}:{m:02d}:{s:02d}+00:00"
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # A single chain of 6 files, each 10 min long and created 1 sec before its
+    # first scan:
+    writer = LmcrecTestFileWriter(str(tmp_path), checkpoint_every=4)
+    for i in range(6):
+        ts = T0 + i * FILE_DURATION
+        writer.write_file(
+            _file_name(ts), make_test_scans(ts + 1, FILE_DURATION // 5 - 1)
+        )
+    return str(tmp_path)
+
+
+def test_lmcrec_file_name_ts():
+    assert lmcrec_file_name_ts("2025-01-01/00:10:00+00:00.lmcrec") == T0 + 600
+    assert lmcrec_file_name_ts("2025-01-01/02:10:00+02:00.lmcrec.gz") == T0 + 600
+    assert lmcrec_file_name_ts("2025-01-01/file1.lmcrec") is None
+    assert lmcrec_file_name_ts("2025-01-01/25:00:00+00:00.lmcrec") is None
+
+
+def test_prune_lmcrec_files_by_name():
+    lmcrec_file_list = [
+        os.path.join(LMCREC_TEST_FILE_DATE_DIR, _file_name(T0 + i * FILE_DURATION))
+        + ".lmcrec"
+        for i in range(6)
+    ] + ["2025-01-01/file1.lmcrec"]
+    assert prune_lmcrec_files_by_name(lmcrec_file_list) == lmcrec_file_list
+    # The file created at from_ts may have scans before from_ts, the previous
+    # one is kept as well:
+    assert (
+        prune_lmcrec_files_by_name(
+            lmcrec_file_list,
+            from_ts=T0 + 2 * FILE_DURATION,
+            to_ts=T0 + 3 * FILE_DURATION,
+        )
+        == lmcrec_file_list[1:4] + lmcrec_file_list[-1:]
+    )
+    assert (
+        prune_lmcrec_files_by_name(lmcrec_file_list, from_ts=T0 + 2 * FILE_DURATION + 1)
+        == lmcrec_file_list[2:]
+    )
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts",
+    [
+        (None, None),
+        (T0 + 2 * FILE_DURATION, None),
+        (T0 + 2 * FILE_DURATION + 1, T0 + 3 * FILE_DURATION),
+        (None, T0 + 3 * FILE_DURATION - 1),
+        (T0 + 7 * FILE_DURATION, None),
+    ],
+)
+def test_parallel_load(record_files_dir: str, from_ts, to_ts):
+    expect = chain_to_file_list(
+        build_lmcrec_file_chains(
+            record_files_dir, from_ts=from_ts, to_ts=to_ts, info_workers=None
+        )
+    )
+    with patch(
+        "lmcrec.playback.query.file_selector.prune_lmcrec_files_by_name",
+        lambda lmcrec_file_list, **kwargs: lmcrec_file_list,
+    ):
+        # The pruning does not change the outcome:
+        assert expect == chain_to_file_list(
+            build_lmcrec_file_chains(
+                record_files_dir, from_ts=from_ts, to_ts=to_ts, info_workers=None
+            )
+        )
+    for _ in range(4):
+        assert expect == chain_to_file_list(
+            build_lmcrec_file_chains(
+                record_files_dir, from_ts=from_ts, to_ts=to_ts, info_workers=4
+            )
+        )
@@ -0,0 +1,94 @@
+# /usr/bin/env python3
+
+"""Unit tests for the as-of join"""
+
+import os
+from typing import Optional
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.query import LmcrecAsOfJoin, LmcrecQuery
+from lmcrec.playback.query.parallel import copy_query_result
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter, label]}"
+
+T0 = 1_700_000_000
+
+
+@pytest.fixture
+def record_files_dirs(tmp_path) -> dict:
+    # Different phases and intervals, "fast" has a gap:
+    chains_by_name = {
+        "drv": [[make_test_scans(T0 + 2, 30, interval=5)]],
+        "fast": [
+            [make_test_scans(T0, 25, interval=3)],
+            [make_test_scans(T0 + 120, 10, interval=3)],
+        ],
+        "slow": [[make_test_scans(T0 + 11, 10, interval=13)]],
+    }
+    return {
+        name: write_test_chains(os.path.join(str(tmp_path), name), chains)
+        for name, chains in chains_by_name.items()
+    }
+
+
+def _all_scans(record_files_dir: str) -> list:
+    scans = []
+    LmcrecQuery(record_files_dir, QUERY).run_with_callback(
+        lambda result, query_state_cache: scans.append(
+            (query_state_cache.ts, copy_query_result(result))
+        )
+        or True
+    )
+    return scans
+
+
+@pytest.mark.parametrize("tolerance", [None, 10])
+def test_asof_join(record_files_dirs: dict, tolerance: Optional[float]):
+    all_scans = {name: _all_scans(d) for name, d in record_files_dirs.items()}
+    asof_join = LmcrecAsOfJoin(
+        LmcrecQuery(record_files_dirs["drv"], QUERY),
+        LmcrecQuery(record_files_dirs["fast"], QUERY),
+        LmcrecQuery(record_files_dirs["slow"], QUERY),
+        tolerance=tolerance,
+    )
+    joined = []
+    asof_join.run_with_callback(
+        lambda scans: joined.append(
+            [
+                (scan.ts, copy_query_result(scan.result) if scan.result else None)
+                for scan in scans
+            ]
+        )
+        or True
+    )
+    assert [scans[0] for scans in joined] == all_scans["drv"]
+    for k, name in enumerate(["fast", "slow"], start=1):
+        for scans in joined:
+            drv_ts = scans[0][0]
+            expect = (None, None)
+            for ts, result in all_scans[name]:
+                if ts > drv_ts:
+                    break
+                if tolerance is None or drv_ts - ts <= tolerance:
+                    expect = (ts, result)
+                else:
+                    expect = (None, None)
+            assert scans[k] == expect
+    # The slow stream starts after the driver:
+    assert joined[0][2] == (None, None)
+    if tolerance is not None:
+        # The gap in the fast stream:
+        assert any(scans[1] == (None, None) for scans in joined[1:])
+    assert asof_join.ret_codes == [LmcrecScanRetCode.ATEOR] * 2
+
+
+def test_asof_join_invalid(record_files_dirs: dict):
+    with pytest.raises(ValueError):
+        LmcrecAsOfJoin(LmcrecQuery(record_files_dirs["drv"], QUERY))
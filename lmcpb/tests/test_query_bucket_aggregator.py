@@ -0,0 +1,195 @@
+# /usr/bin/env python3
+
+"""Unit tests for LmcrecQueryBucketAggregator"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+from lmcrec.playback.query.bucket_aggregator import (
+    LmcrecQueryBucketAggregator,
+    parse_bucket_aggregates,
+)
+from lmcrec.playback.query.query_selector import LmcrecQueryClassResult
+
+
+@dataclass
+class LmcrecQueryBucketAggregatorTestCase:
+    name: Optional[str] = None
+    description: Optional[str] = None
+    bucket: float = 10
+    aggregates: Optional[List[str]] = None
+    # List of (ts, {query_name: {class_name: LmcrecQueryClassResult}}):
+    scans: List[Tuple[float, Dict[str, Dict[str, LmcrecQueryClassResult]]]] = field(
+        default_factory=list
+    )
+    # Expected buckets, in order: (bucket_ts, {query_name: {class_name:
+    # (var_names, vals_by_inst)}}):
+    expect_buckets: List[
+        Tuple[float, Dict[str, Dict[str, Tuple[List[str], Dict[str, List[Any]]]]]]
+    ] = field(default_factory=list)
+
+
+def _scan(ts, var_names, vals_by_inst, query_name="q", class_name="c"):
+    return (
+        ts,
+        {
+            query_name: {
+                class_name: LmcrecQueryClassResult(
+                    var_names=var_names, vals_by_inst=vals_by_inst
+                )
+            }
+        },
+    )
+
+
+test_cases = [
+    LmcrecQueryBucketAggregatorTestCase(
+        name="SingleBucket",
+        description="All scans in the same bucket, emitted at flush",
+        aggregates=["last", "min", "max", "mean", "sum"],
+        scans=[
+            _scan(1, ["v", "v:d"], {"i1": [10, None]}),
+            _scan(5, ["v", "v:d"], {"i1": [14, 4]}),
+            _scan(9, ["v", "v:d"], {"i1": [12, -2]}),
+        ],
+        expect_buckets=[
+            (
+                0,
+                {
+                    "q": {
+                        "c": (
+                            [
+                                "last(v)",
+                                "min(v)",
+                                "max(v)",
+                                "mean(v)",
+                                "last(v:d)",
+                                "min(v:d)",
+                                "max(v:d)",
+                                "mean(v:d)",
+                                "sum(v:d)",
+                            ],
+                            {"i1": [12, 10, 14, 12, -2, -2, 4, 1, 2]},
+                        )
+                    }
+                },
+            ),
+        ],
+    ),
+    LmcrecQueryBucketAggregatorTestCase(
+        name="MultipleBuckets",
+        description="Buckets are aligned to multiples of the bucket duration",
+        aggregates=["last", "sum"],
+        scans=[
+            _scan(8, ["v:d"], {"i1": [1]}),
+            _scan(12, ["v:d"], {"i1": [2]}),
+            _scan(18, ["v:d"], {"i1": [3]}),
+            _scan(35, ["v:d"], {"i1": [4]}),
+        ],
+        expect_buckets=[
+            (0, {"q": {"c": (["last(v:d)", "sum(v:d)"], {"i1": [1, 1]})}}),
+            (10, {"q": {"c": (["last(v:d)", "sum(v:d)"], {"i1": [3, 5]})}}),
+            (30, {"q": {"c": (["last(v:d)", "sum(v:d)"], {"i1": [4, 4]})}}),
+        ],
+    ),
+    LmcrecQueryBucketAggregatorTestCase(
+        name="NonNumerical",
+        description="Only last applies to non-numerical values",
+        aggregates=["last", "max"],
+        scans=[
+            _scan(1, ["s", "b"], {"i1": ["x", False]}),
+            _scan(2, ["s", "b"], {"i1": ["y", True]}),
+        ],
+        expect_buckets=[
+            (
+                0,
+                {
+                    "q": {
+                        "c": (
+                            ["last(s)", "max(s)", "last(b)", "max(b)"],
+                            {"i1": ["y", None, True, None]},
+                        )
+                    }
+                },
+            ),
+        ],
+    ),
+    LmcrecQueryBucketAggregatorTestCase(
+        name="InstancesAndColumnsChange",
+        description="Instances and columns appearing mid bucket",
+        aggregates=["last", "min"],
+        scans=[
+            _scan(1, ["v1"], {"i1": [1]}),
+            _scan(2, ["v1", "v2"], {"i1": [2, 20], "i2": [3, 30]}),
+        ],
+        expect_buckets=[
+            (
+                0,
+                {
+                    "q": {
+                        "c": (
+                            ["last(v1)", "min(v1)", "last(v2)", "min(v2)"],
+                            {"i1": [2, 1, 20, 20], "i2": [3, 3, 30, 30]},
+                        )
+                    }
+                },
+            ),
+        ],
+    ),
+]
+
+
+@pytest.mark.parametrize("tc", test_cases, ids=lambda tc: tc.name)
+def test_lmcrec_query_bucket_aggregator(tc: LmcrecQueryBucketAggregatorTestCase):
+    aggregator = LmcrecQueryBucketAggregator(tc.bucket, aggregates=tc.aggregates)
+    buckets = []
+    for ts, result in tc.scans:
+        bucket_result = aggregator.update(ts, result)
+        if bucket_result is not None:
+            buckets.append(bucket_result)
+    bucket_result = aggregator.flush()
+    if bucket_result is not None:
+        buckets.append(bucket_result)
+    assert aggregator.flush() is None
+    assert len(buckets) == len(tc.expect_buckets)
+    for (bucket_ts, result), (expect_bucket_ts, expect_result) in zip(
+        buckets, tc.expect_buckets
+    ):
+        assert bucket_ts == expect_bucket_ts
+        assert set(result) == set(expect_result)
+        for query_name, expect_query_result in expect_result.items():
+            query_result = result[query_name]
+            assert set(query_result) == set(expect_query_result)
+            for class_name, (var_names, vals_by_inst) in expect_query_result.items():
+                class_result = query_result[class_name]
+                assert class_result.var_names == var_names
+                assert class_result.vals_by_inst == vals_by_inst
+
+
+@pytest.mark.parametrize(
+    "spec, expect",
+    [
+        (None, ["last", "min", "max", "mean", "sum"]),
+        ("sum,last", ["last", "sum"]),
+        (" Max , min ", ["min", "max"]),
+        ("median", None),
+    ],
+)
+def test_parse_bucket_aggregates(spec: Optional[str], expect: Optional[List[str]]):
+    if expect is None:
+        with pytest.raises(ValueError):
+            parse_bucket_aggregates(spec)
+    else:
+        assert parse_bucket_aggregates(spec) == expect
+
+
+def test_lmcrec_query_bucket_aggregator_invalid_bucket():
+    with pytest.raises(ValueError):
+        LmcrecQueryBucketAggregator(0)
+
+
+def test_lmcrec_query_bucket_aggregator_no_aggregates():
+    with pytest.raises(ValueError):
+        LmcrecQueryBucketAggregator(5, aggregates=[])
@@ -0,0 +1,128 @@
+# /usr/bin/env python3
+
+"""Unit tests for the persistent catalog of record files"""
+
+import os
+import time
+from typing import List, Tuple
+
+import pytest
+
+from lmcrec.playback.codec import LmcrecInfoState
+from lmcrec.playback.query import (
+    LmcrecFileCatalog,
+    build_lmcrec_file_chains,
+)
+
+from .lmcrec_files_def import (
+    LMCREC_TEST_FILE_DATE_DIR,
+    LmcrecTestFileWriter,
+    make_test_scans,
+    write_test_chains,
+)
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0, T1 = 1_700_000_000, 1_700_001_000
+
+
+def _backdate(top_dir: str, age: float = 3600):
+    """Make the recently modified files and dirs old enough to be trusted by
+    the catalog"""
+
+    now = time.time()
+    for dir_path, _, fnames in os.walk(top_dir):
+        for path in [os.path.join(dir_path, fname) for fname in fnames] + [dir_path]:
+            if now - os.stat(path).st_mtime < 60:
+                os.utime(path, (now - age, now - age))
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    record_files_dir = os.path.join(str(tmp_path), "rec")
+    scans = make_test_scans(T0, 20)
+    write_test_chains(
+        record_files_dir,
+        [[scans[:10], scans[10:]], [make_test_scans(T1, 10)]],
+        active=True,
+    )
+    _backdate(record_files_dir)
+    return record_files_dir
+
+
+def _chains(chain_list) -> List[List[Tuple]]:
+    chains = []
+    for entry in chain_list or []:
+        chain = []
+        while entry is not None:
+            chain.append((entry.file_name, entry.lmcrec_info))
+            entry = entry.next
+        chains.append(chain)
+    return chains
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts",
+    [
+        (None, None),
+        (T0 + 62, None),
+        (None, T0 + 20),
+        (T1 + 10, T1 + 20),
+    ],
+)
+def test_catalog_chains(tmp_path, record_files_dir: str, from_ts, to_ts):
+    catalog_file = os.path.join(str(tmp_path), "catalog.json")
+    for sub_dir in ["", LMCREC_TEST_FILE_DATE_DIR]:
+        files_dir = os.path.join(record_files_dir, sub_dir)
+        expect = build_lmcrec_file_chains(files_dir, from_ts=from_ts, to_ts=to_ts)
+        catalog = LmcrecFileCatalog(files_dir, catalog_file=catalog_file)
+        got = build_lmcrec_file_chains(
+            files_dir, from_ts=from_ts, to_ts=to_ts, catalog=catalog
+        )
+        assert _chains(got) == _chains(expect)
+
+
+def test_catalog_incremental_refresh(tmp_path, record_files_dir: str):
+    catalog_file = os.path.join(str(tmp_path), "catalog.json")
+    catalog = LmcrecFileCatalog(record_files_dir, catalog_file=catalog_file)
+    assert len(catalog.lookup()) == 3
+    assert (catalog.num_dir_lists, catalog.num_info_decodes) == (1, 3)
+    assert os.path.isfile(catalog_file)
+
+    # Reloaded, nothing changed: only the active file .info is checked, w/o
+    # being decoded:
+    catalog = LmcrecFileCatalog(record_files_dir, catalog_file=catalog_file)
+    assert len(catalog.lookup()) == 3
+    assert (catalog.num_dir_lists, catalog.num_info_decodes) == (0, 0)
+
+    # The active file is updated and a new file added:
+    writer = LmcrecTestFileWriter(record_files_dir, checkpoint_every=4)
+    writer.prev_file_name = os.path.join(LMCREC_TEST_FILE_DATE_DIR, "chain1-0.lmcrec")
+    writer.write_file("chain1-1", make_test_scans(T1 + 100, 5))
+    writer = LmcrecTestFileWriter(record_files_dir, checkpoint_every=4)
+    writer.write_file("chain1-0", make_test_scans(T1, 15))
+    _backdate(record_files_dir)
+    lmcrec_files = dict(catalog.lookup())
+    assert len(lmcrec_files) == 4
+    assert (catalog.num_dir_lists, catalog.num_info_decodes) == (1, 2)
+    chain1_0 = lmcrec_files[os.path.join(LMCREC_TEST_FILE_DATE_DIR, "chain1-0.lmcrec")]
+    assert chain1_0.state == LmcrecInfoState.CLOSED
+    assert chain1_0.most_recent_ts == T1 + 14 * 5
+
+    # Time range lookup, the day dir is out of range:
+    assert catalog.lookup(from_ts=T1 + 86400 * 1000) == []
+
+
+def test_catalog_racy_files(tmp_path, record_files_dir: str):
+    catalog_file = os.path.join(str(tmp_path), "catalog.json")
+    catalog = LmcrecFileCatalog(record_files_dir, catalog_file=catalog_file)
+    catalog.lookup()
+    # A recent change is not trusted, it is checked again at the next lookup,
+    # even if the modification time did not change:
+    writer = LmcrecTestFileWriter(record_files_dir, checkpoint_every=4)
+    writer.write_file("chain9-0", make_test_scans(T1 + 1000, 2))
+    num_dir_lists = catalog.num_dir_lists
+    catalog.lookup()
+    catalog.lookup()
+    assert catalog.num_dir_lists == num_dir_lists + 2
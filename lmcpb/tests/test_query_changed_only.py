@@ -0,0 +1,131 @@
+# /usr/bin/env python3
+
+"""Unit tests for changed-only query results"""
+
+from unittest.mock import MagicMock
+
+import pytest
+import yaml
+
+from lmcrec.playback.cache.state_cache import LmcrecScanRetCode, LmcrecStateCache
+from lmcrec.playback.codec.decoder import LmcRecord, LmcrecType, LmcVarType
+from lmcrec.playback.query.query_selector import (
+    LmcrecQueryClassResult,
+    LmcrecQuerySelector,
+)
+
+from .query_selector_def import LmcrecQueryIntervalStateCacheBuilder
+
+
+def _scan_records(ts, vals, with_info=False):
+    records = [LmcRecord(record_type=LmcrecType.TIMESTAMP_USEC, value=ts)]
+    if with_info:
+        records.extend(
+            [
+                LmcRecord(record_type=LmcrecType.CLASS_INFO, class_id=1, name="C"),
+                LmcRecord(
+                    record_type=LmcrecType.VAR_INFO,
+                    class_id=1,
+                    var_id=11,
+                    lmc_var_type=LmcVarType.COUNTER,
+                    name="v1",
+                ),
+                LmcRecord(
+                    record_type=LmcrecType.VAR_INFO,
+                    class_id=1,
+                    var_id=12,
+                    lmc_var_type=LmcVarType.STRING,
+                    name="v2",
+                ),
+            ]
+        )
+    for inst_id, inst_vals in vals.items():
+        if with_info:
+            records.append(
+                LmcRecord(
+                    record_type=LmcrecType.INST_INFO,
+                    class_id=1,
+                    inst_id=inst_id,
+                    parent_inst_id=0,
+                    name=f"inst{inst_id}",
+                )
+            )
+        else:
+            records.append(
+                LmcRecord(record_type=LmcrecType.SET_INST_ID, inst_id=inst_id)
+            )
+        for var_id, val in inst_vals.items():
+            records.append(
+                LmcRecord(record_type=LmcrecType.VAR_VALUE, var_id=var_id, value=val)
+            )
+    records.append(LmcRecord(record_type=LmcrecType.DURATION_USEC, value=1))
+    return records
+
+
+@pytest.mark.parametrize("track_changes", [False, True])
+def test_lmcrec_state_cache_track_changes(track_changes: bool):
+    state_cache = LmcrecStateCache(decoder=None, track_changes=track_changes)
+    scans = [
+        _scan_records(1000, {1: {11: 1, 12: "a"}, 2: {11: 2}}, with_info=True),
+        # Checkpoint like, re-stated values:
+        _scan_records(2000, {1: {11: 1, 12: "a"}, 2: {11: 2}}, with_info=True),
+        _scan_records(3000, {1: {12: "b"}, 2: {11: 2}}),
+        _scan_records(4000, {2: {11: 3}}),
+    ]
+    expect_changed_vars = [
+        {1: {11, 12}, 2: {11}},
+        {},
+        {1: {12}},
+        {2: {11}},
+    ]
+    for records, expect in zip(scans, expect_changed_vars):
+        decoder = MagicMock()
+        decoder.next_record.side_effect = records
+        state_cache.set_decoder(decoder)
+        assert state_cache.apply_next_scan() == LmcrecScanRetCode.COMPLETE
+        if track_changes:
+            assert state_cache.changed_vars == expect
+        else:
+            assert state_cache.changed_vars is None
+
+
+def test_lmcrec_query_selector_run_changed_only():
+    query_selector = LmcrecQuerySelector(
+        yaml.safe_load("{c: class1, v: [v1, v2]}"), changed_only=True
+    )
+    query_state_cache = LmcrecQueryIntervalStateCacheBuilder(
+        instances=[
+            ("inst1", "class1", {"v1": 1, "v2": 10, "v3": 100}),
+            ("inst2", "class1", {"v1": 2, "v2": 20, "v3": 200}),
+            ("inst3", "class1", {"v1": 3, "v2": 30, "v3": 300}),
+        ]
+    )(is_primer=True)
+    query_state_cache.changed_vars = dict()
+
+    # The first scan of a chain is reported in full:
+    result = query_selector.run(query_state_cache)
+    assert sorted(result["class1"].vals_by_inst) == ["inst1", "inst2", "inst3"]
+
+    # Only inst1 changed a selected var, inst3 changed an unselected one:
+    query_state_cache.new_chain = False
+    inst_by_name = query_state_cache.inst_by_name
+    var_info_by_name = query_state_cache.class_by_name["class1"].var_info_by_name
+    inst_by_name["inst1"].vars[var_info_by_name["v2"].var_id] = 11
+    inst_by_name["inst3"].vars[var_info_by_name["v3"].var_id] = 301
+    query_state_cache.changed_vars = {
+        inst_by_name["inst1"].inst_id: {var_info_by_name["v2"].var_id},
+        inst_by_name["inst3"].inst_id: {var_info_by_name["v3"].var_id},
+    }
+    result = query_selector.run(query_state_cache)
+    assert result == {
+        "class1": LmcrecQueryClassResult(
+            var_names=["v1", "v2"], vals_by_inst={"inst1": [1, 11]}
+        )
+    }
+
+    # Nothing changed:
+    query_state_cache.changed_vars = dict()
+    result = query_selector.run(query_state_cache)
+    assert result == {
+        "class1": LmcrecQueryClassResult(var_names=["v1", "v2"], vals_by_inst={})
+    }
@@ -0,0 +1,215 @@
+# /usr/bin/env python3
+
+"""Unit tests for LmcrecQueryColumnarBuilder"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+from lmcrec.playback.query.columnar import (
+    COLUMNAR_FORMAT_ARROW,
+    COLUMNAR_FORMAT_PANDAS,
+    LmcrecQueryColumnarBuilder,
+)
+from lmcrec.playback.query.query_selector import LmcrecQueryClassResult
+
+
+@dataclass
+class LmcrecQueryColumnarBuilderTestCase:
+    name: Optional[str] = None
+    description: Optional[str] = None
+    batch_size: int = 0
+    # List of (ts, {query_name: {class_name: LmcrecQueryClassResult}}):
+    scans: List[Tuple[float, Dict[str, Dict[str, LmcrecQueryClassResult]]]] = field(
+        default_factory=list
+    )
+    # Expected batches, in order: (query_name, class_name, {col: [vals]}):
+    expect_batches: List[Tuple[str, str, Dict[str, List[Any]]]] = field(
+        default_factory=list
+    )
+
+
+test_cases = [
+    LmcrecQueryColumnarBuilderTestCase(
+        name="SingleScan",
+        description="Single scan, unbounded batch, delivered at flush",
+        scans=[
+            (
+                1.0,
+                {
+                    "q": {
+                        "c": LmcrecQueryClassResult(
+                            var_names=["v1", "v2:d"],
+                            vals_by_inst={"i1": [1, None], "i2": [2, 3]},
+                        )
+                    }
+                },
+            ),
+        ],
+        expect_batches=[
+            (
+                "q",
+                "c",
+                {
+                    "timestamp": [1.0, 1.0],
+                    "instance": ["i1", "i2"],
+                    "v1": [1, 2],
+                    "v2:d": [None, 3],
+                },
+            ),
+        ],
+    ),
+    LmcrecQueryColumnarBuilderTestCase(
+        name="BatchSize",
+        description="Multiple scans split into batches by size",
+        batch_size=2,
+        scans=[
+            (
+                1.0,
+                {
+                    "q": {
+                        "c": LmcrecQueryClassResult(
+                            var_names=["v1"], vals_by_inst={"i1": [1]}
+                        )
+                    }
+                },
+            ),
+            (
+                2.0,
+                {
+                    "q": {
+                        "c": LmcrecQueryClassResult(
+                            var_names=["v1"], vals_by_inst={"i1": [2], "i2": [20]}
+                        )
+                    }
+                },
+            ),
+        ],
+        expect_batches=[
+            (
+                "q",
+                "c",
+                {"timestamp": [1.0, 2.0], "instance": ["i1", "i1"], "v1": [1, 2]},
+            ),
+            ("q", "c", {"timestamp": [2.0], "instance": ["i2"], "v1": [20]}),
+        ],
+    ),
+    LmcrecQueryColumnarBuilderTestCase(
+        name="VarNamesChange",
+        description="A change in var names forces a new batch",
+        batch_size=10,
+        scans=[
+            (
+                1.0,
+                {
+                    "q": {
+                        "c": LmcrecQueryClassResult(
+                            var_names=["v1"], vals_by_inst={"i1": [1]}
+                        )
+                    }
+                },
+            ),
+            (
+                2.0,
+                {
+                    "q": {
+                        "c": LmcrecQueryClassResult(
+                            var_names=["v1", "v2"], vals_by_inst={"i1": [2, 3]}
+                        )
+                    }
+                },
+            ),
+        ],
+        expect_batches=[
+            ("q", "c", {"timestamp": [1.0], "instance": ["i1"], "v1": [1]}),
+            ("q", "c", {"timestamp": [2.0], "instance": ["i1"], "v1": [2], "v2": [3]}),
+        ],
+    ),
+    LmcrecQueryColumnarBuilderTestCase(
+        name="MultipleQueriesClasses",
+        description="Batches are kept separately for each (query, class)",
+        scans=[
+            (
+                1.0,
+                {
+                    "q1": {
+                        "c1": LmcrecQueryClassResult(
+                            var_names=["v1"], vals_by_inst={"i1": [1]}
+                        ),
+                        "c2": LmcrecQueryClassResult(
+                            var_names=["v2"], vals_by_inst={"i2": [2]}
+                        ),
+                    },
+                    "q2": {
+                        "c1": LmcrecQueryClassResult(
+                            var_names=["v1:r"], vals_by_inst={"i1": [0.5]}
+                        ),
+                    },
+                },
+            ),
+        ],
+        expect_batches=[
+            ("q1", "c1", {"timestamp": [1.0], "instance": ["i1"], "v1": [1]}),
+            ("q1", "c2", {"timestamp": [1.0], "instance": ["i2"], "v2": [2]}),
+            ("q2", "c1", {"timestamp": [1.0], "instance": ["i1"], "v1:r": [0.5]}),
+        ],
+    ),
+]
+
+
+def _collect_batches(builder, tc: LmcrecQueryColumnarBuilderTestCase) -> list:
+    batches = []
+    for ts, result in tc.scans:
+        batches.extend(builder.add(ts, result))
+    batches.extend(builder.flush())
+    return batches
+
+
+@pytest.mark.parametrize("tc", test_cases, ids=lambda tc: tc.name)
+def test_lmcrec_query_columnar_builder(tc: LmcrecQueryColumnarBuilderTestCase):
+    builder = LmcrecQueryColumnarBuilder(batch_size=tc.batch_size)
+    batches = _collect_batches(builder, tc)
+    assert len(batches) == len(tc.expect_batches)
+    for batch, (query_name, class_name, cols) in zip(batches, tc.expect_batches):
+        assert batch.query_name == query_name
+        assert batch.class_name == class_name
+        assert batch.col_names == list(cols)
+        assert batch.data == cols
+        assert batch.num_rows == len(cols["timestamp"])
+
+
+@pytest.mark.parametrize("tc", test_cases, ids=lambda tc: tc.name)
+def test_lmcrec_query_columnar_builder_pandas(tc: LmcrecQueryColumnarBuilderTestCase):
+    pytest.importorskip("pandas")
+    builder = LmcrecQueryColumnarBuilder(
+        batch_size=tc.batch_size, output_format=COLUMNAR_FORMAT_PANDAS
+    )
+    batches = _collect_batches(builder, tc)
+    assert len(batches) == len(tc.expect_batches)
+    for batch, (_, _, cols) in zip(batches, tc.expect_batches):
+        df = batch.data
+        assert list(df.columns) == list(cols)
+        assert [ts.timestamp() for ts in df["timestamp"]] == cols["timestamp"]
+        assert list(df["instance"]) == cols["instance"]
+
+
+@pytest.mark.parametrize("tc", test_cases, ids=lambda tc: tc.name)
+def test_lmcrec_query_columnar_builder_arrow(tc: LmcrecQueryColumnarBuilderTestCase):
+    pytest.importorskip("pyarrow")
+    builder = LmcrecQueryColumnarBuilder(
+        batch_size=tc.batch_size, output_format=COLUMNAR_FORMAT_ARROW
+    )
+    batches = _collect_batches(builder, tc)
+    assert len(batches) == len(tc.expect_batches)
+    for batch, (_, _, cols) in zip(batches, tc.expect_batches):
+        record_batch = batch.data
+        assert record_batch.schema.names == list(cols)
+        assert record_batch.num_rows == len(cols["timestamp"])
+        for col_name in list(cols)[1:]:
+            assert record_batch.column(col_name).to_pylist() == cols[col_name]
+
+
+def test_lmcrec_query_columnar_builder_invalid_format():
+    with pytest.raises(ValueError):
+        LmcrecQueryColumnarBuilder(output_format="invalid")
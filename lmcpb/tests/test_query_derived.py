@@ -0,0 +1,177 @@
+# /usr/bin/env python3
+
+"""Unit tests for query derived columns"""
+
+from typing import Any, Dict, List
+
+import pytest
+import yaml
+
+from lmcrec.playback.codec.decoder import LmcVarType
+from lmcrec.playback.query.query_selector import (
+    LmcrecQuerySelector,
+    compile_derived,
+    parse_derived_specs,
+)
+
+from .query_selector_def import LmcrecQueryIntervalStateCacheBuilder
+
+
+@pytest.mark.parametrize(
+    "spec, expect",
+    [
+        (
+            "ratio = hits:d / (hits:d + misses:d)",
+            [("ratio", ["hits:d", "misses:d"])],
+        ),
+        (
+            ["total = a + b:v + c:p", "x=max(a, 1e3) * 2"],
+            [("total", ["a", "b", "c:p"]), ("x", ["a"])],
+        ),
+        ({"r": "abs(a:D) ** 0.5"}, [("r", ["a:D"])]),
+        ({"r": "a ** -2 + (b ** 2) ** 16"}, [("r", ["a", "b"])]),
+    ],
+)
+def test_parse_derived_specs(spec: Any, expect: List):
+    assert [
+        (derived.name, derived.refs) for derived in parse_derived_specs(spec)
+    ] == expect
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "ratio",
+        "ratio = ",
+        "ratio = 1 + 2",
+        "ratio = a:dr / 2",
+        "ratio = a.real",
+        "ratio = a if b else c",
+        "ratio = a + 'x'",
+        "ratio = __import__('os')",
+        "ratio = a[0]",
+        "ratio = (a",
+        "ratio = a ** b",
+        "ratio = 2 ** a",
+        "ratio = a ** 17",
+        "ratio = a ** -17",
+        "ratio = a ** (1 + 1)",
+        "ratio = a ** True",
+    ],
+)
+def test_parse_derived_specs_invalid(spec: str):
+    with pytest.raises(ValueError):
+        parse_derived_specs(spec)
+
+
+def test_compile_derived():
+    (derived,) = parse_derived_specs("x = (a:d - b) / min(a:d, 4) % 3")
+    func = compile_derived(derived, [2, 0])
+    assert func([1, None, 10]) == ((10 - 1) / 4) % 3
+
+
+def _state_cache():
+    return LmcrecQueryIntervalStateCacheBuilder(
+        classes={
+            "class1": (
+                0,
+                [
+                    ("hits", LmcVarType.COUNTER),
+                    ("misses", LmcVarType.COUNTER),
+                    ("name", LmcVarType.STRING),
+                ],
+            ),
+            "class2": (
+                1,
+                [
+                    ("hits", LmcVarType.COUNTER),
+                    ("name", LmcVarType.STRING),
+                ],
+            ),
+        },
+        instances=[
+            ("inst1", "class1", {"hits": (130, 100), "misses": (20, 10), "name": "a"}),
+            ("inst2", "class1", {"hits": (100, 100), "misses": (10, 10), "name": "b"}),
+            ("inst3", "class1", {"hits": 100, "misses": 10, "name": "c"}),
+            ("inst4", "class2", {"hits": (200, 100), "name": "d"}),
+        ],
+        d_time=10,
+    )(is_primer=True)
+
+
+@pytest.mark.parametrize(
+    "query, expect",
+    [
+        (
+            # Hidden references:
+            "{v: name, e: 'ratio = hits:d / (hits:d + misses:d)'}",
+            {
+                "class1": {
+                    "inst1": {"name": "a", "ratio": 0.75},
+                    # Division by 0:
+                    "inst2": {"name": "b", "ratio": None},
+                    # No previous values:
+                    "inst3": {"name": "c", "ratio": None},
+                },
+                "class2": {
+                    # Missing variable:
+                    "inst4": {"name": "d", "ratio": None},
+                },
+            },
+        ),
+        (
+            # Selected references:
+            "{c: class1, v: [hits, misses], e: {total: hits + misses, half: hits / 2}}",
+            {
+                "class1": {
+                    "inst1": {"hits": 130, "misses": 20, "total": 150, "half": 65.0},
+                    "inst2": {"hits": 100, "misses": 10, "total": 110, "half": 50.0},
+                    "inst3": {"hits": 100, "misses": 10, "total": 110, "half": 50.0},
+                },
+            },
+        ),
+        (
+            # Mixed references, w/ predicates on selected variables:
+            "{c: class1, v: [hits:d>0, name], e: ['rate = hits:r + misses:r']}",
+            {
+                "class1": {
+                    "inst1": {"hits:d": 30, "name": "a", "rate": 4.0},
+                },
+            },
+        ),
+        (
+            # Top-K by derived column:
+            "{c: class1, v: name, e: 'total = hits + misses', k: total/1}",
+            {"class1": {"inst1": {"name": "a", "total": 150}}},
+        ),
+        (
+            # Group-by derived column:
+            "{c: class1, v: name, e: 'total = hits + misses', a: [sum, max]}",
+            {
+                "class1": {
+                    "class1": {
+                        "sum(name)": None,
+                        "max(name)": None,
+                        "sum(total)": 370,
+                        "max(total)": 150,
+                    }
+                }
+            },
+        ),
+    ],
+)
+def test_lmcrec_query_selector_run_derived(
+    query: str, expect: Dict[str, Dict[str, Dict[str, Any]]]
+):
+    query_selector = LmcrecQuerySelector(yaml.safe_load(query))
+    assert query_selector.needs_prev == ("hits:" in query or "misses:" in query)
+    query_state_cache = _state_cache()
+    for _ in range(2):
+        result = query_selector.run(query_state_cache)
+        assert {
+            class_name: class_result.as_dict()
+            for class_name, class_result in result.items()
+        } == expect
+        for class_result in result.values():
+            for vals in class_result.vals_by_inst.values():
+                assert len(vals) == len(class_result.var_names)
@@ -0,0 +1,83 @@
+# /usr/bin/env python3
+
+"""Unit tests for the query cost estimator (explain mode)"""
+
+import os
+
+import pytest
+
+from lmcrec.playback.codec import locate_checkpoint
+from lmcrec.playback.query import (
+    explain_query,
+    format_explain_plan,
+    load_pb_perf_calibration,
+    save_pb_perf_calibration,
+)
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0, T1 = 1_700_000_000, 1_700_001_000
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # 2 chains, the first one made of 2 files:
+    scans = make_test_scans(T0, 20)
+    return write_test_chains(
+        str(tmp_path), [[scans[:10], scans[10:]], [make_test_scans(T1, 10)]]
+    )
+
+
+def test_explain_query_all(record_files_dir: str):
+    plan = explain_query(record_files_dir, decode_speed=100)
+    assert plan.num_chains == 2
+    assert [f.chain_index for f in plan.files] == [0, 0, 1]
+    assert [os.path.basename(f.file_name) for f in plan.files] == [
+        "chain0-0.lmcrec",
+        "chain0-1.lmcrec",
+        "chain1-0.lmcrec",
+    ]
+    for f in plan.files:
+        assert f.checkpoint_offset is None
+        assert f.fraction == 1.0
+        assert f.est_decode_bytes == f.file_size == os.stat(f.file_name).st_size
+        assert f.est_scans == 10
+    assert plan.est_decode_bytes == sum(f.file_size for f in plan.files)
+    assert plan.est_time == pytest.approx(plan.est_decode_bytes / 1000 / 100)
+
+
+def test_explain_query_window(record_files_dir: str):
+    from_ts, to_ts = T0 + 27, T0 + 62
+    plan = explain_query(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    assert plan.num_chains == 1
+    assert len(plan.files) == 2
+    first, second = plan.files
+    chkpt_ts, chkpt_off = locate_checkpoint(first.file_name, from_ts)
+    assert (first.replay_from_ts, first.checkpoint_offset) == (chkpt_ts, chkpt_off)
+    assert first.replay_to_ts == first.most_recent_ts
+    assert 0 < first.fraction < 1
+    assert first.est_decode_bytes < first.file_size
+    # The subsequent file is replayed from its start, up to to_ts:
+    assert second.checkpoint_offset is None
+    assert (second.replay_from_ts, second.replay_to_ts) == (second.start_ts, to_ts)
+    assert second.est_decode_bytes < second.file_size
+    assert second.est_scans == 3
+
+    assert "Estimated time" in format_explain_plan(plan, record_files_dir)
+
+
+def test_explain_query_empty(record_files_dir: str):
+    plan = explain_query(record_files_dir, from_ts=T1 + 1000)
+    assert (plan.num_chains, plan.files, plan.est_decode_bytes) == (0, [], 0)
+
+
+def test_pb_perf_calibration(tmp_path):
+    calibration_file = os.path.join(str(tmp_path), "sub", "calibration.json")
+    assert load_pb_perf_calibration(calibration_file) is None
+    save_pb_perf_calibration(1234.5, calibration_file=calibration_file)
+    calibration = load_pb_perf_calibration(calibration_file)
+    assert calibration["speed_kb_sec"] == 1234.5
+    assert not calibration["have_prev"]
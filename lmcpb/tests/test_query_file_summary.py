@@ -0,0 +1,149 @@
+# /usr/bin/env python3
+
+"""Unit tests for the per file summaries"""
+
+import os
+from typing import List
+
+import pytest
+
+from lmcrec.playback.query import (
+    LmcrecBloomFilter,
+    LmcrecFileSummary,
+    LmcrecQuery,
+    LmcrecQuerySelector,
+    build_lmcrec_file_summary,
+    chain_to_file_list,
+    load_lmcrec_file_summary,
+    summarize_lmcrec_file,
+)
+from lmcrec.playback.query.parallel import copy_query_result
+
+from .lmcrec_files_def import (
+    LMCREC_TEST_FILE_DATE_DIR,
+    LmcrecTestFileWriter,
+    make_test_scans,
+)
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0 = 1_700_000_000
+
+
+def _make_class_scans(class_name: str, ts: float, n: int) -> List:
+    return [
+        (ts, {f"{class_name}-{inst_name}": v for inst_name, v in scan.items()})
+        for ts, scan in make_test_scans(ts, n, class_name=class_name)
+    ]
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # A single chain: ClassA only, ClassA then ClassB, ClassC only:
+    writer = LmcrecTestFileWriter(str(tmp_path), 4)
+    writer.write_file("f0", _make_class_scans("ClassA", T0, 10))
+    writer.write_file(
+        "f1",
+        _make_class_scans("ClassA", T0 + 50, 10)
+        + _make_class_scans("ClassB", T0 + 100, 10),
+    )
+    writer.write_file("f2", _make_class_scans("ClassC", T0 + 150, 10))
+    return os.path.join(str(tmp_path), LMCREC_TEST_FILE_DATE_DIR)
+
+
+def _file_path(record_files_dir: str, name: str) -> str:
+    return os.path.join(record_files_dir, name + ".lmcrec")
+
+
+def test_bloom_filter():
+    items = [f"inst{k}" for k in range(1000)]
+    bloom = LmcrecBloomFilter.for_capacity(len(items))
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f"other{k}" in bloom for k in range(10000))
+    assert false_positives < 300
+    bloom2 = LmcrecBloomFilter.from_json(bloom.to_json())
+    assert bloom2.bits == bloom.bits
+    assert all(item in bloom2 for item in items)
+
+
+def test_file_summary(record_files_dir: str):
+    file_name = _file_path(record_files_dir, "f1")
+    summary = build_lmcrec_file_summary(file_name)
+    assert summary.classes == {
+        "ClassA": (T0 + 50, T0 + 95),
+        "ClassB": (T0 + 100, T0 + 145),
+    }
+    assert summary.num_inst == 4
+    assert summary.may_have_inst("ClassB-inst1")
+    assert summary.has_class("ClassA", T0 + 90, T0 + 200)
+    assert not summary.has_class("ClassA", T0 + 96, T0 + 200)
+    assert not summary.has_class("ClassC")
+    assert LmcrecFileSummary.from_json(summary.to_json()) == summary
+    with pytest.raises(ValueError, match="got: 2"):
+        LmcrecFileSummary.from_json(dict(summary.to_json(), version=2))
+
+    assert load_lmcrec_file_summary(file_name) is None
+    assert summarize_lmcrec_file(file_name) == summary
+    assert load_lmcrec_file_summary(file_name) == summary
+    # Out of date:
+    st = os.stat(file_name)
+    os.utime(file_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert load_lmcrec_file_summary(file_name) is None
+
+
+def test_file_filter_spec():
+    assert LmcrecQuerySelector({"i": "~inst"}).file_filter_spec() is None
+    assert LmcrecQuerySelector({"c": "A", "i": "/x/"}).file_filter_spec() == (
+        {"A"},
+        None,
+    )
+    assert LmcrecQuerySelector({"i": ["x", "y"]}).file_filter_spec() == (
+        None,
+        {"x", "y"},
+    )
+    assert LmcrecQuerySelector({"i": "x", "s": "y"}).file_filter_spec() is None
+
+
+@pytest.mark.parametrize(
+    "query, want_files",
+    [
+        ("{c: ClassB, v: [counter]}", ["f1"]),
+        ("{c: [ClassA, ClassC], v: [counter]}", ["f0", "f1", "f2"]),
+        ("{i: ClassC-inst1, v: [counter]}", ["f2"]),
+        ("{i: ~inst1, v: [counter]}", ["f0", "f1", "f2"]),
+    ],
+)
+def test_query_use_summaries(record_files_dir: str, query: str, want_files: List):
+    for name in ["f0", "f1", "f2"]:
+        summarize_lmcrec_file(_file_path(record_files_dir, name))
+
+    results = []
+    for use_summaries in [False, True]:
+        lmcrec_query = LmcrecQuery(record_files_dir, query, use_summaries=use_summaries)
+        file_list = chain_to_file_list(lmcrec_query.query_state_cache._chain_list)
+        scans = []
+        lmcrec_query.run_with_callback(
+            lambda result, query_state_cache: scans.append(
+                (query_state_cache.ts, copy_query_result(result))
+            )
+            or True
+        )
+        # Only the scans w/ matching instances are comparable, the skipped
+        # files may still hold selected classes w/ no instances:
+        results.append(
+            [
+                scan
+                for scan in scans
+                if any(
+                    class_result.vals_by_inst
+                    for query_result in scan[1].values()
+                    for class_result in query_result.values()
+                )
+            ]
+        )
+    assert [os.path.basename(f)[:-7] for f in file_list] == want_files
+    assert results[1] == results[0]
+    assert results[0]
@@ -0,0 +1,146 @@
+# /usr/bin/env python3
+
+"""Unit tests for fleet, i.e. multi instance, queries"""
+
+import os
+from typing import List, Optional
+
+import pytest
+
+from lmcrec.playback.query import (
+    LmcrecFleetQuery,
+    LmcrecQuery,
+    get_fleet_record_files_dirs,
+    tag_fleet_result,
+)
+from lmcrec.playback.query.parallel import copy_query_result
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter:dr, flag, label]}"
+
+T0 = 1_700_000_000
+
+
+@pytest.fixture
+def record_files_dir_by_inst(tmp_path) -> dict:
+    # Interleaved scans, inst0 has 2 chains, inst1 has a single one, made of 2
+    # files, which overlaps w/ both chains of inst0:
+    scans = make_test_scans(T0 + 3, 70, num_inst=3)
+    chains_by_inst = {
+        "inst0": [
+            [make_test_scans(T0, 20, interval=10)],
+            [make_test_scans(T0 + 300, 10, interval=10)],
+        ],
+        "inst1": [[scans[:35], scans[35:]]],
+    }
+    return {
+        inst: write_test_chains(os.path.join(str(tmp_path), inst), chains)
+        for inst, chains in chains_by_inst.items()
+    }
+
+
+def _run_query(
+    record_files_dir: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> List:
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            (
+                query_state_cache.ts,
+                query_state_cache.new_chain,
+                copy_query_result(result),
+            )
+        )
+        return True
+
+    LmcrecQuery(
+        record_files_dir, QUERY, from_ts=from_ts, to_ts=to_ts
+    ).run_with_callback(cb)
+    return scans
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts, workers, segment_duration",
+    [
+        (None, None, 1, None),
+        (None, None, 1, 60),
+        (None, None, 2, 60),
+        (T0 + 57, T0 + 333, 1, 60),
+        (T0 + 57, T0 + 333, 3, 30),
+    ],
+)
+def test_fleet_query(
+    record_files_dir_by_inst: dict,
+    from_ts: Optional[float],
+    to_ts: Optional[float],
+    workers: int,
+    segment_duration: Optional[float],
+):
+    expect = []
+    for inst_index, (inst, record_files_dir) in enumerate(
+        record_files_dir_by_inst.items()
+    ):
+        for ts, new_chain, result in _run_query(record_files_dir, from_ts, to_ts):
+            expect.append((ts, inst_index, inst, new_chain, result))
+    expect = [scan[:1] + scan[2:] for scan in sorted(expect, key=lambda s: s[:2])]
+    assert len({scan[1] for scan in expect}) == 2
+
+    fleet_query = LmcrecFleetQuery(
+        record_files_dir_by_inst,
+        QUERY,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        workers=workers,
+        segment_duration=segment_duration,
+    )
+    scans = []
+
+    def cb(result, scan_state):
+        scans.append(
+            (
+                scan_state.ts,
+                scan_state.inst,
+                scan_state.new_chain,
+                copy_query_result(result),
+            )
+        )
+        return True
+
+    fleet_query.run_with_callback(cb)
+    assert scans == expect
+    assert fleet_query.ret_code_by_inst == {}
+    assert (fleet_query.first_ts, fleet_query.last_ts) == (expect[0][0], expect[-1][0])
+
+
+def test_tag_fleet_result():
+    assert tag_fleet_result("inst0", {"q": 1, "r": 2}) == {"inst0/q": 1, "inst0/r": 2}
+
+
+def test_get_fleet_record_files_dirs(tmp_path):
+    config_file = os.path.join(str(tmp_path), "lmcrec-config.yaml")
+    with open(config_file, "wt") as f:
+        f.write(
+            "default:\n"
+            "  record_files_dir: /rec/<INST>\n"
+            "recorders:\n"
+            "  - inst: ads1\n"
+            "  - inst: adh1\n"
+            "    record_files_dir: /other/adh1\n"
+        )
+    assert get_fleet_record_files_dirs(config_file=config_file) == {
+        "ads1": "/rec/ads1",
+        "adh1": "/other/adh1",
+    }
+    assert get_fleet_record_files_dirs(["adh1", "ads2"], config_file) == {
+        "adh1": "/other/adh1",
+        "ads2": "/rec/ads2",
+    }
+    with pytest.raises(RuntimeError):
+        get_fleet_record_files_dirs(["ads1", "ads1"], config_file)
@@ -0,0 +1,154 @@
+# /usr/bin/env python3
+
+"""Unit tests for the instance lifecycle index"""
+
+import os
+from typing import List
+
+import pytest
+
+from lmcrec.playback.codec import (
+    LmcrecFileDecoder,
+    LmcrecInfoState,
+    LmcRecord,
+    LmcrecType,
+)
+from lmcrec.playback.query import (
+    LmcrecLifecycleIndex,
+    LmcrecLifecycleInterval,
+    decode_lmcrec_file_lifecycle,
+    summarize_lifecycle,
+)
+
+from .lmcrec_files_def import (
+    LMCREC_TEST_FILE_DATE_DIR,
+    LmcrecTestFileWriter,
+    LmcrecTestScan,
+    make_test_scans,
+)
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0 = 1_700_000_000
+
+
+def _make_lifecycle_scans(from_ts: float, num_scans: int) -> List[LmcrecTestScan]:
+    # inst0 throughout, inst1 deleted at scan 3 and re-created at scan 6:
+    scans = make_test_scans(from_ts, num_scans)
+    for i in range(3, min(6, num_scans)):
+        del scans[i][1]["inst1"]
+    return scans
+
+
+@pytest.fixture
+def writer(tmp_path) -> LmcrecTestFileWriter:
+    writer = LmcrecTestFileWriter(str(tmp_path), 4)
+    writer.write_file("f0", _make_lifecycle_scans(T0, 10))
+    writer.write_file("f1", make_test_scans(T0 + 50, 10, num_inst=1))
+    return writer
+
+
+def _record_files_dir(writer: LmcrecTestFileWriter) -> str:
+    return os.path.join(writer.record_files_dir, LMCREC_TEST_FILE_DATE_DIR)
+
+
+def _file_path(writer: LmcrecTestFileWriter, name: str) -> str:
+    return os.path.join(_record_files_dir(writer), name + ".lmcrec")
+
+
+def test_next_structure_record(writer: LmcrecTestFileWriter):
+    file_name = _file_path(writer, "f0")
+    want = []
+    decoder = LmcrecFileDecoder(file_name)
+    try:
+        while True:
+            record = decoder.next_record()
+            if record.record_type in {
+                LmcrecType.TIMESTAMP_USEC,
+                LmcrecType.CLASS_INFO,
+                LmcrecType.INST_INFO,
+                LmcrecType.DELETE_INST_ID,
+                LmcrecType.EOR,
+            }:
+                want.append(str(record))
+            if record.record_type == LmcrecType.EOR:
+                break
+    finally:
+        decoder.close()
+
+    got = []
+    decoder = LmcrecFileDecoder(file_name)
+    record = LmcRecord()
+    try:
+        while True:
+            decoder.next_structure_record(record)
+            got.append(str(record))
+            if record.record_type == LmcrecType.EOR:
+                break
+    finally:
+        decoder.close()
+    assert got == want
+
+
+def test_decode_lmcrec_file_lifecycle(writer: LmcrecTestFileWriter):
+    assert decode_lmcrec_file_lifecycle(_file_path(writer, "f0")) == {
+        "inst0": [["TestClass", T0, T0 + 45, False]],
+        "inst1": [
+            ["TestClass", T0, T0 + 10, True],
+            ["TestClass", T0 + 30, T0 + 45, False],
+        ],
+    }
+    # inst1 deleted at the file boundary:
+    assert decode_lmcrec_file_lifecycle(_file_path(writer, "f1")) == {
+        "inst0": [["TestClass", T0 + 50, T0 + 95, False]],
+    }
+
+
+def test_lifecycle_index(writer: LmcrecTestFileWriter, tmp_path):
+    record_files_dir = _record_files_dir(writer)
+    index_file = os.path.join(str(tmp_path), "lifecycle", "index.json")
+    lifecycle_index = LmcrecLifecycleIndex(record_files_dir, index_file=index_file)
+    assert lifecycle_index.refresh()
+    assert lifecycle_index.num_file_decodes == 2
+    assert not lifecycle_index.refresh()
+    assert lifecycle_index.num_file_decodes == 2
+
+    assert lifecycle_index.lookup("inst1") == [
+        LmcrecLifecycleInterval("inst1", "TestClass", "f0.lmcrec", T0, T0 + 10, True),
+        LmcrecLifecycleInterval(
+            "inst1", "TestClass", "f0.lmcrec", T0 + 30, T0 + 45, False
+        ),
+    ]
+    assert [
+        (interval.inst_name, interval.first_ts)
+        for interval in lifecycle_index.lookup("~0", from_ts=T0 + 60)
+    ] == [("inst0", T0 + 50)]
+    assert [
+        interval.first_ts
+        for interval in lifecycle_index.lookup("/inst[01]$/", to_ts=T0 + 20)
+    ] == [T0, T0]
+    assert lifecycle_index.lookup("inst2") == []
+    assert summarize_lifecycle(lifecycle_index.lookup()) == [
+        LmcrecLifecycleInterval("inst0", "TestClass", "f1.lmcrec", T0, T0 + 95, False),
+        LmcrecLifecycleInterval("inst1", "TestClass", "f0.lmcrec", T0, T0 + 45, False),
+    ]
+
+    # Incremental refresh, the active file is not indexed:
+    writer.write_file(
+        "f2", make_test_scans(T0 + 100, 5, num_inst=3), state=LmcrecInfoState.ACTIVE
+    )
+    lifecycle_index = LmcrecLifecycleIndex(record_files_dir, index_file=index_file)
+    assert not lifecycle_index.refresh()
+    assert lifecycle_index.num_file_decodes == 0
+    assert lifecycle_index.lookup("inst2") == []
+
+    # Closed, same chain:
+    writer.prev_file_name = os.path.join(LMCREC_TEST_FILE_DATE_DIR, "f1.lmcrec")
+    writer.write_file("f2", make_test_scans(T0 + 100, 5, num_inst=3))
+    assert lifecycle_index.refresh()
+    assert lifecycle_index.num_file_decodes == 1
+    assert [
+        (interval.file_name, interval.first_ts)
+        for interval in lifecycle_index.lookup("inst2")
+    ] == [("f2.lmcrec", T0 + 100)]
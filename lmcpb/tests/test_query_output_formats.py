@@ -0,0 +1,215 @@
+# /usr/bin/env python3
+
+"""Unit tests for the lmcrec-query output formats, file handle pool and args"""
+
+import csv
+import gzip
+import json
+import os
+import sys
+from typing import List
+
+import pytest
+
+from lmcrec.playback.commands.lmcrec_query import (
+    CsvTableFormatter,
+    FileHandlePool,
+    FileTableFormatter,
+    FixedWidthTableFormatter,
+    JsonlTableFormatter,
+)
+from lmcrec.playback.commands.lmcrec_query import main as lmcrec_query_main
+from lmcrec.playback.query import LmcrecQueryClassResult
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+TS = 1_700_000_000
+VAR_NAMES = ["count:d", "flag", "label"]
+
+
+def _result(vals_by_inst):
+    return {
+        "q": {
+            "TestClass": LmcrecQueryClassResult(
+                var_names=VAR_NAMES, vals_by_inst=vals_by_inst
+            )
+        }
+    }
+
+
+SCANS = [
+    {"inst0": [None, False, ""], "inst1": [None, True, ""]},
+    {"inst0": [0, False, ""], "inst1": [5, True, ""]},
+    {"inst0": [0, False, "x"], "inst1": [0, True, ""]},
+]
+
+
+def _run(formatter, capsys, window_index=None) -> str:
+    for i, vals_by_inst in enumerate(SCANS):
+        formatter.format(TS + 5 * i, _result(vals_by_inst), window_index)
+    return capsys.readouterr().out
+
+
+def _run_csv(output_dir: str, window_index=None, **kwargs) -> List[List[str]]:
+    formatter = CsvTableFormatter(output_dir, **kwargs)
+    for i, vals_by_inst in enumerate(SCANS):
+        formatter.format(TS + 5 * i, _result(vals_by_inst), window_index)
+    formatter.close()
+    with open(os.path.join(output_dir, "q", "TestClass.csv"), "rt") as f:
+        return list(csv.reader(f))
+
+
+def test_csv_non_null(tmp_path):
+    rows = _run_csv(str(tmp_path))
+    # Single header, w/ all the columns:
+    assert rows[0] == ["Timestamp", "Instance"] + VAR_NAMES
+    # The rows w/ null values only are omitted:
+    assert [row[1:] for row in rows[1:]] == [
+        ["inst0", "", "False", ""],
+        ["inst1", "", "True", ""],
+        ["inst0", "0", "False", ""],
+        ["inst1", "5", "True", ""],
+        ["inst0", "0", "False", "x"],
+        ["inst1", "0", "True", ""],
+    ]
+
+
+def test_csv_full_data(tmp_path):
+    rows = _run_csv(str(tmp_path), 1, full_data=True)
+    assert rows[0] == ["Timestamp", "Window", "Instance"] + VAR_NAMES
+    # Single header, all instances:
+    assert len(rows) == 1 + 2 * len(SCANS)
+    assert rows[1][:3] == ["2023-11-14T22:13:20+00:00", "2", "inst0"]
+
+
+def test_csv_stdout():
+    with pytest.raises(ValueError):
+        CsvTableFormatter(None)
+
+
+def test_jsonl(capsys):
+    rows = [
+        json.loads(line)
+        for line in _run(JsonlTableFormatter(None), capsys).splitlines()
+    ]
+    assert len(rows) == 2 * len(SCANS)
+    assert rows[0] == {
+        "Timestamp": "2023-11-14T22:13:20+00:00",
+        "Query": "q",
+        "Class": "TestClass",
+        "Instance": "inst0",
+        "Values": {"flag": False},
+    }
+    assert rows[-1]["Values"] == {"count:d": 0, "flag": True, "label": ""}
+
+
+def test_fixed_width(capsys):
+    lmcrec_schema = {
+        "info": {"inst_max_size": 12},
+        "classes": {
+            "TestClass": {
+                "count": {"type": "COUNTER"},
+                "flag": {"type": "BOOLEAN"},
+                "label": {"type": "STRING", "max_size": 10},
+            }
+        },
+    }
+    formatter = FixedWidthTableFormatter(
+        None, full_data=True, lmcrec_schema=lmcrec_schema
+    )
+    lines = _run(formatter, capsys).splitlines()
+    assert len(lines) == 2 + 2 * len(SCANS)
+    # All the lines have the same width:
+    assert len({len(line) for line in lines}) == 1
+    header = lines[0]
+    assert header.index("Instance") + 12 + 2 + 20 == header.index("count:d") + len(
+        "count:d"
+    )
+    assert lines[-2].endswith("x         ")
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_file_handle_pool(tmp_path, compress: bool):
+    open_fn = gzip.open if compress else open
+    pool = FileHandlePool(max_open_files=2, compress=compress)
+    file_paths = [os.path.join(str(tmp_path), f"f{i}") for i in range(3)]
+    for n in range(3):
+        for file_path in file_paths:
+            pool.get(file_path).write(f"{n}\n")
+        assert len(pool) == 2
+    pool.close()
+    assert pool.num_opens == 9
+    assert pool.num_evictions == 7
+    for file_path in file_paths:
+        with open_fn(file_path, "rt") as f:
+            assert f.read() == "0\n1\n2\n"
+
+
+@pytest.mark.parametrize("formatter_class", [FileTableFormatter, CsvTableFormatter])
+def test_output_dir_max_open_files(tmp_path, formatter_class):
+    class_names = [f"Class{i}" for i in range(5)]
+
+    def run(output_dir, max_open_files):
+        formatter = formatter_class(
+            output_dir, compress_level=1, max_open_files=max_open_files
+        )
+        for i, vals_by_inst in enumerate(SCANS):
+            class_result = _result(vals_by_inst)["q"]["TestClass"]
+            formatter.format(
+                TS + 5 * i,
+                {"q": {class_name: class_result for class_name in class_names}},
+            )
+        formatter.close()
+        return {
+            class_name: gzip.open(
+                os.path.join(
+                    output_dir,
+                    "q",
+                    class_name + formatter_class.file_suffix + ".gz",
+                ),
+                "rt",
+            ).read()
+            for class_name in class_names
+        }
+
+    expect = run(os.path.join(str(tmp_path), "all"), len(class_names))
+    assert run(os.path.join(str(tmp_path), "lru"), 2) == expect
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["-b", "0"],
+        ["-b", "0m0s"],
+        ["-b", "5x"],
+        ["-b", "5m", "--aggregates", ""],
+        ["-b", "5m", "--aggregates", " "],
+        ["-b", "5m", "--aggregates", "median"],
+        ["--aggregates", "max"],
+    ],
+)
+def test_lmcrec_query_invalid_args(monkeypatch, args: List[str]):
+    monkeypatch.setattr(sys, "argv", ["lmcrec-query"] + args + ["{c: TestClass}"])
+    with pytest.raises(RuntimeError):
+        lmcrec_query_main()
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["-W", ",2023-11-14T22:14:00Z", "-j", "4"],
+        ["-W", ",2023-11-14T22:14:00Z", "-R", "cache"],
+        ["-W", ",2023-11-14T22:14:00Z", "-Z"],
+        ["-W", "2023-11-14T22:14:00Z"],
+        ["-W", ",2023-11-14T22:14:00Z", "-W", "2023-11-14T22:13:50Z,"],
+    ],
+)
+def test_lmcrec_query_invalid_window_args(tmp_path, monkeypatch, args: List[str]):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["lmcrec-query", "-d", str(tmp_path)] + args + ["{c: TestClass}"],
+    )
+    with pytest.raises(RuntimeError):
+        lmcrec_query_main()
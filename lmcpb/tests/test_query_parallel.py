@@ -0,0 +1,252 @@
+# /usr/bin/env python3
+
+"""Unit tests for parallel query execution"""
+
+import os
+import time
+from typing import List, Optional
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.query import LmcrecQuery
+from lmcrec.playback.query.lmcrec_query import prepare_query_selectors
+from lmcrec.playback.query.parallel import (
+    build_query_tasks,
+    iter_query_task,
+    merge_task_batches,
+    run_query_task,
+    run_tasks_in_order,
+    split_chain,
+    stream_tasks_in_order,
+)
+from lmcrec.playback.query.query_state_cache import LmcrecQueryIntervalStateCache
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter:dr, flag, label]}"
+
+
+def _sleep_and_square(task: int, delay: float = 0) -> int:
+    # Later tasks complete first:
+    time.sleep(delay / (task + 1))
+    return task * task
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_run_tasks_in_order(workers: int):
+    tasks = list(range(10))
+    results = list(run_tasks_in_order(_sleep_and_square, tasks, workers, delay=0.05))
+    assert results == [task * task for task in tasks]
+
+
+def _sleep_and_count(task: int, num_items: int = 5, delay: float = 0):
+    # Later tasks complete first:
+    for k in range(num_items):
+        time.sleep(delay / (task + 1))
+        yield task * num_items + k
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_stream_tasks_in_order(workers: int):
+    tasks = list(range(6))
+    results = list(stream_tasks_in_order(_sleep_and_count, tasks, workers, delay=0.01))
+    assert results == list(range(len(tasks) * 5))
+
+
+def test_stream_tasks_in_order_early_close():
+    results = stream_tasks_in_order(_sleep_and_count, range(100), 2, num_items=1000)
+    assert next(results) == 0
+    assert next(results) == 1
+    results.close()
+    assert next(results, None) is None
+
+
+def _wait_for_file(task: str, timeout: float = 10):
+    yield "started"
+    # The consumer creates the file once it got the 1st item:
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(task):
+        if time.monotonic() >= deadline:
+            yield "not streamed"
+            return
+        time.sleep(0.01)
+    yield "streamed"
+
+
+def test_stream_tasks_in_order_while_running(tmp_path):
+    marker_file = os.path.join(str(tmp_path), "marker")
+    results = stream_tasks_in_order(_wait_for_file, [marker_file], 2)
+    assert next(results) == "started"
+    open(marker_file, "w").close()
+    assert list(results) == ["streamed"]
+
+
+def test_run_tasks_in_order_early_close():
+    results = run_tasks_in_order(_sleep_and_square, range(100), 2)
+    assert next(results) == 0
+    assert next(results) == 1
+    results.close()
+    assert next(results, None) is None
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # 3 chains, the first one made of 2 files:
+    scans = make_test_scans(1_700_000_000, 20)
+    return write_test_chains(
+        str(tmp_path),
+        [
+            [scans[:10], scans[10:]],
+            [make_test_scans(1_700_001_000, 10, num_inst=3)],
+            [make_test_scans(1_700_002_000, 15)],
+        ],
+    )
+
+
+def _run_query(
+    record_files_dir: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    workers: int = 1,
+    segment_duration: Optional[float] = None,
+) -> List:
+    lmcrec_query = LmcrecQuery(
+        record_files_dir,
+        QUERY,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        workers=workers,
+        segment_duration=segment_duration,
+    )
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            (
+                query_state_cache.ts,
+                query_state_cache.prev_ts,
+                query_state_cache.new_chain,
+                {
+                    class_name: class_result.as_dict()
+                    for class_name, class_result in result["query#1"].items()
+                },
+            )
+        )
+        return True
+
+    ret_code = lmcrec_query.run_with_callback(cb)
+    return ret_code, lmcrec_query.first_ts, lmcrec_query.last_ts, scans
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts",
+    [
+        (None, None),
+        (1_700_000_012, 1_700_002_030),
+        (1_700_000_060, 1_700_001_020),
+    ],
+)
+def test_lmcrec_query_parallel(
+    record_files_dir: str, from_ts: Optional[float], to_ts: Optional[float]
+):
+    want = _run_query(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    assert len(want[3]) > 0
+    got = _run_query(record_files_dir, from_ts=from_ts, to_ts=to_ts, workers=3)
+    assert got == want
+
+
+@pytest.mark.parametrize("segment_duration", [1, 30, 45, 1000])
+@pytest.mark.parametrize(
+    "from_ts, to_ts",
+    [
+        (None, None),
+        (1_700_000_020, 1_700_000_080),
+        (1_700_000_012, 1_700_001_020),
+    ],
+)
+def test_lmcrec_query_parallel_segments(
+    record_files_dir: str,
+    from_ts: Optional[float],
+    to_ts: Optional[float],
+    segment_duration: float,
+):
+    want = _run_query(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    got = _run_query(
+        record_files_dir,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        workers=2,
+        segment_duration=segment_duration,
+    )
+    assert got == want
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts, segment_duration, want_segments",
+    [
+        # Checkpoints every 4 scans, 5 sec apart: ts 0, 20, 40, 50 (2nd file),
+        # 70, 90 relative to 1_700_000_000:
+        (None, None, None, [(0, None, None)]),
+        (None, None, 30, [(0, None, 40), (0, 40, 70), (1, 70, None)]),
+        (
+            None,
+            None,
+            20,
+            [(0, None, 20), (0, 20, 40), (0, 40, 70), (1, 70, 90), (1, 90, None)],
+        ),
+        (5, 85, 30, [(0, 5, 40), (0, 40, 70), (1, 70, 85)]),
+        (20, 50, 10, [(0, 20, 40), (0, 40, 50)]),
+    ],
+)
+def test_split_chain(
+    record_files_dir: str,
+    from_ts: Optional[float],
+    to_ts: Optional[float],
+    segment_duration: Optional[float],
+    want_segments: List,
+):
+    base_ts = 1_700_000_000
+    if from_ts is not None:
+        from_ts += base_ts
+    if to_ts is not None:
+        to_ts += base_ts
+    chain_list = LmcrecQueryIntervalStateCache(record_files_dir)._chain_list
+    chain_entry = chain_list[0]
+    file_entries = [chain_entry, chain_entry.next]
+    segments = split_chain(
+        chain_entry, from_ts=from_ts, to_ts=to_ts, segment_duration=segment_duration
+    )
+    assert [
+        (
+            file_entries.index(entry),
+            None if seg_from_ts is None else seg_from_ts - base_ts,
+            None if seg_to_ts is None else seg_to_ts - base_ts,
+        )
+        for entry, seg_from_ts, seg_to_ts in segments
+    ] == want_segments
+
+    tasks = build_query_tasks(
+        chain_list[:1], from_ts=from_ts, to_ts=to_ts, segment_duration=segment_duration
+    )
+    assert [task.index for task in tasks] == list(range(len(segments)))
+    assert [task.skip_first for task in tasks] == [k > 0 for k in range(len(segments))]
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 1000])
+def test_iter_query_task(record_files_dir: str, batch_size: int):
+    selectors, have_prev = prepare_query_selectors(QUERY)
+    chain_list = LmcrecQueryIntervalStateCache(record_files_dir)._chain_list
+    for task in build_query_tasks(chain_list, segment_duration=30):
+        batches = list(
+            iter_query_task(task, selectors, have_prev=have_prev, batch_size=batch_size)
+        )
+        assert all(len(batch.scans) <= batch_size for batch in batches)
+        assert [batch.ret_code for batch in batches[:-1]] == [None] * (len(batches) - 1)
+        assert batches[-1].ret_code == LmcrecScanRetCode.ATEOR
+        assert not any(batch.new_chain for batch in batches[1:])
+        want = run_query_task(task, selectors, have_prev=have_prev)
+        assert merge_task_batches(batches) == want
@@ -0,0 +1,142 @@
+# /usr/bin/env python3
+
+"""Unit tests for query value predicates"""
+
+import operator
+from typing import Any, Dict, List
+
+import pytest
+import yaml
+
+from lmcrec.playback.codec.decoder import LmcVarType
+from lmcrec.playback.query.query_selector import (
+    LmcrecQuerySelector,
+    eval_predicate,
+    parse_predicate_operand,
+    split_var_predicate,
+)
+
+from .query_selector_def import LmcrecQueryIntervalStateCacheBuilder
+
+
+@pytest.mark.parametrize(
+    "spec, expect_var, expect_predicate",
+    [
+        ("var", "var", None),
+        ("var:dr", "var:dr", None),
+        ("var:r>10", "var:r", (operator.gt, 10)),
+        ("var >= 1.5", "var", (operator.ge, 1.5)),
+        ("var<=-3", "var", (operator.le, -3)),
+        ("var==UP", "var", (operator.eq, "UP")),
+        ("var!='10'", "var", (operator.ne, "10")),
+        ('var=="a:b"', "var", (operator.eq, "a:b")),
+        ("var==True", "var", (operator.eq, True)),
+        ("var<0", "var", (operator.lt, 0)),
+    ],
+)
+def test_split_var_predicate(spec, expect_var, expect_predicate):
+    assert split_var_predicate(spec) == (expect_var, expect_predicate)
+
+
+@pytest.mark.parametrize(
+    "predicate, val, expect",
+    [
+        ((operator.gt, 10), 11, True),
+        ((operator.gt, 10), 10, False),
+        ((operator.gt, 10), None, False),
+        ((operator.ne, 10), None, False),
+        ((operator.gt, 10), "abc", False),
+        ((operator.eq, "UP"), "UP", True),
+        ((operator.eq, True), True, True),
+    ],
+)
+def test_eval_predicate(predicate, val, expect):
+    assert eval_predicate(predicate, val) == expect
+
+
+def test_parse_predicate_operand():
+    assert parse_predicate_operand(" 12 ") == 12
+    assert parse_predicate_operand("1e3") == 1000.0
+    assert parse_predicate_operand("false") is False
+    assert parse_predicate_operand('"12"') == "12"
+    assert parse_predicate_operand("abc") == "abc"
+
+
+def test_predicate_multiple_qualifiers():
+    with pytest.raises(ValueError):
+        LmcrecQuerySelector(yaml.safe_load("{v: [var:dr>10]}"))
+
+
+def _state_cache(d_time=None, **builder_args):
+    return LmcrecQueryIntervalStateCacheBuilder(
+        classes={
+            "class1": (
+                0,
+                [
+                    ("drops", LmcVarType.COUNTER),
+                    ("state", LmcVarType.STRING),
+                    ("total", LmcVarType.COUNTER),
+                ],
+            ),
+        },
+        instances=[
+            ("inst1", "class1", {"drops": (110, 100), "state": "UP", "total": 1}),
+            ("inst2", "class1", {"drops": (100, 100), "state": "UP", "total": 2}),
+            ("inst3", "class1", {"drops": (130, 100), "state": "DOWN", "total": 3}),
+            ("inst4", "class1", {"state": "UP", "total": 4}),
+        ],
+        d_time=d_time,
+        **builder_args,
+    )
+
+
+@pytest.mark.parametrize(
+    "query, expect",
+    [
+        (
+            "{c: class1, v: [drops:d>0, total]}",
+            {"inst1": [10, 1], "inst3": [30, 3]},
+        ),
+        (
+            "{c: class1, v: [drops:r>=10, total]}",
+            {"inst3": [15.0, 3]},
+        ),
+        (
+            "{c: class1, v: [drops:d>0, state==UP]}",
+            {"inst1": [10, "UP"]},
+        ),
+        (
+            "{c: class1, v: [state!=UP]}",
+            {"inst3": ["DOWN"]},
+        ),
+        (
+            # No class has the variable:
+            "{v: [total, missing>0]}",
+            {},
+        ),
+    ],
+)
+def test_lmcrec_query_selector_run_predicates(query: str, expect: Dict[str, List[Any]]):
+    query_selector = LmcrecQuerySelector(yaml.safe_load(query))
+    result = query_selector.run(_state_cache(d_time=2)(is_primer=True))
+    assert result["class1"].vals_by_inst == expect
+
+
+def test_lmcrec_query_selector_run_predicates_next_scan():
+    query_selector = LmcrecQuerySelector(
+        yaml.safe_load("{c: class1, v: [drops:d>0, total]}")
+    )
+    query_state_cache = _state_cache()(is_primer=True)
+    result = query_selector.run(query_state_cache)
+    assert sorted(result["class1"].vals_by_inst) == ["inst1", "inst3"]
+
+    # inst1 no longer matches, inst2 does:
+    inst_by_name = query_state_cache.inst_by_name
+    drops_var_id = (
+        query_state_cache.class_by_name["class1"].var_info_by_name["drops"].var_id
+    )
+    query_state_cache.new_chain = False
+    inst_by_name["inst1"].prev_vars[drops_var_id] = 110
+    inst_by_name["inst2"].vars[drops_var_id] = 105
+    result = query_selector.run(query_state_cache)
+    assert result["class1"].vals_by_inst == {"inst2": [5, 2], "inst3": [30, 3]}
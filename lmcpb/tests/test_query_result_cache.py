@@ -0,0 +1,216 @@
+# /usr/bin/env python3
+
+"""Unit tests for the persistent query result cache"""
+
+import os
+from typing import List, Optional
+
+import pytest
+
+import lmcrec.playback.query.result_cache as result_cache_module
+from lmcrec.playback.query import LmcrecQuery
+from lmcrec.playback.query.parallel import LmcrecQueryTaskResult
+from lmcrec.playback.query.query_selector import LmcrecQueryClassResult
+from lmcrec.playback.query.result_cache import (
+    QUERY_RESULT_CACHE_CLEANUP_MARKER,
+    QUERY_RESULT_CACHE_FILE_SUFFIX,
+    LmcrecQueryResultCache,
+    decode_task_result,
+    encode_task_result,
+)
+from lmcrec.playback.query.result_cache import iter_query_task as _iter_query_task
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter:dr, flag, label]}"
+
+
+def test_encode_decode_task_result():
+    task_result = LmcrecQueryTaskResult(
+        index=3,
+        scans=[
+            (
+                10.0,
+                None,
+                {
+                    "q1": {
+                        "c1": LmcrecQueryClassResult(
+                            var_names=["a", "b:d"],
+                            vals_by_inst={"i1": [1, None], "i2": ["x", 2.5]},
+                        ),
+                        "c2": LmcrecQueryClassResult(var_names=["a"]),
+                    },
+                    "q2": {},
+                },
+            ),
+            (
+                15.0,
+                10.0,
+                {
+                    "q1": {
+                        "c2": LmcrecQueryClassResult(
+                            var_names=["a"], vals_by_inst={"i3": [True]}
+                        ),
+                        "c1": LmcrecQueryClassResult(
+                            var_names=["a", "b:d", "c"],
+                            vals_by_inst={"i2": ["y", -1, False]},
+                        ),
+                    },
+                    "q2": {
+                        "c1": LmcrecQueryClassResult(
+                            var_names=["a"], vals_by_inst={"i1": [7]}
+                        ),
+                    },
+                },
+            ),
+        ],
+        first_ts=10.0,
+        last_ts=15.0,
+        ret_code=result_cache_module.LmcrecScanRetCode.ATEOR,
+        new_chain=False,
+    )
+    got = decode_task_result(encode_task_result(task_result, ["q1", "q2"]), index=3)
+    assert got == task_result
+    # The order of the classes is preserved as well:
+    for (_, _, got_result), (_, _, want_result) in zip(got.scans, task_result.scans):
+        for query_name in want_result:
+            assert list(got_result[query_name]) == list(want_result[query_name])
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    scans = make_test_scans(1_700_000_000, 30)
+    return write_test_chains(
+        str(tmp_path), [[scans[:10], scans[10:20], scans[20:]]], active=True
+    )
+
+
+def _run_query(
+    record_files_dir: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    result_cache_dir: Optional[str] = None,
+    workers: int = 1,
+) -> List:
+    lmcrec_query = LmcrecQuery(
+        record_files_dir,
+        QUERY,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        workers=workers,
+        result_cache_dir=result_cache_dir,
+    )
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            (
+                query_state_cache.ts,
+                query_state_cache.prev_ts,
+                query_state_cache.new_chain,
+                {
+                    class_name: class_result.as_dict()
+                    for class_name, class_result in result["query#1"].items()
+                },
+            )
+        )
+        return True
+
+    ret_code = lmcrec_query.run_with_callback(cb)
+    return ret_code, lmcrec_query.first_ts, lmcrec_query.last_ts, scans
+
+
+def _cache_files(cache_dir: str) -> List[str]:
+    return sorted(
+        os.path.join(dir_path, file_name)
+        for dir_path, _, file_names in os.walk(cache_dir)
+        for file_name in file_names
+        if file_name.endswith(QUERY_RESULT_CACHE_FILE_SUFFIX)
+    )
+
+
+@pytest.mark.parametrize(
+    "from_ts, to_ts, want_cached, want_replayed",
+    [
+        # a and b are closed, c is active:
+        (None, None, 2, 1),
+        (1_700_000_012, None, 2, 1),
+        # The active file is needed only for the end checkpoint:
+        (None, 1_700_000_100, 2, 0),
+        # to_ts within the active file, whose scans up to to_ts are final:
+        (None, 1_700_000_120, 3, 0),
+        (1_700_000_060, 1_700_000_080, 1, 0),
+    ],
+)
+def test_lmcrec_query_result_cache(
+    record_files_dir: str,
+    tmp_path,
+    monkeypatch,
+    from_ts: Optional[float],
+    to_ts: Optional[float],
+    want_cached: int,
+    want_replayed: int,
+):
+    num_runs = [0]
+
+    def iter_query_task(*args, **kwargs):
+        num_runs[0] += 1
+        return _iter_query_task(*args, **kwargs)
+
+    monkeypatch.setattr(result_cache_module, "iter_query_task", iter_query_task)
+
+    cache_dir = os.path.join(str(tmp_path), "query-cache")
+    want = _run_query(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    assert len(want[3]) > 0
+    got = _run_query(
+        record_files_dir, from_ts=from_ts, to_ts=to_ts, result_cache_dir=cache_dir
+    )
+    assert got == want
+    assert len(_cache_files(cache_dir)) == want_cached
+
+    # Now from the cache:
+    num_runs[0] = 0
+    got = _run_query(
+        record_files_dir, from_ts=from_ts, to_ts=to_ts, result_cache_dir=cache_dir
+    )
+    assert got == want
+    assert num_runs[0] == want_replayed
+
+
+def test_lmcrec_query_result_cache_parallel(record_files_dir: str, tmp_path):
+    cache_dir = os.path.join(str(tmp_path), "query-cache")
+    want = _run_query(record_files_dir)
+    for _ in range(2):
+        got = _run_query(record_files_dir, result_cache_dir=cache_dir, workers=2)
+        assert got == want
+
+
+def test_lmcrec_query_result_cache_cleanup(record_files_dir: str, tmp_path):
+    cache_dir = os.path.join(str(tmp_path), "query-cache")
+    want = _run_query(record_files_dir)
+    assert _run_query(record_files_dir, result_cache_dir=cache_dir) == want
+    cache_files = _cache_files(cache_dir)
+    assert len(cache_files) == 2
+    marker = os.path.join(cache_dir, QUERY_RESULT_CACHE_CLEANUP_MARKER)
+    assert os.path.isfile(marker)
+
+    # Age the entries, the most recently used one is kept:
+    for i, file_name in enumerate(cache_files):
+        os.utime(file_name, (1_700_000_000 + i, 1_700_000_000 + i))
+    result_cache = LmcrecQueryResultCache(
+        cache_dir, max_size=os.path.getsize(cache_files[1])
+    )
+    # Too soon after the previous cleanup:
+    assert result_cache.maybe_cleanup() == 0
+    os.utime(marker, (1_700_000_000, 1_700_000_000))
+    assert result_cache.maybe_cleanup() == 1
+    assert _cache_files(cache_dir) == cache_files[1:]
+    assert result_cache.maybe_cleanup() == 0
+
+    # A cache hit marks the entry as recently used:
+    assert _run_query(record_files_dir, result_cache_dir=cache_dir) == want
+    assert os.path.getmtime(cache_files[1]) > 1_700_000_001
+    assert LmcrecQueryResultCache(cache_dir, max_size=0).cleanup() == 0
@@ -0,0 +1,329 @@
+# /usr/bin/env python3
+
+"""Unit tests for the query service and the sidecar file caches"""
+
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from lmcrec.playback.codec import (
+    INDEX_FILE_SUFFIX,
+    INFO_FILE_SUFFIX,
+    LmcrecIndexCache,
+    LmcrecIndexFileDecoder,
+    LmcrecInfoCache,
+    decode_lmcrec_info_from_file,
+)
+from lmcrec.playback.commands.lmcrec_serve import build_server
+from lmcrec.playback.query import (
+    LmcrecQuery,
+    LmcrecQueryService,
+    LmcrecStateSnapshotCache,
+)
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter:d, flag, label]}"
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    scans = make_test_scans(1_700_000_000, 20)
+    return write_test_chains(str(tmp_path), [[scans[:10], scans[10:]]])
+
+
+def _lmcrec_file(record_files_dir: str, name: str) -> str:
+    for fname in os.listdir(record_files_dir):
+        if fname.startswith(name) and fname.endswith((".lmcrec", ".lmcrec.gz")):
+            return os.path.join(record_files_dir, fname)
+    raise FileNotFoundError(name)
+
+
+def test_info_cache(record_files_dir: str):
+    info_file_name = _lmcrec_file(record_files_dir, "chain0-0") + INFO_FILE_SUFFIX
+    info_cache = LmcrecInfoCache()
+    lmcrec_info = info_cache.get(info_file_name)
+    assert lmcrec_info == decode_lmcrec_info_from_file(info_file_name)
+    assert info_cache.get(info_file_name) is lmcrec_info
+    assert (info_cache.hits, info_cache.misses) == (1, 1)
+    # Updated file:
+    st = os.stat(info_file_name)
+    os.utime(info_file_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert info_cache.get(info_file_name) is not lmcrec_info
+    assert (info_cache.hits, info_cache.misses) == (1, 2)
+    with pytest.raises(FileNotFoundError):
+        info_cache.get(info_file_name + ".missing")
+
+
+def test_index_cache(record_files_dir: str):
+    index_file_name = _lmcrec_file(record_files_dir, "chain0-0") + INDEX_FILE_SUFFIX
+    index_cache = LmcrecIndexCache(max_files=1)
+    checkpoints = index_cache.get(index_file_name)
+    assert checkpoints == list(LmcrecIndexFileDecoder(index_file_name).checkpoints())
+    assert len(checkpoints) > 1
+    for from_ts in [
+        checkpoints[0][0] - 1,
+        checkpoints[0][0],
+        checkpoints[1][0] - 0.5,
+        checkpoints[-1][0] + 100,
+    ]:
+        assert index_cache.last_checkpoint(
+            index_file_name, from_ts
+        ) == LmcrecIndexFileDecoder(index_file_name).last_checkpoint(from_ts)
+    assert index_cache.misses == 1
+    # LRU eviction:
+    index_cache.get(_lmcrec_file(record_files_dir, "chain0-1") + INDEX_FILE_SUFFIX)
+    assert len(index_cache) == 1
+    index_cache.get(index_file_name)
+    assert index_cache.misses == 3
+
+
+def _query_scans(record_files_dir: str, **kwargs):
+    lmcrec_query = LmcrecQuery(record_files_dir, QUERY, **kwargs)
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            {
+                "ts": query_state_cache.ts,
+                "prev_ts": query_state_cache.prev_ts,
+                "new_chain": query_state_cache.new_chain,
+                "result": {
+                    query_name: {
+                        class_name: {
+                            "var_names": list(class_result.var_names),
+                            "vals_by_inst": {
+                                inst_name: list(vals)
+                                for inst_name, vals in class_result.vals_by_inst.items()
+                            },
+                        }
+                        for class_name, class_result in query_result.items()
+                    }
+                    for query_name, query_result in result.items()
+                },
+            }
+        )
+        return True
+
+    lmcrec_query.run_with_callback(cb)
+    return scans
+
+
+@pytest.mark.parametrize("use_result_cache", [False, True])
+def test_query_service(record_files_dir: str, tmp_path, use_result_cache: bool):
+    from_ts, to_ts = 1_700_000_012, 1_700_000_080
+    want = _query_scans(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    assert len(want) > 0
+    service = LmcrecQueryService(
+        record_files_dir,
+        result_cache_dir=str(tmp_path / "cache") if use_result_cache else None,
+    )
+    request = {"queries": QUERY, "from": from_ts, "to": to_ts}
+    response = service.query(request)
+    assert response["ret_code"] == "ATEOR"
+    assert response["cached"] is False
+    assert response["scans"] == want
+    assert response["first_ts"] == want[0]["ts"]
+    assert response["last_ts"] == want[-1]["ts"]
+    response = service.query(request)
+    assert response["cached"] is True
+    assert response["scans"] == want
+    status = service.status()
+    assert status["num_requests"] == 2
+    assert status["num_cached_responses"] == 1
+    assert status["info_cache"]["hits"] > 0
+    assert status["index_cache"]["files"] > 0
+
+    # A change in the underlying files invalidates the response; simulate an
+    # update of the .info file w/ a newer most_recent_ts:
+    info_file_name = _lmcrec_file(record_files_dir, "chain0-1") + INFO_FILE_SUFFIX
+    st = os.stat(info_file_name)
+    os.utime(info_file_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    lmcrec_info = service.info_cache.get(info_file_name)
+    lmcrec_info.most_recent_ts += 1
+    response = service.query(request)
+    assert response["cached"] is False
+    assert response["scans"] == want
+
+
+@pytest.mark.parametrize(
+    "request_",
+    [
+        [],
+        {},
+        {"queries": 1},
+        {"queries": QUERY, "from": True},
+        {"queries": QUERY, "from": "yesterday"},
+    ],
+)
+def test_query_service_invalid(record_files_dir: str, request_):
+    service = LmcrecQueryService(record_files_dir)
+    with pytest.raises((ValueError, RuntimeError)):
+        service.query(request_)
+
+
+def test_lmcrec_serve(record_files_dir: str):
+    service = LmcrecQueryService(record_files_dir)
+    server = build_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        request = urllib.request.Request(
+            f"{url}/query",
+            data=json.dumps(
+                {"queries": [QUERY], "from": "2023-11-14T22:13:40+00:00", "to": "+30s"}
+            ).encode("utf-8"),
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as f:
+            response = json.load(f)
+        assert response["scans"] == _query_scans(
+            record_files_dir, from_ts=1_700_000_020, to_ts=1_700_000_050
+        )
+        with urllib.request.urlopen(f"{url}/status") as f:
+            assert json.load(f)["num_requests"] == 1
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(
+                urllib.request.Request(f"{url}/query", data=b"{}", method="POST")
+            )
+        assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("shared_scan", [False, True])
+def test_query_service_max_scans(record_files_dir: str, shared_scan: bool):
+    from_ts, to_ts = 1_700_000_012, 1_700_000_080
+    want = _query_scans(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+    service = LmcrecQueryService(
+        record_files_dir, max_scans=len(want), shared_scan=shared_scan
+    )
+    request = {"queries": QUERY, "from": from_ts, "to": to_ts}
+    response = service.query(request)
+    assert response["truncated"] is False
+    assert response["scans"] == want
+    response = service.query(dict(request, max_scans=3))
+    assert response["truncated"] is True
+    assert response["scans"] == want[:3]
+    assert response["last_ts"] == want[2]["ts"]
+    # The request cannot raise the limit:
+    response = service.query(dict(request, max_scans=len(want) + 10))
+    assert response["cached"] is True
+    assert response["scans"] == want
+    with pytest.raises(ValueError):
+        service.query(dict(request, max_scans=0))
+
+
+def test_query_service_relative_ts(record_files_dir: str, monkeypatch):
+    now = 1_700_000_100.0
+    monkeypatch.setattr("time.time", lambda: now)
+    service = LmcrecQueryService(record_files_dir, response_cache_ts_granularity=10)
+    request = {"queries": QUERY, "from": "-60s"}
+    want = _query_scans(record_files_dir, from_ts=now - 60, to_ts=now)
+    response = service.query(request)
+    assert response["cached"] is False
+    assert response["scans"] == want
+    now += 5
+    assert service.query(request)["cached"] is True
+    now += 5
+    response = service.query(request)
+    assert response["cached"] is False
+    assert response["scans"] == _query_scans(
+        record_files_dir, from_ts=now - 60, to_ts=now
+    )
+
+
+def test_query_service_response_cache_size(record_files_dir: str):
+    service = LmcrecQueryService(record_files_dir)
+    request = {"queries": QUERY, "from": 1_700_000_012, "to": 1_700_000_080}
+    service.query(request)
+    size = service.status()["response_cache_used"]
+    assert size > 0
+
+    # Room for a single response:
+    service = LmcrecQueryService(record_files_dir, response_cache_size=size)
+    service.query(request)
+    service.query(dict(request, to=1_700_000_079))
+    assert service.status()["response_cache"] == 1
+    assert service.query(request)["cached"] is False
+    # Too big to be cached:
+    service = LmcrecQueryService(record_files_dir, response_cache_size=size - 1)
+    service.query(request)
+    assert service.status()["response_cache"] == 0
+
+
+@pytest.mark.parametrize("changed_only", [False, True])
+def test_state_snapshot_cache(record_files_dir: str, changed_only: bool):
+    snapshot_cache = LmcrecStateSnapshotCache()
+    # The 1st query seeds a snapshot at from_ts, past the checkpoint; the
+    # next ones resume from it, including at from_ts exactly:
+    for from_ts, to_ts, hits in [
+        (1_700_000_025, 1_700_000_060, 0),
+        (1_700_000_030, 1_700_000_090, 1),
+        (1_700_000_025, None, 2),
+        (1_700_000_026, 1_700_000_040, 3),
+    ]:
+        want = _query_scans(
+            record_files_dir, from_ts=from_ts, to_ts=to_ts, changed_only=changed_only
+        )
+        assert len(want) > 0
+        got = _query_scans(
+            record_files_dir,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            changed_only=changed_only,
+            snapshot_cache=snapshot_cache,
+        )
+        assert got == want
+        assert snapshot_cache.hits == hits
+    # A snapshot older than the checkpoint preceding from_ts is not used:
+    _query_scans(
+        record_files_dir,
+        from_ts=1_700_000_045,
+        changed_only=changed_only,
+        snapshot_cache=snapshot_cache,
+    )
+    assert snapshot_cache.hits == 3
+    # Neither are the snapshots w/ a different change tracking:
+    _query_scans(
+        record_files_dir,
+        from_ts=1_700_000_030,
+        changed_only=not changed_only,
+        snapshot_cache=snapshot_cache,
+    )
+    assert snapshot_cache.hits == 3
+
+
+def test_state_snapshot_cache_max_snapshots(record_files_dir: str):
+    snapshot_cache = LmcrecStateSnapshotCache(max_snapshots=1)
+    for from_ts in [1_700_000_025, 1_700_000_060]:
+        _query_scans(record_files_dir, from_ts=from_ts, snapshot_cache=snapshot_cache)
+    assert len(snapshot_cache) == 1
+    _query_scans(record_files_dir, from_ts=1_700_000_026, snapshot_cache=snapshot_cache)
+    assert snapshot_cache.hits == 0
+
+    snapshot_cache = LmcrecStateSnapshotCache(max_snapshots=0)
+    _query_scans(record_files_dir, from_ts=1_700_000_025, snapshot_cache=snapshot_cache)
+    assert len(snapshot_cache) == 0
+
+
+def test_query_service_state_snapshots(record_files_dir: str):
+    service = LmcrecQueryService(record_files_dir, response_cache_size=0)
+    for from_ts in [1_700_000_025, 1_700_000_030]:
+        request = {"queries": QUERY, "from": from_ts, "to": 1_700_000_080}
+        response = service.query(request)
+        assert response["scans"] == _query_scans(
+            record_files_dir, from_ts=from_ts, to_ts=1_700_000_080
+        )
+    status = service.status()
+    assert status["snapshot_cache"]["snapshots"] > 0
+    assert status["snapshot_cache"]["hits"] == 1
@@ -0,0 +1,169 @@
+# /usr/bin/env python3
+
+"""Unit tests for the shared scan scheduler"""
+
+import os
+import threading
+import time
+from typing import List, Optional
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.query import (
+    LmcrecQuery,
+    LmcrecQueryService,
+    LmcrecSharedScanConsumer,
+    LmcrecSharedScanScheduler,
+)
+from lmcrec.playback.query.parallel import copy_query_result
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+START_TS = 1_700_000_000
+QUERY = "{c: TestClass, v: [counter:d, flag, label]}"
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    scans = make_test_scans(START_TS, 20)
+    return write_test_chains(str(tmp_path), [[scans[:10], scans[10:]]])
+
+
+def _standalone(
+    record_files_dir: str,
+    query: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> List:
+    lmcrec_query = LmcrecQuery(
+        record_files_dir, query, from_ts=from_ts, to_ts=to_ts, force_prev=True
+    )
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            (
+                query_state_cache.ts,
+                query_state_cache.prev_ts,
+                query_state_cache.new_chain,
+                copy_query_result(result),
+            )
+        )
+        return True
+
+    assert lmcrec_query.run_with_callback(cb) == LmcrecScanRetCode.ATEOR
+    return scans
+
+
+def _consumer(
+    record_files_dir: str,
+    query: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+) -> LmcrecSharedScanConsumer:
+    return LmcrecSharedScanConsumer.from_query(
+        LmcrecQuery(
+            record_files_dir, query, from_ts=from_ts, to_ts=to_ts, force_prev=True
+        )
+    )
+
+
+# The windows start between checkpoints, otherwise a standalone run would not
+# have the previous values for its first scan, whereas the shared pass does.
+@pytest.mark.parametrize(
+    "windows",
+    [
+        [(None, None)],
+        [(None, None), (START_TS + 25, START_TS + 60)],
+        [(START_TS + 30, None), (START_TS + 7, START_TS + 42), (None, START_TS + 3)],
+    ],
+)
+def test_shared_scan_batch(record_files_dir: str, windows: List):
+    scheduler = LmcrecSharedScanScheduler(record_files_dir)
+    consumers = [
+        _consumer(record_files_dir, QUERY, from_ts, to_ts) for from_ts, to_ts in windows
+    ]
+    ret_codes = scheduler.run_batch(consumers)
+    assert ret_codes == [LmcrecScanRetCode.ATEOR] * len(windows)
+    assert scheduler.num_passes == 1
+    assert scheduler.num_private_runs == 0
+    for consumer, (from_ts, to_ts) in zip(consumers, windows):
+        assert consumer.scans == _standalone(record_files_dir, QUERY, from_ts, to_ts)
+
+
+def test_shared_scan_changed_only_runs_alone(record_files_dir: str):
+    scheduler = LmcrecSharedScanScheduler(record_files_dir)
+    consumer = LmcrecSharedScanConsumer.from_query(
+        LmcrecQuery(record_files_dir, QUERY, changed_only=True)
+    )
+    assert scheduler.run(consumer) == LmcrecScanRetCode.ATEOR
+    assert (scheduler.num_passes, scheduler.num_private_runs) == (0, 1)
+    assert len(consumer.scans) == 20
+
+
+@pytest.mark.parametrize(
+    "join_after, joiner_window",
+    [
+        (5, (None, None)),
+        (5, (START_TS + 10, START_TS + 80)),
+        (9, (START_TS + 45, None)),
+        # Past the leader window, the suffix is replayed:
+        (3, (START_TS + 5, None)),
+    ],
+)
+def test_shared_scan_late_joiner(record_files_dir: str, join_after, joiner_window):
+    leader_window = (None, START_TS + 50)
+    joiner = _consumer(record_files_dir, QUERY, *joiner_window)
+    joiner_thread = None
+    num_scans = 0
+
+    def on_scan(query_state_cache):
+        nonlocal num_scans, joiner_thread
+        num_scans += 1
+        if num_scans != join_after:
+            return
+        joiner_thread = threading.Thread(target=scheduler.run, args=(joiner,))
+        joiner_thread.start()
+        deadline = time.time() + 5
+        while scheduler.num_joins == 0 and time.time() < deadline:
+            time.sleep(0.001)
+
+    scheduler = LmcrecSharedScanScheduler(record_files_dir, _on_scan=on_scan)
+    leader = _consumer(record_files_dir, QUERY, *leader_window)
+    assert scheduler.run(leader) == LmcrecScanRetCode.ATEOR
+    joiner_thread.join(timeout=5)
+    assert scheduler.num_joins == 1
+    assert leader.scans == _standalone(record_files_dir, QUERY, *leader_window)
+    assert joiner.ret_code == LmcrecScanRetCode.ATEOR
+    assert joiner.scans == _standalone(record_files_dir, QUERY, *joiner_window)
+
+
+def test_query_service_shared_scan(record_files_dir: str):
+    service = LmcrecQueryService(
+        record_files_dir, response_cache_size=0, shared_scan=True
+    )
+    requests = [
+        {"queries": QUERY},
+        {"queries": QUERY, "from": START_TS + 25, "to": START_TS + 60},
+    ]
+    responses = [None] * len(requests)
+
+    def run(i):
+        responses[i] = service.query(requests[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    reference = LmcrecQueryService(record_files_dir, response_cache_size=0)
+    for request, response in zip(requests, responses):
+        assert response == reference.query(request)
+    status = service.status()
+    assert status["shared_scan"]
+    assert status["shared_scan_stats"]["passes"] >= 1
@@ -0,0 +1,169 @@
+# /usr/bin/env python3
+
+"""Unit tests for the hierarchy aware (subtree) instance selection"""
+
+from typing import List
+
+import pytest
+import yaml
+
+from lmcrec.playback.codec.decoder import LmcVarType
+from lmcrec.playback.query.query_selector import LmcrecQuerySelector
+
+from .query_selector_def import LmcrecQueryIntervalStateCacheBuilder
+
+# host.1.adh.0
+#   ├── host.1.adh.0.rrcpTransport (transport)
+#   │     ├── host.1.adh.0.rrcpTransport.bus0 (bus)
+#   │     │     └── host.1.adh.0.rrcpTransport.bus0.stats (stats)
+#   │     └── host.1.adh.0.rrcpTransport.bus1 (bus)
+#   └── host.1.adh.0.sourceThread (thread)
+#         └── host.1.adh.0.sourceThread.stats (stats)
+ROOT = "host.1.adh.0"
+TRANSPORT = f"{ROOT}.rrcpTransport"
+BUS0 = f"{TRANSPORT}.bus0"
+BUS0_STATS = f"{BUS0}.stats"
+BUS1 = f"{TRANSPORT}.bus1"
+THREAD = f"{ROOT}.sourceThread"
+THREAD_STATS = f"{THREAD}.stats"
+
+
+def _builder() -> LmcrecQueryIntervalStateCacheBuilder:
+    return LmcrecQueryIntervalStateCacheBuilder(
+        classes={
+            cls: (0, [("msgs", LmcVarType.COUNTER)])
+            for cls in ["adh", "transport", "bus", "stats", "thread"]
+        },
+        instances=[
+            (ROOT, "adh", {"msgs": 1}),
+            (TRANSPORT, "transport", {"msgs": 2}),
+            (BUS0, "bus", {"msgs": 3}),
+            (BUS0_STATS, "stats", {"msgs": 4}),
+            (BUS1, "bus", {"msgs": 5}),
+            (THREAD, "thread", {"msgs": 6}),
+            (THREAD_STATS, "stats", {"msgs": 7}),
+        ],
+        parents={
+            TRANSPORT: ROOT,
+            BUS0: TRANSPORT,
+            BUS0_STATS: BUS0,
+            BUS1: TRANSPORT,
+            THREAD: ROOT,
+            THREAD_STATS: THREAD,
+        },
+    )
+
+
+def test_get_inst_descendants():
+    state_cache = _builder()(is_primer=True)
+    assert state_cache.get_inst_descendants(TRANSPORT) == [BUS0, BUS1, BUS0_STATS]
+    assert set(state_cache.get_inst_descendants(ROOT)) == {
+        TRANSPORT,
+        BUS0,
+        BUS0_STATS,
+        BUS1,
+        THREAD,
+        THREAD_STATS,
+    }
+    assert set(state_cache.get_inst_descendants(ROOT, {"stats"})) == {
+        BUS0_STATS,
+        THREAD_STATS,
+    }
+    assert state_cache.get_inst_descendants(BUS1) == []
+    assert state_cache.get_inst_descendants("no.such.inst") == []
+
+
+def _selected(query: str, state_cache) -> List[str]:
+    result = LmcrecQuerySelector(yaml.safe_load(query)).run(state_cache)
+    return sorted(
+        inst_name
+        for class_result in result.values()
+        for inst_name in class_result.vals_by_inst
+    )
+
+
+@pytest.mark.parametrize(
+    "query, expect",
+    [
+        (
+            f"{{s: {TRANSPORT}, v: msgs}}",
+            [BUS0, BUS0_STATS, BUS1],
+        ),
+        (
+            f"{{s: {TRANSPORT}, c: bus, v: msgs}}",
+            [BUS0, BUS1],
+        ),
+        (
+            f"{{s: {ROOT}, c: [bus, stats], v: msgs}}",
+            [BUS0, BUS0_STATS, BUS1, THREAD_STATS],
+        ),
+        (
+            f"{{s: [{BUS0}, {THREAD}], v: msgs}}",
+            [BUS0_STATS, THREAD_STATS],
+        ),
+        (
+            "{s: ~.adh.0.sourceThread, v: msgs}",
+            [THREAD_STATS],
+        ),
+        # Combined w/ the instance selector:
+        (
+            f"{{s: {BUS0}, i: {BUS1}, v: msgs}}",
+            [BUS0_STATS, BUS1],
+        ),
+        (
+            "{s: no.such.inst, v: msgs}",
+            [],
+        ),
+    ],
+)
+def test_subtree_selector(query: str, expect: List[str]):
+    assert _selected(query, _builder()(is_primer=True)) == expect
+
+
+def test_subtree_selector_new_inst():
+    builder = _builder()
+    query_selector = LmcrecQuerySelector(
+        yaml.safe_load(f"{{s: {TRANSPORT}, c: bus, v: msgs}}")
+    )
+    result = query_selector.run(builder(is_primer=True))
+    assert sorted(result["bus"].vals_by_inst) == [BUS0, BUS1]
+
+    # A new bus under the transport and one elsewhere:
+    bus2, other_bus = f"{TRANSPORT}.bus2", f"{THREAD}.bus"
+    builder.instances.extend(
+        [(bus2, "bus", {"msgs": 8}), (other_bus, "bus", {"msgs": 9})]
+    )
+    builder.parents.update({bus2: TRANSPORT, other_bus: THREAD})
+    builder.ts, builder.new_inst = 1, True
+    result = query_selector.run(builder())
+    assert sorted(result["bus"].vals_by_inst) == [BUS0, BUS1, bus2]
+
+
+def test_subtree_selector_suffix_new_del_inst():
+    builder = _builder()
+    query_selector = LmcrecQuerySelector(
+        yaml.safe_load("{s: ~.sourceThread, c: stats, v: msgs}")
+    )
+    result = query_selector.run(builder(is_primer=True))
+    assert sorted(result["stats"].vals_by_inst) == [THREAD_STATS]
+
+    # A new matching root, w/ a child, resolved from the new instances only:
+    thread1 = "host.1.adh.1.sourceThread"
+    thread1_stats = f"{thread1}.stats"
+    builder.instances.extend(
+        [(thread1, "thread", {"msgs": 8}), (thread1_stats, "stats", {"msgs": 9})]
+    )
+    builder.parents.update({thread1_stats: thread1})
+    builder.ts, builder.new_inst = 1, True
+    builder.new_inst_names = [thread1, thread1_stats]
+    result = query_selector.run(builder())
+    assert sorted(result["stats"].vals_by_inst) == [THREAD_STATS, thread1_stats]
+    assert query_selector._subtree_suffix_roots == {THREAD, thread1}
+
+    # The deleted roots are dropped:
+    del builder.instances[-2:]
+    builder.ts, builder.new_inst, builder.deleted_inst = 2, False, True
+    builder.new_inst_names = []
+    result = query_selector.run(builder())
+    assert sorted(result["stats"].vals_by_inst) == [THREAD_STATS]
+    assert query_selector._subtree_suffix_roots == {THREAD}
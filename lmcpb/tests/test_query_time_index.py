@@ -0,0 +1,153 @@
+# /usr/bin/env python3
+
+"""Unit tests for the global time index"""
+
+import os
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.codec import INDEX_FILE_SUFFIX, LmcrecInfoState
+from lmcrec.playback.query import LmcrecQuery, LmcrecTimeIndex
+from lmcrec.playback.query.parallel import copy_query_result
+
+from .lmcrec_files_def import (
+    LMCREC_TEST_FILE_DATE_DIR,
+    LmcrecTestFileWriter,
+    make_test_scans,
+)
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0 = 1_700_000_000
+
+
+@pytest.fixture
+def writer(tmp_path) -> LmcrecTestFileWriter:
+    # f0: T0..T0+45, f1: T0+50..T0+95, checkpoints every 20 sec; a gap and
+    # then f2: T0+200..T0+245, in a new chain:
+    writer = LmcrecTestFileWriter(str(tmp_path), 4)
+    writer.write_file("f0", make_test_scans(T0, 10))
+    writer.write_file("f1", make_test_scans(T0 + 50, 10))
+    writer.prev_file_name = ""
+    writer.write_file("f2", make_test_scans(T0 + 200, 10))
+    return writer
+
+
+def _record_files_dir(writer: LmcrecTestFileWriter) -> str:
+    return os.path.join(writer.record_files_dir, LMCREC_TEST_FILE_DATE_DIR)
+
+
+def _file_path(writer: LmcrecTestFileWriter, name: str) -> str:
+    return os.path.join(_record_files_dir(writer), name + ".lmcrec")
+
+
+@pytest.mark.parametrize(
+    "ts, want",
+    [
+        (T0 - 100, ("f0", T0)),
+        (T0, ("f0", T0)),
+        (T0 + 19, ("f0", T0)),
+        (T0 + 45, ("f0", T0 + 40)),
+        (T0 + 47, ("f1", T0 + 50)),
+        (T0 + 95, ("f1", T0 + 90)),
+        (T0 + 150, ("f2", T0 + 200)),
+        (T0 + 245, ("f2", T0 + 240)),
+        (T0 + 246, None),
+    ],
+)
+def test_time_index_seek(writer: LmcrecTestFileWriter, tmp_path, ts, want):
+    time_index = LmcrecTimeIndex(
+        _record_files_dir(writer), index_dir=os.path.join(str(tmp_path), "tix")
+    )
+    assert time_index.refresh()
+    assert time_index.num_entries == 9
+    found = time_index.seek(ts)
+    if want is None:
+        assert found is None
+        return
+    file_name, chkpt_ts, chkpt_off = found
+    name, want_chkpt_ts = want
+    assert file_name == _file_path(writer, name)
+    assert chkpt_ts == want_chkpt_ts
+    assert time_index.last_checkpoint(
+        file_name + INDEX_FILE_SUFFIX, chkpt_ts
+    ) == time_index.index_cache.last_checkpoint(file_name + INDEX_FILE_SUFFIX, chkpt_ts)
+    assert (
+        chkpt_off
+        == time_index.last_checkpoint(file_name + INDEX_FILE_SUFFIX, chkpt_ts)[1]
+    )
+
+
+def test_time_index_refresh(writer: LmcrecTestFileWriter, tmp_path):
+    index_dir = os.path.join(str(tmp_path), "tix")
+    time_index = LmcrecTimeIndex(_record_files_dir(writer), index_dir=index_dir)
+    assert time_index.refresh()
+    assert time_index.num_file_decodes == 3
+    assert not time_index.refresh()
+    generation = time_index._generation
+
+    # The active file is not indexed, its lookups are delegated:
+    f3 = writer.write_file(
+        "f3", make_test_scans(T0 + 250, 10), state=LmcrecInfoState.ACTIVE
+    )
+    time_index = LmcrecTimeIndex(_record_files_dir(writer), index_dir=index_dir)
+    assert not time_index.refresh()
+    assert time_index.num_file_decodes == 0
+    assert time_index.num_entries == 9
+    assert time_index.last_checkpoint(f3 + INDEX_FILE_SUFFIX, T0 + 275) == (
+        T0 + 270,
+        time_index.index_cache.last_checkpoint(f3 + INDEX_FILE_SUFFIX, T0 + 275)[1],
+    )
+    assert (time_index.hits, time_index.misses) == (0, 1)
+
+    # Closed, appended:
+    writer.prev_file_name = os.path.join(LMCREC_TEST_FILE_DATE_DIR, "f2.lmcrec")
+    writer.write_file("f3", make_test_scans(T0 + 250, 10))
+    assert time_index.refresh()
+    assert time_index.num_file_decodes == 1
+    assert time_index.num_entries == 12
+    assert time_index._generation == generation
+    assert time_index.seek(T0 + 275)[:2] == (f3, T0 + 270)
+
+    # Removed, rebuilt:
+    os.unlink(_file_path(writer, "f0"))
+    assert time_index.refresh()
+    assert time_index.num_file_decodes == 4
+    assert time_index.num_entries == 9
+    assert time_index._generation == generation + 1
+    assert sorted(os.listdir(index_dir)) == sorted(
+        [f"{prefix}-{generation + 1}.bin" for prefix in ["file", "offset", "ts"]]
+        + ["files.json"]
+    )
+    assert time_index.seek(T0)[:2] == (_file_path(writer, "f1"), T0 + 50)
+    time_index.close()
+
+
+def test_query_with_time_index(writer: LmcrecTestFileWriter, tmp_path):
+    record_files_dir = _record_files_dir(writer)
+    time_index = LmcrecTimeIndex(
+        record_files_dir, index_dir=os.path.join(str(tmp_path), "tix")
+    )
+    time_index.refresh()
+    results = []
+    for index_cache in [None, time_index]:
+        scans = []
+        ret_code = LmcrecQuery(
+            record_files_dir,
+            "{v: [counter]}",
+            from_ts=T0 + 65,
+            to_ts=T0 + 220,
+            index_cache=index_cache,
+        ).run_with_callback(
+            lambda result, query_state_cache: scans.append(
+                (query_state_cache.ts, copy_query_result(result))
+            )
+            or True
+        )
+        assert ret_code == LmcrecScanRetCode.ATEOR
+        results.append(scans)
+    assert results[1] == results[0]
+    assert results[0][0][0] == T0 + 65
+    assert time_index.hits > 0
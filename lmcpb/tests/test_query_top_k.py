@@ -0,0 +1,200 @@
+# /usr/bin/env python3
+
+"""Unit tests for top-K queries"""
+
+from typing import Any, Dict, List
+
+import pytest
+import yaml
+
+from lmcrec.playback.codec.decoder import LmcVarType
+from lmcrec.playback.query import LmcrecQuery
+from lmcrec.playback.query.query_selector import (
+    LmcrecQueryClassResult,
+    LmcrecQuerySelector,
+    parse_top_k_spec,
+)
+from lmcrec.playback.query.top_k_aggregator import LmcrecQueryTopKAggregator
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+from .query_selector_def import LmcrecQueryIntervalStateCacheBuilder
+
+
+@pytest.mark.parametrize(
+    "spec, expect",
+    [
+        ("var/10", (("var", 10), False)),
+        ("var:v/10", (("var", 10), False)),
+        ("var:r / 3 / w", (("var:r", 3), True)),
+        ("var:d/1/w", (("var:d", 1), True)),
+        ("var/0", None),
+        ("var/x", None),
+        ("var", None),
+        ("/3", None),
+        ("var/3/x", None),
+        ("var:dr/3", None),
+    ],
+)
+def test_parse_top_k_spec(spec, expect):
+    if expect is None:
+        with pytest.raises(ValueError):
+            parse_top_k_spec(spec)
+    else:
+        assert parse_top_k_spec(spec) == expect
+
+
+def _state_cache():
+    return LmcrecQueryIntervalStateCacheBuilder(
+        classes={
+            "class1": (
+                0,
+                [
+                    ("msgs", LmcVarType.COUNTER),
+                    ("name", LmcVarType.STRING),
+                ],
+            ),
+        },
+        instances=[
+            ("inst1", "class1", {"msgs": (110, 100), "name": "a"}),
+            ("inst2", "class1", {"msgs": (300, 100), "name": "b"}),
+            ("inst3", "class1", {"msgs": (130, 100), "name": "c"}),
+            ("inst4", "class1", {"msgs": (100, 100), "name": "d"}),
+            ("inst5", "class1", {"name": "e"}),
+        ],
+        d_time=10,
+    )(is_primer=True)
+
+
+@pytest.mark.parametrize(
+    "query, expect",
+    [
+        (
+            "{c: class1, v: [msgs:r, name], k: msgs:r/2}",
+            {"inst2": [20.0, "b"], "inst3": [3.0, "c"]},
+        ),
+        (
+            "{c: class1, v: [msgs:d, name], k: msgs:d/10}",
+            {
+                "inst2": [200, "b"],
+                "inst3": [30, "c"],
+                "inst1": [10, "a"],
+                "inst4": [0, "d"],
+            },
+        ),
+        (
+            "{c: class1, v: [msgs:d, name], k: name/2}",
+            {},
+        ),
+        (
+            # Predicates are applied first:
+            "{c: class1, v: [msgs:d<100, name], k: msgs:d/2}",
+            {"inst3": [30, "c"], "inst1": [10, "a"]},
+        ),
+        (
+            # The ranking column is not selected:
+            "{c: class1, v: [msgs:d], k: msgs:r/2}",
+            {},
+        ),
+    ],
+)
+def test_lmcrec_query_selector_run_top_k(query: str, expect: Dict[str, List[Any]]):
+    query_selector = LmcrecQuerySelector(yaml.safe_load(query))
+    vals_by_inst = query_selector.run(_state_cache())["class1"].vals_by_inst
+    assert vals_by_inst == expect
+    # Descending order:
+    assert list(vals_by_inst) == list(expect)
+
+
+def _result(var_names, vals_by_inst, query_name="q", class_name="c"):
+    return {
+        query_name: {
+            class_name: LmcrecQueryClassResult(
+                var_names=var_names, vals_by_inst=vals_by_inst
+            )
+        }
+    }
+
+
+def test_lmcrec_query_top_k_aggregator():
+    aggregator = LmcrecQueryTopKAggregator({"q": ("v:r", 2)})
+    scans = [
+        _result(["v:r", "s"], {"i1": [5, "a"], "i2": [1, "b"]}),
+        _result(["v:r", "s"], {"i3": [4, "c"], "i2": [3, "b"]}),
+        _result(["v:r", "s"], {"i2": [7, "b"], "i4": [None, "d"]}),
+        _result(["v:r", "s"], {"i1": [2, "a"], "i3": [4.5, "c"]}),
+    ]
+    for result in scans:
+        other_result = aggregator.update(
+            {**result, "other": {"c": LmcrecQueryClassResult()}}
+        )
+        assert list(other_result) == ["other"]
+    result = aggregator.flush()
+    assert list(result["q"]["c"].vals_by_inst.items()) == [
+        ("i2", [7, "b"]),
+        ("i1", [5, "a"]),
+    ]
+    assert aggregator.flush() is None
+
+
+def test_lmcrec_query_top_k_aggregator_var_names_change():
+    aggregator = LmcrecQueryTopKAggregator({"q": ("v", 3)})
+    aggregator.update(_result(["v", "s"], {"i1": [5, "a"]}))
+    aggregator.update(_result(["s", "t", "v"], {"i2": ["b", True, 3]}))
+    result = aggregator.flush()
+    assert result["q"]["c"].var_names == ["s", "t", "v"]
+    assert result["q"]["c"].vals_by_inst == {
+        "i1": ["a", None, 5],
+        "i2": ["b", True, 3],
+    }
+
+
+def test_lmcrec_query_top_k_aggregator_many():
+    k, n = 5, 1000
+    aggregator = LmcrecQueryTopKAggregator({"q": ("v", k)})
+    peak_val = dict()
+    for scan in range(10):
+        vals_by_inst = {f"i{i}": [(i * 7919 + scan * 104729) % n] for i in range(n)}
+        for inst_name, vals in vals_by_inst.items():
+            peak_val[inst_name] = max(peak_val.get(inst_name, vals[0]), vals[0])
+        aggregator.update(_result(["v"], vals_by_inst))
+        # The memory usage is bounded:
+        tracker = aggregator._trackers["q"]["c"]
+        assert len(tracker.best) <= k
+        assert len(tracker._heap) <= 2 * k + 1
+    result = aggregator.flush()
+    # Ties are resolved in favor of the instances reaching the peak first:
+    expect = sorted(peak_val.values(), reverse=True)[:k]
+    vals_by_inst = result["q"]["c"].vals_by_inst
+    assert [vals[0] for vals in vals_by_inst.values()] == expect
+    for inst_name, vals in vals_by_inst.items():
+        assert peak_val[inst_name] == vals[0]
+
+
+def test_lmcrec_query_window_top_k(tmp_path):
+    record_files_dir = write_test_chains(
+        str(tmp_path), [[make_test_scans(1_700_000_000, 10, num_inst=4)]]
+    )
+    lmcrec_query = LmcrecQuery(
+        record_files_dir,
+        """
+            - {n: scan, c: TestClass, v: [counter:r, label], k: counter:r/2}
+            - {n: window, c: TestClass, v: [counter, label], k: counter/1/w}
+        """,
+    )
+    assert lmcrec_query.window_top_k == {"window": ("counter", 1)}
+    top_k_aggregator = LmcrecQueryTopKAggregator(lmcrec_query.window_top_k)
+    scan_insts = []
+
+    def cb(result, query_state_cache):
+        result = top_k_aggregator.update(result)
+        assert list(result) == ["scan"]
+        scan_insts.append(list(result["scan"]["TestClass"].vals_by_inst))
+        return True
+
+    lmcrec_query.run_with_callback(cb)
+    # No rate for the 1st scan:
+    assert scan_insts == [[]] + [["inst3", "inst2"]] * 9
+    result = top_k_aggregator.flush()
+    assert result["window"]["TestClass"].as_dict() == {
+        "inst3": {"counter": 1_700_000_045 * 4, "label": "label3-2"}
+    }
@@ -0,0 +1,141 @@
+# /usr/bin/env python3
+
+"""Unit tests for multiple time windows played back in a single pass"""
+
+import os
+from typing import List, Optional, Tuple
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.query import LmcrecQuery, parse_window_spec
+from lmcrec.playback.query.parallel import copy_query_result
+from lmcrec.playback.query.query_state_cache import normalize_query_windows
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+QUERY = "{c: TestClass, v: [counter:d, flag, label]}"
+T0, T1, T2 = 1_700_000_000, 1_700_001_000, 1_700_002_000
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # 3 chains, the first one made of 2 files:
+    scans = make_test_scans(T0, 20)
+    return write_test_chains(
+        str(tmp_path),
+        [
+            [scans[:10], scans[10:]],
+            [make_test_scans(T1, 10, num_inst=3)],
+            [make_test_scans(T2, 15)],
+        ],
+    )
+
+
+@pytest.mark.parametrize(
+    "windows, expect",
+    [
+        ([(None, 10)], [(None, 10, 0)]),
+        (
+            [(30, None), (None, 10), (15, 20)],
+            [(None, 10, 1), (15, 20, 2), (30, None, 0)],
+        ),
+        ([(10, 5)], None),
+        ([], None),
+        ([(None, 10), (10, 20)], None),
+        ([(None, None), (10, 20)], None),
+        ([(0, 10), (5, 20)], None),
+    ],
+)
+def test_normalize_query_windows(windows, expect):
+    if expect is None:
+        with pytest.raises(ValueError):
+            normalize_query_windows(windows)
+    else:
+        assert normalize_query_windows(windows) == expect
+
+
+def test_parse_window_spec():
+    assert parse_window_spec(",") == (None, None)
+    from_ts, to_ts = parse_window_spec("2025-01-02T03:04:05+00:00,+1h")
+    assert to_ts - from_ts == 3600
+    with pytest.raises(ValueError):
+        parse_window_spec("2025-01-02T03:04:05+00:00")
+
+
+def _run_query(
+    record_files_dir: str,
+    from_ts: Optional[float] = None,
+    to_ts: Optional[float] = None,
+    windows: Optional[List[Tuple]] = None,
+) -> Tuple[List, int]:
+    lmcrec_query = LmcrecQuery(
+        record_files_dir, QUERY, from_ts=from_ts, to_ts=to_ts, windows=windows
+    )
+    query_state_cache = lmcrec_query.query_state_cache
+    num_decoded = 0
+    apply_next_scan = query_state_cache._apply_next_scan
+
+    def counting_apply_next_scan():
+        nonlocal num_decoded
+        num_decoded += 1
+        return apply_next_scan()
+
+    query_state_cache._apply_next_scan = counting_apply_next_scan
+    scans = []
+
+    def cb(result, query_state_cache):
+        scans.append(
+            (
+                query_state_cache.window_index,
+                query_state_cache.ts,
+                query_state_cache.prev_ts,
+                query_state_cache.new_chain,
+                copy_query_result(result),
+            )
+        )
+        return True
+
+    assert lmcrec_query.run_with_callback(cb) == LmcrecScanRetCode.ATEOR
+    return scans, num_decoded
+
+
+@pytest.mark.parametrize(
+    "windows",
+    [
+        [(None, None)],
+        [(T0 + 12, T0 + 22)],
+        # Within the same file:
+        [(T0 + 2, T0 + 12), (T0 + 33, T0 + 41)],
+        # Across files and chains, out of order:
+        [(T2 + 21, T2 + 60), (T0 + 7, T0 + 18), (T0 + 62, T1 + 12)],
+        # Empty windows:
+        [(T0 + 101, T0 + 102), (T1 + 21, T1 + 34), (T1 + 500, T1 + 600)],
+    ],
+)
+def test_query_windows(record_files_dir: str, windows: List[Tuple]):
+    scans, num_decoded = _run_query(record_files_dir, windows=windows)
+
+    expect_scans = []
+    for window_index, (from_ts, to_ts) in sorted(
+        enumerate(windows), key=lambda w: w[1][0] or 0
+    ):
+        window_scans, _ = _run_query(record_files_dir, from_ts=from_ts, to_ts=to_ts)
+        expect_scans.extend(
+            (window_index,) + window_scan[1:] for window_scan in window_scans
+        )
+    assert scans == expect_scans
+    if len(windows) > 1:
+        # The gaps are skipped:
+        _, num_decoded_all = _run_query(record_files_dir)
+        assert num_decoded < num_decoded_all
+
+
+def test_query_windows_invalid(record_files_dir: str):
+    with pytest.raises(ValueError):
+        LmcrecQuery(record_files_dir, QUERY, from_ts=T0, windows=[(T0, T0 + 10)])
+    with pytest.raises(ValueError):
+        LmcrecQuery(record_files_dir, QUERY, windows=[(T0, T0 + 10), (T0 + 5, None)])
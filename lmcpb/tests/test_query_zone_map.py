@@ -0,0 +1,145 @@
+# /usr/bin/env python3
+
+"""Unit tests for the per segment zone maps"""
+
+import operator
+import os
+from typing import List, Optional
+
+import pytest
+
+from lmcrec.playback.cache import LmcrecScanRetCode
+from lmcrec.playback.query import (
+    LmcrecQuery,
+    LmcrecZoneMap,
+    build_lmcrec_file_chains,
+    build_lmcrec_zone_map,
+    build_query_selectors,
+    get_zone_map_windows,
+    load_lmcrec_zone_map,
+    map_lmcrec_file,
+)
+from lmcrec.playback.query.parallel import copy_query_result
+from lmcrec.playback.query.zone_map import range_may_match
+
+from .lmcrec_files_def import make_test_scans, write_test_chains
+
+if "LMCREC_TZ" in os.environ:
+    del os.environ["LMCREC_TZ"]
+
+T0 = 1_700_000_000
+
+
+@pytest.fixture
+def record_files_dir(tmp_path) -> str:
+    # A single chain, 2 files w/ 5 segments each; counter = ts for inst0 and
+    # 2 x ts for inst1:
+    scans = make_test_scans(T0, 40)
+    return write_test_chains(str(tmp_path), [[scans[:20], scans[20:]]])
+
+
+def _file_path(record_files_dir: str, name: str) -> str:
+    return os.path.join(record_files_dir, name + ".lmcrec")
+
+
+def test_build_zone_map(record_files_dir: str):
+    file_name = _file_path(record_files_dir, "chain0-1")
+    zone_map = build_lmcrec_zone_map(file_name, per_inst=True)
+    assert [(s.ts, s.last_ts) for s in zone_map.segments] == [
+        (T0 + 100 + 20 * k, T0 + 115 + 20 * k) for k in range(5)
+    ]
+    segment = zone_map.segments[1]
+    assert segment.stats_by_class["TestClass"]["counter"] == [
+        T0 + 120,
+        2 * (T0 + 135),
+        8,
+    ]
+    assert segment.stats_by_class["TestClass"]["label"] is None
+    assert segment.stats_by_inst["inst0"]["counter"] == [T0 + 120, T0 + 135, 4]
+    assert LmcrecZoneMap.from_json(zone_map.to_json()) == zone_map
+    with pytest.raises(ValueError, match="got: 2"):
+        LmcrecZoneMap.from_json(dict(zone_map.to_json(), version=2))
+
+    assert load_lmcrec_zone_map(file_name) is None
+    assert map_lmcrec_file(file_name, per_inst=True) == zone_map
+    assert load_lmcrec_zone_map(file_name) == zone_map
+    st = os.stat(file_name)
+    os.utime(file_name, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert load_lmcrec_zone_map(file_name) is None
+
+
+@pytest.mark.parametrize(
+    "op, operand, want",
+    [
+        (operator.gt, 10, False),
+        (operator.ge, 10, True),
+        (operator.lt, 5, False),
+        (operator.le, 5, True),
+        (operator.eq, 7, True),
+        (operator.eq, 11, False),
+        (operator.ne, 5, True),
+        (operator.gt, "x", True),
+    ],
+)
+def test_range_may_match(op, operand, want: bool):
+    assert range_may_match((op, operand), [5, 10, 0]) == want
+
+
+@pytest.mark.parametrize(
+    "query, per_inst, want_windows",
+    [
+        (f"{{c: TestClass, v: [counter>{2 * (T0 + 170)}]}}", False, [(160, 195)]),
+        (f"{{i: inst0, v: [counter>{T0 + 150}]}}", True, [(140, 195)]),
+        (f"{{i: inst0, v: [counter>{T0 + 150}]}}", False, [(0, 195)]),
+        (f"{{v: [counter<{T0 + 50}, flag==true]}}", False, [(0, 55)]),
+        (f"{{v: [counter>{3 * T0}]}}", False, []),
+        ("{v: [counter, label=='label0-1']}", False, [(0, 195)]),
+        ("{v: [counter:d>0]}", False, None),
+    ],
+)
+def test_query_use_zone_maps(
+    record_files_dir: str,
+    query: str,
+    per_inst: bool,
+    want_windows: Optional[List],
+):
+    for name in ["chain0-0", "chain0-1"]:
+        map_lmcrec_file(_file_path(record_files_dir, name), per_inst=per_inst)
+
+    windows = get_zone_map_windows(
+        build_lmcrec_file_chains(record_files_dir),
+        build_query_selectors(query),
+    )
+    if want_windows is None:
+        assert windows is None
+    else:
+        assert windows == [
+            (T0 + from_ts, T0 + to_ts) for from_ts, to_ts in want_windows
+        ]
+
+    results = []
+    for use_zone_maps in [False, True]:
+        scans = []
+        ret_code = LmcrecQuery(
+            record_files_dir, query, use_zone_maps=use_zone_maps
+        ).run_with_callback(
+            lambda result, query_state_cache: scans.append(
+                (query_state_cache.ts, copy_query_result(result))
+            )
+            or True
+        )
+        assert ret_code == LmcrecScanRetCode.ATEOR
+        results.append(
+            [
+                scan
+                for scan in scans
+                if any(
+                    class_result.vals_by_inst
+                    for query_result in scan[1].values()
+                    for class_result in query_result.values()
+                )
+            ]
+        )
+    assert results[1] == results[0]
+    if want_windows:
+        assert results[0]
@@ -67,8 +67,12 @@ def _run_test_case(tc: LmcrecStateCacheTestCase):
     assert not unexpected, "Unexpected inst names"
 
     assert state_cache.inst_by_class_name == tc.expect_inst_by_class_name
+    if tc.expect_children_by_inst_id is not None:
+        assert state_cache.children_by_inst_id == tc.expect_children_by_inst_id
 
     assert state_cache.new_inst == tc.expect_new_inst
+    if tc.expect_new_inst_names is not None:
+        assert state_cache.new_inst_names == tc.expect_new_inst_names
     assert state_cache.deleted_inst == tc.expect_deleted_inst
     assert state_cache.new_class_def == tc.expect_new_class_def
 